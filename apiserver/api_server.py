@@ -28,7 +28,6 @@ from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse
 from fastapi import WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-import aiohttp
 import shutil
 from pathlib import Path
 
@@ -36,14 +35,19 @@ from pathlib import Path
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 # 导入独立的工具调用模块
-from .tool_call_utils import parse_tool_calls, execute_tool_calls, tool_call_loop
-from .message_manager import message_manager  # 导入统一的消息管理器
+from .tool_call_utils import parse_tool_calls, execute_tool_calls, tool_call_loop, tool_call_loop_stream
+from .native_tools import get_tool_protocol_stats
+from .message_manager import get_message_manager  # 导入统一的消息管理器
 from .prompt_logger import prompt_logger  # 导入prompt日志记录器
+from .llm_client import get_llm_client_pool  # 共享LLM连接池
+from .llm_scheduler import (  # 全局LLM请求调度
+    get_llm_scheduler, estimate_tokens, retry_after_from, LLMLane, LLMRateLimitError
+)
+from .context_builder import get_context_builder  # token预算上下文组装
 
 # 导入配置系统
 from config import config  # 使用新的配置系统
 from ui.response_utils import extract_message  # 导入消息提取工具
-from agents.extensions.handoff_prompt import RECOMMENDED_PROMPT_PREFIX  # handoff提示词
 
 # 全局NagaAgent实例 - 延迟导入避免循环依赖
 naga_agent = None
@@ -90,6 +94,10 @@ async def lifespan(app: FastAPI):
         sys.exit(1)
     finally:
         print("[INFO] 正在清理资源...")
+        try:
+            await get_llm_client_pool().aclose()
+        except Exception as e:
+            print(f"[WARNING] 关闭LLM连接池时出错: {e}")
         if naga_agent and hasattr(naga_agent, 'mcp'):
             try:
                 await naga_agent.mcp.cleanup()
@@ -222,6 +230,118 @@ async def get_system_info():
         api_key_configured=bool(config.api.api_key and config.api.api_key != "sk-placeholder-key-not-set")
     )
 
+def _make_llm_caller(session_id: str):
+    """构造工具调用循环使用的LLM调用函数，复用共享连接池中的长连接"""
+    async def call_llm(messages: List[Dict], tools: Optional[List[Dict]] = None) -> Dict:
+        """调用LLM API，tools不为空时使用原生函数调用"""
+        # 保存prompt日志
+        prompt_logger.log_prompt(session_id, messages, api_status="sending")
+        
+        payload = {
+            "model": config.api.model,
+            "messages": messages,
+            "temperature": config.api.temperature,
+            "max_tokens": config.api.max_tokens,
+            "stream": False
+        }
+        if tools:
+            payload["tools"] = tools
+        
+        async def post():
+            resp = await get_llm_client_pool().post_chat_completion(payload)
+            if resp.status_code == 429:
+                raise LLMRateLimitError(retry_after=retry_after_from(resp))
+            return resp
+        
+        try:
+            # 交互通道，同一通道内按会话轮转
+            resp = await get_llm_scheduler().run(
+                post, lane=LLMLane.INTERACTIVE, session_id=session_id,
+                tokens=estimate_tokens(messages, config.api.max_tokens)
+            )
+        except LLMRateLimitError:
+            prompt_logger.log_prompt(session_id, messages, api_status="failed")
+            raise HTTPException(status_code=429, detail="LLM API限流，请稍后重试")
+        if resp.status_code != 200:
+            # 保存失败的prompt日志
+            prompt_logger.log_prompt(session_id, messages, api_status="failed")
+            raise HTTPException(status_code=resp.status_code, detail="LLM API调用失败")
+        
+        data = resp.json()
+        # 保存成功的prompt日志
+        prompt_logger.log_prompt(session_id, messages, data, api_status="success")
+        message = data['choices'][0]['message']
+        return {
+            'content': message.get('content'),
+            'tool_calls': message.get('tool_calls'),
+            'status': 'success'
+        }
+    return call_llm
+
+def _make_llm_stream_caller(session_id: str):
+    """构造流式LLM调用函数：解析上游SSE，逐块产出文本增量"""
+    async def call_llm_stream(messages: List[Dict], tools: Optional[List[Dict]] = None):
+        """流式调用LLM API，tools不为空时tool_calls增量以{'tool_calls': [...]}产出"""
+        # 保存prompt日志
+        prompt_logger.log_prompt(session_id, messages, api_status="sending")
+        
+        content_parts = []
+        payload = {
+            "model": config.api.model,
+            "messages": messages,
+            "temperature": config.api.temperature,
+            "max_tokens": config.api.max_tokens,
+            "stream": True
+        }
+        if tools:
+            payload["tools"] = tools
+        scheduler = get_llm_scheduler()
+        tokens = estimate_tokens(messages, config.api.max_tokens)
+        attempt = 0
+        while True:
+            # 交互通道，流式输出期间占用配额；直接申请/归还而不用slot()，避免跨yield标记持有配额
+            ticket = await scheduler.acquire(LLMLane.INTERACTIVE, session_id, tokens)
+            try:
+                async with get_llm_client_pool().stream_chat_completion(payload) as resp:
+                    if resp.status_code == 429 and not ticket.reentrant and attempt < scheduler.max_retries:
+                        # 尚未输出内容，归还配额，等调度器退避后重试
+                        ticket.rate_limited(resp)
+                        attempt += 1
+                        continue
+                    if resp.status_code != 200:
+                        # 保存失败的prompt日志
+                        prompt_logger.log_prompt(session_id, messages, api_status="failed")
+                        raise HTTPException(status_code=resp.status_code, detail="LLM API调用失败")
+                    
+                    async for line in resp.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            break
+                        try:
+                            chunk = json.loads(data)
+                        except json.JSONDecodeError:
+                            continue
+                        choices = chunk.get('choices') or []
+                        delta = (choices[0].get('delta') or {}) if choices else {}
+                        if delta.get('content'):
+                            content_parts.append(delta['content'])
+                            yield delta['content']
+                        if delta.get('tool_calls'):
+                            yield {'tool_calls': delta['tool_calls']}
+            finally:
+                scheduler.release(ticket)
+            break
+        
+        # 保存成功的prompt日志（流式响应只记录拼接后的内容）
+        prompt_logger.log_prompt(session_id, messages, {"content": ''.join(content_parts), "stream": True}, api_status="success")
+    return call_llm_stream
+
+def _sse_data(text: str) -> str:
+    """按SSE规范编码一个事件，多行文本拆为多个data行"""
+    return "".join(f"data: {line}\n" for line in text.split("\n")) + "\n"
+
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
     """普通对话接口"""
@@ -233,57 +353,28 @@ async def chat(request: ChatRequest):
     
     try:
         # 获取或创建会话ID
+        message_manager = get_message_manager()
         session_id = message_manager.create_session(request.session_id)
         
-        # 构建系统提示词
-        system_prompt = f"{RECOMMENDED_PROMPT_PREFIX}\n{config.prompts.naga_system_prompt}"
-        available_services = naga_agent.mcp.get_available_services_filtered()
-        services_text = naga_agent._format_services_for_prompt(available_services)
-        system_prompt = system_prompt.format(**services_text)
+        # 构建系统提示词（前缀稳定，已缓存），时间/城市附在当前用户消息开头
+        # 原生函数调用协议下服务目录改由tools参数发送
+        toolset = naga_agent.get_native_toolset()
+        system_prompt = naga_agent.get_system_prompt(native=toolset is not None)
         
         # 使用消息管理器构建完整的对话消息
         messages = message_manager.build_conversation_messages(
             session_id=session_id,
             system_prompt=system_prompt,
-            current_message=request.message
+            current_message=request.message,
+            context_message=naga_agent.get_context_message()
         )
         
-        # 定义LLM调用函数
-        async def call_llm(messages: List[Dict]) -> Dict:
-            """调用LLM API"""
-            async with aiohttp.ClientSession() as session:
-                # 保存prompt日志
-                prompt_logger.log_prompt(session_id, messages, api_status="sending")
-                
-                async with session.post(
-                    f"{config.api.base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {config.api.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": config.api.model,
-                        "messages": messages,
-                        "temperature": config.api.temperature,
-                        "max_tokens": config.api.max_tokens,
-                        "stream": False
-                    }
-                ) as resp:
-                    if resp.status != 200:
-                        # 保存失败的prompt日志
-                        prompt_logger.log_prompt(session_id, messages, api_status="failed")
-                        raise HTTPException(status_code=resp.status, detail="LLM API调用失败")
-                    
-                    data = await resp.json()
-                    # 保存成功的prompt日志
-                    prompt_logger.log_prompt(session_id, messages, data, api_status="success")
-                    return {
-                        'content': data['choices'][0]['message']['content'],
-                        'status': 'success'
-                    }
+        # LLM调用函数（复用共享连接池）
+        call_llm = _make_llm_caller(session_id)
         
         # 处理工具调用循环
-        result = await tool_call_loop(messages, naga_agent.mcp, call_llm, is_streaming=False)
+        result = await tool_call_loop(messages, naga_agent.mcp, call_llm, is_streaming=False, toolset=toolset)
+        naga_agent.record_native_turn(toolset, result['recursion_depth'] + 1)
         
         # 提取最终响应
         response_text = result['content']
@@ -314,66 +405,36 @@ async def chat_stream(request: ChatRequest):
     async def generate_response() -> AsyncGenerator[str, None]:
         try:
             # 获取或创建会话ID
+            message_manager = get_message_manager()
             session_id = message_manager.create_session(request.session_id)
             
             # 发送会话ID信息
             yield f"data: session_id: {session_id}\n\n"
             
-            # 构建系统提示词
-            system_prompt = f"{RECOMMENDED_PROMPT_PREFIX}\n{config.prompts.naga_system_prompt}"
-            available_services = naga_agent.mcp.get_available_services_filtered()
-            services_text = naga_agent._format_services_for_prompt(available_services)
-            system_prompt = system_prompt.format(**services_text)
+            # 构建系统提示词（前缀稳定，已缓存），时间/城市附在当前用户消息开头
+            # 原生函数调用协议下服务目录改由tools参数发送
+            toolset = naga_agent.get_native_toolset()
+            system_prompt = naga_agent.get_system_prompt(native=toolset is not None)
             
             # 使用消息管理器构建完整的对话消息
             messages = message_manager.build_conversation_messages(
                 session_id=session_id,
                 system_prompt=system_prompt,
-                current_message=request.message
+                current_message=request.message,
+                context_message=naga_agent.get_context_message()
             )
             
-            # 定义LLM调用函数
-            async def call_llm(messages: List[Dict]) -> Dict:
-                """调用LLM API"""
-                async with aiohttp.ClientSession() as session:
-                    # 保存prompt日志
-                    prompt_logger.log_prompt(session_id, messages, api_status="sending")
-                    
-                    async with session.post(
-                        f"{config.api.base_url}/chat/completions",
-                        headers={
-                            "Authorization": f"Bearer {config.api.api_key}",
-                            "Content-Type": "application/json"
-                        },
-                        json={
-                            "model": config.api.model,
-                            "messages": messages,
-                            "temperature": config.api.temperature,
-                            "max_tokens": config.api.max_tokens,
-                            "stream": False
-                        }
-                    ) as resp:
-                        if resp.status != 200:
-                            # 保存失败的prompt日志
-                            prompt_logger.log_prompt(session_id, messages, api_status="failed")
-                            raise HTTPException(status_code=resp.status, detail="LLM API调用失败")
-                        
-                        data = await resp.json()
-                        # 保存成功的prompt日志
-                        prompt_logger.log_prompt(session_id, messages, data, api_status="success")
-                        return {
-                            'content': data['choices'][0]['message']['content'],
-                            'status': 'success'
-                        }
-            
-            # 处理工具调用循环
-            result = await tool_call_loop(messages, naga_agent.mcp, call_llm, is_streaming=True)
+            # 流式LLM调用函数（复用共享连接池）
+            call_llm_stream = _make_llm_stream_caller(session_id)
             
-            # 流式输出最终结果
-            final_content = result['content']
-            for line in final_content.splitlines():
-                if line.strip():
-                    yield f"data: {line}\n\n"
+            # 流式工具调用循环：文本增量即时下发，工具调用块在服务端缓冲执行
+            final_content = ''
+            async for event in tool_call_loop_stream(messages, naga_agent.mcp, call_llm_stream, toolset=toolset):
+                if event['type'] == 'text':
+                    yield _sse_data(event['content'])
+                elif event['type'] == 'done':
+                    final_content = event['content']
+                    naga_agent.record_native_turn(toolset, event['recursion_depth'] + 1)
             
             # 保存对话历史到消息管理器
             message_manager.add_message(session_id, "user", request.message)
@@ -404,7 +465,7 @@ async def mcp_handoff(request: MCPRequest):
     
     try:
         # 获取或创建会话ID
-        session_id = message_manager.get_or_create_session(request.session_id)
+        session_id = get_message_manager().get_or_create_session(request.session_id)
         
         # 直接调用MCP handoff
         result = await naga_agent.mcp.handoff(
@@ -568,20 +629,67 @@ async def get_memory_stats():
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"获取记忆统计失败: {str(e)}")
 
+@app.get("/llm/scheduler/stats")
+async def get_llm_scheduler_stats():
+    """获取全局LLM调度器统计（各优先级通道的排队深度、等待时间、限流次数）"""
+    try:
+        return {
+            "status": "success",
+            "scheduler": get_llm_scheduler().get_stats()
+        }
+    except Exception as e:
+        print(f"获取LLM调度器统计错误: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"获取LLM调度器统计失败: {str(e)}")
+
+@app.get("/llm/tool_protocol/stats")
+async def get_tool_protocol_stats_endpoint():
+    """获取工具调用协议统计（当前协议、工具定义数、原生函数调用相对文本协议节省的提示词token数）"""
+    try:
+        return {
+            "status": "success",
+            "tool_protocol": get_tool_protocol_stats()
+        }
+    except Exception as e:
+        print(f"获取工具调用协议统计错误: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"获取工具调用协议统计失败: {str(e)}")
+
+@app.get("/context/stats")
+async def get_context_stats():
+    """获取上下文组装统计（token用量、系统提示词前缀哈希及复用率）"""
+    try:
+        return {
+            "status": "success",
+            "prompt_layout": getattr(config.api, 'prompt_layout', 'prefix_cache'),
+            "last_report": get_message_manager().last_context_report,
+            "stats": get_context_builder().get_stats()
+        }
+    except Exception as e:
+        print(f"获取上下文统计错误: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"获取上下文统计失败: {str(e)}")
+
 @app.get("/sessions")
-async def get_sessions():
-    """获取所有会话信息"""
+async def get_sessions(offset: int = 0, limit: int = 50):
+    """分页获取会话信息（按最近活跃时间倒序）"""
     try:
-        # 清理过期会话
+        offset = max(offset, 0)
+        limit = min(max(limit, 1), 500)
+        
+        # 清理过期会话（按last_activity索引删除）
+        message_manager = get_message_manager()
         message_manager.cleanup_old_sessions()
         
-        # 获取所有会话信息
-        sessions_info = message_manager.get_all_sessions_info()
+        # 只读取当前页的会话摘要
+        sessions_info = message_manager.get_all_sessions_info(offset, limit)
         
         return {
             "status": "success",
             "sessions": sessions_info,
-            "total_sessions": len(sessions_info)
+            "total_sessions": message_manager.count_sessions(),
+            "offset": offset,
+            "limit": limit
         }
     except Exception as e:
         print(f"获取会话信息错误: {e}")
@@ -592,6 +700,7 @@ async def get_sessions():
 async def get_session_detail(session_id: str):
     """获取指定会话的详细信息"""
     try:
+        message_manager = get_message_manager()
         session_info = message_manager.get_session_info(session_id)
         if not session_info:
             raise HTTPException(status_code=404, detail="会话不存在")
@@ -614,7 +723,7 @@ async def get_session_detail(session_id: str):
 async def delete_session(session_id: str):
     """删除指定会话"""
     try:
-        success = message_manager.delete_session(session_id)
+        success = get_message_manager().delete_session(session_id)
         if success:
             return {
                 "status": "success",
@@ -633,7 +742,7 @@ async def delete_session(session_id: str):
 async def clear_all_sessions():
     """清空所有会话"""
     try:
-        count = message_manager.clear_all_sessions()
+        count = get_message_manager().clear_all_sessions()
         return {
             "status": "success",
             "message": f"已清空 {count} 个会话"
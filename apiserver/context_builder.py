@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+按token预算组装对话上下文
+- 本地分词器计数（tiktoken，不可用时按字符估算），按消息内容缓存计数结果
+- 先为系统提示词、当前用户消息和预期回复长度预留空间，剩余预算从新到旧填充历史消息；
+  当前消息本身超出预算时截断，预算不足时历史为空而不是出现负数预算
+- 工具调用循环中追加的工具结果同样按剩余预算截断（小结果完整保留，剩余空间均分给大结果）
+- 每轮报告各部分占用的token数，便于统计提示词体积
+- 时间/城市等易变信息作为环境信息附在当前用户消息开头（不单独发送system消息，部分后端不接受对话中间的system消息），
+  系统提示词和历史前缀保持逐字节稳定；每轮报告前缀哈希，统计前缀变化次数以评估服务端前缀缓存命中率
+"""
+
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("ContextBuilder")
+
+MESSAGE_OVERHEAD = 4  # 每条消息的角色/分隔符开销（OpenAI chat格式）
+REPLY_PRIMER = 3  # 回复起始标记
+TRUNCATED_MARK = "\n…（内容过长，已截断）"
+MIN_CURRENT_TOKENS = 256  # 当前消息截断后至少保留的token数（系统提示词过长时也不丢掉用户问题）
+MIN_TOOL_RESULT_TOKENS = 128  # 每个工具结果至少保留的token数
+
+def with_context(current_message: str, context_message: Optional[str]) -> str:
+    """把环境信息附在当前用户消息开头（历史中保存的仍是原始消息，下一轮前缀不受影响）"""
+    return f"{context_message}\n\n{current_message}" if context_message else current_message
+
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+class TokenCounter:
+    """带缓存的token计数器"""
+
+    def __init__(self, encoding_name: str = "cl100k_base", cache_size: int = 4096):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        try:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(encoding_name)
+        except ImportError:
+            logger.warning("未安装tiktoken，token数按字符估算")
+        except Exception as e:
+            # 首次使用需要下载词表，离线时退回估算
+            logger.warning(f"加载分词器 {encoding_name} 失败，token数按字符估算: {e}")
+        self.count_text = lru_cache(maxsize=cache_size)(self._count_text)
+
+    @property
+    def exact(self) -> bool:
+        return self._encoding is not None
+
+    def _count_text(self, text: str) -> int:
+        if not text:
+            return 0
+        if self._encoding is not None:
+            return len(self._encoding.encode(text, disallowed_special=()))
+        # 估算：中日韩字符约1 token/字，其余约4字符/token
+        cjk = len(_CJK_RE.findall(text))
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+    def count_message(self, message: Dict) -> int:
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = str(content)
+        tokens = MESSAGE_OVERHEAD + self.count_text(content)
+        if message.get("tool_calls"):
+            tokens += self.count_text(json.dumps(message["tool_calls"], ensure_ascii=False))
+        return tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """把文本截断到不超过max_tokens"""
+        if max_tokens <= 0:
+            return ""
+        if self.count_text(text) <= max_tokens:
+            return text
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            return self._encoding.decode(tokens[:max_tokens])
+        # 估算模式下二分查找截断位置
+        lo, hi = 0, len(text)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._count_text(text[:mid]) <= max_tokens:
+                lo = mid
+            else:
+                hi = mid - 1
+        return text[:lo]
+
+    def cache_info(self):
+        return self.count_text.cache_info()
+
+
+def prefix_hash(system_prompt: Optional[str]) -> str:
+    """系统提示词前缀哈希（用于核对服务端前缀缓存能否命中）"""
+    return hashlib.sha256((system_prompt or "").encode("utf-8")).hexdigest()[:16]
+
+
+class ContextBuilder:
+    """token预算上下文组装器"""
+
+    def __init__(self, max_context_tokens: int = 32768, completion_reserve: int = 2000,
+                 encoding_name: str = "cl100k_base"):
+        self.max_context_tokens = max_context_tokens
+        self.completion_reserve = completion_reserve
+        self.counter = TokenCounter(encoding_name)
+        self._lock = threading.Lock()
+        self._stats = {"turns": 0, "prompt_tokens": 0, "history_tokens": 0,
+                       "history_dropped_tokens": 0, "history_dropped_messages": 0, "truncated_messages": 0,
+                       "truncated_current": 0, "truncated_tool_results": 0, "tool_result_dropped_tokens": 0,
+                       "over_budget": 0, "prefix_changes": 0}
+        self._last_prefix_hash = None
+
+    def build(self, system_prompt: Optional[str], history: List[Dict], current_message: str,
+              max_history_messages: Optional[int] = None,
+              context_message: Optional[str] = None) -> Tuple[List[Dict], Dict]:
+        """组装 [system] + 历史 + 当前消息（环境信息附在开头），返回 (消息列表, 用量报告)"""
+        counter = self.counter
+        system_msg = {"role": "system", "content": system_prompt} if system_prompt else None
+        current_msg = {"role": "user", "content": with_context(current_message, context_message)}
+
+        system_tokens = counter.count_message(system_msg) if system_msg else 0
+        context_tokens = counter.count_text(context_message) if context_message else 0
+        current_tokens = counter.count_message(current_msg) - context_tokens
+        available = self.max_context_tokens - self.completion_reserve - system_tokens - context_tokens - REPLY_PRIMER
+        current_truncated = False
+        if current_tokens > available:
+            # 当前消息本身超出预算（如粘贴的长文档）：截断，但至少保留MIN_CURRENT_TOKENS
+            room = max(available, MIN_CURRENT_TOKENS) - MESSAGE_OVERHEAD - counter.count_text(TRUNCATED_MARK)
+            current_message = counter.truncate(current_message, room) + TRUNCATED_MARK
+            current_msg = {"role": "user", "content": with_context(current_message, context_message)}
+            current_tokens = counter.count_message(current_msg) - context_tokens
+            current_truncated = True
+        history_budget = max(0, available - current_tokens)
+        over_budget = available - current_tokens < 0
+        if over_budget:
+            logger.warning(f"系统提示词与当前消息已超出上下文预算（可用 {available}，当前消息 {current_tokens}）")
+
+        candidates = history[-max_history_messages:] if max_history_messages else history
+        selected: List[Dict] = []
+        used = 0
+        truncated = 0
+        candidate_tokens = 0
+        # 从新到旧填充，遇到放不下的消息即停止，保证历史连续
+        for index in range(len(candidates) - 1, -1, -1):
+            msg = candidates[index]
+            tokens = counter.count_message(msg)
+            candidate_tokens += tokens
+            if used + tokens <= history_budget:
+                selected.append(msg)
+                used += tokens
+                continue
+            if not selected and history_budget - used > MESSAGE_OVERHEAD + 64:
+                # 最近一条消息本身超出预算（如粘贴的长文档），截断后保留
+                room = history_budget - used - MESSAGE_OVERHEAD - counter.count_text(TRUNCATED_MARK)
+                content = counter.truncate(str(msg.get("content") or ""), room) + TRUNCATED_MARK
+                msg = {**msg, "content": content}
+                tokens = counter.count_message(msg)
+                selected.append(msg)
+                used += tokens
+                truncated += 1
+            for rest in candidates[:index]:
+                candidate_tokens += counter.count_message(rest)
+            break
+        selected.reverse()
+
+        messages = ([system_msg] if system_msg else []) + selected + [current_msg]
+        prompt_tokens = system_tokens + used + context_tokens + current_tokens + REPLY_PRIMER
+        digest = prefix_hash(system_prompt)
+        report = {
+            "prefix_hash": digest,
+            "system_tokens": system_tokens,
+            "history_tokens": used,
+            "history_messages": len(selected),
+            "history_available_tokens": candidate_tokens,  # 全部候选历史的token数，与history_tokens对比即为节省量
+            "history_dropped_messages": len(candidates) - len(selected),
+            "truncated_messages": truncated,
+            "truncated_current": current_truncated,
+            "over_budget": over_budget,
+            "context_tokens": context_tokens,
+            "current_tokens": current_tokens,
+            "completion_reserve": self.completion_reserve,
+            "prompt_tokens": prompt_tokens,
+            "budget": self.max_context_tokens,
+            "exact": counter.exact,
+        }
+        with self._lock:
+            self._stats["turns"] += 1
+            self._stats["prompt_tokens"] += prompt_tokens
+            self._stats["history_tokens"] += used
+            self._stats["history_dropped_tokens"] += max(candidate_tokens - used, 0)
+            self._stats["history_dropped_messages"] += report["history_dropped_messages"]
+            self._stats["truncated_messages"] += truncated
+            self._stats["truncated_current"] += int(current_truncated)
+            self._stats["over_budget"] += int(over_budget)
+            if self._last_prefix_hash is not None and digest != self._last_prefix_hash:
+                self._stats["prefix_changes"] += 1
+            self._last_prefix_hash = digest
+        logger.info(f"上下文token: 系统 {system_tokens} + 历史 {used}/{candidate_tokens}"
+                    f"（{len(selected)}条，丢弃{report['history_dropped_messages']}条）+ 环境 {context_tokens}"
+                    f" + 当前 {current_tokens} = {prompt_tokens}，预留回复 {self.completion_reserve}，"
+                    f"上限 {self.max_context_tokens}，前缀 {digest}")
+        return messages, report
+
+    def fit_tool_results(self, messages: List[Dict], results: List[str]) -> List[str]:
+        """按剩余预算截断本轮工具结果（messages为已组装的消息，含本轮助手回复）
+
+        小结果完整保留，剩余空间均分给较大的结果；每个结果至少保留MIN_TOOL_RESULT_TOKENS
+        """
+        if self.max_context_tokens <= 0 or not results:
+            return results
+        counter = self.counter
+        used = sum(counter.count_message(m) for m in messages) + REPLY_PRIMER + MESSAGE_OVERHEAD * len(results)
+        room = self.max_context_tokens - self.completion_reserve - used
+        sizes = [counter.count_text(str(r or "")) for r in results]
+        if sum(sizes) <= room:
+            return results
+        # 注水式分配：从小到大满足，放不下的结果平分剩余空间
+        limits = [0] * len(results)
+        remaining = max(room, 0)
+        order = sorted(range(len(results)), key=lambda i: sizes[i])
+        for position, index in enumerate(order):
+            share = max(remaining // (len(order) - position), MIN_TOOL_RESULT_TOKENS)
+            limits[index] = min(sizes[index], share)
+            remaining = max(0, remaining - limits[index])
+        fitted = []
+        mark_tokens = counter.count_text(TRUNCATED_MARK)
+        truncated = dropped = 0
+        for result, size, limit in zip(results, sizes, limits):
+            if size <= limit:
+                fitted.append(result)
+                continue
+            fitted.append(counter.truncate(str(result), max(limit - mark_tokens, 0)) + TRUNCATED_MARK)
+            truncated += 1
+            dropped += size - limit
+        with self._lock:
+            self._stats["truncated_tool_results"] += truncated
+            self._stats["tool_result_dropped_tokens"] += dropped
+        logger.info(f"工具结果超出上下文预算（剩余 {room}），截断 {truncated} 个结果，共约 {dropped} token")
+        return fitted
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            turns = self._stats["turns"]
+            info = self.counter.cache_info()
+            return {
+                **self._stats,
+                "avg_prompt_tokens": round(self._stats["prompt_tokens"] / turns, 1) if turns else 0.0,
+                "token_cache_hits": info.hits,
+                "token_cache_misses": info.misses,
+                "exact": self.counter.exact,
+                "last_prefix_hash": self._last_prefix_hash,
+                # 与上一轮前缀相同的比例，即服务端前缀缓存可命中的轮次占比上限
+                "prefix_reuse_rate": round(1 - self._stats["prefix_changes"] / (turns - 1), 4) if turns > 1 else 0.0,
+            }
+
+
+_CONTEXT_BUILDER: Optional[ContextBuilder] = None
+
+
+def get_context_builder() -> ContextBuilder:
+    """获取全局上下文组装器"""
+    global _CONTEXT_BUILDER
+    if _CONTEXT_BUILDER is None:
+        try:
+            from config import config
+            _CONTEXT_BUILDER = ContextBuilder(
+                max_context_tokens=getattr(config.api, 'context_max_tokens', 32768),
+                completion_reserve=getattr(config.api, 'context_completion_reserve', None) or config.api.max_tokens,
+                encoding_name=getattr(config.api, 'tokenizer_encoding', 'cl100k_base'),
+            )
+        except Exception:
+            _CONTEXT_BUILDER = ContextBuilder()
+    return _CONTEXT_BUILDER
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+共享LLM HTTP客户端
+- 按base_url维护长连接池（keep-alive），工具调用循环的多轮请求复用已建立的连接
+- 自定义api_base_url的Agent各自使用独立连接池
+- 安装了h2时启用HTTP/2
+- 连接池绑定事件循环，UI线程中的独立事件循环各自持有连接池，互不干扰
+- 由API服务器lifespan统一关闭
+"""
+
+import asyncio
+import importlib.util
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+from config import config
+
+logger = logging.getLogger("LLMClientPool")
+
+DEFAULT_BASE_URL = "https://api.deepseek.com/v1"
+
+
+def _normalize_base_url(base_url: Optional[str]) -> str:
+    return (base_url or config.api.base_url or DEFAULT_BASE_URL).rstrip('/')
+
+
+class LLMClientPool:
+    """按(事件循环, base_url)管理的httpx连接池"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[int, str], Tuple[asyncio.AbstractEventLoop, httpx.AsyncClient]] = {}
+        self._openai_clients: Dict[Tuple[int, str, str], Tuple[httpx.AsyncClient, Any]] = {}
+        self.http2 = bool(getattr(config.api, 'http2', True)) and importlib.util.find_spec("h2") is not None
+        self._stats = {"clients_created": 0, "requests": 0, "errors": 0}
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=getattr(config.api, 'pool_max_connections', 20),
+            max_keepalive_connections=getattr(config.api, 'pool_max_keepalive', 10),
+            keepalive_expiry=getattr(config.api, 'pool_keepalive_expiry', 30.0),
+        )
+
+    def _timeout(self) -> httpx.Timeout:
+        total = config.api.timeout or 120
+        return httpx.Timeout(total, connect=getattr(config.api, 'connect_timeout', 10.0))
+
+    def _prune_closed_loops(self):
+        """移除已关闭事件循环上的连接池（调用方持有锁）"""
+        for key in [k for k, (loop, _) in self._clients.items() if loop.is_closed()]:
+            self._clients.pop(key, None)
+            for okey in [o for o in self._openai_clients if o[0] == key[0] and o[1] == key[1]]:
+                self._openai_clients.pop(okey, None)
+
+    def get_http_client(self, base_url: Optional[str] = None) -> httpx.AsyncClient:
+        """获取当前事件循环上指定base_url的连接池"""
+        loop = asyncio.get_running_loop()
+        key = (id(loop), _normalize_base_url(base_url))
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None and entry[0] is loop and not entry[1].is_closed:
+                return entry[1]
+            self._prune_closed_loops()
+            client = httpx.AsyncClient(
+                base_url=key[1],
+                limits=self._limits(),
+                timeout=self._timeout(),
+                http2=self.http2,
+            )
+            self._clients[key] = (loop, client)
+            self._stats["clients_created"] += 1
+            logger.debug(f"创建LLM连接池: {key[1]} (HTTP/2: {self.http2})")
+            return client
+
+    def get_openai_client(self, base_url: Optional[str] = None, api_key: Optional[str] = None):
+        """获取复用连接池的AsyncOpenAI客户端"""
+        from openai import AsyncOpenAI
+        http_client = self.get_http_client(base_url)
+        url = _normalize_base_url(base_url)
+        key = (id(asyncio.get_running_loop()), url, api_key or config.api.api_key)
+        with self._lock:
+            entry = self._openai_clients.get(key)
+            if entry is None or entry[0] is not http_client:
+                entry = (http_client, AsyncOpenAI(api_key=key[2], base_url=url + '/', http_client=http_client))
+                self._openai_clients[key] = entry
+            return entry[1]
+
+    async def post_chat_completion(self, payload: Dict[str, Any], base_url: Optional[str] = None,
+                                   api_key: Optional[str] = None) -> httpx.Response:
+        """POST /chat/completions（非流式）"""
+        client = self.get_http_client(base_url)
+        self._stats["requests"] += 1
+        try:
+            return await client.post(
+                "/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {api_key or config.api.api_key}",
+                    "Content-Type": "application/json"
+                },
+                json=payload,
+            )
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+
+    def stream_chat_completion(self, payload: Dict[str, Any], base_url: Optional[str] = None,
+                               api_key: Optional[str] = None):
+        """流式POST /chat/completions，返回 httpx 流式响应上下文管理器"""
+        client = self.get_http_client(base_url)
+        self._stats["requests"] += 1
+        return client.stream(
+            "POST",
+            "/chat/completions",
+            headers={
+                "Authorization": f"Bearer {api_key or config.api.api_key}",
+                "Content-Type": "application/json"
+            },
+            json=payload,
+        )
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._stats,
+                "http2": self.http2,
+                "active_pools": [url for (_, url), (loop, c) in self._clients.items() if not loop.is_closed() and not c.is_closed],
+            }
+
+    async def aclose(self):
+        """关闭当前事件循环上的所有连接池"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [k for k, (l, _) in self._clients.items() if l is loop]
+            clients = [self._clients.pop(k)[1] for k in keys]
+            for okey in [o for o in self._openai_clients if o[0] == id(loop)]:
+                self._openai_clients.pop(okey, None)
+        for client in clients:
+            try:
+                await client.aclose()
+            except Exception as e:
+                logger.debug(f"关闭LLM连接池失败: {e}")
+
+
+_LLM_CLIENT_POOL: Optional[LLMClientPool] = None
+
+
+def get_llm_client_pool() -> LLMClientPool:
+    """获取全局LLM连接池管理器"""
+    global _LLM_CLIENT_POOL
+    if _LLM_CLIENT_POOL is None:
+        _LLM_CLIENT_POOL = LLMClientPool()
+    return _LLM_CLIENT_POOL
@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+"""
+全局LLM请求调度器
+- 进程内所有LLM调用（主对话、Agent、树状思考、快速模型、五元组提取）共用一个调度器
+- 每分钟请求数（RPM）和每分钟token数（TPM）两个令牌桶，配额不足时排队等待而不是固定间隔串行
+- 优先级通道：交互对话 > 工具Agent > 深度思考 > 后台记忆提取；同一通道内按会话轮转，避免单个会话占满配额
+- 收到429时全体暂停退避（优先使用Retry-After），并按乘性减小、加性恢复的方式调整发放速率
+- 线程安全：UI线程各自的事件循环、任务管理器的后台线程、线程池中的同步调用均可使用
+- 同一调用链中已持有配额时再次申请直接复用，嵌套调用不会死锁
+"""
+
+import asyncio
+import contextvars
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from enum import IntEnum
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger("LLMScheduler")
+
+
+class LLMLane(IntEnum):
+    """优先级通道（数值越小越优先）"""
+    INTERACTIVE = 0  # 用户当前对话轮次
+    AGENT = 1        # 工具Agent调用
+    THINKING = 2     # 树状深度思考
+    BACKGROUND = 3   # 后台记忆提取
+
+
+class LLMRateLimitError(RuntimeError):
+    """上游返回429"""
+
+    def __init__(self, message: str = "LLM API限流(429)", retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+_current_lane: contextvars.ContextVar = contextvars.ContextVar("llm_lane", default=None)
+_current_session: contextvars.ContextVar = contextvars.ContextVar("llm_session", default=None)
+_held_ticket: contextvars.ContextVar = contextvars.ContextVar("llm_ticket", default=None)
+
+
+@contextmanager
+def llm_context(lane: Optional[LLMLane] = None, session_id: Optional[str] = None):
+    """为调用链设置默认通道和会话（对其中创建的asyncio任务同样生效）"""
+    lane_token = _current_lane.set(lane) if lane is not None else None
+    session_token = _current_session.set(session_id) if session_id is not None else None
+    try:
+        yield
+    finally:
+        if session_token is not None:
+            _current_session.reset(session_token)
+        if lane_token is not None:
+            _current_lane.reset(lane_token)
+
+
+def _reset_held(token: contextvars.Token):
+    """恢复持有标记；生成器在其他任务中被回收时token不属于当前Context，此时忽略"""
+    try:
+        _held_ticket.reset(token)
+    except ValueError:
+        pass
+
+
+def _parse_retry_after(value: Any) -> Optional[float]:
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """判断异常是否为上游限流（兼容openai、httpx、aiohttp、requests的异常）"""
+    if isinstance(error, LLMRateLimitError) or type(error).__name__ == "RateLimitError":
+        return True
+    for holder in (error, getattr(error, "response", None)):
+        if holder is not None and 429 in (getattr(holder, "status_code", None), getattr(holder, "status", None)):
+            return True
+    return False
+
+
+def retry_after_from(source: Any) -> Optional[float]:
+    """从异常或HTTP响应中读取Retry-After（秒）"""
+    if isinstance(source, LLMRateLimitError):
+        return source.retry_after
+    response = getattr(source, "response", None) if not hasattr(source, "headers") else source
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return _parse_retry_after(headers.get("retry-after") or headers.get("Retry-After"))
+    except Exception:
+        return None
+
+
+class TokenBucket:
+    """每分钟配额的令牌桶（limit<=0表示不限）"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def refill(self, now: float, factor: float):
+        if not self.unlimited:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate * factor)
+        self.updated = now
+
+    def wait_time(self, amount: float, factor: float) -> float:
+        if self.unlimited:
+            return 0.0
+        amount = min(amount, self.capacity)  # 超过桶容量的请求在桶满时放行
+        missing = amount - self.tokens
+        return 0.0 if missing <= 0 else missing / (self.rate * factor)
+
+    def take(self, amount: float):
+        if not self.unlimited:
+            self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float):
+        if not self.unlimited:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class LLMTicket:
+    """已获得的调用配额"""
+
+    def __init__(self, scheduler: Optional["LLMScheduler"], lane: LLMLane, session: str, tokens: int):
+        self.scheduler = scheduler
+        self.lane = lane
+        self.session = session
+        self.tokens = tokens
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.released = False
+        self.rate_limited_error = False
+        self.reentrant = scheduler is None  # 复用外层配额时不重复计数
+        self._future: Optional[asyncio.Future] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._event: Optional[threading.Event] = None
+
+    def record_usage(self, total_tokens: Optional[int]):
+        """按实际用量修正TPM令牌桶（预估多扣的退回，少扣的补扣）"""
+        if self.scheduler is not None and total_tokens:
+            self.scheduler._adjust_tokens(self.tokens - int(total_tokens))
+            self.tokens = int(total_tokens)
+
+    def rate_limited(self, source: Any = None):
+        """本次调用收到429"""
+        self.rate_limited_error = True
+        if self.scheduler is not None:
+            self.scheduler.report_rate_limited(retry_after_from(source) if source is not None else None)
+
+
+class LLMScheduler:
+    """进程级LLM请求调度器"""
+
+    def __init__(self, rpm_limit: int = 0, tpm_limit: int = 0, max_concurrent: int = 8,
+                 lane_limits: Optional[Dict[LLMLane, int]] = None, max_retries: int = 3,
+                 backoff_base: float = 1.0, backoff_max: float = 30.0, enabled: bool = True):
+        self.enabled = enabled
+        self.max_concurrent = max_concurrent
+        self.lane_limits = {lane: (lane_limits or {}).get(lane, 0) for lane in LLMLane}  # 0表示只受总并发限制
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._rpm = TokenBucket(rpm_limit)
+        self._tpm = TokenBucket(tpm_limit)
+        self._cond = threading.Condition()
+        self._queues: Dict[LLMLane, "OrderedDict[str, deque]"] = {lane: OrderedDict() for lane in LLMLane}
+        self._active = 0
+        self._active_by_lane = {lane: 0 for lane in LLMLane}
+        self._paused_until = 0.0
+        self._rate_factor = 1.0  # 429后降低的发放速率比例
+        self._consecutive_429 = 0
+        self._thread: Optional[threading.Thread] = None
+        self._waits = {lane: deque(maxlen=500) for lane in LLMLane}  # 近期排队耗时（秒）
+        self._lane_stats = {lane: {"granted": 0, "max_depth": 0, "cancelled": 0} for lane in LLMLane}
+        self._stats = {"requests": 0, "rate_limited": 0, "retries": 0, "reentrant": 0}
+
+    # ---------- 配额申请 ----------
+    def _resolve(self, lane: Optional[LLMLane], session_id: Optional[str]):
+        if lane is None:
+            lane = _current_lane.get()
+        if lane is None:
+            lane = LLMLane.INTERACTIVE
+        session = session_id or _current_session.get() or "_default"
+        return LLMLane(lane), session
+
+    def _enqueue(self, ticket: LLMTicket):
+        """加入等待队列并尝试立即发放（调用方持有锁）"""
+        sessions = self._queues[ticket.lane]
+        sessions.setdefault(ticket.session, deque()).append(ticket)
+        depth = sum(len(q) for q in sessions.values())
+        stats = self._lane_stats[ticket.lane]
+        stats["max_depth"] = max(stats["max_depth"], depth)
+        self._stats["requests"] += 1
+        self._dispatch_locked()
+        self._cond.notify()
+        self._ensure_thread()
+
+    def _dequeue(self, ticket: LLMTicket):
+        """从等待队列移除未发放的请求（调用方持有锁）"""
+        sessions = self._queues[ticket.lane]
+        queue = sessions.get(ticket.session)
+        if queue is not None and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del sessions[ticket.session]
+            self._lane_stats[ticket.lane]["cancelled"] += 1
+
+    async def acquire(self, lane: Optional[LLMLane] = None, session_id: Optional[str] = None,
+                      tokens: int = 0) -> LLMTicket:
+        """异步等待调用配额"""
+        lane, session = self._resolve(lane, session_id)
+        if not self.enabled or _held_ticket.get() is not None:
+            return self._reentrant_ticket(lane, session, tokens)
+        ticket = LLMTicket(self, lane, session, tokens)
+        ticket._loop = asyncio.get_running_loop()
+        ticket._future = ticket._loop.create_future()
+        with self._cond:
+            self._enqueue(ticket)
+        try:
+            await ticket._future
+        except asyncio.CancelledError:
+            with self._cond:
+                if ticket.granted:
+                    self._release_locked(ticket)
+                else:
+                    self._dequeue(ticket)
+            raise
+        return ticket
+
+    def acquire_sync(self, lane: Optional[LLMLane] = None, session_id: Optional[str] = None,
+                     tokens: int = 0, timeout: Optional[float] = None) -> LLMTicket:
+        """同步等待调用配额（线程池中的阻塞调用使用）"""
+        lane, session = self._resolve(lane, session_id)
+        if not self.enabled or _held_ticket.get() is not None:
+            return self._reentrant_ticket(lane, session, tokens)
+        ticket = LLMTicket(self, lane, session, tokens)
+        ticket._event = threading.Event()
+        with self._cond:
+            self._enqueue(ticket)
+        if not ticket._event.wait(timeout):
+            with self._cond:
+                if not ticket.granted:
+                    self._dequeue(ticket)
+                    raise TimeoutError(f"等待LLM调用配额超时（{timeout}秒）")
+        return ticket
+
+    def _reentrant_ticket(self, lane: LLMLane, session: str, tokens: int) -> LLMTicket:
+        if self.enabled:
+            with self._cond:
+                self._stats["reentrant"] += 1
+        ticket = LLMTicket(None, lane, session, tokens)
+        ticket.granted = True
+        return ticket
+
+    def release(self, ticket: LLMTicket):
+        """归还并发配额"""
+        if ticket.reentrant:
+            return
+        with self._cond:
+            self._release_locked(ticket)
+
+    def _release_locked(self, ticket: LLMTicket):
+        if ticket.released:
+            return
+        ticket.released = True
+        self._active -= 1
+        self._active_by_lane[ticket.lane] -= 1
+        if not ticket.rate_limited_error:
+            self._consecutive_429 = 0
+            self._rate_factor = min(1.0, self._rate_factor + 0.05)
+        self._dispatch_locked()
+        self._cond.notify()
+
+    @asynccontextmanager
+    async def slot(self, lane: Optional[LLMLane] = None, session_id: Optional[str] = None, tokens: int = 0):
+        """async with scheduler.slot(...) as ticket: 在配额内执行一次LLM调用"""
+        ticket = await self.acquire(lane, session_id, tokens)
+        held = _held_ticket.set(ticket)
+        try:
+            yield ticket
+        finally:
+            try:
+                self.release(ticket)
+            finally:
+                _reset_held(held)
+
+    @contextmanager
+    def slot_sync(self, lane: Optional[LLMLane] = None, session_id: Optional[str] = None,
+                  tokens: int = 0, timeout: Optional[float] = None):
+        """with scheduler.slot_sync(...) as ticket: 同步版本"""
+        ticket = self.acquire_sync(lane, session_id, tokens, timeout)
+        held = _held_ticket.set(ticket)
+        try:
+            yield ticket
+        finally:
+            try:
+                self.release(ticket)
+            finally:
+                _reset_held(held)
+
+    async def run(self, func: Callable, *args, lane: Optional[LLMLane] = None, session_id: Optional[str] = None,
+                  tokens: int = 0, **kwargs) -> Any:
+        """在配额内执行异步LLM调用，收到429时退避后重试"""
+        attempt = 0
+        while True:
+            async with self.slot(lane, session_id, tokens) as ticket:
+                try:
+                    result = await func(*args, **kwargs)
+                except Exception as e:
+                    if not is_rate_limit_error(e) or ticket.reentrant or attempt >= self.max_retries:
+                        if is_rate_limit_error(e):
+                            ticket.rate_limited(e)
+                        raise
+                    ticket.rate_limited(e)
+                    attempt += 1
+                    with self._cond:
+                        self._stats["retries"] += 1
+                    logger.warning(f"LLM调用被限流，退避后第{attempt}次重试")
+                    continue
+                usage = getattr(result, "usage", None)
+                if usage is not None:
+                    ticket.record_usage(getattr(usage, "total_tokens", None))
+                return result
+
+    # ---------- 限流反馈 ----------
+    def report_rate_limited(self, retry_after: Optional[float] = None):
+        """收到429：暂停发放并降低发放速率"""
+        with self._cond:
+            self._consecutive_429 += 1
+            self._stats["rate_limited"] += 1
+            if retry_after is None:
+                retry_after = min(self.backoff_max, self.backoff_base * (2 ** (self._consecutive_429 - 1)))
+                retry_after *= 1 + random.random() * 0.2  # 抖动，避免多个调用同时恢复
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._rate_factor = max(0.1, self._rate_factor * 0.5)
+            logger.warning(f"LLM API限流，暂停 {retry_after:.1f}秒，发放速率降至 {self._rate_factor:.0%}")
+            self._cond.notify()
+
+    def _adjust_tokens(self, delta: int):
+        with self._cond:
+            if delta > 0:
+                self._tpm.refund(delta)
+            elif delta < 0:
+                self._tpm.tokens += delta  # 实际用量超出预估，允许透支
+            self._dispatch_locked()
+
+    # ---------- 发放 ----------
+    def _grant(self, ticket: LLMTicket):
+        ticket.granted = True
+        self._active += 1
+        self._active_by_lane[ticket.lane] += 1
+        self._lane_stats[ticket.lane]["granted"] += 1
+        self._waits[ticket.lane].append(time.monotonic() - ticket.enqueued_at)
+        if ticket._event is not None:
+            ticket._event.set()
+            return
+        try:
+            ticket._loop.call_soon_threadsafe(self._wake, ticket._future)
+        except RuntimeError:
+            # 申请方的事件循环已关闭，配额立即归还
+            ticket.granted = False
+            ticket.released = True
+            self._active -= 1
+            self._active_by_lane[ticket.lane] -= 1
+
+    @staticmethod
+    def _wake(future: asyncio.Future):
+        if not future.done():
+            future.set_result(None)
+
+    def _dispatch_locked(self) -> Optional[float]:
+        """按优先级和会话轮转发放配额，返回下次需要检查的等待时间（调用方持有锁）"""
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.max_concurrent and self._active >= self.max_concurrent:
+                return None
+            self._rpm.refill(now, self._rate_factor)
+            self._tpm.refill(now, self._rate_factor)
+            candidate = None
+            for lane in LLMLane:
+                sessions = self._queues[lane]
+                limit = self.lane_limits[lane]
+                if sessions and not (limit and self._active_by_lane[lane] >= limit):
+                    candidate = lane
+                    break
+            if candidate is None:
+                return None
+            sessions = self._queues[candidate]
+            session, queue = next(iter(sessions.items()))
+            ticket = queue[0]
+            # 严格优先级：高优先级请求等待令牌时，低优先级请求不插队
+            wait = max(self._rpm.wait_time(1, self._rate_factor),
+                       self._tpm.wait_time(ticket.tokens, self._rate_factor))
+            if wait > 0:
+                return wait
+            queue.popleft()
+            if queue:
+                sessions.move_to_end(session)  # 会话轮转
+            else:
+                del sessions[session]
+            self._rpm.take(1)
+            self._tpm.take(ticket.tokens)
+            self._grant(ticket)
+
+    def _ensure_thread(self):
+        """启动定时发放线程（令牌补充或退避结束时唤醒排队请求，调用方持有锁）"""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="LLMScheduler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        with self._cond:
+            while True:
+                wait = self._dispatch_locked()
+                self._cond.wait(timeout=wait)
+
+    # ---------- 统计 ----------
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            now = time.monotonic()
+            lanes = {}
+            for lane in LLMLane:
+                waits = sorted(self._waits[lane])
+                lanes[lane.name.lower()] = {
+                    "queue_depth": sum(len(q) for q in self._queues[lane].values()),
+                    "sessions_waiting": len(self._queues[lane]),
+                    "active": self._active_by_lane[lane],
+                    "limit": self.lane_limits[lane],
+                    **self._lane_stats[lane],
+                    "wait_ms_p50": round(waits[len(waits) // 2] * 1000, 1) if waits else 0.0,
+                    "wait_ms_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 1) if waits else 0.0,
+                    "wait_ms_max": round(waits[-1] * 1000, 1) if waits else 0.0,
+                }
+            return {
+                "enabled": self.enabled,
+                **self._stats,
+                "active": self._active,
+                "max_concurrent": self.max_concurrent,
+                "rate_factor": round(self._rate_factor, 2),
+                "paused_seconds": round(max(0.0, self._paused_until - now), 2),
+                "rpm_available": None if self._rpm.unlimited else round(self._rpm.tokens, 1),
+                "tpm_available": None if self._tpm.unlimited else round(self._tpm.tokens),
+                "lanes": lanes,
+            }
+
+
+def estimate_tokens(messages: Any, max_tokens: int = 0) -> int:
+    """粗略估算一次请求消耗的token数（输入按字符数估算 + 回复上限），用于TPM预扣"""
+    if isinstance(messages, str):
+        chars = len(messages)
+    else:
+        chars = sum(len(str(m.get("content") or "")) for m in messages or [])
+    return chars // 2 + int(max_tokens or 0)
+
+
+_LLM_SCHEDULER: Optional[LLMScheduler] = None
+_LLM_SCHEDULER_LOCK = threading.Lock()
+
+
+def get_llm_scheduler() -> LLMScheduler:
+    """获取全局LLM调度器"""
+    global _LLM_SCHEDULER
+    if _LLM_SCHEDULER is None:
+        with _LLM_SCHEDULER_LOCK:
+            if _LLM_SCHEDULER is None:
+                try:
+                    from config import config
+                    api = config.api
+                    lane_limits = {LLMLane[name.upper()]: limit
+                                   for name, limit in (getattr(api, 'scheduler_lane_limits', None) or {}).items()
+                                   if name.upper() in LLMLane.__members__}
+                    _LLM_SCHEDULER = LLMScheduler(
+                        rpm_limit=getattr(api, 'rpm_limit', 0),
+                        tpm_limit=getattr(api, 'tpm_limit', 0),
+                        max_concurrent=getattr(api, 'max_concurrent_requests', 8),
+                        lane_limits=lane_limits,
+                        max_retries=getattr(api, 'rate_limit_retries', 3),
+                        backoff_base=getattr(api, 'rate_limit_backoff', 1.0),
+                        backoff_max=getattr(api, 'rate_limit_backoff_max', 30.0),
+                        enabled=getattr(api, 'scheduler_enabled', True),
+                    )
+                except Exception as e:
+                    logger.warning(f"读取调度器配置失败，使用默认配置: {e}")
+                    _LLM_SCHEDULER = LLMScheduler()
+    return _LLM_SCHEDULER
@@ -4,72 +4,245 @@
 支持多会话、多agent的消息存储和拼接
 """
 
-import asyncio
+import atexit
+import threading
+import time
 import uuid
 import logging
+from collections import OrderedDict
 from typing import Dict, List, Optional, Any
 from datetime import datetime
 
+from .context_builder import get_context_builder, prefix_hash, with_context
+from .session_store import SessionBackend, create_session_backend, DEFAULT_DB_PATH
+
 logger = logging.getLogger(__name__)
 
 class MessageManager:
-    """统一的消息管理器"""
+    """统一的消息管理器
+    
+    - 活跃会话保存在内存LRU中，修改后由后台线程批量写回持久化后端（write-behind）
+    - 过期清理走后端的last_activity索引，不再全量扫描
+    - 会话总数和单会话消息数均有上限
+    """
     
-    def __init__(self):
-        self.sessions: Dict[str, Dict] = {}
+    def __init__(self, backend: Optional[SessionBackend] = None):
+        self.sessions: "OrderedDict[str, Dict]" = OrderedDict()  # 热会话LRU
+        self._dirty = set()  # 尚未写回后端的会话
+        self._evicting: Dict[str, Dict] = {}  # 已淘汰出热缓存、正在写回的会话（写回完成前仍从这里读取）
+        self._lock = threading.RLock()
         # 从配置文件读取最大历史轮数，默认为10轮
         try:
             from config import config
             self.max_history_rounds = config.api.max_history_rounds
             self.max_messages_per_session = self.max_history_rounds * 2  # 每轮对话包含用户和助手各一条消息
+            server_cfg = config.api_server
+            backend_name = getattr(server_cfg, 'session_backend', 'sqlite')
+            db_path = getattr(server_cfg, 'session_db_path', DEFAULT_DB_PATH)
+            self.cache_size = getattr(server_cfg, 'session_cache_size', 200)
+            self.max_sessions = getattr(server_cfg, 'max_sessions', 1000)
+            self.session_ttl_hours = getattr(server_cfg, 'session_ttl_hours', 24)
+            self.flush_interval = getattr(server_cfg, 'session_flush_interval', 2.0)
         except ImportError:
             self.max_history_rounds = 10
             self.max_messages_per_session = 20  # 默认20条消息
+            backend_name, db_path = 'sqlite', DEFAULT_DB_PATH
+            self.cache_size, self.max_sessions, self.session_ttl_hours, self.flush_interval = 200, 1000, 24, 2.0
             logger.warning("无法导入配置，使用默认历史轮数设置")
+        self.backend = backend or create_session_backend(backend_name, db_path)
+        self._last_expire = 0.0
+        self.last_context_report: Dict[str, Any] = {}  # 最近一轮上下文token用量
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="SessionFlusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+    
+    # ---------- 缓存与写回 ----------
+    def _get(self, session_id: str) -> Optional[Dict]:
+        """取会话：先查热缓存，未命中再从后端加载"""
+        if not session_id:
+            return None
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                self.sessions.move_to_end(session_id)
+                return session
+            session = self._evicting.get(session_id)
+            if session is not None:
+                # 淘汰后尚未写回：放回热缓存并保持脏标记，避免从后端读到旧数据
+                evicted = self._put_hot(session_id, session)
+                self._dirty.add(session_id)
+        if session is not None:
+            self._write_evicted(evicted)
+            return session
+        session = self.backend.load(session_id)
+        if session is None:
+            return None
+        with self._lock:
+            # 加载期间可能已被其他线程放入缓存
+            existing = self.sessions.get(session_id)
+            if existing is not None:
+                return existing
+            evicted = self._put_hot(session_id, session)
+        self._write_evicted(evicted)
+        return session
+    
+    def _put_hot(self, session_id: str, session: Dict) -> Dict[str, Dict]:
+        """放入热缓存，超出容量时淘汰最久未用的会话（调用方持有锁）
+
+        返回被淘汰的脏会话，由调用方释放锁后交给_write_evicted写回，避免持锁做同步写入
+        """
+        self.sessions[session_id] = session
+        self.sessions.move_to_end(session_id)
+        evicted = {}
+        while len(self.sessions) > self.cache_size:
+            old_id, old_session = self.sessions.popitem(last=False)
+            if old_id in self._dirty:
+                self._dirty.discard(old_id)
+                self._evicting[old_id] = old_session
+                evicted[old_id] = old_session
+        return evicted
+    
+    def _write_evicted(self, evicted: Dict[str, Dict]):
+        """写回被淘汰的脏会话（不持锁调用）"""
+        if not evicted:
+            return
+        with self._lock:
+            snapshot = {sid: {**session, "messages": list(session["messages"])} for sid, session in evicted.items()}
+        if self._save(snapshot):
+            self._finish_evicted(evicted)
+        # 失败时保留在_evicting中，由flush重试
+    
+    def _finish_evicted(self, evicted: Dict[str, Dict]):
+        """写回成功后移出_evicting；写回期间被删除或过期清理的会话从后端再删一次，避免被写回复活"""
+        with self._lock:
+            dropped = []
+            for session_id, session in evicted.items():
+                if self._evicting.get(session_id) is session:
+                    del self._evicting[session_id]
+                elif session_id not in self._evicting and session_id not in self.sessions:
+                    dropped.append(session_id)
+        for session_id in dropped:
+            self.backend.delete(session_id)
+    
+    def _mark_dirty(self, session_id: str):
+        with self._lock:
+            self._dirty.add(session_id)
+    
+    def _save(self, sessions: Dict[str, Dict]) -> bool:
+        """写入后端，失败时重新标记为脏会话，返回是否成功"""
+        if not sessions:
+            return True
+        try:
+            self.backend.save_many(sessions)
+            return True
+        except Exception as e:
+            logger.error(f"会话写回失败: {e}")
+            with self._lock:
+                self._dirty.update(sessions.keys())  # 下次重试
+            return False
     
+    def flush(self):
+        """把所有未写回的会话（含已淘汰但尚未写回的）写入后端"""
+        with self._lock:
+            if not self._dirty and not self._evicting:
+                return
+            snapshot = {}
+            for session_id in self._dirty:
+                session = self.sessions.get(session_id)
+                if session is not None:
+                    snapshot[session_id] = {**session, "messages": list(session["messages"])}
+            evicted = dict(self._evicting)
+            for session_id, session in evicted.items():
+                snapshot.setdefault(session_id, {**session, "messages": list(session["messages"])})
+            self._dirty.clear()
+        if self._save(snapshot):
+            self._finish_evicted(evicted)
+    
+    def _flush_loop(self):
+        """后台写回线程：定期刷盘，并按TTL和数量上限清理会话"""
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+                if time.time() - self._last_expire >= 60:
+                    self.cleanup_old_sessions()
+                    self._enforce_session_limit()
+            except Exception as e:
+                logger.error(f"会话后台维护失败: {e}")
+    
+    def _enforce_session_limit(self):
+        """会话总数超过上限时淘汰最久未活跃的会话"""
+        evicted = self.backend.evict_oldest(self.max_sessions)
+        if evicted:
+            with self._lock:
+                for session_id in evicted:
+                    self.sessions.pop(session_id, None)
+                    self._evicting.pop(session_id, None)
+                    self._dirty.discard(session_id)
+            logger.info(f"会话数超过上限 {self.max_sessions}，淘汰 {len(evicted)} 个")
+    
+    def close(self):
+        """停止后台线程并写回剩余会话"""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self.flush()
+        self.backend.close()
+    
+    # ---------- 会话操作 ----------
     def generate_session_id(self) -> str:
         """生成唯一的会话ID"""
         return str(uuid.uuid4())
     
     def create_session(self, session_id: Optional[str] = None) -> str:
-        """创建新会话"""
+        """获取或创建会话：已存在的会话ID直接沿用，保留历史"""
+        if session_id and self._get(session_id) is not None:
+            return session_id
         if not session_id:
             session_id = self.generate_session_id()
         
-        self.sessions[session_id] = {
-            "created_at": asyncio.get_event_loop().time(),
-            "messages": [],
-            "agent_type": "default",  # 可以扩展支持不同agent类型
-            "last_activity": asyncio.get_event_loop().time()
-        }
+        now = time.time()
+        with self._lock:
+            evicted = self._put_hot(session_id, {
+                "created_at": now,
+                "messages": [],
+                "agent_type": "default",  # 可以扩展支持不同agent类型
+                "last_activity": now
+            })
+        self._write_evicted(evicted)
+        self._mark_dirty(session_id)
         
         logger.info(f"创建新会话: {session_id}")
         return session_id
     
+    get_or_create_session = create_session
+    
     def get_session(self, session_id: str) -> Optional[Dict]:
         """获取会话信息"""
-        return self.sessions.get(session_id)
+        return self._get(session_id)
     
     def add_message(self, session_id: str, role: str, content: str) -> bool:
         """向会话添加消息"""
-        if session_id not in self.sessions:
+        session = self._get(session_id)
+        if session is None:
             logger.warning(f"会话不存在: {session_id}")
             return False
         
-        session = self.sessions[session_id]
-        session["messages"].append({"role": role, "content": content})
-        session["last_activity"] = asyncio.get_event_loop().time()
-        
-        # 限制消息数量
-        if len(session["messages"]) > self.max_messages_per_session:
-            session["messages"] = session["messages"][-self.max_messages_per_session:]
+        with self._lock:
+            session["messages"].append({"role": role, "content": content})
+            session["last_activity"] = time.time()
+            
+            # 限制消息数量
+            if len(session["messages"]) > self.max_messages_per_session:
+                session["messages"] = session["messages"][-self.max_messages_per_session:]
+        self._mark_dirty(session_id)
         
         logger.debug(f"会话 {session_id} 添加消息: {role} - {content[:50]}...")
         return True
     
     def get_messages(self, session_id: str) -> List[Dict]:
         """获取会话的所有消息"""
-        session = self.sessions.get(session_id)
+        session = self._get(session_id)
         return session["messages"] if session else []
     
     def get_recent_messages(self, session_id: str, count: Optional[int] = None) -> List[Dict]:
@@ -80,8 +253,21 @@ class MessageManager:
         return messages[-count:] if messages else []
     
     def build_conversation_messages(self, session_id: str, system_prompt: str, 
-                                  current_message: str, include_history: bool = True) -> List[Dict]:
-        """构建完整的对话消息列表"""
+                                  current_message: str, include_history: bool = True,
+                                  context_message: Optional[str] = None) -> List[Dict]:
+        """构建完整的对话消息列表（按token预算从新到旧选取历史，环境信息附在当前消息开头）"""
+        history = self.get_messages(session_id) if include_history else []
+        builder = get_context_builder()
+        if builder.max_context_tokens > 0:
+            messages, self.last_context_report = builder.build(
+                system_prompt, history, current_message,
+                max_history_messages=self.max_messages_per_session,
+                context_message=context_message
+            )
+            return messages
+        
+        # 未配置token预算时按消息条数截取
+        self.last_context_report = {"prefix_hash": prefix_hash(system_prompt)}
         messages = []
         
         # 添加系统提示词
@@ -92,14 +278,14 @@ class MessageManager:
             recent_messages = self.get_recent_messages(session_id)
             messages.extend(recent_messages)
         
-        # 添加当前用户消息
-        messages.append({"role": "user", "content": current_message})
+        # 添加当前用户消息，易变的环境信息附在开头（不放在系统提示词中，保持前缀稳定）
+        messages.append({"role": "user", "content": with_context(current_message, context_message)})
         
         return messages
     
     def get_session_info(self, session_id: str) -> Optional[Dict]:
         """获取会话详细信息"""
-        session = self.sessions.get(session_id)
+        session = self._get(session_id)
         if not session:
             return None
         
@@ -114,56 +300,94 @@ class MessageManager:
             "last_message": session["messages"][-1]["content"][:100] + "..." if session["messages"] else "无对话历史"
         }
     
-    def get_all_sessions_info(self) -> Dict[str, Dict]:
-        """获取所有会话信息"""
-        sessions_info = {}
-        for session_id, session in self.sessions.items():
-            sessions_info[session_id] = self.get_session_info(session_id)
-        return sessions_info
+    def list_sessions(self, offset: int = 0, limit: int = 50) -> List[Dict]:
+        """按最近活跃时间分页获取会话摘要（只读取一页，不加载消息正文）"""
+        self.flush()
+        page = self.backend.list_page(offset, limit)
+        for info in page:
+            info["conversation_rounds"] = info["message_count"] // 2
+            info["max_history_rounds"] = self.max_history_rounds
+            info["last_message"] = info["last_message"] + "..." if info["last_message"] else "无对话历史"
+        return page
+    
+    def count_sessions(self) -> int:
+        """会话总数"""
+        self.flush()
+        return self.backend.count()
+    
+    def get_all_sessions_info(self, offset: int = 0, limit: int = 50) -> Dict[str, Dict]:
+        """获取会话信息（分页）"""
+        return {info["session_id"]: info for info in self.list_sessions(offset, limit)}
     
     def delete_session(self, session_id: str) -> bool:
         """删除指定会话"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        with self._lock:
+            in_cache = self.sessions.pop(session_id, None) is not None
+            in_cache = self._evicting.pop(session_id, None) is not None or in_cache
+            self._dirty.discard(session_id)
+        deleted = self.backend.delete(session_id) or in_cache
+        if deleted:
             logger.info(f"删除会话: {session_id}")
-            return True
-        return False
+        return deleted
     
     def clear_all_sessions(self) -> int:
         """清空所有会话"""
-        count = len(self.sessions)
-        self.sessions.clear()
+        self.flush()  # 先写回，保证计数包含尚未持久化的新会话
+        with self._lock:
+            self.sessions.clear()
+            self._evicting.clear()
+            self._dirty.clear()
+        count = self.backend.clear()
         logger.info(f"清空所有会话，共 {count} 个")
         return count
     
-    def cleanup_old_sessions(self, max_age_hours: int = 24) -> int:
-        """清理过期会话"""
-        current_time = asyncio.get_event_loop().time()
-        expired_sessions = []
+    def cleanup_old_sessions(self, max_age_hours: Optional[int] = None) -> int:
+        """清理过期会话（后端按last_activity索引删除，热缓存容量有限可直接检查）"""
+        if max_age_hours is None:
+            max_age_hours = self.session_ttl_hours
+        cutoff = time.time() - max_age_hours * 3600
+        self._last_expire = time.time()
         
-        for session_id, session in self.sessions.items():
-            if current_time - session["last_activity"] > max_age_hours * 3600:
-                expired_sessions.append(session_id)
+        with self._lock:
+            expired_hot = [sid for sid, s in self.sessions.items() if s["last_activity"] < cutoff]
+            for session_id in expired_hot:
+                del self.sessions[session_id]
+                self._dirty.discard(session_id)
+            expired_evicting = [sid for sid, s in self._evicting.items() if s["last_activity"] < cutoff]
+            for session_id in expired_evicting:
+                del self._evicting[session_id]  # 不再写回，避免过期会话重新写入后端
+                self._dirty.discard(session_id)
+            expired_hot += expired_evicting
+        expired = set(self.backend.expire_before(cutoff)) | set(expired_hot)
         
-        for session_id in expired_sessions:
-            del self.sessions[session_id]
+        if expired:
+            logger.info(f"清理了 {len(expired)} 个过期会话")
         
-        if expired_sessions:
-            logger.info(f"清理了 {len(expired_sessions)} 个过期会话")
-        
-        return len(expired_sessions)
+        return len(expired)
     
     def set_agent_type(self, session_id: str, agent_type: str) -> bool:
         """设置会话的agent类型"""
-        if session_id in self.sessions:
-            self.sessions[session_id]["agent_type"] = agent_type
+        session = self._get(session_id)
+        if session is not None:
+            session["agent_type"] = agent_type
+            self._mark_dirty(session_id)
             return True
         return False
     
     def get_agent_type(self, session_id: str) -> Optional[str]:
         """获取会话的agent类型"""
-        session = self.sessions.get(session_id)
+        session = self._get(session_id)
         return session["agent_type"] if session else None
 
-# 全局消息管理器实例
-message_manager = MessageManager() 
\ No newline at end of file
+_MESSAGE_MANAGER: Optional[MessageManager] = None
+_MESSAGE_MANAGER_LOCK = threading.Lock()
+
+
+def get_message_manager() -> MessageManager:
+    """获取全局消息管理器（首次使用时才打开后端并启动写回线程）"""
+    global _MESSAGE_MANAGER
+    if _MESSAGE_MANAGER is None:
+        with _MESSAGE_MANAGER_LOCK:
+            if _MESSAGE_MANAGER is None:
+                _MESSAGE_MANAGER = MessageManager()
+    return _MESSAGE_MANAGER
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+原生函数调用（OpenAI tools）工具协议
+- 把各服务agent-manifest.json中的invocationCommands转换为OpenAI tools函数定义，按注册表版本号只转换一次
+- 工具定义通过请求的tools参数发送，系统提示词中不再粘贴服务目录和逐个工具的JSON示例
+- 从回复的结构化tool_calls（含流式增量）读取调用，执行结果以tool角色消息回传
+- 按后端选择协议：config.api.tool_protocol为默认值，tool_protocol_backends按模型名或base_url覆盖
+- 每轮统计相对文本协议节省的提示词token数（系统提示词 + tools定义，按本地分词器计数）
+"""
+
+import json
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("NativeTools")
+
+TEXT_PROTOCOL = "text"
+NATIVE_PROTOCOL = "native"
+AGENT_TOOL_NAME = "call_agent"
+TOOL_PROTOCOL_MARKER = "【工具调用格式要求】"  # 文本协议说明在系统提示词中的起始位置
+RESERVED_ARGS = ("tool_name", "service_name", "agentType")  # 由协议本身决定的参数，不出现在函数参数中
+MAX_DESCRIPTION_CHARS = 300
+
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_-]")
+_PARAM_LINE_RE = re.compile(r"\s*-\s*`[^`]+`\s*:")  # 描述中"- `参数`: 说明"形式的参数行
+
+
+def resolve_tool_protocol(base_url: Optional[str] = None, model: Optional[str] = None) -> str:
+    """当前后端使用的工具调用协议（text/native）"""
+    try:
+        from config import config
+        api = config.api
+    except Exception:
+        return TEXT_PROTOCOL
+    base_url = (base_url if base_url is not None else api.base_url or "").rstrip('/')
+    model = model if model is not None else api.model
+    overrides = getattr(api, 'tool_protocol_backends', None) or {}
+    for key in (model, base_url):
+        if key and key in overrides:
+            return overrides[key]
+    for key, protocol in overrides.items():
+        if key.rstrip('/') == base_url:
+            return protocol
+    return getattr(api, 'tool_protocol', TEXT_PROTOCOL)
+
+
+def _function_name(*parts: str) -> str:
+    """函数名只允许字母数字、下划线和短横线，最长64字符"""
+    return _NAME_RE.sub("_", "__".join(p for p in parts if p))[:64]
+
+
+def _json_type(value: Any) -> str:
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "number"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, dict):
+        return "object"
+    return "string"
+
+
+def _short_description(text: str) -> str:
+    """只保留功能说明：去掉返回格式、调用示例和逐个参数的说明（参数说明已在parameters中）"""
+    text = re.split(r"\*\*(?:返回格式|调用示例)", text or "")[0]
+    lines = [line for line in text.splitlines() if line.strip() and not _PARAM_LINE_RE.match(line)]
+    return "\n".join(lines).strip()[:MAX_DESCRIPTION_CHARS]
+
+
+def _command_parameters(tool: Dict) -> Dict:
+    """由调用示例和服务的inputSchema生成函数参数定义"""
+    schema = tool.get("input_schema") or {}
+    schema_props = schema.get("properties") or {}
+    try:
+        example = json.loads(tool.get("example") or "{}")
+    except (TypeError, ValueError):
+        example = {}
+    if not isinstance(example, dict):
+        example = {}
+    properties = {}
+    for key, value in example.items():
+        if key in RESERVED_ARGS:
+            continue
+        properties[key] = dict(schema_props.get(key) or {"type": _json_type(value)})
+    if not example:
+        properties = {k: dict(v) for k, v in schema_props.items() if k not in RESERVED_ARGS}
+    required = [k for k in schema.get("required") or [] if k in properties]
+    parameters = {"type": "object", "properties": properties}
+    if required:
+        parameters["required"] = required
+    return parameters
+
+
+def build_tool_schemas(available_services: Dict, agents: Optional[List[Dict]] = None
+                       ) -> Tuple[List[Dict], Dict[str, Tuple[str, str]]]:
+    """
+    把服务列表转换为OpenAI tools定义
+
+    Args:
+        available_services: mcp_manager.get_available_services_filtered()的返回值
+        agents: AgentManager中已注册的Agent（base_name, description）
+    Returns:
+        (tools, 函数名 -> (服务名, 工具名)；Agent调用映射为(AGENT_TOOL_NAME, ""))
+    """
+    tools: List[Dict] = []
+    name_map: Dict[str, Tuple[str, str]] = {}
+    for service in sorted(available_services.get("mcp_services", []), key=lambda s: s.get("name", "")):
+        service_name = service.get("name", "")
+        for tool in service.get("available_tools", []):
+            command = tool.get("name", "")
+            if not service_name or not command:
+                continue
+            function_name = _function_name(service_name, command)
+            description = _short_description(tool.get("description", ""))
+            tools.append({
+                "type": "function",
+                "function": {
+                    "name": function_name,
+                    "description": description or f"{service_name} {command}",
+                    "parameters": _command_parameters(tool),
+                },
+            })
+            name_map[function_name] = (service_name, command)
+
+    agents = sorted(agents or [], key=lambda a: a.get("base_name", ""))
+    if agents:
+        catalog = "\n".join(f"- {a.get('base_name', '')}: {a.get('description', '')}".rstrip(": ") for a in agents)
+        tools.append({
+            "type": "function",
+            "function": {
+                "name": AGENT_TOOL_NAME,
+                "description": f"把任务交给指定Agent处理。可用Agent：\n{catalog}",
+                "parameters": {
+                    "type": "object",
+                    "properties": {
+                        "agent_name": {"type": "string", "enum": [a.get("base_name", "") for a in agents]},
+                        "prompt": {"type": "string", "description": "本次任务内容"},
+                    },
+                    "required": ["agent_name", "prompt"],
+                },
+            },
+        })
+        name_map[AGENT_TOOL_NAME] = (AGENT_TOOL_NAME, "")
+    return tools, name_map
+
+
+class NativeToolset:
+    """一组tools定义及其与MCP服务/Agent调用之间的映射"""
+
+    def __init__(self, tools: List[Dict], name_map: Dict[str, Tuple[str, str]]):
+        self.tools = tools
+        self.name_map = name_map
+
+    def parse(self, raw_calls: Optional[List[Dict]], round_index: int = 0) -> List[Dict]:
+        """
+        把回复中的tool_calls转换为工具调度器使用的调用格式（与parse_tool_calls一致）
+        参数无法解析或函数不存在时保留调用并带上error，仍需回传tool消息
+        """
+        calls = []
+        for i, raw in enumerate(raw_calls or []):
+            function = raw.get("function") or {}
+            function_name = function.get("name") or ""
+            arguments = function.get("arguments") or ""
+            call = {
+                "id": raw.get("id") or f"call_{round_index}_{i}",
+                "function": function_name,
+                "arguments": arguments,
+                "name": function_name,
+                "args": {},
+            }
+            try:
+                args = json.loads(arguments) if arguments.strip() else {}
+                if not isinstance(args, dict):
+                    raise ValueError("参数不是JSON对象")
+            except ValueError as e:
+                call["error"] = f"工具 {function_name} 的参数无法解析: {e}"
+                calls.append(call)
+                continue
+            target = self.name_map.get(function_name)
+            if target is None:
+                call["error"] = f"未知工具: {function_name}"
+            elif target[0] == AGENT_TOOL_NAME:
+                call["name"] = "agent_call"
+                call["args"] = {"agentType": "agent", "agent_name": args.get("agent_name"),
+                                "prompt": args.get("prompt")}
+            else:
+                service_name, command = target
+                call["name"] = command
+                call["args"] = {**args, "agentType": "mcp", "service_name": service_name, "tool_name": command}
+            calls.append(call)
+        return calls
+
+    @staticmethod
+    def assistant_message(content: str, calls: List[Dict]) -> Dict:
+        """包含tool_calls的助手消息（id与随后的tool消息一一对应）"""
+        return {
+            "role": "assistant",
+            "content": content or None,
+            "tool_calls": [
+                {"id": c["id"], "type": "function",
+                 "function": {"name": c["function"], "arguments": c["arguments"] or "{}"}}
+                for c in calls
+            ],
+        }
+
+
+async def execute_native_tool_calls(calls: List[Dict], mcp_manager) -> List[Dict]:
+    """并发执行工具调用，按原始顺序返回tool角色消息"""
+    from mcpserver.tool_scheduler import get_tool_scheduler
+    runnable = [c for c in calls if "error" not in c]
+    records = await get_tool_scheduler().execute(runnable, mcp_manager) if runnable else []
+    results = {c["id"]: r["result"] for c, r in zip(runnable, records)}
+    return [{"role": "tool", "tool_call_id": c["id"], "content": str(c.get("error") or results.get(c["id"], ""))}
+            for c in calls]
+
+
+class ToolCallDeltaAccumulator:
+    """按index合并流式回复中的tool_calls增量"""
+
+    def __init__(self):
+        self._calls: Dict[int, Dict] = {}
+
+    def add(self, deltas: List[Dict]):
+        for delta in deltas or []:
+            index = delta.get("index") or 0
+            call = self._calls.setdefault(index, {"id": None, "type": "function",
+                                                  "function": {"name": "", "arguments": ""}})
+            if delta.get("id"):
+                call["id"] = delta["id"]
+            function = delta.get("function") or {}
+            if function.get("name"):
+                call["function"]["name"] += function["name"]
+            if function.get("arguments"):
+                call["function"]["arguments"] += function["arguments"]
+
+    def result(self) -> List[Dict]:
+        return [self._calls[i] for i in sorted(self._calls)]
+
+
+# ---------- 工具定义与系统提示词 ----------
+_TOOLSET_CACHE: Dict[str, Any] = {"key": None, "toolset": None}
+_SAVINGS_CACHE: Dict[str, Any] = {"key": None, "savings": None}
+_STATS = {"turns": 0, "requests": 0, "prompt_tokens_saved": 0, "conversions": 0}
+_STATS_LOCK = threading.Lock()
+
+
+def _available_agents() -> List[Dict]:
+    try:
+        from mcpserver.agent_manager import get_agent_manager
+        return get_agent_manager().get_available_agents()
+    except Exception:
+        return []
+
+
+def get_native_toolset(mcp_manager) -> NativeToolset:
+    """当前服务对应的tools定义，服务注册表和Agent列表不变时复用"""
+    from mcpserver.mcp_registry import get_registry_generation
+    agents = _available_agents()
+    key = (get_registry_generation(), tuple(sorted((a.get("base_name", ""), a.get("description", "")) for a in agents)))
+    if _TOOLSET_CACHE["key"] == key:
+        return _TOOLSET_CACHE["toolset"]
+    tools, name_map = build_tool_schemas(mcp_manager.get_available_services_filtered(), agents)
+    toolset = NativeToolset(tools, name_map)
+    _TOOLSET_CACHE["key"] = key
+    _TOOLSET_CACHE["toolset"] = toolset
+    with _STATS_LOCK:
+        _STATS["conversions"] += 1
+    logger.info(f"已转换 {len(tools)} 个工具为函数调用定义")
+    return toolset
+
+
+def native_system_prompt(template: str, instructions: str = "") -> str:
+    """去掉文本协议说明和服务目录，附加函数调用说明"""
+    if TOOL_PROTOCOL_MARKER in template:
+        persona = template.split(TOOL_PROTOCOL_MARKER, 1)[0].rstrip()
+    else:
+        try:
+            persona = template.format(available_mcp_services="（见函数定义）", available_agent_services="（见函数定义）")
+        except (KeyError, IndexError, ValueError):
+            persona = template
+    return f"{persona}\n\n{instructions.strip()}\n" if instructions else persona
+
+
+def measure_prompt_savings(text_prompt: str, native_prompt: str, toolset: NativeToolset) -> Dict[str, int]:
+    """文本协议与原生协议每次请求的提示词token数（tools定义按JSON计入）"""
+    key = (hash(text_prompt), hash(native_prompt), id(toolset))
+    if _SAVINGS_CACHE["key"] == key:
+        return _SAVINGS_CACHE["savings"]
+    from .context_builder import get_context_builder
+    count = get_context_builder().counter.count_text
+    text_tokens = count(text_prompt)
+    native_tokens = count(native_prompt) + count(json.dumps(toolset.tools, ensure_ascii=False))
+    savings = {"text_prompt_tokens": text_tokens, "native_prompt_tokens": native_tokens,
+               "saved_per_request": text_tokens - native_tokens}
+    _SAVINGS_CACHE["key"] = key
+    _SAVINGS_CACHE["savings"] = savings
+    return savings
+
+
+def record_turn(savings: Dict[str, int], requests: int = 1) -> Dict[str, int]:
+    """记录一轮对话（工具调用循环内每次LLM请求都会发送系统提示词和tools定义）"""
+    saved = savings["saved_per_request"] * max(1, requests)
+    with _STATS_LOCK:
+        _STATS["turns"] += 1
+        _STATS["requests"] += max(1, requests)
+        _STATS["prompt_tokens_saved"] += saved
+    report = {**savings, "requests": max(1, requests), "saved": saved}
+    logger.debug(f"原生工具协议本轮节省提示词 {saved} tokens（{report}）")
+    return report
+
+
+def get_tool_protocol_stats() -> Dict[str, Any]:
+    with _STATS_LOCK:
+        stats = dict(_STATS)
+    stats["protocol"] = resolve_tool_protocol()
+    stats["tools"] = len(_TOOLSET_CACHE["toolset"].tools) if _TOOLSET_CACHE["toolset"] else 0
+    stats["per_request"] = _SAVINGS_CACHE["savings"]
+    stats["avg_saved_per_turn"] = round(stats["prompt_tokens_saved"] / stats["turns"], 1) if stats["turns"] else 0.0
+    return stats
@@ -1,59 +1,98 @@
 """
 Prompt保存工具类
 用于保存发送给LLM的完整prompt消息
+- 每条日志一行JSON追加写入 prompts_YYYY-MM-DD.jsonl，写入成本与当天日志量无关
+- log_prompt只把日志放入有界队列，由后台线程批量写入并合并fsync，不阻塞LLM调用
+- 按日期和大小切分文件，切分出的旧文件压缩为.gz
+- 维护会话ID -> 日志文件的小索引，按会话查询时只读取相关文件
 """
 
+import atexit
+import gzip
 import json
 import os
+import queue
+import shutil
 import datetime
+import threading
+import time
 from typing import List, Dict, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
+INDEX_FILE = "session_index.json"  # 会话索引（会话ID -> 日志文件名，不含.gz后缀）
+
+
+def _read_jsonl(file_path: str) -> List[Dict]:
+    """读取jsonl或jsonl.gz文件，跳过损坏的行"""
+    entries = []
+    opener = gzip.open if file_path.endswith(".gz") else open
+    try:
+        with opener(file_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"读取prompt日志文件失败 {file_path}: {e}")
+    return entries
+
 
 class PromptLogger:
     """Prompt日志记录器"""
-    
-    def __init__(self):
-        self.logs_dir = "logs/prompts"
+
+    def __init__(self, logs_dir: str = "logs/prompts"):
+        self.logs_dir = logs_dir
         self._ensure_directory()
-    
+        self.max_bytes, queue_size, self.fsync_interval = self._load_settings()
+        self._queue: "queue.Queue[Optional[Dict]]" = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        self._closed = False
+        # 当前写入文件状态（仅写线程访问）
+        self._fh = None
+        self._current_date = None
+        self._current_part = 0
+        self._current_name = None
+        self._last_fsync = 0.0
+        # 会话索引
+        self._index: Dict[str, List[str]] = self._load_index()
+        self._index_dirty = False
+        self._stats = {"queued": 0, "written": 0, "dropped": 0, "fsyncs": 0, "rotations": 0}
+        atexit.register(self.close)
+
     def _ensure_directory(self):
         """确保日志目录存在"""
         os.makedirs(self.logs_dir, exist_ok=True)
-    
-    def _get_today_file(self) -> str:
-        """获取今天的日志文件路径"""
-        today = datetime.datetime.now().strftime("%Y-%m-%d")
-        return os.path.join(self.logs_dir, f"prompts_{today}.json")
-    
-    def _load_existing_logs(self, file_path: str) -> List[Dict]:
-        """加载现有的日志文件"""
-        try:
-            if os.path.exists(file_path):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except Exception as e:
-            logger.error(f"加载prompt日志文件失败: {e}")
-        return []
-    
-    def _save_logs(self, file_path: str, logs: List[Dict]):
-        """保存日志到文件"""
+
+    @staticmethod
+    def _load_settings():
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(logs, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"保存prompt日志文件失败: {e}")
-    
-    def log_prompt(self, 
-                   session_id: str, 
-                   messages: List[Dict], 
+            from config import config
+            return (
+                int(getattr(config.system, 'prompt_log_max_mb', 20) * 1024 * 1024),
+                getattr(config.system, 'prompt_log_queue_size', 1000),
+                getattr(config.system, 'prompt_log_fsync_interval', 1.0),
+            )
+        except Exception:
+            return 20 * 1024 * 1024, 1000, 1.0
+
+    # ---------- 写入 ----------
+    def log_prompt(self,
+                   session_id: str,
+                   messages: List[Dict],
                    api_response: Optional[Dict] = None,
                    api_status: str = "unknown") -> None:
         """
-        记录prompt日志
-        
+        记录prompt日志（放入队列后立即返回）
+
         Args:
             session_id: 会话ID
             messages: 发送给LLM的完整消息列表
@@ -65,54 +104,271 @@ class PromptLogger:
             from config import config
             if not getattr(config.system, 'save_prompts', False):
                 return
-            
-            # 创建日志条目
+
+            # 创建日志条目（消息列表浅拷贝，调用方后续追加消息不影响本条日志）
             log_entry = {
                 "timestamp": datetime.datetime.now().isoformat(),
                 "session_id": session_id,
-                "messages": messages,
+                "messages": list(messages),
                 "api_status": api_status,
                 "api_response": api_response
             }
-            
-            # 获取今天的日志文件
-            file_path = self._get_today_file()
-            
-            # 加载现有日志
-            existing_logs = self._load_existing_logs(file_path)
-            
-            # 添加新日志条目
-            existing_logs.append(log_entry)
-            
-            # 保存到文件
-            self._save_logs(file_path, existing_logs)
-            
-            logger.info(f"已保存prompt日志，会话ID: {session_id}")
-            
+
+            self._ensure_writer()
+            try:
+                self._queue.put_nowait(log_entry)
+                self._stats["queued"] += 1
+            except queue.Full:
+                # 写入跟不上时丢弃，不拖慢LLM调用
+                self._stats["dropped"] += 1
+                logger.warning(f"prompt日志队列已满，丢弃日志，会话ID: {session_id}")
+
         except Exception as e:
             logger.error(f"保存prompt日志失败: {e}")
-    
+
+    def _ensure_writer(self):
+        if self._writer is not None and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._closed or (self._writer is not None and self._writer.is_alive()):
+                return
+            self._writer = threading.Thread(target=self._writer_loop, name="PromptLogWriter", daemon=True)
+            self._writer.start()
+
+    def _writer_loop(self):
+        """后台写线程：批量取出队列中的日志追加写入"""
+        while True:
+            try:
+                entry = self._queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                self._sync(force=True)
+                continue
+            batch = [entry]
+            # 一次取完当前积压的日志，合并为一次写入
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            try:
+                self._write_batch([e for e in batch if e is not None])
+            except Exception as e:
+                logger.error(f"写入prompt日志失败: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stop:
+                self._sync(force=True)
+                self._close_file()
+                return
+
+    def _write_batch(self, entries: List[Dict]):
+        if not entries:
+            return
+        for entry in entries:
+            line = (json.dumps(entry, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+            self._open_for(entry.get("timestamp", "")[:10], len(line))
+            self._fh.write(line)
+            self._stats["written"] += 1
+            session_id = entry.get("session_id")
+            if session_id:
+                files = self._index.setdefault(session_id, [])
+                if self._current_name not in files:
+                    files.append(self._current_name)
+                    self._index_dirty = True
+        self._fh.flush()
+        self._sync()
+
+    def _sync(self, force: bool = False):
+        """合并fsync：距上次fsync超过间隔才执行，会话索引随之落盘"""
+        now = time.monotonic()
+        if not force and now - self._last_fsync < self.fsync_interval:
+            return
+        if self._fh is not None:
+            try:
+                self._fh.flush()
+                os.fsync(self._fh.fileno())
+                self._stats["fsyncs"] += 1
+            except Exception as e:
+                logger.debug(f"prompt日志fsync失败: {e}")
+        if self._index_dirty:
+            self._save_index()
+        self._last_fsync = now
+
+    # ---------- 文件切分 ----------
+    def _file_name(self, date_str: str, part: int) -> str:
+        return f"prompts_{date_str}.jsonl" if part == 0 else f"prompts_{date_str}.{part}.jsonl"
+
+    def _open_for(self, date_str: str, incoming: int):
+        """按日期和大小选择写入文件，必要时切分"""
+        date_str = date_str or datetime.datetime.now().strftime("%Y-%m-%d")
+        if self._fh is not None and date_str == self._current_date:
+            if self._fh.tell() + incoming <= self.max_bytes or self._fh.tell() == 0:
+                return
+            self._rotate(date_str, self._current_part + 1)
+            return
+        if self._fh is not None:
+            self._rotate(date_str, None)
+            return
+        # 首次打开：接着当天最后一个分片写
+        part = 0
+        while os.path.exists(os.path.join(self.logs_dir, self._file_name(date_str, part + 1))) or \
+                os.path.exists(os.path.join(self.logs_dir, self._file_name(date_str, part + 1) + ".gz")):
+            part += 1
+        # 已压缩的分片不再追加（否则下次切分压缩时会覆盖已有的.gz）
+        while os.path.exists(os.path.join(self.logs_dir, self._file_name(date_str, part) + ".gz")):
+            part += 1
+        self._open(date_str, part)
+
+    def _open(self, date_str: str, part: int):
+        self._current_date = date_str
+        self._current_part = part
+        self._current_name = self._file_name(date_str, part)
+        self._fh = open(os.path.join(self.logs_dir, self._current_name), "ab")
+
+    def _close_file(self):
+        if self._fh is not None:
+            try:
+                self._fh.close()
+            except Exception:
+                pass
+            self._fh = None
+
+    def _rotate(self, date_str: str, part: Optional[int]):
+        """关闭当前文件并压缩，打开新文件"""
+        old_path = os.path.join(self.logs_dir, self._current_name)
+        self._sync(force=True)
+        self._close_file()
+        self._compress(old_path)
+        self._stats["rotations"] += 1
+        if part is None:
+            self._open_for(date_str, 0)  # 日期变化：打开新日期的文件
+        else:
+            self._open(date_str, part)
+
+    @staticmethod
+    def _compress(path: str):
+        """压缩切分出的旧文件"""
+        try:
+            with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"压缩prompt日志失败 {path}: {e}")
+
+    # ---------- 会话索引 ----------
+    def _load_index(self) -> Dict[str, List[str]]:
+        path = os.path.join(self.logs_dir, INDEX_FILE)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.error(f"加载prompt会话索引失败: {e}")
+            return {}
+
+    def _save_index(self):
+        """写临时文件后原子替换"""
+        path = os.path.join(self.logs_dir, INDEX_FILE)
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(self._index, f, ensure_ascii=False)
+            os.replace(tmp, path)
+            self._index_dirty = False
+        except Exception as e:
+            logger.error(f"保存prompt会话索引失败: {e}")
+
+    # ---------- 读取 ----------
+    def flush(self, timeout: float = 5.0):
+        """等待队列中的日志全部写入"""
+        if self._writer is None or not self._writer.is_alive():
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _resolve(self, name: str) -> Optional[str]:
+        """日志文件可能已被压缩，优先返回存在的路径"""
+        path = os.path.join(self.logs_dir, name)
+        if os.path.exists(path):
+            return path
+        if os.path.exists(path + ".gz"):
+            return path + ".gz"
+        return None
+
+    def _files_for_date(self, date_str: str) -> List[str]:
+        """某天的所有日志文件（按分片顺序）"""
+        names = []
+        part = 0
+        while True:
+            path = self._resolve(self._file_name(date_str, part))
+            if path is None:
+                if part > 0:
+                    break
+            else:
+                names.append(path)
+            part += 1
+        return names
+
+    def _load_legacy(self, file_path: str) -> List[Dict]:
+        """读取旧版整文件JSON日志"""
+        try:
+            if os.path.exists(file_path):
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"加载prompt日志文件失败: {e}")
+        return []
+
     def get_today_logs(self) -> List[Dict]:
         """获取今天的prompt日志"""
-        file_path = self._get_today_file()
-        return self._load_existing_logs(file_path)
-    
+        return self.get_logs_by_date(datetime.datetime.now().strftime("%Y-%m-%d"))
+
     def get_logs_by_date(self, date_str: str) -> List[Dict]:
         """根据日期获取prompt日志"""
-        file_path = os.path.join(self.logs_dir, f"prompts_{date_str}.json")
-        return self._load_existing_logs(file_path)
-    
+        self.flush()
+        logs = self._load_legacy(os.path.join(self.logs_dir, f"prompts_{date_str}.json"))
+        for path in self._files_for_date(date_str):
+            logs.extend(_read_jsonl(path))
+        return logs
+
     def get_logs_by_session(self, session_id: str) -> List[Dict]:
-        """根据会话ID获取prompt日志"""
+        """根据会话ID获取prompt日志（通过索引只读取相关文件）"""
+        self.flush()
         all_logs = []
-        for filename in os.listdir(self.logs_dir):
+        # 旧版整文件日志没有索引，仍需逐个扫描
+        for filename in sorted(os.listdir(self.logs_dir)):
             if filename.startswith("prompts_") and filename.endswith(".json"):
-                file_path = os.path.join(self.logs_dir, filename)
-                logs = self._load_existing_logs(file_path)
-                session_logs = [log for log in logs if log.get("session_id") == session_id]
-                all_logs.extend(session_logs)
+                logs = self._load_legacy(os.path.join(self.logs_dir, filename))
+                all_logs.extend(log for log in logs if log.get("session_id") == session_id)
+        for name in list(self._index.get(session_id, [])):
+            path = self._resolve(name)
+            if path:
+                all_logs.extend(log for log in _read_jsonl(path) if log.get("session_id") == session_id)
         return all_logs
 
+    def get_stats(self) -> Dict:
+        return {**self._stats, "pending": self._queue.qsize(), "sessions_indexed": len(self._index)}
+
+    def close(self):
+        """写入剩余日志并停止后台线程"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self._writer is not None and self._writer.is_alive():
+            try:
+                self._queue.put(None, timeout=1.0)
+                self._writer.join(timeout=5.0)
+            except Exception as e:
+                logger.debug(f"关闭prompt日志写线程失败: {e}")
+
 
 # 全局prompt日志记录器实例
-prompt_logger = PromptLogger() 
\ No newline at end of file
+prompt_logger = PromptLogger()
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+会话持久化后端
+- SessionBackend: 统一接口（加载/保存/删除/分页列表/按TTL过期/按数量淘汰）
+- SQLiteSessionBackend: 嵌入式SQLite（WAL），last_activity建索引，过期和分页都走索引
+- MemorySessionBackend: 纯内存实现，不持久化
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = "logs/sessions.db"
+
+
+def _summary(session_id: str, session: Dict) -> Dict:
+    """会话列表中展示的摘要信息"""
+    messages = session.get("messages", [])
+    return {
+        "session_id": session_id,
+        "created_at": session.get("created_at"),
+        "last_activity": session.get("last_activity"),
+        "agent_type": session.get("agent_type", "default"),
+        "message_count": len(messages),
+        "last_message": messages[-1]["content"][:100] if messages else "",
+    }
+
+
+class SessionBackend:
+    """会话存储接口"""
+
+    name = "base"
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def save_many(self, sessions: Dict[str, Dict]):
+        """批量写入（写回缓存刷盘时调用）"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> bool:
+        raise NotImplementedError
+
+    def clear(self) -> int:
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def list_page(self, offset: int = 0, limit: int = 50) -> List[Dict]:
+        """按最近活跃时间倒序分页返回会话摘要"""
+        raise NotImplementedError
+
+    def expire_before(self, timestamp: float) -> List[str]:
+        """删除last_activity早于timestamp的会话，返回被删除的会话ID"""
+        raise NotImplementedError
+
+    def evict_oldest(self, keep: int) -> List[str]:
+        """只保留最近活跃的keep个会话，返回被删除的会话ID"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MemorySessionBackend(SessionBackend):
+    """内存后端：与旧版行为一致，重启后丢失"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, Dict] = {}
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            return json.loads(json.dumps(session)) if session else None
+
+    def save_many(self, sessions: Dict[str, Dict]):
+        with self._lock:
+            for session_id, session in sessions.items():
+                self._sessions[session_id] = json.loads(json.dumps(session, ensure_ascii=False))
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def clear(self) -> int:
+        with self._lock:
+            count = len(self._sessions)
+            self._sessions.clear()
+            return count
+
+    def count(self) -> int:
+        return len(self._sessions)
+
+    def _ordered(self) -> List[Tuple[str, Dict]]:
+        return sorted(self._sessions.items(), key=lambda kv: kv[1].get("last_activity", 0), reverse=True)
+
+    def list_page(self, offset: int = 0, limit: int = 50) -> List[Dict]:
+        with self._lock:
+            return [_summary(sid, s) for sid, s in self._ordered()[offset:offset + limit]]
+
+    def expire_before(self, timestamp: float) -> List[str]:
+        with self._lock:
+            expired = [sid for sid, s in self._sessions.items() if s.get("last_activity", 0) < timestamp]
+            for sid in expired:
+                del self._sessions[sid]
+            return expired
+
+    def evict_oldest(self, keep: int) -> List[str]:
+        with self._lock:
+            evicted = [sid for sid, _ in self._ordered()[keep:]]
+            for sid in evicted:
+                del self._sessions[sid]
+            return evicted
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at REAL NOT NULL,
+    last_activity REAL NOT NULL,
+    agent_type TEXT NOT NULL DEFAULT 'default',
+    message_count INTEGER NOT NULL DEFAULT 0,
+    last_message TEXT NOT NULL DEFAULT '',
+    messages TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_last_activity ON sessions(last_activity);
+"""
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """SQLite后端：WAL模式，单连接 + 线程锁"""
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str = DEFAULT_DB_PATH):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")  # WAL下NORMAL即可保证崩溃一致性
+        self._conn.executescript(_SCHEMA)
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created_at, last_activity, agent_type, messages FROM sessions WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            messages = json.loads(row[3])
+        except ValueError:
+            logger.error(f"会话消息损坏，已重置: {session_id}")
+            messages = []
+        return {"created_at": row[0], "last_activity": row[1], "agent_type": row[2], "messages": messages}
+
+    def save_many(self, sessions: Dict[str, Dict]):
+        if not sessions:
+            return
+        rows = []
+        for session_id, session in sessions.items():
+            summary = _summary(session_id, session)
+            rows.append((
+                session_id, summary["created_at"], summary["last_activity"], summary["agent_type"],
+                summary["message_count"], summary["last_message"],
+                json.dumps(session.get("messages", []), ensure_ascii=False),
+            ))
+        with self._lock:
+            # 一个事务写入整批，合并磁盘同步
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO sessions (session_id, created_at, last_activity, agent_type, message_count, last_message, messages) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET last_activity = excluded.last_activity, "
+                    "agent_type = excluded.agent_type, message_count = excluded.message_count, "
+                    "last_message = excluded.last_message, messages = excluded.messages",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+    def clear(self) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM sessions").rowcount
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def list_page(self, offset: int = 0, limit: int = 50) -> List[Dict]:
+        # 只读取摘要列，不解析消息正文；按last_activity索引倒序扫描
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id, created_at, last_activity, agent_type, message_count, last_message "
+                "FROM sessions ORDER BY last_activity DESC LIMIT ? OFFSET ?",
+                (limit, offset)
+            ).fetchall()
+        return [{
+            "session_id": r[0], "created_at": r[1], "last_activity": r[2],
+            "agent_type": r[3], "message_count": r[4], "last_message": r[5],
+        } for r in rows]
+
+    def expire_before(self, timestamp: float) -> List[str]:
+        with self._lock:
+            expired = [r[0] for r in self._conn.execute(
+                "SELECT session_id FROM sessions WHERE last_activity < ?", (timestamp,)
+            ).fetchall()]
+            if expired:
+                self._conn.execute("DELETE FROM sessions WHERE last_activity < ?", (timestamp,))
+            return expired
+
+    def evict_oldest(self, keep: int) -> List[str]:
+        with self._lock:
+            total = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            if total <= keep:
+                return []
+            evicted = [r[0] for r in self._conn.execute(
+                "SELECT session_id FROM sessions ORDER BY last_activity ASC LIMIT ?", (total - keep,)
+            ).fetchall()]
+            self._conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(sid,) for sid in evicted])
+            return evicted
+
+    def close(self):
+        with self._lock:
+            try:
+                self._conn.close()
+            except Exception as e:
+                logger.debug(f"关闭会话数据库失败: {e}")
+
+
+def create_session_backend(backend: str = "sqlite", db_path: str = DEFAULT_DB_PATH) -> SessionBackend:
+    """创建会话后端，SQLite不可用时退回内存后端"""
+    if backend == "sqlite":
+        try:
+            return SQLiteSessionBackend(db_path)
+        except Exception as e:
+            logger.error(f"SQLite会话存储初始化失败，改用内存存储: {e}")
+    return MemorySessionBackend()
@@ -8,7 +8,10 @@
 import re
 import json
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Callable, Optional
+
+from .context_builder import get_context_builder
+from .native_tools import NativeToolset, ToolCallDeltaAccumulator, execute_native_tool_calls
 
 logger = logging.getLogger("ToolCallUtils")
 
@@ -59,67 +62,25 @@ def parse_tool_calls(content: str) -> list:
     return tool_calls
 
 async def execute_tool_calls(tool_calls: list, mcp_manager) -> str:
-    """执行工具调用"""
-    results = []
+    """执行工具调用：相互独立的调用并发执行，结果按原始顺序拼接"""
+    from mcpserver.tool_scheduler import get_tool_scheduler
     for i, tool_call in enumerate(tool_calls):
-        try:
-            print(f"[DEBUG] 开始执行工具调用{i+1}: {tool_call['name']}")
-            
-            tool_name = tool_call['name']
-            args = tool_call['args']
-            agent_type = args.get('agentType', 'mcp').lower()
-            
-            print(f"[DEBUG] 工具类型: {agent_type}, 参数: {args}")
-            
-            if agent_type == 'agent':
-                try:
-                    from mcpserver.agent_manager import get_agent_manager
-                    agent_manager = get_agent_manager()
-                    
-                    agent_name = args.get('agent_name')
-                    prompt = args.get('prompt')
-                    
-                    print(f"[DEBUG] Agent调用: {agent_name}, prompt: {prompt}")
-                    
-                    if not agent_name or not prompt:
-                        result = "Agent调用失败: 缺少agent_name或prompt参数"
-                    else:
-                        result = await agent_manager.call_agent(agent_name, prompt)
-                        if result.get("status") == "success":
-                            result = result.get("result", "")
-                        else:
-                            result = f"Agent调用失败: {result.get('error', '未知错误')}"
-                            
-                except Exception as e:
-                    result = f"Agent调用失败: {str(e)}"
-                    
-            else:
-                service_name = args.get('service_name')
-                actual_tool_name = args.get('tool_name', tool_name)
-                tool_args = {k: v for k, v in args.items() 
-                           if k not in ['service_name', 'agentType']}
-                
-                print(f"[DEBUG] MCP调用: service={service_name}, tool={actual_tool_name}, args={tool_args}")
-                
-                if not service_name:
-                    result = "MCP调用失败: 缺少service_name参数"
-                else:
-                    result = await mcp_manager.unified_call(
-                    service_name=service_name,
-                    tool_name=actual_tool_name,
-                    args=tool_args
-                )
-            
-            print(f"[DEBUG] 工具调用{i+1}执行结果: {result}")
-            results.append(f"来自工具 \"{tool_name}\" 的结果:\n{result}")
-        except Exception as e:
-            error_result = f"执行工具 {tool_call['name']} 时发生错误：{str(e)}"
-            print(f"[DEBUG] 工具调用{i+1}执行异常: {error_result}")
-            results.append(error_result)
+        print(f"[DEBUG] 开始执行工具调用{i+1}: {tool_call['name']}")
+    records = await get_tool_scheduler().execute(tool_calls, mcp_manager)
+    results = []
+    for record in records:
+        if record['status'] == 'success':
+            results.append(f"来自工具 \"{record['name']}\" 的结果:\n{record['result']}")
+        else:
+            results.append(record['result'])
     return "\n\n---\n\n".join(results)
 
-async def tool_call_loop(messages: List[Dict], mcp_manager, llm_caller, is_streaming: bool = False, max_recursion: int = None) -> Dict:
-    """工具调用循环主流程"""
+async def tool_call_loop(messages: List[Dict], mcp_manager, llm_caller, is_streaming: bool = False, max_recursion: int = None,
+                         toolset: Optional[NativeToolset] = None) -> Dict:
+    """工具调用循环主流程
+    
+    toolset不为空时使用原生函数调用协议：llm_caller(messages, tools=...)返回的tool_calls直接执行，结果以tool消息回传
+    """
     if max_recursion is None:
         # 默认配置
         max_recursion = 5 if is_streaming else 5
@@ -130,13 +91,19 @@ async def tool_call_loop(messages: List[Dict], mcp_manager, llm_caller, is_strea
     
     while recursion_depth < max_recursion:
         try:
-            resp = await llm_caller(current_messages)
-            current_ai_content = resp.get('content', '')
+            if toolset is not None:
+                resp = await llm_caller(current_messages, tools=toolset.tools)
+            else:
+                resp = await llm_caller(current_messages)
+            current_ai_content = resp.get('content') or ''
             
             print(f"[DEBUG] 第{recursion_depth + 1}轮LLM回复:")
             print(f"[DEBUG] 回复内容: {current_ai_content}")
             
-            tool_calls = parse_tool_calls(current_ai_content)
+            if toolset is not None:
+                tool_calls = toolset.parse(resp.get('tool_calls'), recursion_depth)
+            else:
+                tool_calls = parse_tool_calls(current_ai_content)
             print(f"[DEBUG] 解析到工具调用数量: {len(tool_calls)}")
             
             if not tool_calls:
@@ -146,9 +113,7 @@ async def tool_call_loop(messages: List[Dict], mcp_manager, llm_caller, is_strea
             for i, tool_call in enumerate(tool_calls):
                 print(f"[DEBUG] 工具调用{i+1}: {tool_call}")
             
-            tool_results = await execute_tool_calls(tool_calls, mcp_manager)
-            current_messages.append({'role': 'assistant', 'content': current_ai_content})
-            current_messages.append({'role': 'user', 'content': tool_results})
+            await _append_tool_results(current_messages, current_ai_content, tool_calls, mcp_manager, toolset)
             recursion_depth += 1
         except Exception as e:
             print(f"工具调用循环错误: {e}")
@@ -158,4 +123,121 @@ async def tool_call_loop(messages: List[Dict], mcp_manager, llm_caller, is_strea
         'content': current_ai_content,
         'recursion_depth': recursion_depth,
         'messages': current_messages
-    } 
\ No newline at end of file
+    } 
+
+async def _append_tool_results(messages: List[Dict], content: str, tool_calls: list, mcp_manager,
+                               toolset: Optional[NativeToolset]):
+    """执行工具调用并把本轮回复和结果追加到消息列表（结果按上下文剩余预算截断）"""
+    builder = get_context_builder()
+    if toolset is not None:
+        messages.append(toolset.assistant_message(content, tool_calls))
+        results = await execute_native_tool_calls(tool_calls, mcp_manager)
+        fitted = builder.fit_tool_results(messages, [msg['content'] for msg in results])
+        messages.extend({**msg, 'content': text} for msg, text in zip(results, fitted))
+        return
+    tool_results = await execute_tool_calls(tool_calls, mcp_manager)
+    messages.append({'role': 'assistant', 'content': content})
+    messages.append({'role': 'user', 'content': builder.fit_tool_results(messages, [tool_results])[0]})
+
+class ToolCallStreamSplitter:
+    """流式增量拆分器：纯文本立即放行，｛...｝块在本地缓冲，闭合后不是合法工具调用的块作为文本放行"""
+    
+    OPEN = '｛'
+    CLOSE = '｝'
+    
+    def __init__(self):
+        self.content = ''  # 本轮完整回复（含工具调用块）
+        self._depth = 0  # 当前工具调用块嵌套深度
+        self._block = ''  # 缓冲中的工具调用块
+    
+    def feed(self, delta: str) -> str:
+        """输入增量，返回可立即转发给用户的文本"""
+        if not delta:
+            return ''
+        self.content += delta
+        out = []
+        for ch in delta:
+            if self._depth:
+                self._block += ch
+                if ch == self.OPEN:
+                    self._depth += 1
+                elif ch == self.CLOSE:
+                    self._depth -= 1
+                    if not self._depth:
+                        # 合法工具调用由parse_tool_calls处理，其余（如正文中的全角括号）原样放行
+                        if not parse_tool_calls(self._block):
+                            out.append(self._block)
+                        self._block = ''
+            elif ch == self.OPEN:
+                self._depth = 1
+                self._block = ch
+            else:
+                out.append(ch)
+        return ''.join(out)
+    
+    def flush(self) -> str:
+        """流结束：未闭合的块不是合法工具调用，原样放行"""
+        tail, self._block, self._depth = self._block, '', 0
+        return tail
+
+async def tool_call_loop_stream(messages: List[Dict], mcp_manager, llm_stream_caller: Callable[[List[Dict]], AsyncIterator[str]], max_recursion: int = None,
+                                toolset: Optional[NativeToolset] = None):
+    """流式工具调用循环，逐块产出事件：
+    toolset不为空时使用原生函数调用协议：llm_stream_caller(messages, tools=...)产出文本增量或{'tool_calls': [增量]}，
+    文本直接放行，tool_calls增量按index合并
+    - {'type': 'text', 'content': 增量文本}
+    - {'type': 'tool_calls', 'tool_calls': [...], 'recursion_depth': n}
+    - {'type': 'done', 'content': 最后一轮完整回复, 'recursion_depth': n, 'messages': [...]}
+    """
+    if max_recursion is None:
+        max_recursion = 5
+    
+    recursion_depth = 0
+    current_messages = messages.copy()
+    current_ai_content = ''
+    
+    while recursion_depth < max_recursion:
+        splitter = ToolCallStreamSplitter()
+        accumulator = ToolCallDeltaAccumulator()
+        try:
+            if toolset is not None:
+                async for delta in llm_stream_caller(current_messages, tools=toolset.tools):
+                    if isinstance(delta, dict):
+                        accumulator.add(delta.get('tool_calls'))
+                    elif delta:
+                        splitter.content += delta
+                        yield {'type': 'text', 'content': delta}
+            else:
+                async for delta in llm_stream_caller(current_messages):
+                    text = splitter.feed(delta)
+                    if text:
+                        yield {'type': 'text', 'content': text}
+                tail = splitter.flush()
+                if tail:
+                    yield {'type': 'text', 'content': tail}
+            current_ai_content = splitter.content
+            
+            print(f"[DEBUG] 第{recursion_depth + 1}轮LLM流式回复完成，长度: {len(current_ai_content)}")
+            
+            if toolset is not None:
+                tool_calls = toolset.parse(accumulator.result(), recursion_depth)
+            else:
+                tool_calls = parse_tool_calls(current_ai_content)
+            if not tool_calls:
+                print("[DEBUG] 无工具调用，退出循环")
+                break
+            
+            yield {'type': 'tool_calls', 'tool_calls': tool_calls, 'recursion_depth': recursion_depth + 1}
+            await _append_tool_results(current_messages, current_ai_content, tool_calls, mcp_manager, toolset)
+            recursion_depth += 1
+        except Exception as e:
+            print(f"流式工具调用循环错误: {e}")
+            current_ai_content = current_ai_content or splitter.content
+            break
+    
+    yield {
+        'type': 'done',
+        'content': current_ai_content,
+        'recursion_depth': recursion_depth,
+        'messages': current_messages
+    }
@@ -50,6 +50,10 @@ class SystemConfig(BaseModel):
     stream_mode: bool = Field(default=True, description="是否启用流式响应")
     debug: bool = Field(default=False, description="是否启用调试模式")
     log_level: str = Field(default="INFO", description="日志级别")
+    save_prompts: bool = Field(default=False, description="是否保存发送给LLM的prompt日志")
+    prompt_log_max_mb: float = Field(default=20.0, ge=1.0, le=1024.0, description="单个prompt日志文件大小上限（MB），超过后切分并压缩")
+    prompt_log_queue_size: int = Field(default=1000, ge=10, le=100000, description="prompt日志写入队列长度，队列满时丢弃")
+    prompt_log_fsync_interval: float = Field(default=1.0, ge=0.1, le=60.0, description="prompt日志fsync合并间隔（秒）")
 
     @field_validator('log_level')
     @classmethod
@@ -68,10 +72,33 @@ class APIConfig(BaseModel):
     temperature: float = Field(default=0.7, ge=0.0, le=2.0, description="温度参数")
     max_tokens: int = Field(default=2000, ge=1, le=8192, description="最大token数")
     max_history_rounds: int = Field(default=10, ge=1, le=100, description="最大历史轮数")
+    # 上下文token预算
+    context_max_tokens: int = Field(default=32768, ge=0, le=1048576, description="上下文窗口token上限，0表示按历史轮数截取")
+    context_completion_reserve: Optional[int] = Field(default=None, ge=0, le=65536, description="为回复预留的token数，默认等于max_tokens")
+    tokenizer_encoding: str = Field(default="cl100k_base", description="本地计数使用的tiktoken编码")
+    prompt_layout: str = Field(default="prefix_cache", description="系统提示词布局：prefix_cache（稳定内容在前，时间/城市附在当前用户消息开头）/legacy")
     # 额外可选参数
     top_p: Optional[float] = Field(default=None, ge=0.0, le=1.0, description="Top-p采样参数")
     timeout: Optional[int] = Field(default=None, ge=1, le=300, description="请求超时时间")
     retry_count: Optional[int] = Field(default=None, ge=0, le=10, description="重试次数")
+    # LLM连接池配置
+    http2: bool = Field(default=True, description="安装h2时启用HTTP/2")
+    pool_max_connections: int = Field(default=20, ge=1, le=200, description="每个base_url的最大连接数")
+    pool_max_keepalive: int = Field(default=10, ge=0, le=200, description="每个base_url保持的空闲长连接数")
+    pool_keepalive_expiry: float = Field(default=30.0, ge=1.0, le=600.0, description="空闲长连接保持时间（秒）")
+    connect_timeout: float = Field(default=10.0, ge=1.0, le=60.0, description="建立连接超时（秒）")
+    # 全局LLM请求调度
+    scheduler_enabled: bool = Field(default=True, description="是否启用全局LLM请求调度（优先级通道+令牌桶限流）")
+    rpm_limit: int = Field(default=0, ge=0, le=100000, description="每分钟请求数上限，0表示不限")
+    tpm_limit: int = Field(default=0, ge=0, le=100000000, description="每分钟token数上限，0表示不限")
+    max_concurrent_requests: int = Field(default=8, ge=1, le=256, description="同时进行的LLM请求数上限")
+    scheduler_lane_limits: Dict[str, int] = Field(default_factory=lambda: {"thinking": 3, "background": 2}, description="各通道并发上限（interactive/agent/thinking/background）")
+    rate_limit_retries: int = Field(default=3, ge=0, le=10, description="收到429后的重试次数")
+    rate_limit_backoff: float = Field(default=1.0, ge=0.1, le=60.0, description="429退避初始时间（秒），无Retry-After时按指数增长")
+    rate_limit_backoff_max: float = Field(default=30.0, ge=1.0, le=600.0, description="429退避最长时间（秒）")
+    # 工具调用协议
+    tool_protocol: str = Field(default="text", description="工具调用协议：text（系统提示词中的｛...｝文本格式）/native（OpenAI tools函数调用）")
+    tool_protocol_backends: Dict[str, str] = Field(default_factory=dict, description="按后端覆盖工具调用协议，键为模型名或base_url，值为text/native")
 
     @field_validator('api_key')
     @classmethod
@@ -83,6 +110,21 @@ class APIConfig(BaseModel):
                 raise ValueError("API密钥包含非ASCII字符")
         return v
 
+    @field_validator('tool_protocol')
+    @classmethod
+    def validate_tool_protocol(cls, v):
+        if v not in ("text", "native"):
+            raise ValueError("tool_protocol必须为text或native")
+        return v
+
+    @field_validator('tool_protocol_backends')
+    @classmethod
+    def validate_tool_protocol_backends(cls, v):
+        for key, protocol in v.items():
+            if protocol not in ("text", "native"):
+                raise ValueError(f"tool_protocol_backends[{key}]必须为text或native")
+        return v
+
     @property
     def model_name(self) -> str:
         """兼容旧版本的模型名称属性"""
@@ -96,6 +138,12 @@ class APIServerConfig(BaseModel):
     port: int = Field(default=8000, ge=1, le=65535, description="API服务器端口")
     auto_start: bool = Field(default=True, description="启动时自动启动API服务器")
     docs_enabled: bool = Field(default=True, description="是否启用API文档")
+    session_backend: str = Field(default="sqlite", description="会话存储后端：sqlite/memory")
+    session_db_path: str = Field(default="logs/sessions.db", description="SQLite会话数据库路径")
+    session_cache_size: int = Field(default=200, ge=1, le=100000, description="内存中保留的活跃会话数")
+    max_sessions: int = Field(default=1000, ge=1, le=1000000, description="最多保存的会话数，超出时淘汰最久未活跃的会话")
+    session_ttl_hours: float = Field(default=24, gt=0, le=8760, description="会话过期时间（小时）")
+    session_flush_interval: float = Field(default=2.0, ge=0.1, le=60.0, description="会话写回间隔（秒）")
 
 
 class GRAGConfig(BaseModel):
@@ -108,13 +156,35 @@ class GRAGConfig(BaseModel):
     neo4j_user: str = Field(default="neo4j", description="Neo4j用户名")
     neo4j_password: str = Field(default="X9!m#K2@dL6qR8", description="Neo4j密码")
     neo4j_database: str = Field(default="neo4j", description="Neo4j数据库名")
+    graph_backend: str = Field(default="neo4j", description="图谱后端: neo4j/embedded/memory")
+    graph_backend_fallback: bool = Field(default=True, description="Neo4j不可用时降级为嵌入式后端")
+    embedded_snapshot_path: str = Field(default="logs/knowledge_graph/graph.snapshot", description="嵌入式图谱快照路径")
+    local_keyword_match: bool = Field(default=True, description="记忆召回优先使用本地实体/关系匹配，未命中再调用LLM提取关键词")
+    matcher_min_term_len: int = Field(default=2, ge=1, le=10, description="本地匹配词表的最短词长")
+    neo4j_pool_size: int = Field(default=10, ge=1, le=100, description="Neo4j驱动连接池大小")
+    neo4j_connect_timeout: float = Field(default=5.0, ge=0.5, le=60.0, description="Neo4j连接/获取连接超时（秒）")
+    neo4j_query_timeout: float = Field(default=10.0, ge=1.0, le=300.0, description="Neo4j单次事务超时（秒）")
+    neo4j_batch_size: int = Field(default=500, ge=1, le=10000, description="单个写事务最多写入的五元组数")
     
     # 任务管理器配置
     task_manager_enabled: bool = Field(default=True, description="是否启用任务管理器")
     max_workers: int = Field(default=3, ge=1, le=10, description="最大并发工作线程数")
     max_queue_size: int = Field(default=100, ge=10, le=1000, description="最大任务队列大小")
+    interactive_workers: int = Field(default=1, ge=0, le=5, description="只处理记忆召回等交互任务的专用工作协程数")
+    submit_timeout: float = Field(default=5.0, ge=0.0, le=120.0, description="提取队列已满时提交任务的最长等待时间（秒）")
     task_timeout: int = Field(default=30, ge=5, le=300, description="单个任务超时时间（秒）")
     auto_cleanup_hours: int = Field(default=24, ge=1, le=168, description="自动清理任务保留时间（小时）")
+    extraction_batch_enabled: bool = Field(default=True, description="多轮对话合并为一次请求批量提取五元组")
+    extraction_batch_max_turns: int = Field(default=8, ge=1, le=32, description="单批最多合并的对话轮数（1等同逐轮提取）")
+    extraction_batch_window: float = Field(default=30.0, ge=0.0, le=3600.0, description="批次未满时最长等待时间（秒）")
+    extraction_batch_max_chars: int = Field(default=6000, ge=500, le=100000, description="单批输入文本字符上限")
+    extraction_max_tokens: int = Field(default=2000, ge=200, le=8192, description="批量提取回复的token上限")
+    extraction_batch_timeout: float = Field(default=120.0, ge=10.0, le=600.0, description="单批提取（含拆分重试）的超时时间（秒）")
+    
+    # 五元组存储配置
+    store_compact_ratio: float = Field(default=2.0, ge=1.1, le=10.0, description="日志行数超过唯一五元组数的该倍数时压缩")
+    store_compact_min_lines: int = Field(default=1000, ge=100, description="触发压缩的最少日志行数")
+    store_fsync: bool = Field(default=False, description="每次追加写入后是否fsync")
     
     # 兼容旧版本的字段
     extraction_timeout: Optional[int] = Field(default=None, description="提取超时时间（秒）")
@@ -163,6 +233,27 @@ class MCPConfig(BaseModel):
         default=True,
         description="从MCP服务中排除已注册为Agent的服务"
     )
+    
+    # 工具调用并发调度
+    max_concurrent_tool_calls: int = Field(default=8, ge=1, le=64, description="单轮工具调用最大并发数")
+    tool_call_timeout: float = Field(default=0.0, ge=0.0, le=3600.0,
+                                     description="单次工具调用超时（秒），0表示不限制（漫画下载等长任务可能运行数分钟）；可用service_timeouts按服务设置")
+    service_concurrency: Dict[str, int] = Field(
+        default={"PlaywrightAgent": 1},
+        description="按服务的并发上限（如浏览器自动化同一时刻只允许一个动作）"
+    )
+    service_timeouts: Dict[str, float] = Field(
+        default={},
+        description="按服务覆盖的调用超时（秒）"
+    )
+    
+    # 工具结果缓存（可缓存命令及TTL在agent-manifest.json的invocationCommands或capabilities.cachePolicy中声明）
+    result_cache_enabled: bool = Field(default=True, description="是否启用工具结果缓存")
+    result_cache_size: int = Field(default=256, ge=1, le=10000, description="工具结果缓存最大条目数")
+    
+    # MCP Agent加载
+    lazy_agent_loading: bool = Field(default=True, description="启动时只解析manifest，Agent在首次调用或后台预热时才实例化")
+    warmup_workers: int = Field(default=4, ge=0, le=32, description="后台预热Agent的线程数，0表示不预热")
 
 
 class BrowserConfig(BaseModel):
@@ -295,6 +386,8 @@ class ScoringConfig(BaseModel):
     penalty_for_similar: int = Field(default=1, ge=0, le=3, description="相似结果的惩罚分数")
     min_results_required: int = Field(default=2, ge=1, le=10, description="最少保留结果数量")
     strict_filtering: bool = Field(default=True, description="严格过滤模式")
+    fallback_concurrency: int = Field(default=3, ge=1, le=10, description="批量评分解析失败时逐条评分的并发数")
+    score_cache_size: int = Field(default=1024, ge=0, le=100000, description="评分缓存条数（按内容哈希和偏好）")
 
 
 class ThinkingConfig(BaseModel):
@@ -445,6 +538,14 @@ Agent服务：
         description="娜迦系统提示词"
     )
 
+    native_tool_prompt: str = Field(
+        default="""【工具调用】
+需要执行具体操作时（查询天气/时间、打开应用、控制设备等），直接调用提供的函数，不要在回复中输出｛...｝格式的调用。
+- Agent任务使用call_agent函数，agent_name为Agent名称，prompt为本次任务内容
+- 天气/时间查询的city参数使用当前环境信息中的本地城市""",
+        description="原生函数调用协议下替代工具调用格式说明和服务列表的提示词"
+    )
+
     next_question_prompt: str = Field(
         default="""你是一个问题设计专家，根据当前不完整的思考结果，设计下一级需要深入思考的核心问题。
 要求：
@@ -532,6 +633,8 @@ class NagaConfig(BaseModel):
             "penalty_for_similar": self.scoring.penalty_for_similar,
             "min_results_required": self.scoring.min_results_required,
             "strict_filtering": self.scoring.strict_filtering,
+            "fallback_concurrency": self.scoring.fallback_concurrency,
+            "score_cache_size": self.scoring.score_cache_size,
         }
 
     @property
@@ -12,13 +12,17 @@ import json
 import traceback
 import time # 时间戳打印
 import re # 添加re模块导入
-from typing import List, Dict # 修复List未导入
+from typing import List, Dict, Optional # 修复List未导入
 # 恢复树状思考系统导入
 from thinking import TreeThinkingEngine # 树状思考引擎
+from thinking.speculative import SpeculativeThinking # 推测式深度思考
 from thinking.config import COMPLEX_KEYWORDS # 复杂关键词
 from config import config
 # 导入独立的工具调用模块
-from apiserver.tool_call_utils import parse_tool_calls, execute_tool_calls, tool_call_loop
+from apiserver.tool_call_utils import parse_tool_calls, execute_tool_calls, tool_call_loop, tool_call_loop_stream
+from apiserver.context_builder import get_context_builder, with_context # token预算上下文组装
+from apiserver.llm_scheduler import get_llm_scheduler, estimate_tokens, is_rate_limit_error # 全局LLM请求调度
+from apiserver.native_tools import NATIVE_PROTOCOL, resolve_tool_protocol, get_native_toolset, native_system_prompt, measure_prompt_savings, record_turn # 原生函数调用协议
 
 # Live2D模块导入
 try:
@@ -70,10 +74,36 @@ _MCP_SERVICES_INITIALIZED=False
 
 _VOICE_ENABLED_LOGGED=False
 
+# 系统提示词缓存：键为(注册表版本号, 布局, 时间槽)，服务列表不变时直接复用（prefix_cache布局不含时间槽）
+_SYSTEM_PROMPT_CACHE = {"key": None, "prompt": None, "native": None}
+_STABLE_CITY_HINT = "（填写当前环境信息中的本地城市）" # prefix_cache布局下工具示例中的city占位
+_LOCAL_CITY = None # 本地城市只在首次使用时解析一次（WeatherTimeTool初始化会发起网络请求）
+
+def _get_local_city() -> str:
+    """获取本地城市（进程内缓存）"""
+    global _LOCAL_CITY
+    if _LOCAL_CITY is None:
+        try:
+            from mcpserver.agent_weather_time.agent_weather_time import WeatherTimeTool
+            _LOCAL_CITY = getattr(WeatherTimeTool(), '_local_city', '') or '未知城市'
+        except Exception as e:
+            print(f"[DEBUG] 获取本地城市失败: {e}")
+            _LOCAL_CITY = '未知城市'
+    return _LOCAL_CITY
+
+def _prompt_time_slot() -> str:
+    """系统提示词中的时间精度（分钟），同时作为缓存时间槽"""
+    return datetime.now().strftime('%Y-%m-%d %H:%M')
+
+def _prefix_cache_layout() -> bool:
+    """是否使用前缀缓存友好的提示词布局"""
+    return getattr(config.api, 'prompt_layout', 'prefix_cache') != 'legacy'
+
 class NagaConversation: # 对话主类
     def __init__(self):
         self.mcp = get_mcp_manager()
         self.messages = []
+        self.last_context_report = {} # 最近一轮上下文token用量
         self.dev_mode = False
         self.client = OpenAI(api_key=config.api.api_key, base_url=config.api.base_url.rstrip('/') + '/')
         self.async_client = AsyncOpenAI(api_key=config.api.api_key, base_url=config.api.base_url.rstrip('/') + '/')
@@ -165,47 +195,53 @@ class NagaConversation: # 对话主类
         except Exception as e:
             logger.error(f"保存日志失败: {e}")
     
+    def _max_history_messages(self) -> int:
+        """历史消息条数上限（每轮包含用户和助手各一条）"""
+        return config.api.max_history_rounds * 2
+    
     def add_message(self, role: str, content: str):
         """添加消息到对话历史"""
         self.messages.append({"role": role, "content": content})
         
         # 限制历史消息数量，避免内存泄漏
-        max_messages = 20
+        max_messages = self._max_history_messages()
         if len(self.messages) > max_messages:
             self.messages = self.messages[-max_messages:]
 
-    async def _call_llm(self, messages: List[Dict]) -> Dict:
-        """调用LLM API"""
+    async def _create_completion(self, **params):
+        """创建补全请求，连接已关闭时重建客户端重试一次"""
         try:
-            resp = await self.async_client.chat.completions.create(
+            return await self.async_client.chat.completions.create(**params)
+        except RuntimeError as e:
+            if "handler is closed" not in str(e):
+                raise
+            logger.debug(f"忽略连接关闭异常，重新创建客户端: {e}")
+            self.async_client = AsyncOpenAI(api_key=config.api.api_key, base_url=config.api.base_url.rstrip('/') + '/')
+            return await self.async_client.chat.completions.create(**params)
+
+    async def _call_llm(self, messages: List[Dict], tools: Optional[List[Dict]] = None) -> Dict:
+        """调用LLM API（经全局调度器排队，通道默认为交互对话），tools不为空时使用原生函数调用"""
+        try:
+            params = dict(
                 model=config.api.model, 
                 messages=messages, 
                 temperature=config.api.temperature, 
                 max_tokens=config.api.max_tokens, 
                 stream=False  # 工具调用循环中不使用流式
             )
+            if tools:
+                params["tools"] = tools
+            resp = await get_llm_scheduler().run(
+                self._create_completion,
+                tokens=estimate_tokens(messages, config.api.max_tokens),
+                **params
+            )
+            message = resp.choices[0].message
             return {
-                'content': resp.choices[0].message.content,
+                'content': message.content,
+                'tool_calls': [tc.model_dump() for tc in message.tool_calls] if getattr(message, 'tool_calls', None) else None,
                 'status': 'success'
             }
-        except RuntimeError as e:
-            if "handler is closed" in str(e):
-                logger.debug(f"忽略连接关闭异常: {e}")
-                # 重新创建客户端并重试
-                self.async_client = AsyncOpenAI(api_key=config.api.api_key, base_url=config.api.base_url.rstrip('/') + '/')
-                resp = await self.async_client.chat.completions.create(
-                    model=config.api.model, 
-                    messages=messages, 
-                    temperature=config.api.temperature, 
-                    max_tokens=config.api.max_tokens, 
-                    stream=False
-                )
-                return {
-                    'content': resp.choices[0].message.content,
-                    'status': 'success'
-                }
-            else:
-                raise
         except Exception as e:
             logger.error(f"LLM API调用失败: {e}")
             return {
@@ -213,6 +249,48 @@ class NagaConversation: # 对话主类
                 'status': 'error'
             }
 
+    async def _call_llm_stream(self, messages: List[Dict], tools: Optional[List[Dict]] = None):
+        """流式调用LLM API，逐块产出文本增量（流式输出期间占用调度配额）
+        
+        tools不为空时使用原生函数调用，tool_calls增量以{'tool_calls': [...]}产出
+        """
+        params = dict(
+            model=config.api.model,
+            messages=messages,
+            temperature=config.api.temperature,
+            max_tokens=config.api.max_tokens,
+            stream=True
+        )
+        if tools:
+            params["tools"] = tools
+        scheduler = get_llm_scheduler()
+        tokens = estimate_tokens(messages, config.api.max_tokens)
+        attempt = 0
+        while True:
+            # 直接申请/归还配额而不用slot()：生成器跨yield挂起，不在其Context中标记持有配额
+            ticket = await scheduler.acquire(tokens=tokens)
+            try:
+                try:
+                    stream = await self._create_completion(**params)
+                except Exception as e:
+                    if not is_rate_limit_error(e) or ticket.reentrant or attempt >= scheduler.max_retries:
+                        raise
+                    # 尚未输出内容，归还配额，等调度器退避后重试
+                    ticket.rate_limited(e)
+                    attempt += 1
+                    continue
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta and delta.content:
+                        yield delta.content
+                    if delta and getattr(delta, 'tool_calls', None):
+                        yield {'tool_calls': [tc.model_dump() for tc in delta.tool_calls]}
+                return
+            finally:
+                scheduler.release(ticket)
+
     # 工具调用循环相关方法
     def handle_llm_response(self, a, mcp):
         # 只保留普通文本流式输出逻辑 #
@@ -221,25 +299,20 @@ class NagaConversation: # 对话主类
                 yield ("娜迦", line)
         return text_stream()
 
-    def _format_services_for_prompt(self, available_services: dict) -> str:
-        """格式化可用服务列表为prompt字符串，MCP服务和Agent服务分开，包含具体调用格式"""
+    def _format_services_for_prompt(self, available_services: dict, stable: bool = False) -> str:
+        """格式化可用服务列表为prompt字符串，MCP服务和Agent服务分开，包含具体调用格式
+        
+        stable=True时按名称排序、不注入城市和时间，保证服务不变时输出逐字节一致
+        """
         mcp_services = available_services.get("mcp_services", [])
         agent_services = available_services.get("agent_services", [])
+        if stable:
+            mcp_services = sorted(mcp_services, key=lambda s: s.get("name", ""))
+            agent_services = sorted(agent_services, key=lambda s: s.get("name", ""))
         
-        # 获取本地城市信息和当前时间
-        local_city = "未知城市"
-        current_time = ""
-        try:
-            # 从WeatherTimeAgent获取本地城市信息
-            from mcpserver.agent_weather_time.agent_weather_time import WeatherTimeTool
-            weather_tool = WeatherTimeTool()
-            local_city = getattr(weather_tool, '_local_city', '未知城市') or '未知城市'
-            
-            # 获取当前时间
-            from datetime import datetime
-            current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        except Exception as e:
-            print(f"[DEBUG] 获取本地信息失败: {e}")
+        # 获取本地城市信息和当前时间（城市已缓存，时间精确到分钟以便复用提示词缓存）
+        local_city = _STABLE_CITY_HINT if stable else _get_local_city()
+        current_time = _prompt_time_slot()
         
         # 格式化MCP服务列表，包含具体调用格式
         mcp_list = []
@@ -315,6 +388,8 @@ class NagaConversation: # 对话主类
             from mcpserver.agent_manager import get_agent_manager
             agent_manager = get_agent_manager()
             agent_manager_agents = agent_manager.get_available_agents()
+            if stable:
+                agent_manager_agents = sorted(agent_manager_agents, key=lambda a: a.get("base_name", ""))
             
             for agent in agent_manager_agents:
                 name = agent.get("name", "")
@@ -331,8 +406,8 @@ class NagaConversation: # 对话主类
             # 如果AgentManager不可用，静默处理
             pass
         
-        # 添加本地信息说明
-        local_info = f"\n\n【当前环境信息】\n- 本地城市: {local_city}\n- 当前时间: {current_time}\n\n【使用说明】\n- 天气/时间查询时，请使用上述本地城市信息作为city参数\n- 所有时间相关查询都基于当前系统时间"
+        # 添加本地信息说明（prefix_cache布局下改为附在当前用户消息开头的环境信息）
+        local_info = "" if stable else f"\n\n【当前环境信息】\n- 本地城市: {local_city}\n- 当前时间: {current_time}\n\n【使用说明】\n- 天气/时间查询时，请使用上述本地城市信息作为city参数\n- 所有时间相关查询都基于当前系统时间"
         
         # 返回格式化的服务列表
         result = {
@@ -342,6 +417,59 @@ class NagaConversation: # 对话主类
         
         return result
 
+    def get_system_prompt(self, native: bool = False) -> str:
+        """获取渲染后的系统提示词
+        
+        prefix_cache布局：只含人设、工具协议和服务列表，按注册表版本号缓存，服务不变时逐字节一致；
+        legacy布局：服务列表后附带城市和时间，按(注册表版本号, 时间槽)缓存；
+        native=True：原生函数调用协议，服务目录改由tools参数发送，只含人设和函数调用说明
+        """
+        if native:
+            if _SYSTEM_PROMPT_CACHE["native"] is None:
+                _SYSTEM_PROMPT_CACHE["native"] = native_system_prompt(
+                    f"{RECOMMENDED_PROMPT_PREFIX}\n{config.prompts.naga_system_prompt}", config.prompts.native_tool_prompt
+                )
+            return _SYSTEM_PROMPT_CACHE["native"]
+        from mcpserver.mcp_registry import get_registry_generation
+        stable = _prefix_cache_layout()
+        cache_key = (get_registry_generation(), "prefix_cache" if stable else _prompt_time_slot())
+        if _SYSTEM_PROMPT_CACHE["key"] == cache_key:
+            return _SYSTEM_PROMPT_CACHE["prompt"]
+        
+        # 添加handoff提示词
+        system_prompt = f"{RECOMMENDED_PROMPT_PREFIX}\n{config.prompts.naga_system_prompt}"
+        available_services = self.mcp.get_available_services_filtered()
+        services_text = self._format_services_for_prompt(available_services, stable=stable)
+        prompt = system_prompt.format(**services_text)
+        
+        _SYSTEM_PROMPT_CACHE["key"] = cache_key
+        _SYSTEM_PROMPT_CACHE["prompt"] = prompt
+        return prompt
+
+    def get_native_toolset(self):
+        """当前后端使用原生函数调用协议时返回工具定义，否则返回None"""
+        if resolve_tool_protocol() != NATIVE_PROTOCOL:
+            return None
+        return get_native_toolset(self.mcp)
+    
+    def record_native_turn(self, toolset, requests: int = 1) -> Optional[Dict]:
+        """记录原生协议本轮相对文本协议节省的提示词token数"""
+        if toolset is None:
+            return None
+        try:
+            savings = measure_prompt_savings(self.get_system_prompt(), self.get_system_prompt(native=True), toolset)
+            return record_turn(savings, requests)
+        except Exception as e:
+            logger.debug(f"统计提示词节省失败: {e}")
+            return None
+
+    def get_context_message(self) -> Optional[str]:
+        """环境信息（本地城市和当前时间），附在当前用户消息开头；legacy布局下已包含在系统提示词中，返回None"""
+        if not _prefix_cache_layout():
+            return None
+        return (f"【当前环境信息】\n- 本地城市: {_get_local_city()}\n- 当前时间: {_prompt_time_slot()}\n"
+                f"- 天气/时间查询时，请使用上述本地城市作为city参数；时间相关查询都基于当前时间")
+
     async def process(self, u, is_voice_input=False):  # 添加is_voice_input参数
         try:
             # 开发者模式优先判断
@@ -367,41 +495,39 @@ class NagaConversation: # 对话主类
             #     except Exception as e:
             #         logger.error(f"GRAG记忆查询失败: {e}")
             
-            # 添加handoff提示词
-            system_prompt = f"{RECOMMENDED_PROMPT_PREFIX}\n{config.prompts.naga_system_prompt}"
-            
-            # 获取过滤后的服务列表
-            available_services = self.mcp.get_available_services_filtered()
-            services_text = self._format_services_for_prompt(available_services)
+            # 系统提示词（含handoff提示词和服务列表，已缓存）和附在当前消息开头的环境信息
+            # 原生函数调用协议下服务目录改由tools参数发送
+            toolset = self.get_native_toolset()
+            system_prompt = self.get_system_prompt(native=toolset is not None)
+            context_message = self.get_context_message()
             
-            # 简化的消息拼接逻辑（UI界面使用）
-            sysmsg = {"role": "system", "content": system_prompt.format(**services_text)}
-            msgs = [sysmsg] if sysmsg else []
-            msgs += self.messages[-20:] + [{"role": "user", "content": u}]
+            # 按token预算拼接消息（UI界面使用）
+            builder = get_context_builder()
+            if builder.max_context_tokens > 0:
+                msgs, self.last_context_report = builder.build(
+                    system_prompt, self.messages, u, max_history_messages=self._max_history_messages(),
+                    context_message=context_message
+                )
+            else:
+                msgs = [{"role": "system", "content": system_prompt}]
+                msgs += self.messages[-self._max_history_messages():]
+                msgs.append({"role": "user", "content": with_context(u, context_message)})
 
             print(f"GTP请求发送：{now()}")  # AI请求前
             
-            # 非线性思考判断：启动后台异步判断任务
-            thinking_task = None
+            # 非线性思考判断：启动后台异步判断任务，难度达到阈值时（推测式模式下）立即与主回答并行深度思考
+            thinking = None
             if hasattr(self, 'tree_thinking') and self.tree_thinking and getattr(self.tree_thinking, 'is_enabled', False):
-                # 启动异步思考判断任务
-                import asyncio
-                thinking_task = asyncio.create_task(self._async_thinking_judgment(u))
+                thinking = SpeculativeThinking(self.tree_thinking, u, context=self._thinking_context()).start()
             
             # 普通模式：走工具调用循环（根据配置决定是否流式）
             try:
                 # 根据配置决定是否使用流式处理
                 is_streaming = config.system.stream_mode
-                result = await tool_call_loop(msgs, self.mcp, self._call_llm, is_streaming=is_streaming)
-                final_content = result['content']
-                recursion_depth = result['recursion_depth']
-                
-                if recursion_depth > 0:
-                    print(f"工具调用循环完成，共执行 {recursion_depth} 轮")
                 
                 # 根据配置决定输出方式
                 if is_streaming:
-                    # 流式输出最终结果
+                    # 真流式：LLM增量直接转发，工具调用块在循环内部缓冲
                     
                     # 发布AI响应开始事件
                     if self.live2d_enabled:
@@ -411,16 +537,25 @@ class NagaConversation: # 对话主类
                         except Exception as e:
                             logger.debug(f"Live2D事件发布失败: {e}")
                     
-                    for line in final_content.splitlines():
-                        # 发布AI文本块事件
-                        if self.live2d_enabled:
-                            try:
-                                text_event = create_ai_response_event("main", line)
-                                await event_bus.publish("ai_text_chunk", text_event)
-                            except Exception as e:
-                                logger.debug(f"Live2D事件发布失败: {e}")
-                        
-                        yield ("娜迦", line)
+                    final_content = ''
+                    recursion_depth = 0
+                    async for event in tool_call_loop_stream(msgs, self.mcp, self._call_llm_stream, toolset=toolset):
+                        if event['type'] == 'text':
+                            # 发布AI文本块事件
+                            if self.live2d_enabled:
+                                try:
+                                    text_event = create_ai_response_event("main", event['content'])
+                                    await event_bus.publish("ai_text_chunk", text_event)
+                                except Exception as e:
+                                    logger.debug(f"Live2D事件发布失败: {e}")
+                            
+                            yield ("娜迦", event['content'])
+                        elif event['type'] == 'done':
+                            final_content = event['content']
+                            recursion_depth = event['recursion_depth']
+                    
+                    if recursion_depth > 0:
+                        print(f"工具调用循环完成，共执行 {recursion_depth} 轮")
                     
                     # 发布AI响应结束事件
                     if self.live2d_enabled:
@@ -430,6 +565,13 @@ class NagaConversation: # 对话主类
                         except Exception as e:
                             logger.debug(f"Live2D事件发布失败: {e}")
                 else:
+                    result = await tool_call_loop(msgs, self.mcp, self._call_llm, is_streaming=False, toolset=toolset)
+                    final_content = result['content']
+                    recursion_depth = result['recursion_depth']
+                    
+                    if recursion_depth > 0:
+                        print(f"工具调用循环完成，共执行 {recursion_depth} 轮")
+                    
                     # 非流式输出完整结果
                     if self.live2d_enabled:
                         try:
@@ -446,8 +588,11 @@ class NagaConversation: # 对话主类
                     
                     yield ("娜迦", final_content)
                 
+                self.record_native_turn(toolset, recursion_depth + 1)
+                
                 # 保存对话历史
-                self.messages += [{"role": "user", "content": u}, {"role": "assistant", "content": final_content}]
+                self.add_message("user", u)
+                self.add_message("assistant", final_content)
                 self.save_log(u, final_content)
                 
                 # GRAG记忆存储（开发者模式不写入）
@@ -458,15 +603,15 @@ class NagaConversation: # 对话主类
                         logger.error(f"GRAG记忆存储失败: {e}")
                 
                 # 检查异步思考判断结果，如果建议深度思考则提示用户
-                if thinking_task and not thinking_task.done():
-                    # 等待思考判断完成（最多等待3秒）
+                if thinking is not None:
                     try:
-                        await asyncio.wait_for(thinking_task, timeout=3.0)
-                        if thinking_task.result():
+                        if not await thinking.should_think_deeply(timeout=3.0):
+                            thinking.cancel()
+                        elif thinking.main_answer_done(final_content):
                             yield ("娜迦", "\n💡 这个问题较为复杂，下面我会更详细地解释这个流程...")
-                            # 启动深度思考
+                            # 推测式模式下深度思考已在后台运行，这里只等待剩余部分
                             try:
-                                thinking_result = await self.tree_thinking.think_deeply(u)
+                                thinking_result = await thinking.result()
                                 if thinking_result and "answer" in thinking_result:
                                     # 直接使用thinking系统的结果，避免重复处理
                                     yield ("娜迦", f"\n{thinking_result['answer']}")
@@ -485,14 +630,14 @@ class NagaConversation: # 对话主类
                             except Exception as e:
                                 logger.error(f"深度思考处理失败: {e}")
                                 yield ("娜迦", f"🌳 深度思考系统出错: {str(e)}")
-                    except asyncio.TimeoutError:
-                        # 超时取消任务
-                        thinking_task.cancel()
                     except Exception as e:
+                        thinking.cancel()
                         logger.debug(f"思考判断任务异常: {e}")
                 
             except Exception as e:
                 print(f"工具调用循环失败: {e}")
+                if thinking is not None:
+                    thinking.cancel()
                 yield ("娜迦", f"[MCP异常]: {e}")
                 return
 
@@ -507,59 +652,26 @@ class NagaConversation: # 对话主类
     async def get_response(self, prompt: str, temperature: float = 0.7) -> str:
         """为树状思考系统等提供API调用接口""" # 统一接口
         try:
-            response = await self.async_client.chat.completions.create(
+            response = await get_llm_scheduler().run(
+                self._create_completion,
+                tokens=estimate_tokens(prompt, config.api.max_tokens),
                 model=config.api.model,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=temperature,
                 max_tokens=config.api.max_tokens
             )
             return response.choices[0].message.content
-        except RuntimeError as e:
-            if "handler is closed" in str(e):
-                logger.debug(f"忽略连接关闭异常，重新创建客户端: {e}")
-                # 重新创建客户端并重试
-                self.async_client = AsyncOpenAI(api_key=config.api.api_key, base_url=config.api.base_url.rstrip('/') + '/')
-                response = await self.async_client.chat.completions.create(
-                    model=config.api.model,
-                    messages=[{"role": "user", "content": prompt}],
-                    temperature=temperature,
-                    max_tokens=config.api.max_tokens
-                )
-                return response.choices[0].message.content
-            else:
-                logger.error(f"API调用失败: {e}")
-                return f"API调用出错: {str(e)}"
         except Exception as e:
             logger.error(f"API调用失败: {e}")
             return f"API调用出错: {str(e)}"
 
-    async def _async_thinking_judgment(self, question: str) -> bool:
-        """异步判断问题是否需要深度思考
-        
-        Args:
-            question: 用户问题
-            
-        Returns:
-            bool: 是否需要深度思考
-        """
-        try:
-            if not self.tree_thinking:
-                return False
-            
-            # 使用thinking文件夹中现成的难度判断器
-            difficulty_assessment = await self.tree_thinking.difficulty_judge.assess_difficulty(question)
-            difficulty = difficulty_assessment.get("difficulty", 3)
-            
-            # 根据难度判断是否需要深度思考
-            # 难度4-5（复杂/极难）建议深度思考
-            should_think_deeply = difficulty >= 4
-            
-            logger.info(f"难度判断：{difficulty}/5，建议深度思考：{should_think_deeply}")
-            return should_think_deeply
-                   
-        except Exception as e:
-            logger.debug(f"异步思考判断失败: {e}")
-            return False
+    def _thinking_context(self, max_messages: int = 4) -> str:
+        """深度思考使用的对话上下文（与主回答相同的最近历史）"""
+        lines = []
+        for msg in self.messages[-max_messages:]:
+            role = "用户" if msg.get("role") == "user" else "娜迦"
+            lines.append(f"{role}: {str(msg.get('content', ''))[:500]}")
+        return "\n".join(lines)
 
 async def process_user_message(s,msg):
     if config.system.voice_enabled and not msg: #无文本输入时启动语音识别
@@ -105,7 +105,7 @@ if memory_manager.enabled:
     stats = memory_manager.get_memory_stats()
     # 检查Neo4j连接
     from summer_memory.quintuple_graph import graph, GRAG_ENABLED
-    print(f"Neo4j连接: {'成功' if graph and GRAG_ENABLED else '失败'}")
+    print(f"图谱后端: {graph.name if graph and GRAG_ENABLED else '不可用'}")
 print("=" * 30)
 
 # Live2D模块初始化
@@ -358,8 +358,9 @@ class AgentManager:
     async def _call_llm_api(self, agent_config: AgentConfig, messages: List[Dict[str, str]]) -> Dict[str, Any]:
         """调用LLM API，使用Agent配置中的参数"""
         try:
-            # 使用新版本的OpenAI API
-            from openai import AsyncOpenAI
+            # 共享连接池（按base_url复用长连接）
+            from apiserver.llm_client import get_llm_client_pool
+            from apiserver.llm_scheduler import get_llm_scheduler, estimate_tokens, LLMLane
             
             # 记录调试信息
             if self.debug_mode:
@@ -378,10 +379,10 @@ class AgentManager:
             if not agent_config.api_key:
                 return {"status": "error", "error": "Agent配置缺少API密钥"}
             
-            # 创建客户端，使用Agent配置中的参数
-            client = AsyncOpenAI(
-                api_key=agent_config.api_key,
-                base_url=agent_config.api_base_url or "https://api.deepseek.com/v1"
+            # 获取客户端，使用Agent配置中的参数（同一base_url复用连接池）
+            client = get_llm_client_pool().get_openai_client(
+                base_url=agent_config.api_base_url or "https://api.deepseek.com/v1",
+                api_key=agent_config.api_key
             )
             
             # 准备API调用参数
@@ -397,8 +398,11 @@ class AgentManager:
             if self.debug_mode:
                 logger.debug(f"API调用参数: {api_params}")
             
-            # 调用API
-            response = await client.chat.completions.create(**api_params)
+            # 调用API（全局调度器的Agent通道）
+            response = await get_llm_scheduler().run(
+                client.chat.completions.create, lane=LLMLane.AGENT,
+                tokens=estimate_tokens(messages, agent_config.max_output_tokens), **api_params
+            )
             
             # 提取响应内容
             assistant_content = response.choices[0].message.content
@@ -459,7 +463,16 @@ class AgentManager:
         """重新加载Agent配置"""
         self.agents.clear()
         self._load_agent_configs()
+        self._bump_registry_generation()
         logger.info("Agent配置已重新加载")
+
+    def _bump_registry_generation(self):
+        """Agent列表变化时通知注册表，使系统提示词缓存失效"""
+        try:
+            from mcpserver.mcp_registry import bump_registry_generation # 延迟导入避免循环依赖
+            bump_registry_generation()
+        except Exception as e:
+            logger.debug(f"更新注册表版本号失败: {e}")
     
     def _register_agent_from_manifest(self, agent_name: str, agent_config: Dict[str, Any]):
         """从manifest注册Agent
@@ -490,6 +503,7 @@ class AgentManager:
             
             # 注册到agents字典
             self.agents[agent_name] = agent_config_obj
+            self._bump_registry_generation()
             logger.info(f"已从manifest注册Agent: {agent_name} ({agent_config_obj.name})")
             return True
             
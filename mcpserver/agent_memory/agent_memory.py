@@ -8,6 +8,16 @@ try:
 except Exception as e:
     memory_manager = None
 
+def _invalidate_recall_cache(added, reset):
+    """五元组有新增或被整体替换时清空recall的缓存结果（manifest中recall声明了cacheTTL）"""
+    if not added and not reset:
+        return
+    try:
+        from mcpserver.tool_result_cache import get_tool_result_cache
+        get_tool_result_cache().invalidate_service(MemoryAgent.name)
+    except Exception:
+        pass
+
 class MemoryAgent(Agent):
     name = "MemoryAgent"
     instructions = "知识图谱记忆MCP Agent，支持五元组回忆与查询"
@@ -18,6 +28,11 @@ class MemoryAgent(Agent):
             tools=[],
             model="memory-mcp"
         )
+        try:
+            from summer_memory.quintuple_store import get_quintuple_store
+            get_quintuple_store().add_listener(_invalidate_recall_cache)
+        except Exception:
+            pass
 
     async def handle_handoff(self, data: dict) -> str:
         tool_name = data.get("tool_name")
@@ -31,6 +31,7 @@ async def llm_select_app(user_input: str, app_list: List[Dict]) -> Optional[Dict
     try:
         from openai import AsyncOpenAI
         from config import config
+        from apiserver.llm_scheduler import get_llm_scheduler, estimate_tokens, LLMLane
         
         # 创建LLM客户端
         client = AsyncOpenAI(
@@ -60,7 +61,8 @@ async def llm_select_app(user_input: str, app_list: List[Dict]) -> Optional[Dict
 4. 应用名称必须完全匹配列表中的名称"""
 
         # 调用LLM
-        response = await client.chat.completions.create(
+        response = await get_llm_scheduler().run(
+            client.chat.completions.create, lane=LLMLane.AGENT, tokens=estimate_tokens(prompt, 50),
             model=config.api.model,
             messages=[{"role": "user", "content": prompt}],
             temperature=0.1,  # 低温度确保一致性
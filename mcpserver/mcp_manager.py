@@ -13,7 +13,7 @@ from pathlib import Path
 
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
-from mcpserver.mcp_registry import MCP_REGISTRY # MCP服务注册表
+from mcpserver.mcp_registry import MCP_REGISTRY, aget_mcp_agent, bump_registry_generation # MCP服务注册表
 
 from config import DEBUG, LOG_LEVEL
 
@@ -161,6 +161,7 @@ class MCPManager:
             "filter_fn": remove_tools_filter,  # 使用函数而不是类实例
             "strict_schema": strict_schema
         }
+        bump_registry_generation() # handoff服务变化，系统提示词需重建
         
     async def _default_handoff_callback(
         self,
@@ -217,9 +218,9 @@ class MCPManager:
                     # 继续执行，使用原始消息
                 
             # 创建代理实例
-            from mcpserver.mcp_registry import MCP_REGISTRY # 统一注册中心
+            from mcpserver.mcp_registry import aget_mcp_agent # 统一注册中心
             agent_name = service["agent_name"]
-            agent = MCP_REGISTRY.get(agent_name)
+            agent = await aget_mcp_agent(agent_name) # 延迟加载的服务在此时实例化
             if not agent:
                 raise ValueError(f"找不到已注册的Agent实例: {agent_name}")
             sys.stderr.write(f"使用注册中心中的Agent实例: {agent_name}\n".encode('utf-8', errors='replace').decode('utf-8'))
@@ -352,6 +353,8 @@ class MCPManager:
     async def unified_call(self, service_name: str, tool_name: str, args: dict):
         """统一调用接口，支持MCP服务和Agent服务
         
+        manifest中声明了cacheTTL的命令会命中结果缓存，相同的并发调用只执行一次
+        
         Args:
             service_name: 服务名称
             tool_name: 工具名称
@@ -360,6 +363,14 @@ class MCPManager:
         Returns:
             调用结果
         """
+        from mcpserver.tool_result_cache import get_tool_result_cache
+        return await get_tool_result_cache().get_or_call(
+            service_name, tool_name, args,
+            lambda: self._unified_call_uncached(service_name, tool_name, args)
+        )
+
+    async def _unified_call_uncached(self, service_name: str, tool_name: str, args: dict):
+        """直接调用后端服务，不经过结果缓存"""
         try:
             # 首先尝试作为handoff服务调用
             if service_name in self.services:
@@ -367,7 +378,9 @@ class MCPManager:
             
             # 然后尝试作为MCP服务调用
             if service_name in MCP_REGISTRY:
-                agent = MCP_REGISTRY[service_name]
+                agent = await aget_mcp_agent(service_name) # 首次调用时在线程池中实例化
+                if agent is None:
+                    return f"调用失败: MCP服务 {service_name} 加载失败"
                 if hasattr(agent, 'handle_handoff'):
                     return await agent.handle_handoff(args)
                 elif hasattr(agent, tool_name):
@@ -491,7 +504,12 @@ class MCPManager:
             Dict[str, Any]: 统计信息
         """
         from mcpserver.mcp_registry import get_service_statistics # 动态服务池查询
-        return get_service_statistics()
+        from mcpserver.tool_scheduler import get_tool_scheduler
+        statistics = get_service_statistics()
+        statistics["tool_scheduler"] = get_tool_scheduler().get_stats() # 工具调用耗时统计
+        from mcpserver.tool_result_cache import get_tool_result_cache
+        statistics["result_cache"] = get_tool_result_cache().get_stats() # 工具结果缓存命中统计
+        return statistics
     
     def get_service_tools(self, service_name: str) -> List[Dict[str, Any]]:
         """获取指定服务的可用工具列表
@@ -550,6 +568,9 @@ class MCPManager:
             # 新的动态注册系统已经自动扫描并注册了所有MCP服务
             # 不再需要手动注册handoff服务
             sys.stderr.write("✅ MCP服务已通过动态扫描自动注册完成\n")
+            # 延迟加载的服务在后台线程池中预热，首次调用无需等待实例化
+            from mcpserver.mcp_registry import warm_up_mcp_agents
+            warm_up_mcp_agents()
         except Exception as e:
             sys.stderr.write(f"❌ 自动注册服务失败: {e}\n")
             import traceback
@@ -3,41 +3,170 @@ import json
 import os
 import importlib
 import inspect
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple
 
-MCP_REGISTRY = {} # 全局MCP服务池
+_REGISTRY_GENERATION = 0 # 注册表版本号，注册/注销时递增，用于失效依赖注册表的缓存（如系统提示词）
+_MANIFEST_FILE_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {} # manifest路径 -> (mtime, 内容)
+_SCAN_STATS = {"manifest_scan_ms": 0.0, "manifests": 0} # 最近一次扫描统计
+_LOAD_FAILURES: Dict[str, Dict[str, Any]] = {} # 加载失败（已从服务池移除）的Agent
+
+def _lazy_loading_enabled() -> bool:
+    try:
+        from config import config
+        return getattr(config.mcp, 'lazy_agent_loading', True)
+    except Exception:
+        return True
+
+class _LazyAgent:
+    """延迟创建的MCP Agent占位：首次调用或后台预热时才导入模块并实例化"""
+    
+    def __init__(self, name: str, manifest: Dict[str, Any]):
+        self.name = name
+        self.manifest = manifest
+        self.instance = None
+        self.status = "pending" # pending/loading/ready/failed
+        self.error = None
+        self.load_time_ms = 0.0
+        self._lock = threading.Lock()
+    
+    def load(self) -> Optional[Any]:
+        """导入并实例化Agent，多线程并发调用时只创建一次"""
+        with self._lock:
+            if self.status == "ready":
+                return self.instance
+            if self.status == "failed":
+                return None
+            self.status = "loading"
+            start = time.perf_counter()
+            try:
+                self.instance = _instantiate(self.manifest)
+                self.status = "ready"
+            except Exception as e:
+                self.error = str(e)
+                self.status = "failed"
+            self.load_time_ms = (time.perf_counter() - start) * 1000
+        if self.status == "ready":
+            _LOAD_FAILURES.pop(self.name, None)
+            sys.stderr.write(f"✅ 已加载MCP Agent: {self.name} ({self.load_time_ms:.0f}ms)\n")
+        else:
+            _LOAD_FAILURES[self.name] = {"status": "failed", "load_time_ms": round(self.load_time_ms, 1), "error": self.error}
+            sys.stderr.write(f"创建agent实例失败 {self.name}: {self.error}\n")
+        return self.instance
+
+class _LazyRegistry(dict):
+    """服务池：值可以是Agent实例或延迟占位，按名称取值时才实例化
+    
+    名称列表（keys/in/len）不触发实例化，提示词可以立即列出全部服务
+    """
+    
+    def __getitem__(self, name):
+        value = dict.__getitem__(self, name)
+        if isinstance(value, _LazyAgent):
+            instance = value.load()
+            if instance is None:
+                # 创建失败：从服务池移除，提示词中不再列出
+                if dict.get(self, name) is value:
+                    unregister_mcp_agent(name)
+                raise KeyError(f"MCP服务 {name} 加载失败: {value.error}")
+            return instance
+        return value
+    
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+    
+    def peek(self, name) -> Optional[Any]:
+        """获取已创建的实例，不触发实例化"""
+        value = dict.get(self, name)
+        return value.instance if isinstance(value, _LazyAgent) else value
+    
+    def is_loaded(self, name) -> bool:
+        value = dict.get(self, name)
+        return value is not None and (not isinstance(value, _LazyAgent) or value.status == "ready")
+
+MCP_REGISTRY = _LazyRegistry() # 全局MCP服务池
 MANIFEST_CACHE = {} # 缓存manifest信息
 
+def get_registry_generation() -> int:
+    """获取当前注册表版本号"""
+    return _REGISTRY_GENERATION
+
+def bump_registry_generation() -> int:
+    """递增注册表版本号，服务池发生变化时调用"""
+    global _REGISTRY_GENERATION
+    _REGISTRY_GENERATION += 1
+    return _REGISTRY_GENERATION
+
+def register_mcp_agent(agent_name: str, instance: Any, manifest: Optional[Dict[str, Any]] = None):
+    """注册MCP服务实例到服务池"""
+    if manifest is not None:
+        MANIFEST_CACHE[agent_name] = manifest
+    MCP_REGISTRY[agent_name] = instance
+    bump_registry_generation()
+
+def register_lazy_mcp_agent(agent_name: str, manifest: Dict[str, Any]):
+    """注册延迟加载的MCP服务：只记录manifest，首次调用时才实例化"""
+    register_mcp_agent(agent_name, _LazyAgent(agent_name, manifest), manifest)
+
+def unregister_mcp_agent(agent_name: str) -> bool:
+    """从服务池注销MCP服务"""
+    existed = MCP_REGISTRY.pop(agent_name, None) is not None
+    MANIFEST_CACHE.pop(agent_name, None)
+    if existed:
+        bump_registry_generation()
+    return existed
+
+async def aget_mcp_agent(agent_name: str) -> Optional[Any]:
+    """异步获取Agent实例，未加载时在线程池中导入和实例化，不阻塞事件循环"""
+    import asyncio
+    value = dict.get(MCP_REGISTRY, agent_name)
+    if isinstance(value, _LazyAgent) and value.status != "ready":
+        await asyncio.get_running_loop().run_in_executor(None, value.load)
+    return MCP_REGISTRY.get(agent_name)
+
 def load_manifest_file(manifest_path: Path) -> Optional[Dict[str, Any]]:
-    """加载manifest文件"""
+    """加载manifest文件（按mtime缓存，未修改时不重复解析）"""
+    key = str(manifest_path)
     try:
+        mtime = os.path.getmtime(manifest_path)
+        cached = _MANIFEST_FILE_CACHE.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
         with open(manifest_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            manifest = json.load(f)
+        _MANIFEST_FILE_CACHE[key] = (mtime, manifest)
+        return manifest
     except Exception as e:
         sys.stderr.write(f"加载manifest文件失败 {manifest_path}: {e}\n")
         return None
 
+def _instantiate(manifest: Dict[str, Any]) -> Any:
+    """根据manifest导入模块并创建实例，失败时抛出异常"""
+    entry_point = manifest.get('entryPoint', {})
+    module_name = entry_point.get('module')
+    class_name = entry_point.get('class')
+    
+    if not module_name or not class_name:
+        raise ValueError("manifest缺少entryPoint信息")
+        
+    # 动态导入模块
+    module = importlib.import_module(module_name)
+    agent_class = getattr(module, class_name)
+    
+    # 创建实例
+    return agent_class()
+
 def create_agent_instance(manifest: Dict[str, Any]) -> Optional[Any]:
     """根据manifest创建agent实例"""
     try:
-        entry_point = manifest.get('entryPoint', {})
-        module_name = entry_point.get('module')
-        class_name = entry_point.get('class')
-        
-        if not module_name or not class_name:
-            sys.stderr.write(f"manifest缺少entryPoint信息: {manifest.get('name', 'unknown')}\n")
-            return None
-            
-        # 动态导入模块
-        module = importlib.import_module(module_name)
-        agent_class = getattr(module, class_name)
-        
-        # 创建实例
-        instance = agent_class()
-        return instance
-        
+        return _instantiate(manifest)
     except Exception as e:
         sys.stderr.write(f"创建agent实例失败 {manifest.get('name', 'unknown')}: {e}\n")
         return None
@@ -46,9 +175,13 @@ def scan_and_register_mcp_agents(mcp_dir: str = 'mcpserver') -> list:
     """扫描目录中的JSON元数据文件，注册MCP类型的agent和Agent类型的agent"""
     d = Path(mcp_dir)
     registered_agents = []
+    lazy = _lazy_loading_enabled()
+    scan_start = time.perf_counter()
+    manifest_count = 0
     
     # 扫描所有agent-manifest.json文件
     for manifest_file in d.glob('**/agent-manifest.json'):
+        manifest_count += 1
         try:
             # 加载manifest
             manifest = load_manifest_file(manifest_file)
@@ -65,10 +198,19 @@ def scan_and_register_mcp_agents(mcp_dir: str = 'mcpserver') -> list:
             # 根据agentType进行分类处理
             if agent_type == 'mcp':
                 # MCP类型：注册到MCP_REGISTRY
+                if MANIFEST_CACHE.get(agent_name) is manifest and agent_name in MCP_REGISTRY:
+                    registered_agents.append(agent_name) # manifest未修改，保留已注册的服务
+                    continue
+                if lazy:
+                    # 只登记manifest，模块导入和实例化推迟到首次调用或后台预热
+                    register_lazy_mcp_agent(agent_name, manifest)
+                    registered_agents.append(agent_name)
+                    sys.stderr.write(f"✅ 已注册MCP Agent（延迟加载）: {agent_name}\n")
+                    continue
                 MANIFEST_CACHE[agent_name] = manifest
                 agent_instance = create_agent_instance(manifest)
                 if agent_instance:
-                    MCP_REGISTRY[agent_name] = agent_instance
+                    register_mcp_agent(agent_name, agent_instance)
                     registered_agents.append(agent_name)
                     sys.stderr.write(f"✅ 已注册MCP Agent: {agent_name}\n")
                     
@@ -105,8 +247,46 @@ def scan_and_register_mcp_agents(mcp_dir: str = 'mcpserver') -> list:
             sys.stderr.write(f"处理manifest文件失败 {manifest_file}: {e}\n")
             continue
     
+    _SCAN_STATS["manifest_scan_ms"] = round((time.perf_counter() - scan_start) * 1000, 1)
+    _SCAN_STATS["manifests"] = manifest_count
     return registered_agents
 
+def warm_up_mcp_agents(max_workers: Optional[int] = None) -> list:
+    """在后台线程池中预热尚未实例化的MCP Agent，返回Future列表"""
+    if max_workers is None:
+        try:
+            from config import config
+            max_workers = getattr(config.mcp, 'warmup_workers', 4)
+        except Exception:
+            max_workers = 4
+    pending = [(name, value) for name, value in list(dict.items(MCP_REGISTRY))
+               if isinstance(value, _LazyAgent) and value.status == "pending"]
+    if not pending or max_workers <= 0:
+        return []
+    
+    def _warm(name: str, lazy_agent: _LazyAgent):
+        if lazy_agent.load() is None and dict.get(MCP_REGISTRY, name) is lazy_agent:
+            unregister_mcp_agent(name) # 预热失败的服务不再出现在提示词中
+    
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(pending)), thread_name_prefix="mcp-warmup")
+    futures = [executor.submit(_warm, name, value) for name, value in pending]
+    executor.shutdown(wait=False)
+    return futures
+
+def get_agent_startup_stats() -> Dict[str, Any]:
+    """各MCP Agent的加载状态与耗时"""
+    agents = dict(_LOAD_FAILURES)
+    for name, value in list(dict.items(MCP_REGISTRY)):
+        if isinstance(value, _LazyAgent):
+            agents[name] = {
+                "status": value.status,
+                "load_time_ms": round(value.load_time_ms, 1),
+                "error": value.error,
+            }
+        else:
+            agents[name] = {"status": "ready", "load_time_ms": None, "error": None}
+    return {**_SCAN_STATS, "agents": agents}
+
 def get_service_info(service_name: str) -> Optional[Dict[str, Any]]:
     """获取指定服务的详细信息
     
@@ -120,7 +300,7 @@ def get_service_info(service_name: str) -> Optional[Dict[str, Any]]:
         return None
         
     manifest = MANIFEST_CACHE.get(service_name, {})
-    instance = MCP_REGISTRY[service_name]
+    instance = MCP_REGISTRY.peek(service_name) # 仅查询信息，不触发延迟实例化
     
     return {
         "name": service_name,
@@ -208,6 +388,8 @@ def get_service_statistics() -> Dict[str, Any]:
         "total_services": total_services,
         "total_tools": total_tools,
         "registered_services": list(MCP_REGISTRY.keys()),
+        "registry_generation": _REGISTRY_GENERATION,
+        "agent_startup": get_agent_startup_stats(),
         "last_update": "动态更新"
     }
 
@@ -59,63 +59,17 @@ def parse_tool_calls(content: str) -> list:
     return tool_calls
 
 async def execute_tool_calls(tool_calls: list, mcp_manager) -> str:
-    """执行工具调用"""
-    results = []
+    """执行工具调用：相互独立的调用并发执行，结果按原始顺序拼接"""
+    from mcpserver.tool_scheduler import get_tool_scheduler
     for i, tool_call in enumerate(tool_calls):
-        try:
-            print(f"[DEBUG] 开始执行工具调用{i+1}: {tool_call['name']}")
-            
-            tool_name = tool_call['name']
-            args = tool_call['args']
-            agent_type = args.get('agentType', 'mcp').lower()
-            
-            print(f"[DEBUG] 工具类型: {agent_type}, 参数: {args}")
-            
-            if agent_type == 'agent':
-                try:
-                    from mcpserver.agent_manager import get_agent_manager
-                    agent_manager = get_agent_manager()
-                    
-                    agent_name = args.get('agent_name')
-                    prompt = args.get('prompt')
-                    
-                    print(f"[DEBUG] Agent调用: {agent_name}, prompt: {prompt}")
-                    
-                    if not agent_name or not prompt:
-                        result = "Agent调用失败: 缺少agent_name或prompt参数"
-                    else:
-                        result = await agent_manager.call_agent(agent_name, prompt)
-                        if result.get("status") == "success":
-                            result = result.get("result", "")
-                        else:
-                            result = f"Agent调用失败: {result.get('error', '未知错误')}"
-                            
-                except Exception as e:
-                    result = f"Agent调用失败: {str(e)}"
-                    
-            else:
-                service_name = args.get('service_name')
-                actual_tool_name = args.get('tool_name', tool_name)
-                tool_args = {k: v for k, v in args.items() 
-                           if k not in ['service_name', 'agentType']}
-                
-                print(f"[DEBUG] MCP调用: service={service_name}, tool={actual_tool_name}, args={tool_args}")
-                
-                if not service_name:
-                    result = "MCP调用失败: 缺少service_name参数"
-                else:
-                    result = await mcp_manager.unified_call(
-                    service_name=service_name,
-                    tool_name=actual_tool_name,
-                    args=tool_args
-                )
-            
-            print(f"[DEBUG] 工具调用{i+1}执行结果: {result}")
-            results.append(f"来自工具 \"{tool_name}\" 的结果:\n{result}")
-        except Exception as e:
-            error_result = f"执行工具 {tool_call['name']} 时发生错误：{str(e)}"
-            print(f"[DEBUG] 工具调用{i+1}执行异常: {error_result}")
-            results.append(error_result)
+        print(f"[DEBUG] 开始执行工具调用{i+1}: {tool_call['name']}")
+    records = await get_tool_scheduler().execute(tool_calls, mcp_manager)
+    results = []
+    for record in records:
+        if record['status'] == 'success':
+            results.append(f"来自工具 \"{record['name']}\" 的结果:\n{record['result']}")
+        else:
+            results.append(record['result'])
     return "\n\n---\n\n".join(results)
 
 async def tool_call_loop(messages: List[Dict], mcp_manager, llm_caller, is_streaming: bool = False, max_recursion: int = None) -> Dict:
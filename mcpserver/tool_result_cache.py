@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MCP工具结果缓存
+- 缓存键为 (服务, 工具, 规范化参数)
+- 是否可缓存及TTL由agent-manifest.json中invocationCommands条目声明：
+    "cacheTTL": 600              # 秒，>0 表示结果可缓存
+    "cacheIgnoreArgs": ["query"] # 不影响结果的参数，不参与缓存键
+    "readOnly": true             # 不可缓存但无副作用，调用时不清空该服务的缓存
+  未在invocationCommands中列出的工具（不希望出现在提示词里）可在capabilities.cachePolicy中按工具名声明同样的字段：
+    "cachePolicy": {"get_document_text": {"cacheTTL": 30}}
+  未声明cacheTTL且未标记readOnly的命令视为有副作用，调用时清空该服务已缓存的结果
+- LRU容量上限；并发的相同调用只执行一次（single-flight）
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger("ToolResultCache")
+
+DEFAULT_MAX_ENTRIES = 256
+
+# 调度相关参数，不影响工具结果
+_CONTROL_ARGS = ('service_name', 'agentType', 'tool_name')
+
+
+class _Policy:
+    __slots__ = ("ttl", "ignore_args", "read_only")
+
+    def __init__(self, ttl: float = 0.0, ignore_args=(), read_only: bool = False):
+        self.ttl = ttl
+        self.ignore_args = frozenset(ignore_args)
+        self.read_only = read_only
+
+    @property
+    def cacheable(self) -> bool:
+        return self.ttl > 0
+
+
+_NO_CACHE = _Policy()
+
+
+def _is_error_result(result: Any) -> bool:
+    """失败结果不缓存"""
+    if result is None:
+        return True
+    if isinstance(result, dict):
+        return result.get('status') in ('error', 'failed')
+    if isinstance(result, str):
+        text = result.lstrip()
+        if text.startswith('调用失败'):
+            return True
+        if text.startswith('{'):
+            try:
+                data = json.loads(text)
+            except (ValueError, TypeError):
+                return False
+            return isinstance(data, dict) and data.get('status') in ('error', 'failed')
+    return False
+
+
+class ToolResultCache:
+    """工具结果LRU缓存（TTL来自manifest）"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, enabled: bool = True):
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str, str], Tuple[float, Any]]" = OrderedDict()  # key -> (过期时间, 结果)
+        self._inflight: Dict[tuple, asyncio.Future] = {}  # (循环id, key) -> Future
+        self._policies: Dict[Tuple[str, str], _Policy] = {}
+        self._policy_generation = -1
+        self._stats = {"hits": 0, "misses": 0, "coalesced": 0, "bypass": 0,
+                       "evictions": 0, "expired": 0, "invalidations": 0, "errors_not_cached": 0}
+
+    # ---------- 策略 ----------
+    def _load_policies(self):
+        """根据注册表中的manifest构建缓存策略，注册表版本变化时重建"""
+        from mcpserver.mcp_registry import MANIFEST_CACHE, get_registry_generation
+        generation = get_registry_generation()
+        if generation == self._policy_generation:
+            return
+        policies = {}
+        for service_name, manifest in list(MANIFEST_CACHE.items()):
+            capabilities = manifest.get('capabilities', {})
+            declared = {}
+            commands = capabilities.get('invocationCommands', [])
+            if isinstance(commands, list):
+                for cmd in commands:
+                    if isinstance(cmd, dict) and cmd.get('command'):
+                        declared[cmd['command']] = cmd
+            cache_policy = capabilities.get('cachePolicy', {})
+            if isinstance(cache_policy, dict):
+                for name, cmd in cache_policy.items():
+                    if isinstance(cmd, dict):
+                        declared[name] = {**declared.get(name, {}), **cmd}
+            for name, cmd in declared.items():
+                try:
+                    ttl = float(cmd.get('cacheTTL', 0) or 0)
+                except (TypeError, ValueError):
+                    ttl = 0.0
+                policies[(service_name, name)] = _Policy(
+                    ttl=ttl,
+                    ignore_args=cmd.get('cacheIgnoreArgs', ()),
+                    read_only=bool(cmd.get('readOnly', False)),
+                )
+        with self._lock:
+            self._policies = policies
+            self._policy_generation = generation
+
+    def policy_for(self, service_name: str, tool_name: str) -> _Policy:
+        self._load_policies()
+        return self._policies.get((service_name, tool_name), _NO_CACHE)
+
+    @staticmethod
+    def make_key(service_name: str, tool_name: str, args: dict, ignore_args=frozenset()) -> Tuple[str, str, str]:
+        """规范化参数：去掉调度参数和声明忽略的参数，按键排序序列化"""
+        canonical = {k: v for k, v in (args or {}).items()
+                     if k not in _CONTROL_ARGS and k not in ignore_args}
+        return (service_name, tool_name,
+                json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str))
+
+    # ---------- 读写 ----------
+    def _get(self, key) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._stats["expired"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def _put(self, key, value: Any, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate_service(self, service_name: str) -> int:
+        """清空指定服务的缓存结果"""
+        with self._lock:
+            keys = [k for k in self._entries if k[0] == service_name]
+            for k in keys:
+                del self._entries[k]
+            if keys:
+                self._stats["invalidations"] += 1
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    async def get_or_call(self, service_name: str, tool_name: str, args: dict,
+                          call: Callable[[], Awaitable[Any]]) -> Any:
+        """命中缓存直接返回；否则执行call，相同的并发调用共享同一次执行"""
+        if not self.enabled:
+            return await call()
+        policy = self.policy_for(service_name, tool_name)
+        if not policy.cacheable:
+            if not policy.read_only:
+                self.invalidate_service(service_name)  # 可能有副作用，之前缓存的读结果不再可信
+            with self._lock:
+                self._stats["bypass"] += 1
+            return await call()
+
+        key = self.make_key(service_name, tool_name, args, policy.ignore_args)
+        hit, value = self._get(key)
+        if hit:
+            with self._lock:
+                self._stats["hits"] += 1
+            logger.debug(f"工具结果缓存命中: {service_name}.{tool_name}")
+            return value
+
+        loop = asyncio.get_running_loop()
+        flight_key = (id(loop), key)
+        with self._lock:
+            future = self._inflight.get(flight_key)
+            owner = future is None
+            if owner:
+                future = loop.create_future()
+                self._inflight[flight_key] = future
+                self._stats["misses"] += 1
+            else:
+                self._stats["coalesced"] += 1
+        if not owner:
+            # shield：等待方被取消时不影响正在执行的调用
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    # 执行方被取消（如超时），由当前调用方重新执行
+                    return await self.get_or_call(service_name, tool_name, args, call)
+                raise
+
+        try:
+            value = await call()
+        except asyncio.CancelledError:
+            if not future.done():
+                future.cancel()
+            raise
+        except BaseException as e:
+            if not future.done():
+                future.set_exception(e)
+                future.exception()  # 标记已读取，避免无人等待时告警
+            raise
+        else:
+            if _is_error_result(value):
+                with self._lock:
+                    self._stats["errors_not_cached"] += 1
+            else:
+                self._put(key, value, policy.ttl)
+            if not future.done():
+                future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._inflight.pop(flight_key, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"] + self._stats["coalesced"]
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                **self._stats,
+                "hit_rate": round((self._stats["hits"] + self._stats["coalesced"]) / lookups, 4) if lookups else 0.0,
+                "cacheable_commands": sum(1 for p in self._policies.values() if p.cacheable),
+            }
+
+
+_CACHE: Optional[ToolResultCache] = None
+
+
+def get_tool_result_cache() -> ToolResultCache:
+    """获取全局工具结果缓存"""
+    global _CACHE
+    if _CACHE is None:
+        try:
+            from config import config
+            _CACHE = ToolResultCache(
+                max_entries=getattr(config.mcp, 'result_cache_size', DEFAULT_MAX_ENTRIES),
+                enabled=getattr(config.mcp, 'result_cache_enabled', True),
+            )
+        except Exception:
+            _CACHE = ToolResultCache()
+    return _CACHE
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+工具调用调度器 - 同一轮LLM回复中的多个工具调用并发执行
+- asyncio.gather并发执行，结果按原始调用顺序返回，保证提示词稳定
+- 全局并发上限 + 按服务的并发上限（如浏览器自动化同一时刻只允许一个动作）
+- 可选的单次调用超时（默认不限制，可按服务设置），超时后取消该调用，不影响其他调用
+- 先占服务配额再占全局配额，排队等待同一服务的调用不占用全局并发
+- 记录每次调用的排队/执行耗时，便于定位拖慢整轮回复的工具
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("ToolScheduler")
+
+DEFAULT_TOOL_TIMEOUT = 0.0  # 单次工具调用默认超时（秒），0表示不限制
+DEFAULT_MAX_CONCURRENCY = 8  # 单轮最大并发数
+
+
+def _service_key(tool_call: dict) -> str:
+    """工具调用所属服务，用于按服务限流"""
+    args = tool_call.get('args', {})
+    if args.get('agentType', 'mcp').lower() == 'agent':
+        return f"agent:{args.get('agent_name', '')}"
+    return args.get('service_name') or tool_call.get('name', '')
+
+
+async def _invoke(tool_call: dict, mcp_manager) -> Any:
+    """执行单个工具调用（MCP服务或Agent）"""
+    tool_name = tool_call['name']
+    args = tool_call['args']
+    agent_type = args.get('agentType', 'mcp').lower()
+
+    if agent_type == 'agent':
+        try:
+            from mcpserver.agent_manager import get_agent_manager
+            agent_manager = get_agent_manager()
+
+            agent_name = args.get('agent_name')
+            prompt = args.get('prompt')
+
+            print(f"[DEBUG] Agent调用: {agent_name}, prompt: {prompt}")
+
+            if not agent_name or not prompt:
+                return "Agent调用失败: 缺少agent_name或prompt参数"
+            result = await agent_manager.call_agent(agent_name, prompt)
+            if result.get("status") == "success":
+                return result.get("result", "")
+            return f"Agent调用失败: {result.get('error', '未知错误')}"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            return f"Agent调用失败: {str(e)}"
+
+    service_name = args.get('service_name')
+    actual_tool_name = args.get('tool_name', tool_name)
+    tool_args = {k: v for k, v in args.items()
+                 if k not in ['service_name', 'agentType']}
+
+    print(f"[DEBUG] MCP调用: service={service_name}, tool={actual_tool_name}, args={tool_args}")
+
+    if not service_name:
+        return "MCP调用失败: 缺少service_name参数"
+    return await mcp_manager.unified_call(
+        service_name=service_name,
+        tool_name=actual_tool_name,
+        args=tool_args
+    )
+
+
+class ToolCallScheduler:
+    """并发工具调用调度器"""
+
+    def __init__(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                 default_timeout: float = DEFAULT_TOOL_TIMEOUT,
+                 service_concurrency: Optional[Dict[str, int]] = None,
+                 service_timeouts: Optional[Dict[str, float]] = None):
+        self.max_concurrency = max_concurrency
+        self.default_timeout = default_timeout
+        self.service_concurrency = dict(service_concurrency or {})
+        self.service_timeouts = dict(service_timeouts or {})
+        self._lock = threading.Lock()
+        # 信号量绑定事件循环，UI线程与API服务器各自的循环分别持有
+        self._semaphores: Dict[tuple, tuple] = {}  # (循环id, key) -> (循环, 信号量)
+        self._stats: Dict[str, Dict[str, Any]] = {}
+        self._batches = 0
+
+    def _semaphore(self, key: str, limit: int) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        skey = (id(loop), key)
+        with self._lock:
+            entry = self._semaphores.get(skey)
+            if entry is None or entry[0] is not loop:
+                # 清理已关闭事件循环上的信号量
+                for k in [k for k, (l, _) in self._semaphores.items() if l.is_closed()]:
+                    self._semaphores.pop(k, None)
+                entry = (loop, asyncio.Semaphore(limit))
+                self._semaphores[skey] = entry
+            return entry[1]
+
+    def _timeout_for(self, service: str) -> Optional[float]:
+        """服务超时（秒），未设置或<=0时不限制"""
+        timeout = self.service_timeouts.get(service, self.default_timeout)
+        return timeout if timeout and timeout > 0 else None
+
+    async def _run_one(self, index: int, tool_call: dict, mcp_manager) -> Dict[str, Any]:
+        service = _service_key(tool_call)
+        timeout = self._timeout_for(service)
+        record = {
+            "index": index,
+            "name": tool_call.get('name', ''),
+            "service": service,
+            "status": "success",
+            "queued_ms": 0.0,
+            "elapsed_ms": 0.0,
+            "result": None,
+        }
+        queued_at = time.perf_counter()
+        limit = self.service_concurrency.get(service)
+        service_sem = self._semaphore(f"service:{service}", limit) if limit else None
+        global_sem = self._semaphore("global", self.max_concurrency)
+
+        # 先等服务配额：同一服务串行排队的调用不应占住全局并发，挡住其他服务
+        if service_sem is not None:
+            await service_sem.acquire()
+        try:
+            async with global_sem:
+                started = time.perf_counter()
+                record["queued_ms"] = (started - queued_at) * 1000
+                try:
+                    record["result"] = await asyncio.wait_for(_invoke(tool_call, mcp_manager), timeout=timeout)
+                except asyncio.TimeoutError:
+                    record["status"] = "timeout"
+                    record["result"] = f"执行工具 {record['name']} 超时（{timeout:g}秒），已取消"
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    record["status"] = "error"
+                    record["result"] = f"执行工具 {record['name']} 时发生错误：{str(e)}"
+                record["elapsed_ms"] = (time.perf_counter() - started) * 1000
+        finally:
+            if service_sem is not None:
+                service_sem.release()
+
+        self._record(record)
+        print(f"[DEBUG] 工具调用{index + 1} [{service}] {record['status']}: "
+              f"执行 {record['elapsed_ms']:.0f}ms, 排队 {record['queued_ms']:.0f}ms")
+        return record
+
+    def _record(self, record: Dict[str, Any]):
+        with self._lock:
+            s = self._stats.setdefault(record["service"], {
+                "calls": 0, "errors": 0, "timeouts": 0,
+                "total_ms": 0.0, "max_ms": 0.0, "queued_ms": 0.0,
+            })
+            s["calls"] += 1
+            if record["status"] == "error":
+                s["errors"] += 1
+            elif record["status"] == "timeout":
+                s["timeouts"] += 1
+            s["total_ms"] += record["elapsed_ms"]
+            s["max_ms"] = max(s["max_ms"], record["elapsed_ms"])
+            s["queued_ms"] += record["queued_ms"]
+
+    async def execute(self, tool_calls: List[dict], mcp_manager) -> List[Dict[str, Any]]:
+        """并发执行一轮工具调用，返回按原始顺序排列的执行记录"""
+        if not tool_calls:
+            return []
+        started = time.perf_counter()
+        records = await asyncio.gather(
+            *(self._run_one(i, call, mcp_manager) for i, call in enumerate(tool_calls))
+        )
+        wall_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._batches += 1
+        slowest = max(records, key=lambda r: r["elapsed_ms"])
+        logger.info(f"工具调用完成: {len(records)}个, 总耗时 {wall_ms:.0f}ms, "
+                    f"最慢 {slowest['name']}[{slowest['service']}] {slowest['elapsed_ms']:.0f}ms")
+        return list(records)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            services = {}
+            for name, s in self._stats.items():
+                services[name] = {
+                    **{k: (round(v, 1) if isinstance(v, float) else v) for k, v in s.items()},
+                    "avg_ms": round(s["total_ms"] / s["calls"], 1) if s["calls"] else 0.0,
+                }
+            return {
+                "batches": self._batches,
+                "max_concurrency": self.max_concurrency,
+                "default_timeout": self.default_timeout,
+                "services": services,
+            }
+
+
+_SCHEDULER: Optional[ToolCallScheduler] = None
+
+
+def get_tool_scheduler() -> ToolCallScheduler:
+    """获取全局工具调用调度器"""
+    global _SCHEDULER
+    if _SCHEDULER is None:
+        try:
+            from config import config
+            mcp_cfg = config.mcp
+            _SCHEDULER = ToolCallScheduler(
+                max_concurrency=getattr(mcp_cfg, 'max_concurrent_tool_calls', DEFAULT_MAX_CONCURRENCY),
+                default_timeout=getattr(mcp_cfg, 'tool_call_timeout', DEFAULT_TOOL_TIMEOUT),
+                service_concurrency=getattr(mcp_cfg, 'service_concurrency', None),
+                service_timeouts=getattr(mcp_cfg, 'service_timeouts', None),
+            )
+        except Exception:
+            _SCHEDULER = ToolCallScheduler()
+    return _SCHEDULER
@@ -0,0 +1,352 @@
+"""
+嵌入式知识图谱后端（无需Neo4j）
+- 字符串驻留 + 整数id：实体、类型、关系名都只保存一份字符串
+- 邻接表：实体id -> 出边/入边id列表
+- 倒排索引：实体名 -> 实体id、实体类型 -> 实体id集合、关系名 -> 边id列表
+- n-gram索引：单字/二元组 -> 字符串id集合，用于实现 CONTAINS 子串匹配
+- 快照：紧凑二进制格式，通过mmap加载
+"""
+
+import atexit
+import heapq
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence, Set
+
+from .graph_backend import GraphBackend, Quintuple, DEFAULT_KEYWORD_LIMIT, _valid_rows
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SNAPSHOT_PATH = "logs/knowledge_graph/graph.snapshot"
+SNAPSHOT_MAGIC = b"NGKG"
+SNAPSHOT_VERSION = 1
+# 头部: magic, version, 源五元组数, 字符串数, 字符串区字节数, 实体数, 边数
+_HEADER = struct.Struct("<4sIQIQII")
+
+
+class EmbeddedGraphBackend(GraphBackend):
+    """进程内图谱索引"""
+
+    name = "embedded"
+
+    def __init__(self, snapshot_path: Optional[str] = DEFAULT_SNAPSHOT_PATH,
+                 snapshot_every: int = 1000, source_store=None):
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every  # 累计写入多少条后自动保存快照
+        self._lock = threading.RLock()
+        self._reset()
+        self._dirty = 0
+        self._source_store = source_store  # 五元组存储（权威数据源）
+        self._source_count = 0  # 快照对应的源五元组数量，用于判断快照是否过期
+        self._stats = {"write_batches": 0, "read_queries": 0, "snapshot_loads": 0, "snapshot_saves": 0}
+        self._load(source_store)
+        if snapshot_path:
+            atexit.register(self.close)
+
+    def _reset(self):
+        # 字符串驻留表
+        self._strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+        # 实体: 名称字符串id / 类型字符串id
+        self._ent_name = array("i")
+        self._ent_type = array("i")
+        self._ent_by_name: Dict[int, int] = {}  # 名称sid -> 实体id
+        self._ents_by_type: Dict[int, Set[int]] = {}  # 类型sid -> 实体id集合
+        # 边: 头实体 / 关系sid / 尾实体
+        self._edge_head = array("i")
+        self._edge_rel = array("i")
+        self._edge_tail = array("i")
+        self._edge_keys: Dict[tuple, int] = {}  # (头, 关系, 尾) -> 边id，用于MERGE去重
+        self._edges_by_rel: Dict[int, List[int]] = {}
+        self._edges_by_type: Dict[int, List[int]] = {}  # 实体类型sid -> 端点为该类型的边id
+        self._type_unsorted: Set[int] = set()  # 实体改类型后需重新排序的类型列表
+        self._out_adj: List[List[int]] = []
+        self._in_adj: List[List[int]] = []
+        # n-gram索引: 单字和二元组 -> 字符串id集合
+        self._grams: Dict[str, Set[int]] = {}
+
+    # ---------- 内部索引维护 ----------
+    def _intern(self, s: str) -> int:
+        sid = self._string_ids.get(s)
+        if sid is None:
+            sid = len(self._strings)
+            self._strings.append(s)
+            self._string_ids[s] = sid
+            for g in self._grams_of(s):
+                self._grams.setdefault(g, set()).add(sid)
+        return sid
+
+    @staticmethod
+    def _grams_of(s: str) -> Set[str]:
+        grams = set(s)
+        grams.update(s[i:i + 2] for i in range(len(s) - 1))
+        return grams
+
+    def _entity(self, name: str, entity_type: str) -> int:
+        name_sid = self._intern(name)
+        type_sid = self._intern(entity_type or "")
+        eid = self._ent_by_name.get(name_sid)
+        if eid is None:
+            eid = len(self._ent_name)
+            self._ent_name.append(name_sid)
+            self._ent_type.append(type_sid)
+            self._ent_by_name[name_sid] = eid
+            self._ents_by_type.setdefault(type_sid, set()).add(eid)
+            self._out_adj.append([])
+            self._in_adj.append([])
+        elif self._ent_type[eid] != type_sid:
+            # 与Neo4j的 MERGE ... SET entity_type 语义一致：后写覆盖
+            self._ents_by_type[self._ent_type[eid]].discard(eid)
+            self._ent_type[eid] = type_sid
+            self._ents_by_type.setdefault(type_sid, set()).add(eid)
+            # 旧类型列表中的边在查询时按当前类型过滤，新类型列表追加后标记待排序
+            moved = self._out_adj[eid] + self._in_adj[eid]
+            if moved:
+                self._edges_by_type.setdefault(type_sid, []).extend(moved)
+                self._type_unsorted.add(type_sid)
+        return eid
+
+    def _add_edge(self, head: int, rel_sid: int, tail: int) -> bool:
+        key = (head, rel_sid, tail)
+        if key in self._edge_keys:
+            return False
+        edge_id = len(self._edge_head)
+        self._edge_head.append(head)
+        self._edge_rel.append(rel_sid)
+        self._edge_tail.append(tail)
+        self._edge_keys[key] = edge_id
+        self._edges_by_rel.setdefault(rel_sid, []).append(edge_id)
+        self._out_adj[head].append(edge_id)
+        self._in_adj[tail].append(edge_id)
+        head_type, tail_type = self._ent_type[head], self._ent_type[tail]
+        self._edges_by_type.setdefault(head_type, []).append(edge_id)
+        if tail_type != head_type:
+            self._edges_by_type.setdefault(tail_type, []).append(edge_id)
+        return True
+
+    def _ingest(self, rows: Iterable[Quintuple]) -> int:
+        count = 0
+        for head, head_type, rel, tail, tail_type in rows:
+            h = self._entity(head, head_type)
+            t = self._entity(tail, tail_type)
+            self._add_edge(h, self._intern(rel), t)
+            count += 1
+        return count
+
+    def _matching_strings(self, kw: str) -> Set[int]:
+        """n-gram候选 + 子串校验，得到包含关键词的字符串id"""
+        if len(kw) == 1:
+            return set(self._grams.get(kw, ()))
+        gram_sets = []
+        for i in range(len(kw) - 1):
+            ids = self._grams.get(kw[i:i + 2])
+            if not ids:
+                return set()
+            gram_sets.append(ids)
+        # 从最小的集合开始求交，减少中间结果
+        gram_sets.sort(key=len)
+        candidates = gram_sets[0]
+        for ids in gram_sets[1:]:
+            candidates = candidates & ids
+            if not candidates:
+                return set()
+        return {sid for sid in candidates if kw in self._strings[sid]}
+
+    def _type_edges(self, type_sid: int):
+        """端点类型为type_sid的边（递增顺序，过滤因实体改类型而失效的条目）"""
+        edges = self._edges_by_type.get(type_sid)
+        if not edges:
+            return ()
+        if type_sid in self._type_unsorted:
+            edges.sort()
+            self._type_unsorted.discard(type_sid)
+        ent_type, head, tail = self._ent_type, self._edge_head, self._edge_tail
+        return (e for e in edges if ent_type[head[e]] == type_sid or ent_type[tail[e]] == type_sid)
+
+    def _edge_tuple(self, edge_id: int) -> Quintuple:
+        h = self._edge_head[edge_id]
+        t = self._edge_tail[edge_id]
+        s = self._strings
+        return (s[self._ent_name[h]], s[self._ent_type[h]], s[self._edge_rel[edge_id]],
+                s[self._ent_name[t]], s[self._ent_type[t]])
+
+    # ---------- GraphBackend接口 ----------
+    def merge_quintuples(self, quintuples: Sequence[Quintuple]) -> int:
+        rows = _valid_rows(quintuples)
+        if not rows:
+            return 0
+        with self._lock:
+            written = self._ingest(rows)
+            self._stats["write_batches"] += 1
+            self._dirty += written
+            if self.snapshot_path and self._dirty >= self.snapshot_every:
+                self.save_snapshot()
+        return written
+
+    def query_by_keywords(self, keywords: Sequence[str], limit_per_keyword: int = DEFAULT_KEYWORD_LIMIT) -> List[Quintuple]:
+        results = []
+        with self._lock:
+            self._stats["read_queries"] += 1
+            for kw in keywords:
+                if not kw:
+                    continue
+                # 各邻接表/倒排表中的边id均按写入顺序递增，多路归并后取前N个即可，无需物化全部命中
+                sources = []
+                for sid in self._matching_strings(kw):
+                    # 实体名命中：该实体的出边和入边
+                    eid = self._ent_by_name.get(sid)
+                    if eid is not None:
+                        sources.append(self._out_adj[eid])
+                        sources.append(self._in_adj[eid])
+                    # 实体类型命中：端点为该类型的边
+                    if sid in self._edges_by_type:
+                        sources.append(self._type_edges(sid))
+                    # 关系名命中
+                    rel_edges = self._edges_by_rel.get(sid)
+                    if rel_edges:
+                        sources.append(rel_edges)
+                picked = []
+                for edge_id in heapq.merge(*[src for src in sources if src]):
+                    if picked and picked[-1] == edge_id:
+                        continue
+                    picked.append(edge_id)
+                    if len(picked) >= limit_per_keyword:
+                        break
+                for edge_id in picked:
+                    results.append(self._edge_tuple(edge_id))
+        return results
+
+    def neighbors(self, entity: str) -> List[Quintuple]:
+        """实体的全部出边和入边"""
+        with self._lock:
+            eid = self._ent_by_name.get(self._string_ids.get(entity, -1))
+            if eid is None:
+                return []
+            return [self._edge_tuple(e) for e in self._out_adj[eid] + self._in_adj[eid]]
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "strings": len(self._strings),
+                "entities": len(self._ent_name),
+                "edges": len(self._edge_head),
+                "grams": len(self._grams),
+                "source_count": self._source_count,
+                **self._stats,
+            }
+
+    def close(self):
+        if self.snapshot_path and self._dirty:
+            try:
+                self.save_snapshot()
+            except Exception as e:
+                logger.error(f"保存图谱快照失败: {e}")
+
+    # ---------- 快照 ----------
+    def save_snapshot(self, path: Optional[str] = None):
+        """保存紧凑二进制快照（写临时文件后原子替换）"""
+        path = path or self.snapshot_path
+        with self._lock:
+            if self._source_store is not None:
+                try:
+                    self._source_count = self._source_store.count()
+                except Exception as e:
+                    logger.debug(f"读取五元组存储数量失败: {e}")
+            blob = bytearray()
+            offsets = array("I")
+            for s in self._strings:
+                offsets.append(len(blob))
+                blob += s.encode("utf-8")
+            offsets.append(len(blob))
+            header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self._source_count,
+                                  len(self._strings), len(blob), len(self._ent_name), len(self._edge_head))
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(header)
+                f.write(offsets.tobytes())
+                f.write(blob)
+                for arr in (self._ent_name, self._ent_type, self._edge_head, self._edge_rel, self._edge_tail):
+                    f.write(arr.tobytes())
+            os.replace(tmp, path)
+            self._dirty = 0
+            self._stats["snapshot_saves"] += 1
+
+    def load_snapshot(self, path: Optional[str] = None) -> bool:
+        """通过mmap加载快照并重建索引"""
+        path = path or self.snapshot_path
+        if not path or not os.path.exists(path) or os.path.getsize(path) < _HEADER.size:
+            return False
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, source_count, n_str, blob_len, n_ent, n_edge = _HEADER.unpack_from(mm, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                logger.warning(f"图谱快照格式不匹配，忽略: {path}")
+                return False
+            view = memoryview(mm)
+            try:
+                pos = _HEADER.size
+                offsets = view[pos:pos + (n_str + 1) * 4].cast("I")
+                pos += (n_str + 1) * 4
+                blob = view[pos:pos + blob_len]
+                pos += blob_len
+
+                def _ints(n):
+                    nonlocal pos
+                    arr = array("i")
+                    arr.frombytes(view[pos:pos + n * 4])
+                    pos += n * 4
+                    return arr
+
+                with self._lock:
+                    self._reset()
+                    for i in range(n_str):
+                        s = bytes(blob[offsets[i]:offsets[i + 1]]).decode("utf-8")
+                        self._intern(s)
+                    self._ent_name = _ints(n_ent)
+                    self._ent_type = _ints(n_ent)
+                    edge_head, edge_rel, edge_tail = _ints(n_edge), _ints(n_edge), _ints(n_edge)
+                    del offsets, blob
+                    for eid in range(n_ent):
+                        self._ent_by_name[self._ent_name[eid]] = eid
+                        self._ents_by_type.setdefault(self._ent_type[eid], set()).add(eid)
+                        self._out_adj.append([])
+                        self._in_adj.append([])
+                    for i in range(n_edge):
+                        self._add_edge(edge_head[i], edge_rel[i], edge_tail[i])
+                    self._source_count = source_count
+                    self._dirty = 0
+            finally:
+                view.release()
+        self._stats["snapshot_loads"] += 1
+        return True
+
+    def _load(self, source_store):
+        """优先加载快照；快照缺失或与五元组存储数量不一致时从存储重建"""
+        loaded = False
+        try:
+            loaded = self.load_snapshot()
+        except Exception as e:
+            logger.warning(f"加载图谱快照失败，将从五元组存储重建: {e}")
+        if source_store is None:
+            return
+        try:
+            total = source_store.count()
+            if loaded and total == self._source_count:
+                logger.info(f"嵌入式图谱已从快照加载: {len(self._edge_head)} 条边")
+                return
+            with self._lock:
+                self._reset()
+                rows = _valid_rows(source_store.get_all())
+                self._ingest(rows)
+                self._source_count = total
+                self._dirty = len(rows)
+            logger.info(f"嵌入式图谱已从五元组存储重建: {len(self._edge_head)} 条边")
+            if self.snapshot_path:
+                self.save_snapshot()
+        except Exception as e:
+            logger.error(f"从五元组存储构建嵌入式图谱失败: {e}")
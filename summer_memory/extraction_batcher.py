@@ -0,0 +1,308 @@
+"""
+五元组批量提取
+- 对话轮次先进入批次缓冲区，凑满批次大小/字符上限或等待超过时间窗口后合并为一次带轮次标记的LLM请求
+- 回复按轮次编号拆回各轮；回复被截断或无法拆分时对半拆分重试，单轮仍失败才放弃，不损失产出
+- 根据回复长度和失败率自适应调整批次大小（失败减半，回复余量充足时逐步增大）
+- 批次作为一个任务提交给QuintupleTaskManager执行，结果经on_task_completed回调入库
+- 每批有截止时间（任务执行超时减去余量），各次请求、重试和拆分共享，保证在任务管理器判定超时前结束
+- 进程退出时在有限时间内同步提取并入库尚未提交的轮次；清空记忆时丢弃待提取轮次并取消已提交的批次
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from .task_manager import task_manager, TaskPriority, TaskQueueFullError
+
+logger = logging.getLogger(__name__)
+
+MIN_TURN_TOKENS = 200  # 单轮回复预算下限（与单轮提取的max_tokens一致）
+MAX_TURN_TOKENS = 800  # 单轮回复预算上限
+GROW_THRESHOLD = 0.6  # 回复占预算比例低于该值时增大批次
+DEADLINE_MARGIN = 5.0  # 批次截止时间相对任务执行超时的余量（秒），含线程池排队
+SHUTDOWN_TIMEOUT = 30.0  # 进程退出时同步提取剩余轮次的最长时间（秒）
+
+
+class ExtractionBatcher:
+    """对话轮次批量提取器"""
+
+    def __init__(self, max_turns: int = 8, window_seconds: float = 30.0, max_chars: int = 6000,
+                 max_tokens: int = 2000, run_timeout: float = 120.0):
+        self.max_turns = max_turns
+        self.window_seconds = window_seconds
+        self.max_chars = max_chars
+        self.max_tokens = max_tokens
+        self.run_timeout = run_timeout
+        self.batch_turns = max(1, min(4, max_turns))  # 当前批次大小，按结果自适应
+        self._tokens_per_char = 0.5  # 回复token数/输入字符数的滑动平均，用于估算回复预算
+        self._cond = threading.Condition()
+        self._pending: List[Tuple[str, str]] = []  # (文本哈希, 文本)
+        self._pending_hashes = set()
+        self._pending_chars = 0
+        self._first_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+        self._submitted: Set[str] = set()  # 已提交、可能尚未完成的批次任务ID
+        self._stats = {"turns": 0, "duplicates": 0, "dropped_turns": 0, "cleared_turns": 0, "extracted_turns": 0,
+                       "batches": 0, "requests": 0, "splits": 0,
+                       "truncated": 0, "errors": 0, "failed_turns": 0, "quintuples": 0, "completion_tokens": 0}
+
+    # ---------- 收集 ----------
+    async def add(self, text: str) -> Optional[str]:
+        """加入一轮对话；凑满一批时立即提交（队列满时等待，形成背压），返回提交的任务ID"""
+        text_hash = hashlib.sha256(text.encode()).hexdigest()
+        with self._cond:
+            if text_hash in self._pending_hashes:
+                self._stats["duplicates"] += 1
+                return None
+            self._pending.append((text_hash, text))
+            self._pending_hashes.add(text_hash)
+            self._pending_chars += len(text)
+            self._stats["turns"] += 1
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            batch = self._take() if self._full() else None
+            self._cond.notify()
+        self._ensure_timer()
+        if batch:
+            return await self._submit_async(batch)
+        return None
+
+    def _full(self) -> bool:
+        return len(self._pending) >= self.batch_turns or self._pending_chars >= self.max_chars
+
+    def _take(self) -> List[str]:
+        """取出一批（需持有锁）"""
+        batch, chars = [], 0
+        while self._pending and len(batch) < self.batch_turns:
+            text_hash, text = self._pending[0]
+            if batch and chars + len(text) > self.max_chars:
+                break
+            self._pending.pop(0)
+            self._pending_hashes.discard(text_hash)
+            batch.append(text)
+            chars += len(text)
+        self._pending_chars -= chars
+        self._first_at = time.monotonic() if self._pending else None
+        return batch
+
+    def _label(self, batch: List[str]) -> str:
+        return f"batch[{len(batch)}]:" + "|".join(t[:20] for t in batch)
+
+    def _track(self, task_id: Optional[str]) -> Optional[str]:
+        """记录已提交的批次，顺带清理已结束的任务ID"""
+        if task_id:
+            with self._cond:
+                self._submitted = {tid for tid in self._submitted
+                                   if (task_manager.get_task_status(tid) or {}).get("status") in ("pending", "running")}
+                self._submitted.add(task_id)
+        return task_id
+
+    async def _submit_async(self, batch: List[str]) -> Optional[str]:
+        try:
+            return self._track(await task_manager.submit(self._label(batch), priority=TaskPriority.BACKGROUND,
+                                                         func=self.run_batch, args=(batch,),
+                                                         run_timeout=self.run_timeout))
+        except TaskQueueFullError as e:
+            logger.warning(f"提取队列积压，丢弃本批 {len(batch)} 轮对话: {e}")
+            with self._cond:
+                self._stats["dropped_turns"] += len(batch)
+            return None
+
+    # ---------- 时间窗口 ----------
+    def _ensure_timer(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._timer_loop, name="ExtractionBatcher", daemon=True)
+            self._thread.start()
+
+    def _timer_loop(self):
+        """等待时间窗口到期后提交未满的批次"""
+        while True:
+            with self._cond:
+                while self._first_at is None:
+                    self._cond.wait()
+                remaining = self._first_at + self.window_seconds - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(timeout=remaining)
+                    continue
+                batch = self._take()
+            if batch:
+                self._submit_nowait(batch)
+
+    def _submit_nowait(self, batch: List[str]):
+        try:
+            self._track(task_manager.add_task(self._label(batch), priority=TaskPriority.BACKGROUND,
+                                              func=self.run_batch, args=(batch,), run_timeout=self.run_timeout))
+        except TaskQueueFullError:
+            # 队列满时放回，下个时间窗口再提交
+            with self._cond:
+                for text in reversed(batch):
+                    text_hash = hashlib.sha256(text.encode()).hexdigest()
+                    self._pending.insert(0, (text_hash, text))
+                    self._pending_hashes.add(text_hash)
+                    self._pending_chars += len(text)
+                self._first_at = time.monotonic()
+        except Exception as e:
+            logger.error(f"提交批量提取任务失败: {e}")
+
+    def flush(self):
+        """立即提交所有待提取的轮次"""
+        while True:
+            with self._cond:
+                batch = self._take()
+            if not batch:
+                return
+            self._submit_nowait(batch)
+
+    def clear(self) -> int:
+        """丢弃待提取的轮次并取消已提交的批次（清空记忆时调用），返回丢弃的轮数"""
+        with self._cond:
+            dropped = len(self._pending)
+            self._pending.clear()
+            self._pending_hashes.clear()
+            self._pending_chars = 0
+            self._first_at = None
+            self._stats["cleared_turns"] += dropped
+            submitted, self._submitted = self._submitted, set()
+        for task_id in submitted:
+            task_manager.cancel_task(task_id)
+        return dropped
+
+    def shutdown(self, timeout: float = SHUTDOWN_TIMEOUT) -> int:
+        """进程退出时调用：事件循环可能已停止，直接在当前线程提取剩余轮次并入库，返回入库的五元组数"""
+        with self._cond:
+            batch = self._take_all()
+        if not batch:
+            return 0
+        from .quintuple_graph import store_quintuples
+        deadline = time.monotonic() + timeout
+        stored = 0
+        for start in range(0, len(batch), self.max_turns):
+            chunk = batch[start:start + self.max_turns]
+            if time.monotonic() >= deadline:
+                logger.warning(f"退出前提取超时，放弃 {len(batch) - start} 轮对话")
+                with self._cond:
+                    self._stats["dropped_turns"] += len(batch) - start
+                break
+            quintuples = self.run_batch(chunk, deadline=deadline)
+            if quintuples and store_quintuples(quintuples):
+                stored += len(quintuples)
+        logger.info(f"退出前提取完成: {len(batch)}轮，入库 {stored} 个五元组")
+        return stored
+
+    def _take_all(self) -> List[str]:
+        """取出全部待提取轮次（需持有锁）"""
+        batch = [text for _, text in self._pending]
+        self._pending.clear()
+        self._pending_hashes.clear()
+        self._pending_chars = 0
+        self._first_at = None
+        return batch
+
+    # ---------- 执行（在任务管理器线程池中运行） ----------
+    def _budget(self, batch: List[str]) -> int:
+        """按输入长度估算回复预算"""
+        per_turn = [min(MAX_TURN_TOKENS, max(MIN_TURN_TOKENS, int(len(t) * self._tokens_per_char * 1.5))) for t in batch]
+        return min(self.max_tokens, sum(per_turn))
+
+    def _adapt(self, batch: List[str], budget: int, info: Dict, ok: bool):
+        """失败或截断时批次减半；回复余量充足时批次加一"""
+        with self._cond:
+            if not ok or info.get("truncated"):
+                self.batch_turns = max(1, min(self.batch_turns, len(batch)) // 2)
+                return
+            chars = sum(len(t) for t in batch)
+            if chars and info.get("completion_tokens"):
+                self._tokens_per_char = 0.8 * self._tokens_per_char + 0.2 * (info["completion_tokens"] / chars)
+            if len(batch) >= self.batch_turns and info.get("completion_tokens", 0) < budget * GROW_THRESHOLD:
+                self.batch_turns = min(self.max_turns, self.batch_turns + 1)
+
+    def _extract(self, batch: List[str], deadline: float) -> List[List[tuple]]:
+        from .quintuple_extractor import extract_quintuples_batch
+        budget = self._budget(batch)
+        results, info = extract_quintuples_batch(batch, max_tokens=budget, deadline=deadline)
+        ok = results is not None
+        with self._cond:
+            self._stats["requests"] += 1
+            self._stats["completion_tokens"] += info.get("completion_tokens", 0)
+            if info.get("truncated"):
+                self._stats["truncated"] += 1
+            if not ok:
+                self._stats["errors"] += 1
+        if ok:
+            self._adapt(batch, budget, info, ok)
+            return results
+        if info.get("expired"):
+            # 时间用尽：不再拆分，也不据此缩小批次
+            logger.error(f"五元组提取超出批次时限，放弃 {len(batch)} 轮")
+            with self._cond:
+                self._stats["failed_turns"] += len(batch)
+            return [[] for _ in batch]
+        self._adapt(batch, budget, info, ok)
+        if len(batch) == 1:
+            logger.error(f"五元组提取失败: {info.get('error')}")
+            with self._cond:
+                self._stats["failed_turns"] += 1
+            return [[]]
+        # 回复被截断或无法拆分：对半拆分重试
+        logger.warning(f"批量提取失败（{info.get('error') or '回复被截断'}），拆分为两批重试")
+        with self._cond:
+            self._stats["splits"] += 1
+        middle = len(batch) // 2
+        return self._extract(batch[:middle], deadline) + self._extract(batch[middle:], deadline)
+
+    def run_batch(self, batch: List[str], deadline: Optional[float] = None) -> List[tuple]:
+        """提取一批对话的五元组，返回合并后的五元组列表
+
+        deadline默认为任务执行超时减去余量，拆分后的各次请求共享同一截止时间
+        """
+        if deadline is None:
+            deadline = time.monotonic() + max(1.0, self.run_timeout - DEADLINE_MARGIN)
+        per_turn = self._extract(batch, deadline)
+        quintuples = [q for turn in per_turn for q in turn]
+        with self._cond:
+            self._stats["batches"] += 1
+            self._stats["extracted_turns"] += len(batch)
+            self._stats["quintuples"] += len(quintuples)
+        logger.info(f"批量提取完成: {len(batch)}轮，各轮五元组数 {[len(t) for t in per_turn]}")
+        return quintuples
+
+    def get_stats(self) -> Dict:
+        with self._cond:
+            turns_done = self._stats["extracted_turns"]
+            return {
+                **self._stats,
+                "pending_turns": len(self._pending),
+                "batch_turns": self.batch_turns,
+                "max_turns": self.max_turns,
+                "window_seconds": self.window_seconds,
+                # 与逐轮提取对比：每轮请求数（逐轮为1）和每轮五元组产出
+                "requests_per_turn": round(self._stats["requests"] / turns_done, 3) if turns_done > 0 else 0.0,
+                "quintuples_per_turn": round(self._stats["quintuples"] / turns_done, 3) if turns_done > 0 else 0.0,
+            }
+
+
+_BATCHER: Optional[ExtractionBatcher] = None
+
+
+def get_extraction_batcher() -> ExtractionBatcher:
+    """获取全局批量提取器"""
+    global _BATCHER
+    if _BATCHER is None:
+        try:
+            from config import config
+            _BATCHER = ExtractionBatcher(
+                max_turns=getattr(config.grag, 'extraction_batch_max_turns', 8),
+                window_seconds=getattr(config.grag, 'extraction_batch_window', 30.0),
+                max_chars=getattr(config.grag, 'extraction_batch_max_chars', 6000),
+                max_tokens=getattr(config.grag, 'extraction_max_tokens', 2000),
+                run_timeout=getattr(config.grag, 'extraction_batch_timeout', 120.0),
+            )
+        except Exception:
+            _BATCHER = ExtractionBatcher()
+    return _BATCHER
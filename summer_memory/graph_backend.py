@@ -0,0 +1,275 @@
+"""
+GRAG图谱后端接口
+- GraphBackend: 统一接口（批量写入五元组 / 按关键词批量查询）
+- Neo4jGraphBackend: 连接池驱动 + 参数化 UNWIND 批量写入，单条参数化查询覆盖所有关键词
+- InMemoryGraphBackend: 进程内假后端，实现相同接口，用于离线测试
+- EmbeddedGraphBackend: 嵌入式索引后端（见embedded_graph.py），Neo4j不可用时的降级方案
+"""
+
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+Quintuple = Tuple[str, str, str, str, str]
+
+# 单关键词返回条数上限（与旧版 LIMIT 5 一致）
+DEFAULT_KEYWORD_LIMIT = 5
+
+
+def _valid_rows(quintuples: Iterable) -> List[Quintuple]:
+    """过滤head或tail为空的五元组"""
+    rows = []
+    for q in quintuples:
+        try:
+            head, head_type, rel, tail, tail_type = q
+        except (TypeError, ValueError):
+            logger.warning(f"跳过格式错误的五元组: {q}")
+            continue
+        if not head or not tail or not rel:
+            logger.warning(f"跳过无效五元组，head/rel/tail为空: {q}")
+            continue
+        rows.append((head, head_type, rel, tail, tail_type))
+    return rows
+
+
+class GraphBackend:
+    """图谱后端接口"""
+
+    name = "base"
+
+    def merge_quintuples(self, quintuples: Sequence[Quintuple]) -> int:
+        """批量合并五元组，返回成功写入的数量"""
+        raise NotImplementedError
+
+    def query_by_keywords(self, keywords: Sequence[str], limit_per_keyword: int = DEFAULT_KEYWORD_LIMIT) -> List[Quintuple]:
+        """按关键词查询相关五元组（实体名/实体类型/关系名包含关键词）"""
+        raise NotImplementedError
+
+    def is_available(self) -> bool:
+        return True
+
+    def get_stats(self) -> Dict:
+        return {"backend": self.name}
+
+    def close(self):
+        pass
+
+
+class InMemoryGraphBackend(GraphBackend):
+    """内存假后端：语义与Neo4j后端一致（MERGE去重、CONTAINS匹配、每关键词LIMIT）"""
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.nodes: Dict[str, str] = {}  # name -> entity_type
+        self.edges: Dict[Tuple[str, str, str], Dict[str, str]] = {}  # (head, rel, tail) -> 属性
+        self.write_batches = 0  # 写事务次数，用于验证批量写入
+        self.read_queries = 0  # 读查询次数
+
+    def merge_quintuples(self, quintuples: Sequence[Quintuple]) -> int:
+        rows = _valid_rows(quintuples)
+        if not rows:
+            return 0
+        with self._lock:
+            self.write_batches += 1
+            for head, head_type, rel, tail, tail_type in rows:
+                self.nodes[head] = head_type
+                self.nodes[tail] = tail_type
+                self.edges[(head, rel, tail)] = {"head_type": head_type, "tail_type": tail_type}
+        return len(rows)
+
+    def query_by_keywords(self, keywords: Sequence[str], limit_per_keyword: int = DEFAULT_KEYWORD_LIMIT) -> List[Quintuple]:
+        keywords = [kw for kw in keywords if kw]
+        if not keywords:
+            return []
+        results = []
+        with self._lock:
+            self.read_queries += 1
+            for kw in keywords:
+                hits = 0
+                for (head, rel, tail) in self.edges:
+                    head_type = self.nodes.get(head, "")
+                    tail_type = self.nodes.get(tail, "")
+                    if (kw in head or kw in tail or kw in rel
+                            or kw in (head_type or "") or kw in (tail_type or "")):
+                        results.append((head, head_type, rel, tail, tail_type))
+                        hits += 1
+                        if hits >= limit_per_keyword:
+                            break
+        return results
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {
+                "backend": self.name,
+                "nodes": len(self.nodes),
+                "edges": len(self.edges),
+                "write_batches": self.write_batches,
+                "read_queries": self.read_queries,
+            }
+
+
+# 按关键词查询：一条参数化语句覆盖全部关键词，查询计划可被服务端缓存
+_KEYWORD_QUERY = """
+UNWIND $keywords AS kw
+CALL {
+    WITH kw
+    MATCH (e1:Entity)-[r]->(e2:Entity)
+    WHERE e1.name CONTAINS kw OR e2.name CONTAINS kw OR type(r) CONTAINS kw
+       OR e1.entity_type CONTAINS kw OR e2.entity_type CONTAINS kw
+    RETURN e1.name AS head, e1.entity_type AS head_type, type(r) AS rel,
+           e2.name AS tail, e2.entity_type AS tail_type
+    LIMIT $limit
+}
+RETURN head, head_type, rel, tail, tail_type
+"""
+
+
+def _merge_statement(rel_type: str) -> str:
+    """关系类型无法参数化，按关系类型分组生成语句（反引号转义）"""
+    escaped = rel_type.replace("`", "``")
+    return (
+        "UNWIND $rows AS row\n"
+        "MERGE (h:Entity {name: row.head}) SET h.entity_type = row.head_type\n"
+        "MERGE (t:Entity {name: row.tail}) SET t.entity_type = row.tail_type\n"
+        f"MERGE (h)-[r:`{escaped}`]->(t)\n"
+        "SET r.head_type = row.head_type, r.tail_type = row.tail_type"
+    )
+
+
+class Neo4jGraphBackend(GraphBackend):
+    """Neo4j后端：官方驱动连接池，单事务批量写入"""
+
+    name = "neo4j"
+
+    def __init__(self, uri: str, user: str, password: str, database: str = "neo4j",
+                 pool_size: int = 10, connect_timeout: float = 5.0,
+                 query_timeout: float = 10.0, batch_size: int = 500):
+        from neo4j import GraphDatabase  # 延迟导入，未安装时由调用方降级
+
+        self.database = database
+        self.query_timeout = query_timeout
+        self.batch_size = batch_size
+        self._driver = GraphDatabase.driver(
+            uri,
+            auth=(user, password),
+            max_connection_pool_size=pool_size,
+            connection_timeout=connect_timeout,
+            connection_acquisition_timeout=connect_timeout,
+        )
+        # 启动时校验连通性，失败直接抛出由调用方处理
+        self._driver.verify_connectivity()
+        self._stats = {"write_batches": 0, "written": 0, "read_queries": 0, "errors": 0}
+
+    def _query(self, text: str):
+        from neo4j import Query
+        return Query(text, timeout=self.query_timeout)
+
+    def merge_quintuples(self, quintuples: Sequence[Quintuple]) -> int:
+        rows = _valid_rows(quintuples)
+        if not rows:
+            return 0
+
+        # 按关系类型分组，同一事务内每种关系一条UNWIND语句
+        grouped = defaultdict(list)
+        for head, head_type, rel, tail, tail_type in rows:
+            grouped[rel].append({
+                "head": head, "head_type": head_type,
+                "tail": tail, "tail_type": tail_type,
+            })
+
+        def _write(tx, groups):
+            for rel, rel_rows in groups:
+                tx.run(self._query(_merge_statement(rel)), rows=rel_rows).consume()
+
+        written = 0
+        items = list(grouped.items())
+        with self._driver.session(database=self.database) as session:
+            # 超大批次按batch_size切分，避免单事务过大
+            chunk, chunk_count = [], 0
+            for rel, rel_rows in items:
+                for i in range(0, len(rel_rows), self.batch_size):
+                    part = rel_rows[i:i + self.batch_size]
+                    chunk.append((rel, part))
+                    chunk_count += len(part)
+                    if chunk_count >= self.batch_size:
+                        session.execute_write(_write, chunk)
+                        self._stats["write_batches"] += 1
+                        written += chunk_count
+                        chunk, chunk_count = [], 0
+            if chunk:
+                session.execute_write(_write, chunk)
+                self._stats["write_batches"] += 1
+                written += chunk_count
+        self._stats["written"] += written
+        return written
+
+    def query_by_keywords(self, keywords: Sequence[str], limit_per_keyword: int = DEFAULT_KEYWORD_LIMIT) -> List[Quintuple]:
+        keywords = [kw for kw in keywords if kw]
+        if not keywords:
+            return []
+
+        def _read(tx):
+            result = tx.run(self._query(_KEYWORD_QUERY), keywords=keywords, limit=limit_per_keyword)
+            return [(r["head"], r["head_type"], r["rel"], r["tail"], r["tail_type"]) for r in result]
+
+        with self._driver.session(database=self.database) as session:
+            records = session.execute_read(_read)
+        self._stats["read_queries"] += 1
+        return records
+
+    def get_stats(self) -> Dict:
+        return {"backend": self.name, **self._stats}
+
+    def close(self):
+        try:
+            self._driver.close()
+        except Exception as e:
+            logger.debug(f"关闭Neo4j驱动失败: {e}")
+
+
+def create_graph_backend(grag_config) -> Optional[GraphBackend]:
+    """根据GRAG配置创建图谱后端，Neo4j不可用时返回None"""
+    backend = getattr(grag_config, "graph_backend", "neo4j")
+    if backend == "memory":
+        return InMemoryGraphBackend()
+    if backend == "embedded":
+        return _create_embedded_backend(grag_config)
+    try:
+        return Neo4jGraphBackend(
+            uri=grag_config.neo4j_uri,
+            user=grag_config.neo4j_user,
+            password=grag_config.neo4j_password,
+            database=grag_config.neo4j_database,
+            pool_size=getattr(grag_config, "neo4j_pool_size", 10),
+            connect_timeout=getattr(grag_config, "neo4j_connect_timeout", 5.0),
+            query_timeout=getattr(grag_config, "neo4j_query_timeout", 10.0),
+            batch_size=getattr(grag_config, "neo4j_batch_size", 500),
+        )
+    except ImportError:
+        logger.error("未安装neo4j驱动，请执行 pip install neo4j")
+    except Exception as e:
+        logger.error(f"Neo4j连接失败: {e}")
+    # Neo4j不可用时降级为嵌入式后端，保证记忆召回可用
+    if getattr(grag_config, "graph_backend_fallback", True):
+        logger.warning("Neo4j不可用，降级使用嵌入式图谱后端")
+        return _create_embedded_backend(grag_config)
+    return None
+
+
+def _create_embedded_backend(grag_config) -> Optional[GraphBackend]:
+    """创建嵌入式后端，以本地五元组存储为数据源"""
+    try:
+        from .embedded_graph import EmbeddedGraphBackend, DEFAULT_SNAPSHOT_PATH
+        from .quintuple_store import get_quintuple_store
+        return EmbeddedGraphBackend(
+            snapshot_path=getattr(grag_config, "embedded_snapshot_path", DEFAULT_SNAPSHOT_PATH),
+            source_store=get_quintuple_store(),
+        )
+    except Exception as e:
+        logger.error(f"嵌入式图谱后端初始化失败: {e}")
+        return None
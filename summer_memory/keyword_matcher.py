@@ -0,0 +1,259 @@
+"""
+本地关键词/实体匹配器
+- Aho-Corasick自动机，词表为五元组存储中的全部实体名和关系名
+- 增量更新：新词先进入小型增量自动机，累积到阈值后合并重建主自动机
+- 命中时直接用匹配到的词查询图谱，未命中才回退到LLM关键词提取
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class AhoCorasick:
+    """多模式字符串匹配自动机"""
+
+    def __init__(self, words: Iterable[str] = ()):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[str, ...]] = [()]
+        self.size = 0
+        for w in words:
+            self._insert(w)
+        self._build()
+
+    def _insert(self, word: str):
+        if not word:
+            return
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = nxt
+        if word not in self._out[node]:
+            self._out[node] = self._out[node] + (word,)
+            self.size += 1
+
+    def _build(self):
+        """BFS构建失配指针，并把失配链上的输出合并到当前节点"""
+        queue = deque()
+        for nxt in self._goto[0].values():
+            self._fail[nxt] = 0
+            queue.append(nxt)
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                if self._out[self._fail[nxt]]:
+                    self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def iter_matches(self, text: str):
+        """产出 (结束位置, 词)"""
+        node = 0
+        goto, fail, out = self._goto, self._fail, self._out
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                for word in out[node]:
+                    yield i, word
+
+
+class KeywordMatcher:
+    """基于五元组存储的实体/关系匹配器"""
+
+    def __init__(self, min_term_len: int = 2, delta_merge_threshold: int = 256):
+        self.min_term_len = min_term_len  # 过短的词（如单字）容易误命中，默认忽略
+        self.delta_merge_threshold = delta_merge_threshold  # 增量词数达到阈值后合并重建
+        self._lock = threading.RLock()
+        self._terms: Set[str] = set()
+        self._main: Optional[AhoCorasick] = None
+        self._delta_terms: Set[str] = set()
+        self._delta: Optional[AhoCorasick] = None
+        self._needs_rebuild = True
+        self._building = False
+        self._pending_terms: Set[str] = set()  # 全量构建期间到达的新词
+        self._pending_reset = False
+        self._store = None
+        self._stats = {
+            "queries": 0,
+            "local_hits": 0,  # 本地匹配命中（无需LLM）
+            "llm_fallbacks": 0,  # 回退到LLM提取
+            "rebuilds": 0,
+            "delta_updates": 0,
+            "matches": 0,
+            "match_time_total_us": 0.0,
+        }
+
+    # ---------- 词表维护 ----------
+    def attach(self, store):
+        """绑定五元组存储并订阅增量变更"""
+        with self._lock:
+            self._store = store
+            self._needs_rebuild = True
+            self._pending_reset = True
+            store.add_listener(self._on_store_change)
+
+    def _terms_of(self, quintuples: Iterable) -> Set[str]:
+        terms = set()
+        for q in quintuples:
+            try:
+                head, _, rel, tail, _ = q
+            except (TypeError, ValueError):
+                continue
+            for term in (head, rel, tail):
+                if term and len(term) >= self.min_term_len:
+                    terms.add(term)
+        return terms
+
+    def _on_store_change(self, added: List, reset: bool):
+        with self._lock:
+            if reset:
+                self._needs_rebuild = True
+                self._pending_reset = True
+                return
+            if self._needs_rebuild:
+                if self._building:
+                    # 快照可能已不含这些词，构建完成时并入
+                    self._pending_terms |= self._terms_of(added)
+                return  # 下次查询时全量构建，无需增量
+            new_terms = self._terms_of(added) - self._terms - self._delta_terms
+            if not new_terms:
+                return
+            self._delta_terms |= new_terms
+            if len(self._delta_terms) >= self.delta_merge_threshold:
+                self._merge_delta()
+            else:
+                self._delta = AhoCorasick(self._delta_terms)
+            self._stats["delta_updates"] += 1
+
+    def _merge_delta(self):
+        self._terms |= self._delta_terms
+        self._delta_terms = set()
+        self._delta = None
+        self._main = AhoCorasick(self._terms)
+        self._stats["rebuilds"] += 1
+
+    def _ensure_built(self):
+        """全量构建词表
+
+        存储在持有自身锁时回调_on_store_change，因此读取存储快照时不能持有本匹配器的锁，
+        否则与add()形成相反的加锁顺序而死锁；快照期间到达的增量先暂存，构建完成时并入
+        """
+        while self._needs_rebuild:
+            with self._lock:
+                if not self._needs_rebuild:
+                    return
+                if self._building:
+                    wait = True
+                else:
+                    wait = False
+                    self._building = True
+                    self._pending_terms = set()
+                    self._pending_reset = False
+            if wait:
+                time.sleep(0.001)  # 其他线程正在构建
+                continue
+            try:
+                all_quintuples = self._store.get_all() if self._store is not None else ()
+                terms = self._terms_of(all_quintuples)
+                with self._lock:
+                    if self._pending_reset:
+                        continue  # 快照期间存储被整体替换，重新构建
+                    self._terms = terms | self._pending_terms
+                    self._pending_terms = set()
+                    self._delta_terms = set()
+                    self._delta = None
+                    self._main = AhoCorasick(self._terms)
+                    self._needs_rebuild = False
+                    self._stats["rebuilds"] += 1
+                    logger.info(f"关键词匹配器构建完成: {len(self._terms)} 个词")
+            finally:
+                with self._lock:
+                    self._building = False
+
+    # ---------- 匹配 ----------
+    def match(self, text: str) -> List[str]:
+        """返回文本中出现的已知实体/关系（去掉被更长匹配完全覆盖的短词，按出现位置排序）"""
+        if not text:
+            return []
+        self._ensure_built()
+        start = time.perf_counter()
+        with self._lock:
+            spans = []
+            for automaton in (self._main, self._delta):
+                if automaton is None:
+                    continue
+                for end, word in automaton.iter_matches(text):
+                    spans.append((end - len(word) + 1, end, word))
+        # 长词优先，丢弃被更长匹配覆盖的短词
+        spans.sort(key=lambda x: (x[0], -(x[1] - x[0])))
+        kept = []
+        for s, e, word in spans:
+            if any(ks <= s and e <= ke and (ke - ks) > (e - s) for ks, ke, _ in kept):
+                continue
+            kept.append((s, e, word))
+        result = []
+        for _, _, word in sorted(kept):
+            if word not in result:
+                result.append(word)
+        self._stats["matches"] += 1
+        self._stats["match_time_total_us"] += (time.perf_counter() - start) * 1e6
+        return result
+
+    def record(self, local_hit: bool):
+        """记录一次查询走的路径"""
+        with self._lock:
+            self._stats["queries"] += 1
+            if local_hit:
+                self._stats["local_hits"] += 1
+            else:
+                self._stats["llm_fallbacks"] += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            queries = self._stats["queries"]
+            matches = self._stats["matches"]
+            return {
+                "terms": len(self._terms) + len(self._delta_terms),
+                "delta_terms": len(self._delta_terms),
+                **{k: v for k, v in self._stats.items() if k != "match_time_total_us"},
+                "local_hit_rate": round(self._stats["local_hits"] / queries, 4) if queries else 0.0,
+                "avg_match_time_us": round(self._stats["match_time_total_us"] / matches, 2) if matches else 0.0,
+            }
+
+
+_MATCHER: Optional[KeywordMatcher] = None
+_MATCHER_LOCK = threading.Lock()
+
+
+def get_keyword_matcher() -> KeywordMatcher:
+    """获取全局关键词匹配器（绑定全局五元组存储）"""
+    global _MATCHER
+    if _MATCHER is None:
+        with _MATCHER_LOCK:
+            if _MATCHER is None:
+                from .quintuple_store import get_quintuple_store
+                try:
+                    from config import config
+                    min_len = getattr(config.grag, "matcher_min_term_len", 2)
+                except Exception:
+                    min_len = 2
+                matcher = KeywordMatcher(min_term_len=min_len)
+                matcher.attach(get_quintuple_store())
+                _MATCHER = matcher
+    return _MATCHER
@@ -1,11 +1,13 @@
+import atexit
 import logging
 import asyncio
 import traceback
 from typing import List, Dict, Optional, Tuple
 from .quintuple_extractor import extract_quintuples
-from .quintuple_graph import store_quintuples, query_graph_by_keywords, get_all_quintuples
-from .quintuple_rag_query import query_knowledge, set_context
-from .task_manager import task_manager, start_auto_cleanup
+from .quintuple_graph import store_quintuples, query_graph_by_keywords, get_quintuple_count
+from .quintuple_rag_query import query_knowledge, set_context, get_matcher_stats
+from .task_manager import task_manager, start_auto_cleanup, TaskPriority, TaskQueueFullError
+from .extraction_batcher import get_extraction_batcher
 from config import config
 
 logger = logging.getLogger(__name__)
@@ -18,6 +20,7 @@ class GRAGMemoryManager:
         self.auto_extract = config.grag.auto_extract
         self.context_length = config.grag.context_length
         self.similarity_threshold = config.grag.similarity_threshold
+        self.batch_extract = getattr(config.grag, 'extraction_batch_enabled', True)
         self.recent_context = [] # 最近对话上下文
         self.extraction_cache = set() # 避免重复提取
         self.active_tasks = set() # 当前活跃的任务ID
@@ -38,6 +41,9 @@ class GRAGMemoryManager:
             task_manager.on_task_completed = self._on_task_completed
             task_manager.on_task_failed = self._on_task_failed
             
+            # 退出时提取批次缓冲区中尚未提交的对话，避免最后几轮记忆丢失
+            atexit.register(self.shutdown)
+            
         except Exception as e:
             logger.error(f"GRAG记忆系统初始化失败: {e}")
             self.enabled = False
@@ -55,12 +61,21 @@ class GRAGMemoryManager:
             if len(self.recent_context) > self.context_length:
                 self.recent_context = self.recent_context[-self.context_length:]
 
-            # 使用任务管理器异步提取五元组
+            # 使用任务管理器异步提取五元组（队列满时等待空位，形成背压）
             if self.auto_extract:
                 try:
-                    task_id = task_manager.add_task(conversation_text)
-                    self.active_tasks.add(task_id)
-                    logger.info(f"已提交五元组提取任务: {task_id}")
+                    if self.batch_extract and task_manager.enabled:
+                        # 多轮合并为一次提取请求，凑满一批或时间窗口到期时提交
+                        task_id = await get_extraction_batcher().add(conversation_text)
+                    else:
+                        task_id = await task_manager.submit(conversation_text, priority=TaskPriority.BACKGROUND)
+                    if task_id:
+                        self.active_tasks.add(task_id)
+                        logger.info(f"已提交五元组提取任务: {task_id}")
+                except TaskQueueFullError as e:
+                    # 提取积压时丢弃本轮，不再同步提取以免加重负载
+                    logger.warning(f"提取队列积压，跳过本轮五元组提取: {e}")
+                    return False
                 except Exception as e:
                     logger.error(f"提交提取任务失败: {e}")
                     # 如果任务管理器失败，回退到同步提取
@@ -163,8 +178,8 @@ class GRAGMemoryManager:
             # 设置查询上下文
             set_context(self.recent_context)
             
-            # 异步查询
-            result = await asyncio.to_thread(query_knowledge, question)
+            # 以交互优先级排队查询，先于后台提取任务执行
+            result = await task_manager.run_call(query_knowledge, question, priority=TaskPriority.INTERACTIVE)
             
             if result and "未在知识图谱中找到相关信息" not in result:
                 logger.info("从记忆中找到相关信息")
@@ -195,16 +210,17 @@ class GRAGMemoryManager:
             return {"enabled": False}
             
         try:
-            all_quintuples = get_all_quintuples()
-            task_stats = task_manager.get_stats()
+            task_stats = task_manager.get_task_stats()
             
             return {
                 "enabled": True,
-                "total_quintuples": len(all_quintuples),
+                "total_quintuples": get_quintuple_count(),
                 "context_length": len(self.recent_context),
                 "cache_size": len(self.extraction_cache),
                 "active_tasks": len(self.active_tasks),
-                "task_manager": task_stats
+                "task_manager": task_stats,
+                "extraction_batcher": get_extraction_batcher().get_stats(),
+                "keyword_matcher": get_matcher_stats()
             }
         except Exception as e:
             logger.error(f"获取记忆统计失败: {e}")
@@ -233,7 +249,8 @@ class GRAGMemoryManager:
             self.recent_context.clear()
             self.extraction_cache.clear()
             
-            # 取消所有活跃任务
+            # 丢弃批次缓冲区中待提取的对话，取消所有活跃任务
+            get_extraction_batcher().clear()
             for task_id in list(self.active_tasks):
                 task_manager.cancel_task(task_id)
             self.active_tasks.clear()
@@ -244,5 +261,14 @@ class GRAGMemoryManager:
             logger.error(f"清空记忆失败: {e}")
             return False
 
+    def shutdown(self):
+        """进程退出时调用：同步提取并入库批次缓冲区中剩余的对话"""
+        if not self.enabled or not self.batch_extract:
+            return
+        try:
+            get_extraction_batcher().shutdown()
+        except Exception as e:
+            logger.error(f"退出前提取剩余对话失败: {e}")
+
 # 全局记忆管理器实例
 memory_manager = GRAGMemoryManager() 
@@ -18,6 +18,19 @@ API_URL = f"{config.api.base_url.rstrip('/')}/chat/completions"
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+
+def _llm_slot(prompt, max_tokens, sync=True, timeout=None):
+    """全局LLM调度器后台通道的调用配额（提取请求排在交互对话、Agent和深度思考之后）
+
+    timeout仅对同步版本有效：等待配额超时抛出TimeoutError
+    """
+    from apiserver.llm_scheduler import get_llm_scheduler, estimate_tokens, LLMLane
+    scheduler = get_llm_scheduler()
+    tokens = estimate_tokens(prompt, max_tokens)
+    if sync:
+        return scheduler.slot_sync(LLMLane.BACKGROUND, tokens=tokens, timeout=timeout)
+    return scheduler.slot(LLMLane.BACKGROUND, tokens=tokens)
+
 async def extract_quintuples_async(text):
     """异步版本的五元组提取"""
     prompt = f"""
@@ -58,10 +71,13 @@ async def extract_quintuples_async(text):
             
             logger.info(f"尝试提取五元组 (第{attempt + 1}次，超时{base_timeout + (attempt * 5)}s)")
             
-            async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with _llm_slot(prompt, body["max_tokens"], sync=False) as ticket, \
+                    aiohttp.ClientSession(timeout=timeout) as session:
                 async with session.post(API_URL, headers=headers, json=body) as response:
                     logger.debug(f"状态码: {response.status}")
                     
+                    if response.status == 429:
+                        ticket.rate_limited(response)
                     if response.status != 200:
                         raise Exception(f"API调用失败，状态码: {response.status}")
                     
@@ -148,7 +164,10 @@ def extract_quintuples(text):
             timeout = base_timeout + (attempt * 5)  # 15s, 20s, 25s
             
             logger.info(f"尝试提取五元组 (第{attempt + 1}次，超时{timeout}s)")
-            response = requests.post(API_URL, headers=headers, json=body, timeout=timeout)
+            with _llm_slot(prompt, body["max_tokens"]) as ticket:
+                response = requests.post(API_URL, headers=headers, json=body, timeout=timeout)
+                if response.status_code == 429:
+                    ticket.rate_limited(response)
 
             logger.debug(f"状态码: {response.status_code}")
             logger.debug(f"响应内容: {response.text}")
@@ -197,4 +216,122 @@ def extract_quintuples(text):
             else:
                 return []
     
-    return []
\ No newline at end of file
+    return []
+
+def _load_json_content(content):
+    """去掉```json代码块标记后解析JSON"""
+    match = re.search(r"```json\s*(.*?)\s*```", content, re.DOTALL)
+    if match:
+        json_str = match.group(1)
+    else:
+        json_str = content.strip()
+    return json.loads(json_str)
+
+
+def _to_quintuples(items):
+    if not isinstance(items, list):
+        return []
+    return [tuple(t) for t in items if isinstance(t, (list, tuple)) and len(t) == 5]
+
+
+def extract_quintuples_batch(texts, max_tokens=2000, deadline=None):
+    """
+    一次请求提取多轮对话的五元组，每轮以 [T编号] 标记，模型按编号分别返回
+    
+    deadline为time.monotonic()时间点：等待配额和每次请求的超时都不超过剩余时间，时间不足时不再重试
+    
+    Returns:
+        (results, info): results为与texts一一对应的五元组列表，回复被截断或无法按轮次拆分时为None（调用方应拆小重试）；
+        info包含completion_tokens、truncated、error、expired（超出deadline，调用方不应再拆分重试）
+    """
+    labels = [f"T{i + 1}" for i in range(len(texts))]
+    turns = "\n".join(f"[{label}]\n{text}" for label, text in zip(labels, texts))
+    prompt = f"""
+下面是多轮对话，每轮以 [T编号] 开头。请分别从每一轮中抽取五元组（主语-主语类型-谓语-宾语-宾语类型）关系，每个五元组的格式为 (主体, 主体类型, 动作, 客体, 客体类型)。
+返回一个 JSON 对象：键为轮次编号，值为该轮的五元组数组；没有可抽取内容的轮次返回空数组。
+
+类型包括但不限于：人物、地点、组织、物品、概念、时间、事件、活动等。
+
+例如：
+输入：
+[T1]
+小明在公园里踢足球。
+[T2]
+今天有点累。
+输出：{{"T1": [["小明", "人物", "踢", "足球", "物品"], ["小明", "人物", "在", "公园", "地点"]], "T2": []}}
+
+请从以下对话中提取所有可以识别出的五元组：
+{turns}
+"""
+
+    headers = {
+        "Authorization": f"Bearer {API_KEY}",
+        "Content-Type": "application/json"
+    }
+
+    body = {
+        "model": config.api.model,
+        "messages": [
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.5
+    }
+
+    info = {"completion_tokens": 0, "truncated": False, "error": None, "expired": False}
+    max_retries = 2
+    base_timeout = 30  # 批量请求回复更长
+
+    for attempt in range(max_retries + 1):
+        timeout = base_timeout + (attempt * 10)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining < 1:
+                info["error"] = "超出批次时限"
+                info["expired"] = True
+                return None, info
+            timeout = min(timeout, remaining)
+        try:
+            logger.info(f"尝试批量提取五元组 ({len(texts)}轮，第{attempt + 1}次，超时{timeout:.0f}s)")
+            with _llm_slot(prompt, max_tokens, timeout=timeout) as ticket:
+                if deadline is not None:
+                    timeout = max(1.0, min(timeout, deadline - time.monotonic()))
+                response = requests.post(API_URL, headers=headers, json=body, timeout=timeout)
+                if response.status_code == 429:
+                    ticket.rate_limited(response)
+            response.raise_for_status()
+            content_json = response.json()
+            break
+        except (requests.exceptions.RequestException, TimeoutError) as e:
+            logger.warning(f"批量提取请求失败 (第{attempt + 1}次): {e}")
+            if attempt < max_retries:
+                time.sleep(1)
+                continue
+            info["error"] = f"请求失败: {e}"
+            info["expired"] = deadline is not None and deadline - time.monotonic() < 1
+            return None, info
+
+    choice = content_json['choices'][0]
+    content = choice['message']['content'] or ""
+    usage = content_json.get('usage') or {}
+    info["completion_tokens"] = usage.get('completion_tokens') or len(content) // 2
+    info["truncated"] = choice.get('finish_reason') == 'length'
+
+    try:
+        data = _load_json_content(content)
+    except json.JSONDecodeError as e:
+        info["error"] = f"JSON解析失败: {e}"
+        return None, info
+
+    if isinstance(data, dict):
+        # 键可能被写成 "T1" / "t1" / "1"
+        normalized = {str(k).strip().strip('[]').upper().lstrip('T'): v for k, v in data.items()}
+        results = [_to_quintuples(normalized.get(label[1:], [])) for label in labels]
+    elif isinstance(data, list) and len(texts) == 1:
+        results = [_to_quintuples(data)]
+    else:
+        info["error"] = "回复无法按轮次拆分"
+        return None, info
+
+    logger.info(f"批量提取到的五元组: {sum(len(r) for r in results)}个（{len(texts)}轮）")
+    return results, info
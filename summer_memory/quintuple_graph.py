@@ -1,12 +1,14 @@
 import json as _json
-from py2neo import Graph, Node, Relationship
 import logging
 import sys
 import os
+from types import SimpleNamespace
 
 # 添加项目根目录到路径，以便导入config
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
 
+from .graph_backend import create_graph_backend, DEFAULT_KEYWORD_LIMIT  # 图谱后端（Neo4j/内存）
+
 # 从config模块读取Neo4j配置
 try:
     from config import config
@@ -15,13 +17,7 @@ try:
     NEO4J_USER = config.grag.neo4j_user
     NEO4J_PASSWORD = config.grag.neo4j_password
     NEO4J_DATABASE = config.grag.neo4j_database
-    
-    try:
-        graph = Graph(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), name=NEO4J_DATABASE) if GRAG_ENABLED else None
-    except Exception as e:
-        print(f"[GRAG] Neo4j连接失败: {e}", file=sys.stderr)
-        graph = None
-        GRAG_ENABLED = False
+    _grag_cfg = config.grag
 except Exception as e:
     print(f"[GRAG] 无法从config模块读取Neo4j配置: {e}", file=sys.stderr)
     # 兼容旧版本，从config.json读取
@@ -35,81 +31,54 @@ except Exception as e:
         NEO4J_PASSWORD = grag_cfg['neo4j_password']
         NEO4J_DATABASE = grag_cfg['neo4j_database']
         GRAG_ENABLED = grag_cfg.get('enabled', True)
-        try:
-            graph = Graph(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), name=NEO4J_DATABASE) if GRAG_ENABLED else None
-        except Exception as e:
-            print(f"[GRAG] Neo4j连接失败: {e}", file=sys.stderr)
-            graph = None
-            GRAG_ENABLED = False
+        _grag_cfg = SimpleNamespace(**grag_cfg)
     except Exception as e:
         print(f"[GRAG] 无法从 config.json 读取Neo4j配置: {e}", file=sys.stderr)
-        graph = None
+        _grag_cfg = None
         GRAG_ENABLED = False
 
+# 图谱后端实例（不可用时为None，保持旧版graph变量语义）
+graph = create_graph_backend(_grag_cfg) if GRAG_ENABLED and _grag_cfg is not None else None
+if GRAG_ENABLED and graph is None:
+    print("[GRAG] 图谱后端不可用，仅使用本地五元组存储", file=sys.stderr)
+    GRAG_ENABLED = False
+
 logger = logging.getLogger(__name__)
-QUINTUPLES_FILE = "logs/knowledge_graph/quintuples.json"  # 修改为logs目录下的专门文件夹
+QUINTUPLES_FILE = "logs/knowledge_graph/quintuples.json"  # 旧版整文件存储，仅用于首次迁移
+
+from .quintuple_store import get_quintuple_store  # 追加写五元组存储
 
 
 def load_quintuples():
-    try:
-        with open(QUINTUPLES_FILE, 'r', encoding='utf-8') as f:
-            return set(tuple(t) for t in _json.load(f))
-    except FileNotFoundError:
-        return set()
+    """从内存索引读取所有五元组（首次调用时从追加写日志加载）"""
+    return get_quintuple_store().get_all()
 
 
 def save_quintuples(quintuples):
-    # 确保目录存在
-    import os
-    os.makedirs(os.path.dirname(QUINTUPLES_FILE), exist_ok=True)
-    
-    with open(QUINTUPLES_FILE, 'w', encoding='utf-8') as f:
-        _json.dump(list(quintuples), f, ensure_ascii=False, indent=2)
+    """整体替换存储内容（兼容旧接口，常规写入请使用store_quintuples）"""
+    get_quintuple_store().replace_all(quintuples)
 
 
 def store_quintuples(new_quintuples) -> bool:
     """存储五元组到文件和Neo4j，返回是否成功"""
     try:
-        all_quintuples = load_quintuples()
-        all_quintuples.update(new_quintuples)  # 集合自动去重
+        new_quintuples = list(new_quintuples)
+        # 追加写入，去重由内存索引完成
+        added = get_quintuple_store().add(new_quintuples)
+        logger.debug(f"新增 {len(added)} 个五元组到本地存储")
 
-        # 持久化到文件
-        save_quintuples(all_quintuples)
-
-        # 同步更新Neo4j图谱数据库（仅在GRAG_ENABLED时）
-        success = True
+        # 同步更新图谱数据库（仅在GRAG_ENABLED时），整批一次事务写入
         if graph is not None:
-            success_count = 0
-            for head, head_type, rel, tail, tail_type in new_quintuples:
-                if not head or not tail:
-                    logger.warning(f"跳过无效五元组，head或tail为空: {(head, head_type, rel, tail, tail_type)}")
-                    continue
-
-                try:
-                    # 创建带类型的节点
-                    h_node = Node("Entity", name=head, entity_type=head_type)
-                    t_node = Node("Entity", name=tail, entity_type=tail_type)
-
-                    # 创建关系，保存主体和客体类型信息
-                    r = Relationship(h_node, rel, t_node, head_type=head_type, tail_type=tail_type)
-
-                    # 合并节点时使用name和entity_type作为唯一标识
-                    graph.merge(h_node, "Entity", "name")
-                    graph.merge(t_node, "Entity", "name")
-                    graph.merge(r)
-                    success_count += 1
-                except Exception as e:
-                    logger.error(f"存储五元组失败: {head}-{rel}-{tail}, 错误: {e}")
-                    success = False
-
-            logger.info(f"成功存储 {success_count}/{len(new_quintuples)} 个五元组到Neo4j")
-            # 如果至少成功存储了一个五元组，就认为是成功的
-            if success_count > 0:
-                return True
-            else:
+            try:
+                success_count = graph.merge_quintuples(new_quintuples)
+            except Exception as e:
+                logger.error(f"批量存储五元组到图谱失败: {e}")
                 return False
+            logger.info(f"成功存储 {success_count}/{len(new_quintuples)} 个五元组到{graph.name}图谱")
+            # 如果至少成功存储了一个五元组，就认为是成功的
+            return success_count > 0
         else:
-            logger.info(f"跳过Neo4j存储（未启用），保存 {len(new_quintuples)} 个五元组到文件")
+            logger.info(f"跳过图谱存储（未启用），保存 {len(new_quintuples)} 个五元组到文件")
             return True  # 文件存储成功也算成功
     except Exception as e:
         logger.error(f"存储五元组失败: {e}")
@@ -119,24 +88,17 @@ def get_all_quintuples():
     return load_quintuples()
 
 
-def query_graph_by_keywords(keywords):
-    results = []
-    if graph is not None:
-        for kw in keywords:
-            query = f"""
-            MATCH (e1:Entity)-[r]->(e2:Entity)
-            WHERE e1.name CONTAINS '{kw}' OR e2.name CONTAINS '{kw}' OR type(r) CONTAINS '{kw}'
-               OR e1.entity_type CONTAINS '{kw}' OR e2.entity_type CONTAINS '{kw}'
-            RETURN e1.name, e1.entity_type, type(r), e2.name, e2.entity_type
-            LIMIT 5
-            """
-            res = graph.run(query).data()
-            for record in res:
-                results.append((
-                    record['e1.name'], 
-                    record['e1.entity_type'],
-                    record['type(r)'], 
-                    record['e2.name'],
-                    record['e2.entity_type']
-                ))
-    return results
\ No newline at end of file
+def get_quintuple_count() -> int:
+    """五元组总数（不复制集合）"""
+    return get_quintuple_store().count()
+
+
+def query_graph_by_keywords(keywords, limit_per_keyword: int = DEFAULT_KEYWORD_LIMIT):
+    """按关键词查询图谱，所有关键词合并为一次查询"""
+    if graph is None:
+        return []
+    try:
+        return graph.query_by_keywords(list(keywords), limit_per_keyword)
+    except Exception as e:
+        logger.error(f"图谱关键词查询失败: {e}")
+        return []
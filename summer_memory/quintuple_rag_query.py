@@ -25,8 +25,49 @@ def set_context(texts):
     recent_context = texts[:context_length]  # 限制上下文长度
     logger.info(f"更新查询上下文: {len(recent_context)} 条记录")
 
+def _get_matcher():
+    """获取本地关键词匹配器，未启用或初始化失败时返回None"""
+    if not getattr(config.grag, 'local_keyword_match', True):
+        return None
+    try:
+        from .keyword_matcher import get_keyword_matcher
+        return get_keyword_matcher()
+    except Exception as e:
+        logger.error(f"本地关键词匹配器初始化失败: {e}")
+        return None
+
+def get_matcher_stats():
+    """本地匹配命中统计（可观察LLM回退比例）"""
+    matcher = _get_matcher()
+    return matcher.get_stats() if matcher else {"enabled": False}
+
+def _answer_from_graph(keywords):
+    """根据关键词查询图谱并格式化结果"""
+    from .quintuple_graph import query_graph_by_keywords
+    quintuples = query_graph_by_keywords(keywords)
+    if not quintuples:
+        logger.info(f"未找到相关五元组: {keywords}")
+        return "未在知识图谱中找到相关信息。"
+
+    answer = "我在知识图谱中找到以下相关信息：\n\n"
+    for h, h_type, r, t, t_type in quintuples:
+        answer += f"- {h}({h_type}) —[{r}]→ {t}({t_type})\n"
+    return answer
+
 def query_knowledge(user_question):
-    """使用 DeepSeek API 提取关键词并查询知识图谱"""
+    """查询知识图谱：优先本地匹配已知实体/关系，未命中时使用 DeepSeek API 提取关键词"""
+    matcher = _get_matcher()
+    if matcher is not None:
+        try:
+            keywords = matcher.match(user_question)
+        except Exception as e:
+            logger.error(f"本地关键词匹配失败: {e}")
+            keywords = []
+        matcher.record(bool(keywords))
+        if keywords:
+            logger.info(f"本地匹配关键词: {keywords}")
+            return _answer_from_graph(keywords)
+
     context_str = "\n".join(recent_context) if recent_context else "无上下文"
     prompt = (
         f"基于以下上下文和用户问题，提取与知识图谱相关的关键词（如实体、关系、实体类型），"
@@ -91,16 +132,7 @@ def query_knowledge(user_question):
             return "未找到相关关键词，请提供更具体的问题。"
 
         logger.info(f"提取关键词: {keywords}")
-        from .quintuple_graph import query_graph_by_keywords
-        quintuples = query_graph_by_keywords(keywords)
-        if not quintuples:
-            logger.info(f"未找到相关五元组: {keywords}")
-            return "未在知识图谱中找到相关信息。"
-
-        answer = "我在知识图谱中找到以下相关信息：\n\n"
-        for h, h_type, r, t, t_type in quintuples:
-            answer += f"- {h}({h_type}) —[{r}]→ {t}({t_type})\n"
-        return answer
+        return _answer_from_graph(keywords)
 
     except requests.exceptions.HTTPError as e:
         logger.error(f"DeepSeek API HTTP 错误: {e}")
@@ -0,0 +1,360 @@
+"""
+五元组持久化存储 - 追加写日志 + 内存去重索引
+- 每个五元组一行JSON追加写入 quintuples.jsonl，写入成本与已有记忆总量无关
+- 进程内只加载一次，之后基于内存索引去重；其他进程追加的内容按文件偏移增量读取
+- 重复/失效行过多时自动压缩（写临时文件后原子替换）
+- 线程锁 + 文件锁，任务管理器的多个工作线程以及多个进程可以安全写入
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Iterable, List, Optional, Set, Tuple
+
+# 添加项目根目录到路径，以便导入config
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "logs/knowledge_graph"
+LOG_FILE = os.path.join(STORE_DIR, "quintuples.jsonl")  # 追加写日志
+LEGACY_FILE = os.path.join(STORE_DIR, "quintuples.json")  # 旧版整文件存储，首次加载时迁移
+
+try:
+    from config import config
+    COMPACT_RATIO = getattr(config.grag, "store_compact_ratio", 2.0)
+    COMPACT_MIN_LINES = getattr(config.grag, "store_compact_min_lines", 1000)
+    FSYNC_ON_APPEND = getattr(config.grag, "store_fsync", False)
+except Exception:
+    COMPACT_RATIO = 2.0
+    COMPACT_MIN_LINES = 1000
+    FSYNC_ON_APPEND = False
+
+Quintuple = Tuple[str, str, str, str, str]
+
+
+class _FileLock:
+    """跨进程文件锁（fcntl/msvcrt，均不可用时退化为仅线程锁）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fh = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._fh = open(self.path, "a+b")
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._fh.seek(0)
+                # 阻塞等待锁（LK_LOCK内部最多重试10秒，这里循环直到成功）
+                while True:
+                    try:
+                        msvcrt.locking(self._fh.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        time.sleep(0.05)
+            else:
+                import fcntl
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._fh.seek(0)
+                msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+        except (ImportError, OSError):
+            pass
+        finally:
+            self._fh.close()
+            self._fh = None
+        return False
+
+
+def _normalize(q) -> Optional[Quintuple]:
+    """规范化为五元组字符串元组，非法数据返回None"""
+    try:
+        t = tuple(q)
+    except TypeError:
+        return None
+    if len(t) != 5:
+        return None
+    return tuple("" if x is None else str(x) for x in t)
+
+
+class QuintupleStore:
+    """追加写五元组存储"""
+
+    def __init__(self, log_file: str = LOG_FILE, legacy_file: Optional[str] = LEGACY_FILE):
+        self.log_file = log_file
+        self.legacy_file = legacy_file
+        self.lock_file = log_file + ".lock"
+        self._lock = threading.RLock()
+        self._index: Set[Quintuple] = set()  # 内存去重索引
+        self._loaded = False
+        self._offset = 0  # 已读取到的日志偏移
+        self._file_id = None  # 日志文件标识(dev, ino)，压缩替换后会变化
+        self._log_lines = 0  # 日志中的总行数（含重复行）
+        self._version = 0  # 索引版本号，内容变化时递增，供下游缓存失效使用
+        self._stats = {"appended": 0, "duplicates": 0, "compactions": 0, "bad_lines": 0}
+        self._listeners = []  # 变更监听: fn(新增五元组列表, 是否整体重置)
+
+    # ---------- 加载 ----------
+    def _ensure_loaded(self):
+        if self._loaded:
+            self._refresh()
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            with _FileLock(self.lock_file):
+                if not os.path.exists(self.log_file) and self.legacy_file and os.path.exists(self.legacy_file):
+                    self._migrate_legacy()
+                self._read_from(0, notify=False)
+            self._loaded = True
+            logger.info(f"五元组存储加载完成: {len(self._index)} 条")
+
+    def _migrate_legacy(self):
+        """将旧版quintuples.json迁移为追加写日志（原文件保留）"""
+        try:
+            with open(self.legacy_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.error(f"读取旧版五元组文件失败: {e}")
+            return
+        unique = []
+        seen = set()
+        for item in data:
+            q = _normalize(item)
+            if q is not None and q not in seen:
+                seen.add(q)
+                unique.append(q)
+        self._write_snapshot(unique)
+        logger.info(f"已从 {self.legacy_file} 迁移 {len(unique)} 条五元组")
+
+    def _read_from(self, offset: int, notify: bool = True):
+        """从指定偏移读取日志行并合并到索引（调用方持有锁）"""
+        try:
+            with open(self.log_file, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            self._offset = 0
+            self._file_id = None
+            return
+        self._file_id = self._stat_id()
+        # 只处理完整的行，末尾未写完的半行留到下次
+        end = data.rfind(b"\n") + 1
+        new_items = []
+        for raw in data[:end].splitlines():
+            if not raw.strip():
+                continue
+            self._log_lines += 1
+            try:
+                q = _normalize(json.loads(raw.decode("utf-8")))
+            except Exception:
+                q = None
+            if q is None:
+                self._stats["bad_lines"] += 1
+                continue
+            if q not in self._index:
+                self._index.add(q)
+                new_items.append(q)
+        self._offset = offset + end
+        if new_items:
+            self._version += 1
+            if notify:
+                self._notify(new_items)
+
+    def _stat_id(self):
+        try:
+            st = os.stat(self.log_file)
+            return (st.st_dev, st.st_ino)
+        except OSError:
+            return None
+
+    def _refresh(self):
+        """读取其他进程追加的内容，文件被压缩替换时全量重载"""
+        try:
+            size = os.path.getsize(self.log_file)
+        except OSError:
+            return
+        replaced = self._file_id is not None and self._stat_id() != self._file_id
+        if size == self._offset and not replaced:
+            return
+        with self._lock:
+            if replaced or size < self._offset:
+                # 其他进程执行了压缩，重新全量加载
+                self._index.clear()
+                self._log_lines = 0
+                self._read_from(0, notify=False)
+                self._version += 1
+                self._notify([], reset=True)
+            elif size > self._offset:
+                self._read_from(self._offset)
+
+    # ---------- 写入 ----------
+    def add(self, quintuples: Iterable) -> List[Quintuple]:
+        """追加五元组，返回本次新增（去重后）的五元组列表"""
+        self._ensure_loaded()
+        with self._lock:
+            with _FileLock(self.lock_file):
+                # 持锁后先追平其他进程的写入，避免重复追加
+                self._refresh()
+                added = []
+                for item in quintuples:
+                    q = _normalize(item)
+                    if q is None:
+                        continue
+                    if q in self._index:
+                        self._stats["duplicates"] += 1
+                        continue
+                    self._index.add(q)
+                    added.append(q)
+                if not added:
+                    return []
+                os.makedirs(os.path.dirname(self.log_file) or ".", exist_ok=True)
+                payload = "".join(json.dumps(list(q), ensure_ascii=False) + "\n" for q in added).encode("utf-8")
+                with open(self.log_file, "ab") as f:
+                    f.write(payload)
+                    f.flush()
+                    if FSYNC_ON_APPEND:
+                        os.fsync(f.fileno())
+                self._offset += len(payload)
+                if self._file_id is None:
+                    self._file_id = self._stat_id()
+                self._log_lines += len(added)
+                self._stats["appended"] += len(added)
+                self._version += 1
+                self._maybe_compact()
+                self._notify(added)
+                return added
+
+    def replace_all(self, quintuples: Iterable):
+        """用给定集合整体替换存储内容（兼容旧版save_quintuples）"""
+        self._ensure_loaded()
+        with self._lock:
+            with _FileLock(self.lock_file):
+                unique = []
+                seen = set()
+                for item in quintuples:
+                    q = _normalize(item)
+                    if q is not None and q not in seen:
+                        seen.add(q)
+                        unique.append(q)
+                self._write_snapshot(unique)
+                self._index = seen
+                self._log_lines = len(unique)
+                self._version += 1
+                self._notify([], reset=True)
+
+    # ---------- 变更监听 ----------
+    def add_listener(self, fn):
+        """注册变更监听，用于增量维护下游索引（如关键词匹配器）"""
+        if fn not in self._listeners:
+            self._listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+
+    def _notify(self, added: List[Quintuple], reset: bool = False):
+        for fn in list(self._listeners):
+            try:
+                fn(added, reset)
+            except Exception as e:
+                logger.error(f"五元组变更监听回调失败: {e}")
+
+    # ---------- 压缩 ----------
+    def _maybe_compact(self):
+        """日志行数明显多于唯一条目时压缩（调用方持有锁）"""
+        if self._log_lines >= COMPACT_MIN_LINES and self._log_lines > len(self._index) * COMPACT_RATIO:
+            self._compact_locked()
+
+    def compact(self):
+        """手动压缩日志"""
+        self._ensure_loaded()
+        with self._lock:
+            with _FileLock(self.lock_file):
+                self._refresh()
+                self._compact_locked()
+
+    def _compact_locked(self):
+        before = self._log_lines
+        self._write_snapshot(self._index)
+        self._log_lines = len(self._index)
+        self._stats["compactions"] += 1
+        logger.info(f"五元组日志压缩完成: {before} -> {self._log_lines} 行")
+
+    def _write_snapshot(self, quintuples: Iterable[Quintuple]):
+        """写临时文件后原子替换日志（调用方持有锁）"""
+        os.makedirs(os.path.dirname(self.log_file) or ".", exist_ok=True)
+        tmp = self.log_file + ".tmp"
+        with open(tmp, "wb") as f:
+            for q in quintuples:
+                f.write((json.dumps(list(q), ensure_ascii=False) + "\n").encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.log_file)
+        self._offset = os.path.getsize(self.log_file)
+        self._file_id = self._stat_id()
+
+    # ---------- 读取 ----------
+    def get_all(self) -> Set[Quintuple]:
+        """返回所有五元组（集合副本）"""
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._index)
+
+    def count(self) -> int:
+        """五元组总数"""
+        self._ensure_loaded()
+        return len(self._index)
+
+    def contains(self, quintuple) -> bool:
+        self._ensure_loaded()
+        return _normalize(quintuple) in self._index
+
+    @property
+    def version(self) -> int:
+        """索引版本号（内容变化时递增）"""
+        self._ensure_loaded()
+        return self._version
+
+    def exists(self) -> bool:
+        """是否存在任何已持久化的五元组数据"""
+        return os.path.exists(self.log_file) or bool(self.legacy_file and os.path.exists(self.legacy_file))
+
+    def get_stats(self) -> dict:
+        self._ensure_loaded()
+        return {
+            "total_quintuples": len(self._index),
+            "log_lines": self._log_lines,
+            "log_bytes": self._offset,
+            "version": self._version,
+            **self._stats,
+        }
+
+
+_STORE: Optional[QuintupleStore] = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_quintuple_store() -> QuintupleStore:
+    """获取全局五元组存储实例"""
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = QuintupleStore()
+    return _STORE
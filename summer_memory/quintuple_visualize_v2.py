@@ -1,36 +1,24 @@
 from pyvis.network import Network
 import webbrowser
-import json
-import os
 import logging
 
 logger = logging.getLogger(__name__)
 
 def load_quintuples_from_json():
     """
-    直接从JSON文件中读取五元组数据，解耦数据库依赖
+    从本地五元组存储（追加写日志 + 内存索引）读取五元组数据，解耦数据库依赖
     """
     try:
-        json_file = "logs/knowledge_graph/quintuples.json"
-        print(f"尝试读取 {json_file} 文件...")
-        if not os.path.exists(json_file):
-            print(f"错误：{json_file} 文件不存在！")
+        from summer_memory.quintuple_store import get_quintuple_store
+        store = get_quintuple_store()
+        if not store.exists():
+            print("错误：未找到五元组存储文件！")
             return set()
-            
-        with open(json_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            print(f"JSON文件读取成功，包含 {len(data)} 条记录")
-            result = set(tuple(t) for t in data)
-            print(f"转换为集合后包含 {len(result)} 条唯一记录")
-            return result
-    except FileNotFoundError:
-        print("错误：找不到 quintuples.json 文件")
-        return set()
-    except json.JSONDecodeError as e:
-        print(f"错误：JSON文件格式错误 - {e}")
-        return set()
+        result = store.get_all()
+        print(f"五元组存储读取成功，包含 {len(result)} 条唯一记录")
+        return result
     except Exception as e:
-        print(f"错误：读取文件时发生异常 - {e}")
+        print(f"错误：读取五元组存储时发生异常 - {e}")
         return set()
 
 def visualize_quintuples():
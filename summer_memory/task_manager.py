@@ -2,11 +2,15 @@ import asyncio
 import logging
 import time
 import threading
+import heapq
+import itertools
+from bisect import bisect_left
+from collections import deque
 from typing import Dict, List, Optional, Callable, Any
-from dataclasses import dataclass
-from enum import Enum
+from dataclasses import dataclass, field
+from enum import Enum, IntEnum
 import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, Future
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +22,17 @@ class TaskStatus(Enum):
     FAILED = "failed"        # 失败
     CANCELLED = "cancelled"  # 已取消
 
+class TaskPriority(IntEnum):
+    """任务优先级（数值越小越先执行）"""
+    INTERACTIVE = 0   # 交互式召回，用户正在等待结果
+    NORMAL = 5
+    BACKGROUND = 10   # 后台五元组提取
+
+class TaskQueueFullError(RuntimeError):
+    """任务队列已满"""
+
+_TERMINAL = (TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED)
+
 @dataclass
 class ExtractionTask:
     """五元组提取任务"""
@@ -28,14 +43,68 @@ class ExtractionTask:
     created_at: float
     started_at: Optional[float] = None
     completed_at: Optional[float] = None
-    result: Optional[List] = None
+    result: Optional[Any] = None
     error: Optional[str] = None
     retry_count: int = 0
     max_retries: int = 3
+    priority: int = TaskPriority.BACKGROUND
+    func: Optional[Callable] = None  # 非提取任务（如记忆召回）执行的函数，为None时执行五元组提取
+    args: tuple = ()
+    notify: bool = True  # 结束时是否调用on_task_completed/on_task_failed（结果为五元组列表）
+    run_timeout: Optional[float] = None  # 执行超时，为None时使用task_timeout
+    enqueued_at: float = 0.0  # 入队时间（monotonic），用于统计排队耗时
+    done: Optional[Future] = field(default=None, repr=False)  # 任务结束时完成，可跨事件循环等待
+
+class LatencyHistogram:
+    """固定分桶的耗时直方图（毫秒）"""
+
+    BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, q: float) -> float:
+        """按分桶上界估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return float(self.BUCKETS_MS[i]) if i < len(self.BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def to_dict(self) -> Dict:
+        buckets = {f"<={b}": n for b, n in zip(self.BUCKETS_MS, self.counts)}
+        buckets[f">{self.BUCKETS_MS[-1]}"] = self.counts[-1]
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total_ms / self.count, 1) if self.count else 0.0,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": buckets,
+        }
 
 class QuintupleTaskManager:
-    """五元组提取任务管理器"""
-    
+    """五元组提取任务管理器
+
+    - 优先级队列（堆）+ 文本哈希去重索引 + 各状态计数器，入队/去重/计数均为O(1)或O(log n)
+    - 固定数量的工作协程从队列取任务，运行在独立的后台事件循环线程上；
+      另有交互专用工作协程只处理召回等交互任务，后台提取积压时召回不必排队
+    - submit在队列满时阻塞等待（带超时），为对话循环提供真实的背压
+    """
+
     def __init__(self, max_workers: int = None, max_queue_size: int = None):
         # 从配置文件读取设置
         try:
@@ -45,6 +114,8 @@ class QuintupleTaskManager:
             self.max_queue_size = max_queue_size or config.grag.max_queue_size
             self.task_timeout = config.grag.task_timeout
             self.auto_cleanup_hours = config.grag.auto_cleanup_hours
+            self.interactive_workers = getattr(config.grag, 'interactive_workers', 1)
+            self.submit_timeout = getattr(config.grag, 'submit_timeout', 5.0)
         except Exception as e:
             logger.warning(f"无法读取配置文件，使用默认设置: {e}")
             self.enabled = True
@@ -52,147 +123,375 @@ class QuintupleTaskManager:
             self.max_queue_size = max_queue_size or 100
             self.task_timeout = 30
             self.auto_cleanup_hours = 24
-        
+            self.interactive_workers = 1
+            self.submit_timeout = 5.0
+
         self.tasks: Dict[str, ExtractionTask] = {}
-        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers + self.interactive_workers,
+                                           thread_name_prefix="QuintupleTask")
         self.lock = threading.Lock()
-        self.running_tasks = 0
-        self.completed_tasks = 0
-        self.failed_tasks = 0
-        
+
+        # 队列与索引（均在self.lock保护下访问）
+        self._heap: List[tuple] = []  # (优先级, 序号, 任务ID)，已取消的条目出队时跳过
+        self._seq = itertools.count()
+        self._active_by_hash: Dict[str, str] = {}  # 文本哈希 -> 等待中/运行中的任务ID
+        self._state_counts: Dict[TaskStatus, int] = {status: 0 for status in TaskStatus}
+        self._pending_interactive = 0
+        self._finished: deque = deque()  # 按结束顺序记录 (结束时间, 任务ID)，清理时从头部弹出
+        self._space_waiters: List[Future] = []  # 等待队列空位的submit调用
+
+        # 后台事件循环与工作协程
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._any_event: Optional[asyncio.Event] = None
+        self._interactive_event: Optional[asyncio.Event] = None
+        self._workers: List[asyncio.Task] = []
+
+        # 排队/执行耗时直方图（按优先级分类）
+        self._queue_wait: Dict[str, LatencyHistogram] = {}
+        self._run_time: Dict[str, LatencyHistogram] = {}
+        self._rejected = 0
+        self._deduplicated = 0
+
         # 回调函数
         self.on_task_completed: Optional[Callable] = None
         self.on_task_failed: Optional[Callable] = None
-        
+
         logger.info(f"五元组任务管理器初始化完成，最大并发数: {self.max_workers}, 队列大小: {self.max_queue_size}")
-    
+
     def _generate_task_id(self, text: str) -> str:
         """生成任务ID"""
         text_hash = hashlib.sha256(text.encode()).hexdigest()
         timestamp = int(time.time() * 1000)
-        return f"extract_{text_hash[:8]}_{timestamp}"
-    
+        return f"extract_{text_hash[:8]}_{timestamp}_{next(self._seq)}"
+
     def _generate_text_hash(self, text: str) -> str:
         """生成文本哈希"""
         return hashlib.sha256(text.encode()).hexdigest()
-    
-    def add_task(self, text: str) -> str:
-        """添加提取任务"""
-        if not self.enabled:
-            raise RuntimeError("任务管理器已禁用")
-            
-        if not text or not text.strip():
-            raise ValueError("文本不能为空")
-        
-        text_hash = self._generate_text_hash(text)
-        
-        # 检查是否已有相同文本的任务
+
+    # ---------- 后台事件循环 ----------
+    def _ensure_started(self):
+        """首次提交任务时启动后台事件循环线程和工作协程"""
+        if self._loop_thread is not None and self._loop_thread.is_alive():
+            return
         with self.lock:
-            for task in self.tasks.values():
-                if task.text_hash == text_hash and task.status in [TaskStatus.PENDING, TaskStatus.RUNNING]:
-                    logger.info(f"发现重复任务，返回现有任务ID: {task.task_id}")
-                    return task.task_id
-        
-        # 检查队列大小
-        pending_count = sum(1 for task in self.tasks.values() if task.status == TaskStatus.PENDING)
-        if pending_count >= self.max_queue_size:
-            raise RuntimeError(f"任务队列已满，最大容量: {self.max_queue_size}")
-        
-        task_id = self._generate_task_id(text)
-        task = ExtractionTask(
-            task_id=task_id,
-            text=text,
-            text_hash=text_hash,
-            status=TaskStatus.PENDING,
-            created_at=time.time()
-        )
-        
+            if self._loop_thread is not None and self._loop_thread.is_alive():
+                return
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                loop.run_until_complete(self._start_workers(ready))
+                loop.run_forever()
+
+            self._loop = loop
+            self._loop_thread = threading.Thread(target=run_loop, name="QuintupleTaskLoop", daemon=True)
+            self._loop_thread.start()
+        ready.wait(timeout=5.0)
+
+    async def _start_workers(self, ready: threading.Event):
+        # 事件需在后台循环内创建
+        self._any_event = asyncio.Event()
+        self._interactive_event = asyncio.Event()
+        self._workers = [
+            asyncio.create_task(self._worker(interactive_only=False), name=f"QuintupleWorker-{i}")
+            for i in range(self.max_workers)
+        ] + [
+            asyncio.create_task(self._worker(interactive_only=True), name=f"QuintupleInteractiveWorker-{i}")
+            for i in range(self.interactive_workers)
+        ]
+        # 启动前已入队的任务
+        self._wake(TaskPriority.INTERACTIVE)
+        ready.set()
+
+    def _wake(self, priority: int):
+        """唤醒工作协程（在后台循环内执行）"""
+        if self._any_event is None:
+            return
+        self._any_event.set()
+        if priority == TaskPriority.INTERACTIVE:
+            self._interactive_event.set()
+
+    def _notify_workers(self, priority: int):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake, priority)
+
+    async def _worker(self, interactive_only: bool):
+        """工作协程：循环从队列取任务执行"""
+        event = self._interactive_event if interactive_only else self._any_event
+        while True:
+            task = self._pop(interactive_only)
+            if task is None:
+                event.clear()
+                task = self._pop(interactive_only)
+                if task is None:
+                    await event.wait()
+                    continue
+            try:
+                await self._process_task(task)
+            except Exception as e:
+                logger.error(f"任务处理异常: {task.task_id}, 错误: {e}")
+
+    # ---------- 队列 ----------
+    def _set_status(self, task: ExtractionTask, status: TaskStatus):
+        """切换任务状态并维护计数器和索引（需持有self.lock）"""
+        self._state_counts[task.status] -= 1
+        self._state_counts[status] += 1
+        if task.status == TaskStatus.PENDING and task.priority == TaskPriority.INTERACTIVE:
+            self._pending_interactive -= 1
+        task.status = status
+        if status in _TERMINAL:
+            task.completed_at = time.time()
+            if task.text_hash and self._active_by_hash.get(task.text_hash) == task.task_id:
+                del self._active_by_hash[task.text_hash]
+            self._finished.append((task.completed_at, task.task_id))
+
+    def _pending_background(self) -> int:
+        return self._state_counts[TaskStatus.PENDING] - self._pending_interactive
+
+    def _enqueue(self, text: str, priority: int, func: Optional[Callable] = None, args: tuple = (),
+                 notify: bool = True, run_timeout: Optional[float] = None) -> Optional[str]:
+        """入队，返回任务ID；后台队列已满时返回None"""
+        # 提取任务按文本去重，召回等函数任务不去重
+        text_hash = self._generate_text_hash(text) if func is None else ""
         with self.lock:
+            if text_hash:
+                existing = self._active_by_hash.get(text_hash)
+                if existing is not None:
+                    self._deduplicated += 1
+                    logger.info(f"发现重复任务，返回现有任务ID: {existing}")
+                    return existing
+
+            # 交互任务不受队列容量限制（用户正在等待，且数量有限）
+            if priority != TaskPriority.INTERACTIVE and self._pending_background() >= self.max_queue_size:
+                return None
+
+            task_id = self._generate_task_id(text)
+            task = ExtractionTask(
+                task_id=task_id,
+                text=text,
+                text_hash=text_hash,
+                status=TaskStatus.PENDING,
+                created_at=time.time(),
+                priority=priority,
+                func=func,
+                args=args,
+                notify=notify,
+                run_timeout=run_timeout,
+                enqueued_at=time.monotonic(),
+                done=Future()
+            )
             self.tasks[task_id] = task
+            self._state_counts[TaskStatus.PENDING] += 1
+            if priority == TaskPriority.INTERACTIVE:
+                self._pending_interactive += 1
+            if text_hash:
+                self._active_by_hash[text_hash] = task_id
+            heapq.heappush(self._heap, (priority, next(self._seq), task_id))
+
+        self._ensure_started()
+        self._notify_workers(priority)
+        return task_id
+
+    def _pop(self, interactive_only: bool) -> Optional[ExtractionTask]:
+        """取出优先级最高的等待中任务并标记为运行中"""
+        with self.lock:
+            while self._heap:
+                priority, _, task_id = self._heap[0]
+                task = self.tasks.get(task_id)
+                if task is None or task.status != TaskStatus.PENDING:
+                    heapq.heappop(self._heap)  # 已取消或已清理
+                    continue
+                if interactive_only and priority != TaskPriority.INTERACTIVE:
+                    return None
+                heapq.heappop(self._heap)
+                self._set_status(task, TaskStatus.RUNNING)
+                task.started_at = time.time()
+                freed = priority != TaskPriority.INTERACTIVE
+                break
+            else:
+                return None
+        if freed:
+            self._release_space()
+        return task
+
+    def _release_space(self):
+        """后台队列有空位时唤醒阻塞中的submit"""
+        with self.lock:
+            waiters, self._space_waiters = self._space_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                try:
+                    waiter.set_result(None)
+                except Exception:
+                    pass  # 等待方已超时取消
+
+    def add_task(self, text: str, priority: int = TaskPriority.BACKGROUND, func: Optional[Callable] = None,
+                 args: tuple = (), run_timeout: Optional[float] = None) -> str:
+        """添加提取任务（不阻塞，队列已满时抛出TaskQueueFullError）
         
+        指定func时执行func(*args)代替对text提取五元组（如批量提取），text仅作为任务标签，不参与去重
+        """
+        if not self.enabled:
+            raise RuntimeError("任务管理器已禁用")
+
+        if not text or not text.strip():
+            raise ValueError("文本不能为空")
+
+        task_id = self._enqueue(text, priority, func=func, args=args, run_timeout=run_timeout)
+        if task_id is None:
+            with self.lock:
+                self._rejected += 1
+            raise TaskQueueFullError(f"任务队列已满，最大容量: {self.max_queue_size}")
+
         logger.info(f"添加提取任务: {task_id}, 文本长度: {len(text)}")
-        
-        # 异步启动任务
-        asyncio.create_task(self._process_task(task_id))
-        
         return task_id
-    
-    async def _process_task(self, task_id: str):
-        """处理单个任务"""
+
+    async def submit(self, text: str, priority: int = TaskPriority.BACKGROUND, timeout: Optional[float] = None,
+                     func: Optional[Callable] = None, args: tuple = (), run_timeout: Optional[float] = None) -> str:
+        """添加提取任务，队列已满时等待空位（最多timeout秒），超时抛出TaskQueueFullError"""
+        if not self.enabled:
+            raise RuntimeError("任务管理器已禁用")
+
+        if not text or not text.strip():
+            raise ValueError("文本不能为空")
+
+        timeout = self.submit_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            waiter = Future()
+            with self.lock:
+                self._space_waiters.append(waiter)
+            task_id = self._enqueue(text, priority, func=func, args=args, run_timeout=run_timeout)
+            if task_id is not None:
+                waiter.cancel()
+                logger.info(f"添加提取任务: {task_id}, 文本长度: {len(text)}")
+                return task_id
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                await asyncio.wait_for(asyncio.wrap_future(waiter), timeout=remaining)
+            except asyncio.TimeoutError:
+                with self.lock:
+                    self._rejected += 1
+                raise TaskQueueFullError(f"任务队列已满（等待{timeout:g}秒），最大容量: {self.max_queue_size}")
+
+    async def run_call(self, func: Callable, *args, priority: int = TaskPriority.INTERACTIVE,
+                       timeout: Optional[float] = None) -> Any:
+        """把同步函数（如记忆召回）作为任务排队执行并等待结果"""
+        if not self.enabled:
+            return await asyncio.to_thread(func, *args)
+        name = getattr(func, "__name__", "call")
+        task_id = self._enqueue(f"{name}:{time.monotonic()}", priority, func=func, args=args, notify=False)
+        if task_id is None:
+            raise TaskQueueFullError(f"任务队列已满，最大容量: {self.max_queue_size}")
+        task = self.tasks[task_id]
+        try:
+            await asyncio.wait_for(asyncio.wrap_future(task.done), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.cancel_task(task_id)
+            raise
+        if task.status != TaskStatus.COMPLETED:
+            raise RuntimeError(task.error or f"任务未完成: {task.status.value}")
+        return task.result
+
+    async def wait_task(self, task_id: str, timeout: Optional[float] = None) -> Optional[Dict]:
+        """等待任务结束，返回任务状态"""
         task = self.tasks.get(task_id)
         if not task:
-            logger.error(f"任务不存在: {task_id}")
-            return
-        
-        # 更新任务状态
+            return None
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(task.done)), timeout=timeout)
+        except (asyncio.CancelledError, asyncio.TimeoutError):
+            if not task.done.cancelled():
+                raise
+        return self.get_task_status(task_id)
+
+    # ---------- 执行 ----------
+    def _observe(self, histograms: Dict[str, LatencyHistogram], priority: int, ms: float):
+        try:
+            name = TaskPriority(priority).name.lower()
+        except ValueError:
+            name = str(priority)
         with self.lock:
-            task.status = TaskStatus.RUNNING
-            task.started_at = time.time()
-            self.running_tasks += 1
-        
+            histograms.setdefault(name, LatencyHistogram()).observe(ms)
+
+    def _resolve(self, task: ExtractionTask):
+        if task.done is not None and not task.done.done():
+            if task.status == TaskStatus.CANCELLED:
+                task.done.cancel()
+            else:
+                task.done.set_result(task.status)
+
+    async def _process_task(self, task: ExtractionTask):
+        """处理单个任务"""
+        task_id = task.task_id
+        self._observe(self._queue_wait, task.priority, (time.monotonic() - task.enqueued_at) * 1000)
         logger.info(f"开始处理任务: {task_id}")
-        
+
+        is_extraction = task.func is None
+        func = self._extract_quintuples_sync if is_extraction else task.func
+        args = (task.text,) if is_extraction else task.args
+        timeout = task.run_timeout or self.task_timeout
+        started = time.monotonic()
         try:
-            # 在线程池中执行提取，添加超时控制
-            loop = asyncio.get_event_loop()
+            # 在线程池中执行，添加超时控制
+            loop = asyncio.get_running_loop()
             result = await asyncio.wait_for(
-                loop.run_in_executor(self.executor, self._extract_quintuples_sync, task.text),
-                timeout=self.task_timeout
+                loop.run_in_executor(self.executor, func, *args),
+                timeout=timeout
             )
-            
-            # 更新任务状态
+            self._observe(self._run_time, task.priority, (time.monotonic() - started) * 1000)
+
+            # 更新任务状态（执行期间被取消的任务不再回调）
             with self.lock:
-                task.status = TaskStatus.COMPLETED
-                task.completed_at = time.time()
+                if task.status != TaskStatus.RUNNING:
+                    return
                 task.result = result
-                self.running_tasks -= 1
-                self.completed_tasks += 1
-            
-            logger.info(f"任务完成: {task_id}, 提取到 {len(result)} 个五元组")
-            
+                self._set_status(task, TaskStatus.COMPLETED)
+
+            if task.notify:
+                logger.info(f"任务完成: {task_id}, 提取到 {len(result)} 个五元组")
+            self._resolve(task)
+
             # 调用完成回调
-            if self.on_task_completed:
+            if task.notify and self.on_task_completed:
                 try:
                     await self.on_task_completed(task_id, result)
                 except Exception as e:
                     logger.error(f"任务完成回调执行失败: {e}")
-        
+
         except asyncio.TimeoutError:
-            # 处理超时
-            with self.lock:
-                task.status = TaskStatus.FAILED
-                task.completed_at = time.time()
-                task.error = f"任务超时（{self.task_timeout}秒）"
-                self.running_tasks -= 1
-                self.failed_tasks += 1
-            
-            logger.error(f"任务超时: {task_id}")
-            
-            # 调用失败回调
-            if self.on_task_failed:
-                try:
-                    await self.on_task_failed(task_id, f"任务超时（{self.task_timeout}秒）")
-                except Exception as callback_e:
-                    logger.error(f"任务失败回调执行失败: {callback_e}")
-        
+            self._observe(self._run_time, task.priority, (time.monotonic() - started) * 1000)
+            await self._fail(task, f"任务超时（{timeout}秒）")
+
         except Exception as e:
-            # 处理失败
-            with self.lock:
-                task.status = TaskStatus.FAILED
-                task.completed_at = time.time()
-                task.error = str(e)
-                self.running_tasks -= 1
-                self.failed_tasks += 1
-            
-            logger.error(f"任务失败: {task_id}, 错误: {e}")
-            
-            # 调用失败回调
-            if self.on_task_failed:
-                try:
-                    await self.on_task_failed(task_id, str(e))
-                except Exception as callback_e:
-                    logger.error(f"任务失败回调执行失败: {callback_e}")
-    
+            self._observe(self._run_time, task.priority, (time.monotonic() - started) * 1000)
+            await self._fail(task, str(e))
+
+        finally:
+            self._resolve(task)
+
+    async def _fail(self, task: ExtractionTask, error: str):
+        with self.lock:
+            if task.status != TaskStatus.RUNNING:
+                return
+            task.error = error
+            self._set_status(task, TaskStatus.FAILED)
+
+        logger.error(f"任务失败: {task.task_id}, 错误: {error}")
+        self._resolve(task)
+
+        # 调用失败回调
+        if task.notify and self.on_task_failed:
+            try:
+                await self.on_task_failed(task.task_id, error)
+            except Exception as callback_e:
+                logger.error(f"任务失败回调执行失败: {callback_e}")
+
     def _extract_quintuples_sync(self, text: str) -> List:
         """同步执行五元组提取（在线程池中运行）"""
         try:
@@ -201,117 +500,129 @@ class QuintupleTaskManager:
         except Exception as e:
             logger.error(f"五元组提取失败: {e}")
             raise
-    
+
+    # ---------- 查询 ----------
     def get_task_status(self, task_id: str) -> Optional[Dict]:
         """获取任务状态"""
         task = self.tasks.get(task_id)
         if not task:
             return None
-        
+
         return {
             "task_id": task.task_id,
             "status": task.status.value,
+            "priority": int(task.priority),
             "created_at": task.created_at,
             "started_at": task.started_at,
             "completed_at": task.completed_at,
-            "result_count": len(task.result) if task.result else 0,
+            "result_count": len(task.result) if isinstance(task.result, list) else (1 if task.result else 0),
             "error": task.error,
             "retry_count": task.retry_count
         }
-    
+
     def get_all_tasks(self) -> List[Dict]:
         """获取所有任务状态"""
         with self.lock:
             return [self.get_task_status(task_id) for task_id in self.tasks.keys()]
-    
+
     def get_running_tasks(self) -> List[str]:
         """获取正在运行的任务ID列表"""
         with self.lock:
             return [
-                task_id for task_id, task in self.tasks.items() 
+                task_id for task_id, task in self.tasks.items()
                 if task.status == TaskStatus.RUNNING
             ]
-    
+
     def get_pending_tasks(self) -> List[str]:
-        """获取等待中的任务ID列表"""
+        """获取等待中的任务ID列表（按执行顺序）"""
         with self.lock:
             return [
-                task_id for task_id, task in self.tasks.items() 
-                if task.status == TaskStatus.PENDING
+                task_id for _, _, task_id in sorted(self._heap)
+                if task_id in self.tasks and self.tasks[task_id].status == TaskStatus.PENDING
             ]
-    
+
     def cancel_task(self, task_id: str) -> bool:
-        """取消任务"""
-        task = self.tasks.get(task_id)
-        if not task:
-            return False
-        
-        if task.status in [TaskStatus.PENDING, TaskStatus.RUNNING]:
-            with self.lock:
-                task.status = TaskStatus.CANCELLED
-                task.completed_at = time.time()
-                if task.status == TaskStatus.RUNNING:
-                    self.running_tasks -= 1
-            
-            logger.info(f"任务已取消: {task_id}")
-            return True
-        
-        return False
-    
-    def get_stats(self) -> Dict:
-        """获取任务管理器统计信息"""
+        """取消任务（运行中的任务无法中断线程，结果会被丢弃）"""
         with self.lock:
-            total_tasks = len(self.tasks)
-            pending_tasks = sum(1 for task in self.tasks.values() if task.status == TaskStatus.PENDING)
-            completed_tasks = sum(1 for task in self.tasks.values() if task.status == TaskStatus.COMPLETED)
-            failed_tasks = sum(1 for task in self.tasks.values() if task.status == TaskStatus.FAILED)
-            cancelled_tasks = sum(1 for task in self.tasks.values() if task.status == TaskStatus.CANCELLED)
-            
+            task = self.tasks.get(task_id)
+            if not task or task.status not in (TaskStatus.PENDING, TaskStatus.RUNNING):
+                return False
+            freed = task.status == TaskStatus.PENDING and task.priority != TaskPriority.INTERACTIVE
+            self._set_status(task, TaskStatus.CANCELLED)
+
+        self._resolve(task)
+        if freed:
+            self._release_space()
+        logger.info(f"任务已取消: {task_id}")
+        return True
+
+    def get_task_stats(self) -> Dict:
+        """获取任务管理器统计信息（含排队/执行耗时直方图）"""
+        with self.lock:
+            counts = {status.value: n for status, n in self._state_counts.items()}
+            pending_background = self._pending_background()
             return {
                 "enabled": self.enabled,
-                "total_tasks": total_tasks,
-                "pending_tasks": pending_tasks,
-                "running_tasks": self.running_tasks,
-                "completed_tasks": completed_tasks,
-                "failed_tasks": failed_tasks,
-                "cancelled_tasks": cancelled_tasks,
+                "total_tasks": len(self.tasks),
+                "pending_tasks": counts["pending"],
+                "pending_interactive": self._pending_interactive,
+                "running_tasks": counts["running"],
+                "completed_tasks": counts["completed"],
+                "failed_tasks": counts["failed"],
+                "cancelled_tasks": counts["cancelled"],
+                "deduplicated": self._deduplicated,
+                "rejected": self._rejected,
                 "max_workers": self.max_workers,
+                "interactive_workers": self.interactive_workers,
                 "max_queue_size": self.max_queue_size,
-                "queue_usage": f"{pending_tasks}/{self.max_queue_size}",
-                "task_timeout": self.task_timeout
+                "queue_usage": f"{pending_background}/{self.max_queue_size}",
+                "task_timeout": self.task_timeout,
+                "queue_wait_ms": {name: h.to_dict() for name, h in self._queue_wait.items()},
+                "run_time_ms": {name: h.to_dict() for name, h in self._run_time.items()},
             }
-    
+
+    def get_stats(self) -> Dict:
+        """获取任务管理器统计信息（兼容旧接口）"""
+        return self.get_task_stats()
+
     def clear_completed_tasks(self, max_age_hours: int = None):
-        """清理已完成的任务"""
+        """清理已完成的任务（按结束顺序从最早的开始清理）"""
         if max_age_hours is None:
             max_age_hours = self.auto_cleanup_hours
-            
-        current_time = time.time()
-        max_age_seconds = max_age_hours * 3600
-        
+
+        cutoff = time.time() - max_age_hours * 3600
+
+        removed = 0
         with self.lock:
-            tasks_to_remove = []
-            for task_id, task in self.tasks.items():
-                if task.status in [TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.CANCELLED]:
-                    if task.completed_at and (current_time - task.completed_at) > max_age_seconds:
-                        tasks_to_remove.append(task_id)
-            
-            for task_id in tasks_to_remove:
-                del self.tasks[task_id]
-            
-            if tasks_to_remove:
-                logger.info(f"清理了 {len(tasks_to_remove)} 个过期任务")
-    
+            while self._finished and self._finished[0][0] < cutoff:
+                _, task_id = self._finished.popleft()
+                task = self.tasks.get(task_id)
+                if task is not None and task.status in _TERMINAL:
+                    del self.tasks[task_id]
+                    self._state_counts[task.status] -= 1
+                    removed += 1
+
+        if removed:
+            logger.info(f"清理了 {removed} 个过期任务")
+
     def shutdown(self):
         """关闭任务管理器"""
         logger.info("正在关闭任务管理器...")
-        
+
         # 取消所有等待中的任务
         with self.lock:
-            for task_id, task in self.tasks.items():
-                if task.status == TaskStatus.PENDING:
-                    task.status = TaskStatus.CANCELLED
-        
+            pending = [task for task in self.tasks.values() if task.status == TaskStatus.PENDING]
+            for task in pending:
+                self._set_status(task, TaskStatus.CANCELLED)
+            self._heap.clear()
+        for task in pending:
+            self._resolve(task)
+        self._release_space()
+
+        # 停止后台事件循环
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
         # 关闭线程池
         self.executor.shutdown(wait=True)
         logger.info("任务管理器已关闭")
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+全局LLM调度器测试
+- 优先级通道：并发占满时，排队请求按 交互对话 > 工具Agent > 深度思考 > 后台记忆提取 的顺序发放
+- 令牌桶：RPM/TPM配额耗尽后的请求要等到令牌补充才发放
+- 重入：llm_context中已持有配额时再次申请slot（异步及线程池中的同步调用）直接复用，不排队也不死锁
+- 流式调用的生成器中途被丢弃时，持有的配额会被归还
+用法: python test_llm_scheduler.py
+"""
+
+import sys
+import os
+import gc
+import time
+import asyncio
+sys.path.append(os.path.dirname(__file__))
+
+from apiserver.llm_scheduler import LLMScheduler, LLMLane, llm_context
+
+
+async def check_lane_priority():
+    """max_concurrent=1：先按低优先级顺序排队，释放后应按高优先级顺序发放"""
+    scheduler = LLMScheduler(max_concurrent=1)
+    order = []
+
+    async def worker(lane):
+        async with scheduler.slot(lane=lane, session_id=lane.name):
+            order.append(lane)
+
+    blocker = await scheduler.acquire(LLMLane.INTERACTIVE, "blocker")
+    tasks = []
+    for lane in reversed(list(LLMLane)):  # 后台、思考、Agent、交互依次入队
+        tasks.append(asyncio.create_task(worker(lane)))
+        await asyncio.sleep(0.01)
+    assert not order, "并发已占满时不应发放"
+    scheduler.release(blocker)
+    await asyncio.wait_for(asyncio.gather(*tasks), 2)
+    print(f"发放顺序: {[lane.name for lane in order]}")
+    assert order == list(LLMLane), "应按通道优先级发放"
+
+
+async def check_token_buckets():
+    """RPM=120（每秒补充2个）、TPM=600（每秒补充10个）：配额耗尽后下一次请求需要等待补充"""
+    scheduler = LLMScheduler(rpm_limit=120, max_concurrent=0)
+    for _ in range(120):
+        scheduler.release(await scheduler.acquire())
+    start = time.monotonic()
+    scheduler.release(await asyncio.wait_for(scheduler.acquire(), 3))
+    rpm_wait = time.monotonic() - start
+    print(f"RPM耗尽后等待 {rpm_wait:.2f} 秒")
+    assert rpm_wait >= 0.3, "RPM配额耗尽后应等待令牌补充"
+
+    scheduler = LLMScheduler(tpm_limit=600, max_concurrent=0)
+    scheduler.release(await scheduler.acquire(tokens=600))
+    start = time.monotonic()
+    scheduler.release(await asyncio.wait_for(scheduler.acquire(tokens=5), 3))
+    tpm_wait = time.monotonic() - start
+    print(f"TPM耗尽后等待 {tpm_wait:.2f} 秒")
+    assert tpm_wait >= 0.3, "TPM配额耗尽后应等待令牌补充"
+
+
+async def check_reentrant_slot():
+    """max_concurrent=1：外层slot未释放时，嵌套slot和线程池中的slot_sync都应直接复用配额"""
+    scheduler = LLMScheduler(max_concurrent=1)
+
+    def sync_call():
+        with scheduler.slot_sync(timeout=1) as ticket:
+            return ticket.reentrant
+
+    async def nested():
+        async with scheduler.slot() as inner:
+            assert inner.reentrant
+            return await asyncio.to_thread(sync_call)
+
+    with llm_context(LLMLane.THINKING, "session-1"):
+        async with scheduler.slot() as outer:
+            assert not outer.reentrant and outer.lane == LLMLane.THINKING and outer.session == "session-1"
+            assert await asyncio.wait_for(nested(), 2), "线程池中的同步调用应复用外层配额"
+            stats = scheduler.get_stats()
+            assert stats["active"] == 1 and stats["reentrant"] == 2, stats
+    stats = scheduler.get_stats()
+    print(f"嵌套调用: 重入 {stats['reentrant']} 次，结束后占用 {stats['active']}")
+    assert stats["active"] == 0 and stats["lanes"]["thinking"]["granted"] == 1
+
+
+async def check_abandoned_stream():
+    """流式生成器读到一半被丢弃：配额应被归还，后续请求不被阻塞"""
+    scheduler = LLMScheduler(max_concurrent=1)
+
+    async def stream():
+        async with scheduler.slot():
+            for chunk in ("你", "好"):
+                yield chunk
+
+    generator = stream()
+    assert await generator.__anext__() == "你"
+    del generator
+    gc.collect()
+    await asyncio.sleep(0.05)  # 等待事件循环回收生成器
+    scheduler.release(await asyncio.wait_for(scheduler.acquire(), 2))
+    active = scheduler.get_stats()["active"]
+    print(f"丢弃流式调用后的占用: {active}")
+    assert active == 0, "丢弃的流式调用应归还配额"
+
+
+def test_llm_scheduler():
+    print("=== LLM调度器测试 ===")
+    asyncio.run(check_lane_priority())
+    asyncio.run(check_token_buckets())
+    asyncio.run(check_reentrant_slot())
+    asyncio.run(check_abandoned_stream())
+    print("测试通过")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if test_llm_scheduler() else 1)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+原生函数调用工具协议测试
+- 本地启动一个OpenAI兼容的模拟服务：第一轮回复tool_calls（流式时参数分多个增量到达，并穿插call_agent调用），
+  收到tool消息后回复最终文本
+- 分别检查非流式和流式工具调用循环：参数合并、嵌套花括号参数、未知函数回传错误、tool消息与调用id对应
+- 文本协议（toolset为空）行为不变
+- 按仓库中的真实manifest统计原生协议相对文本协议每次请求节省的提示词token数（只报告，结果取决于分词器和服务数量）
+用法: python test_native_tools.py
+"""
+
+import sys
+import os
+import json
+import asyncio
+import threading
+import urllib.request
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.dirname(__file__))
+
+import conversation_core
+import mcpserver.agent_manager as agent_manager_module
+from conversation_core import NagaConversation
+from apiserver.native_tools import (NativeToolset, build_tool_schemas, measure_prompt_savings)
+from apiserver.tool_call_utils import tool_call_loop, tool_call_loop_stream
+from mcpserver.mcp_registry import load_manifest_file
+
+NESTED_ARGS = {"city": "北京", "options": {"unit": {"temp": "C"}}, "note": "｛不是工具调用｝"}
+
+
+class StubMCPManager:
+    """用仓库中的manifest提供服务列表，unified_call直接回显参数"""
+
+    def __init__(self):
+        self.calls = []
+        self.services = {"mcp_services": [], "agent_services": []}
+        root = Path(os.path.dirname(os.path.abspath(__file__))) / "mcpserver"
+        for path in sorted(root.glob("*/agent-manifest.json")):
+            manifest = load_manifest_file(path)
+            if not manifest or manifest.get("agentType") != "mcp":
+                continue
+            tools = [{"name": c.get("command", ""), "description": c.get("description", ""),
+                      "example": c.get("example", ""), "input_schema": manifest.get("inputSchema", {})}
+                     for c in manifest.get("capabilities", {}).get("invocationCommands", [])]
+            self.services["mcp_services"].append({"name": manifest["name"], "description": manifest.get("description", ""),
+                                                  "available_tools": tools})
+
+    def get_available_services_filtered(self):
+        return self.services
+
+    async def unified_call(self, service_name, tool_name, args):
+        self.calls.append((service_name, tool_name, args))
+        return f"{service_name}.{tool_name} 完成: {json.dumps(args, ensure_ascii=False, sort_keys=True)}"
+
+
+class StubAgentManager:
+    async def call_agent(self, agent_name, prompt):
+        return {"status": "success", "result": f"{agent_name} 已处理: {prompt}"}
+
+
+class ToolsStub(BaseHTTPRequestHandler):
+    """模拟支持tools参数的 /v1/chat/completions"""
+
+    requests = []
+    function_name = ""
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append(body)
+        answered = any(m.get("role") == "tool" for m in body.get("messages", []))
+        if body.get("stream"):
+            self._stream(answered)
+        elif answered:
+            self._reply({"role": "assistant", "content": "天气晴"})
+        else:
+            self._reply({"role": "assistant", "content": None, "tool_calls": [
+                {"id": "c1", "type": "function", "function": {"name": self.function_name,
+                                                              "arguments": json.dumps(NESTED_ARGS, ensure_ascii=False)}},
+                {"id": "c2", "type": "function", "function": {"name": "no_such_tool", "arguments": "{}"}},
+            ]})
+
+    def _stream(self, answered):
+        if answered:
+            deltas = [{"content": "结果"}, {"content": "已返回"}]
+        else:
+            args = json.dumps(NESTED_ARGS, ensure_ascii=False)
+            deltas = [
+                {"content": "稍等"},
+                {"tool_calls": [{"index": 0, "id": "call_a", "type": "function",
+                                 "function": {"name": self.function_name, "arguments": ""}}]},
+                {"tool_calls": [{"index": 0, "function": {"arguments": args[:12]}}]},
+                {"tool_calls": [{"index": 1, "id": "call_b", "type": "function",
+                                 "function": {"name": "call_agent",
+                                              "arguments": json.dumps({"agent_name": "ComicAgent", "prompt": "下载"},
+                                                                      ensure_ascii=False)}}]},
+                {"tool_calls": [{"index": 0, "function": {"arguments": args[12:]}}]},
+            ]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for delta in deltas:
+            chunk = {"choices": [{"index": 0, "delta": delta}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _reply(self, message):
+        out = json.dumps({"choices": [{"index": 0, "message": message, "finish_reason": "stop"}]},
+                         ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as resp:
+        return resp.read().decode("utf-8")
+
+
+def make_callers(url):
+    async def call_llm(messages, tools=None):
+        payload = {"model": "stub", "messages": messages, "stream": False}
+        if tools:
+            payload["tools"] = tools
+        message = json.loads(await asyncio.to_thread(post, url, payload))["choices"][0]["message"]
+        return {"content": message.get("content"), "tool_calls": message.get("tool_calls"), "status": "success"}
+
+    async def call_llm_stream(messages, tools=None):
+        payload = {"model": "stub", "messages": messages, "stream": True}
+        if tools:
+            payload["tools"] = tools
+        for line in (await asyncio.to_thread(post, url, payload)).splitlines():
+            if not line.startswith("data:") or line[5:].strip() == "[DONE]":
+                continue
+            delta = json.loads(line[5:])["choices"][0].get("delta") or {}
+            if delta.get("content"):
+                yield delta["content"]
+            if delta.get("tool_calls"):
+                yield {"tool_calls": delta["tool_calls"]}
+
+    return call_llm, call_llm_stream
+
+
+async def check_loops(url, toolset, mcp):
+    call_llm, call_llm_stream = make_callers(url)
+    base = [{"role": "system", "content": "你是娜迦"}, {"role": "user", "content": "北京天气"}]
+    service_name, command = toolset.name_map[ToolsStub.function_name]
+
+    # 非流式：嵌套花括号参数完整传给服务，未知函数回传错误而不中断循环
+    result = await tool_call_loop(list(base), mcp, call_llm, toolset=toolset)
+    assert result["content"] == "天气晴" and result["recursion_depth"] == 1, result
+    assert "tools" in ToolsStub.requests[0] and len(ToolsStub.requests[0]["tools"]) == len(toolset.tools)
+    assistant, *tool_messages = result["messages"][2:]
+    assert [c["id"] for c in assistant["tool_calls"]] == [m["tool_call_id"] for m in tool_messages] == ["c1", "c2"]
+    assert mcp.calls[-1] == (service_name, command, {**NESTED_ARGS, "tool_name": command}), mcp.calls[-1]
+    assert "未知工具" in tool_messages[1]["content"]
+    print(f"非流式: {len(tool_messages)} 条tool消息，未知函数返回: {tool_messages[1]['content']}")
+
+    # 流式：分片到达的参数按index合并，call_agent交给AgentManager
+    events = [e async for e in tool_call_loop_stream(list(base), mcp, call_llm_stream, toolset=toolset)]
+    text = "".join(e["content"] for e in events if e["type"] == "text")
+    calls = next(e for e in events if e["type"] == "tool_calls")["tool_calls"]
+    assert text == "稍等结果已返回", text
+    assert calls[0]["args"] == {**NESTED_ARGS, "agentType": "mcp", "service_name": service_name, "tool_name": command}
+    assert calls[1]["args"] == {"agentType": "agent", "agent_name": "ComicAgent", "prompt": "下载"}
+    tool_messages = [m for m in events[-1]["messages"] if m["role"] == "tool"]
+    assert [m["tool_call_id"] for m in tool_messages] == ["call_a", "call_b"]
+    assert tool_messages[1]["content"] == "ComicAgent 已处理: 下载"
+    print(f"流式: 文本 {text!r}，调用 {[c['name'] for c in calls]}")
+
+    # 文本协议不受影响：不发送tools，｛...｝仍按文本解析
+    async def text_llm(messages):
+        return {"content": "好的" if any(m["role"] == "assistant" for m in messages) else
+                f'｛"tool_name": "{command}", "service_name": "{service_name}", "agentType": "mcp"｝'}
+    result = await tool_call_loop(list(base), mcp, text_llm)
+    assert result["content"] == "好的" and result["recursion_depth"] == 1
+    assert result["messages"][-1]["role"] == "user" and f"来自工具 \"{command}\"" in result["messages"][-1]["content"]
+    print("文本协议: 行为不变")
+
+
+def test_native_tools():
+    """原生协议下工具调用循环正确，并报告每次请求的提示词token数对比"""
+    print("=== 原生函数调用工具协议测试 ===")
+    mcp = StubMCPManager()
+    tools, name_map = build_tool_schemas(mcp.get_available_services_filtered(),
+                                         [{"base_name": "ComicAgent", "description": "漫画下载"}])
+    toolset = NativeToolset(tools, name_map)
+    assert tools and tools[-1]["function"]["name"] == "call_agent"
+    ToolsStub.function_name = tools[0]["function"]["name"]
+    ToolsStub.requests = []
+    print(f"由manifest转换 {len(tools)} 个函数定义")
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ToolsStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+    original_get_agent_manager = agent_manager_module.get_agent_manager
+    agent_manager_module.get_agent_manager = lambda: StubAgentManager()
+    try:
+        asyncio.run(check_loops(url, toolset, mcp))
+    finally:
+        server.shutdown()
+        agent_manager_module.get_agent_manager = original_get_agent_manager
+
+    agent = NagaConversation.__new__(NagaConversation)  # 不创建LLM客户端
+    agent.mcp = mcp
+    conversation_core._SYSTEM_PROMPT_CACHE.update(key=None, prompt=None, native=None)
+    try:
+        savings = measure_prompt_savings(agent.get_system_prompt(), agent.get_system_prompt(native=True), toolset)
+    finally:
+        conversation_core._SYSTEM_PROMPT_CACHE.update(key=None, prompt=None, native=None)
+    print(f"文本协议: {savings['text_prompt_tokens']} token/请求，原生协议（含tools定义）: "
+          f"{savings['native_prompt_tokens']} token/请求，节省 {savings['saved_per_request']}")
+    assert savings["native_prompt_tokens"] > 0 and "【工具调用格式要求】" not in agent.get_system_prompt(native=True)
+    print("测试通过")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if test_native_tools() else 1)
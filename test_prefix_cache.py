@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+提示词前缀缓存测试
+- 本地启动一个模拟前缀缓存的OpenAI兼容服务：按与之前请求的最长公共前缀（64 token为一块）计算cached_tokens，
+  并像部分后端一样拒绝不在开头的system消息
+- 分别用prefix_cache和legacy布局连续发送多轮对话（每轮时间前进一分钟），对比缓存命中率和每轮前缀哈希
+用法: python test_prefix_cache.py
+"""
+
+import sys
+import os
+import json
+import threading
+import urllib.request
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.append(os.path.dirname(__file__))
+
+import conversation_core
+from conversation_core import NagaConversation
+from apiserver.context_builder import ContextBuilder, TokenCounter
+from config import config
+
+CACHE_BLOCK = 64  # 模拟服务端按块缓存前缀
+TURNS = 6
+
+
+class PrefixCacheStub(BaseHTTPRequestHandler):
+    """模拟前缀缓存的 /v1/chat/completions"""
+
+    prompts = []  # 已处理请求的序列化提示词
+    counter = TokenCounter()
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        messages = body.get("messages", [])
+        if any(m.get("role") == "system" for m in messages[1:]):
+            self._reply(400, {"error": {"message": "system message must be the first message"}})
+            return
+        prompt = "".join(f"<{m['role']}>{m.get('content') or ''}\n" for m in messages)
+        common = max((self._common_prefix(prompt, old) for old in self.prompts), default=0)
+        self.prompts.append(prompt)
+        prompt_tokens = self.counter.count_text(prompt)
+        cached = self.counter.count_text(prompt[:common]) // CACHE_BLOCK * CACHE_BLOCK
+        self._reply(200, {
+            "id": f"stub-{len(self.prompts)}",
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "好的"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 2, "total_tokens": prompt_tokens + 2,
+                      "prompt_tokens_details": {"cached_tokens": min(cached, prompt_tokens)}},
+        })
+
+    @staticmethod
+    def _common_prefix(a, b):
+        n = min(len(a), len(b))
+        i = 0
+        while i < n and a[i] == b[i]:
+            i += 1
+        return i
+
+    def _reply(self, status, data):
+        out = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def post(url, messages):
+    payload = json.dumps({"model": "stub", "messages": messages}).encode("utf-8")
+    request = urllib.request.Request(url, data=payload, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as resp:
+            return json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        raise AssertionError(f"服务端拒绝请求: {e.read().decode('utf-8')}")
+
+
+def run_layout(url, layout):
+    """按指定布局连续发送TURNS轮对话，返回 (缓存命中率, 不同前缀哈希数)"""
+    config.api.prompt_layout = layout
+    conversation_core._SYSTEM_PROMPT_CACHE.update(key=None, prompt=None)
+    conversation_core._LOCAL_CITY = "测试城市"  # 避免联网解析本地城市
+    agent = NagaConversation.__new__(NagaConversation)  # 不创建LLM客户端
+    agent.mcp = conversation_core.get_mcp_manager()
+    builder = ContextBuilder(max_context_tokens=32768, completion_reserve=2000)
+    PrefixCacheStub.prompts = []
+    history, hashes = [], set()
+    prompt_total = cached_total = 0
+    for turn in range(TURNS):
+        conversation_core._prompt_time_slot = lambda minute=turn: f"2026-01-01 10:{minute:02d}"
+        question = f"第{turn + 1}个问题：明天需要带伞吗？"
+        messages, report = builder.build(agent.get_system_prompt(), history, question,
+                                         context_message=agent.get_context_message())
+        assert [m["role"] for m in messages].count("system") == 1 and messages[0]["role"] == "system"
+        usage = post(url, messages)["usage"]
+        hashes.add(report["prefix_hash"])
+        if turn:  # 第一轮没有可复用的缓存
+            prompt_total += usage["prompt_tokens"]
+            cached_total += usage["prompt_tokens_details"]["cached_tokens"]
+        print(f"  [{layout}] 第{turn + 1}轮: 提示词 {usage['prompt_tokens']} token，"
+              f"缓存 {usage['prompt_tokens_details']['cached_tokens']}，前缀 {report['prefix_hash']}")
+        history += [{"role": "user", "content": question}, {"role": "assistant", "content": "好的"}]
+    return (cached_total / prompt_total if prompt_total else 0.0), len(hashes)
+
+
+def test_prefix_cache():
+    """prefix_cache布局下前缀哈希不变，缓存命中率高于legacy布局"""
+    print("=== 提示词前缀缓存测试 ===")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PrefixCacheStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+    original_layout = getattr(config.api, "prompt_layout", "prefix_cache")
+    original_time_slot = conversation_core._prompt_time_slot
+    try:
+        stable_rate, stable_hashes = run_layout(url, "prefix_cache")
+        legacy_rate, legacy_hashes = run_layout(url, "legacy")
+    finally:
+        server.shutdown()
+        config.api.prompt_layout = original_layout
+        conversation_core._prompt_time_slot = original_time_slot
+        conversation_core._SYSTEM_PROMPT_CACHE.update(key=None, prompt=None)
+    print(f"prefix_cache: 缓存命中率 {stable_rate:.1%}，前缀哈希 {stable_hashes} 个")
+    print(f"legacy:       缓存命中率 {legacy_rate:.1%}，前缀哈希 {legacy_hashes} 个")
+    assert stable_hashes == 1, "prefix_cache布局下系统提示词前缀不应变化"
+    assert stable_rate > legacy_rate, "prefix_cache布局的缓存命中率应高于legacy布局"
+    print("测试通过")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if test_prefix_cache() else 1)
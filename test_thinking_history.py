@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+思考历史存储测试
+- 分段数超过上限时删除最旧的分段：内存环形缓冲中属于已删除分段的记录一并移除
+- recent按索引顺序返回，不重复、不乱序；get与get_stats保持一致
+用法: python test_thinking_history.py
+"""
+
+import sys
+import os
+import hashlib
+import tempfile
+sys.path.append(os.path.dirname(__file__))
+
+from thinking.history_store import ThinkingHistoryStore
+
+
+def make_record(i):
+    # 难以压缩的内容，使每条记录压缩后约200字节，一个分段只放得下一条
+    answer = "".join(hashlib.sha1(f"{i}-{n}".encode()).hexdigest() for n in range(6))
+    return {"session_id": f"s{i}", "question": f"第{i}个问题", "final_answer": answer, "thinking_routes": 3,
+            "optimal_routes": 1, "processing_time": 0.5, "timestamp": 1000.0 + i}
+
+
+def test_recent_after_prune():
+    """小分段 + 分段上限2：剪枝后recent、get、get_stats一致"""
+    print("=== 思考历史剪枝测试 ===")
+    with tempfile.TemporaryDirectory() as directory:
+        store = ThinkingHistoryStore(directory, memory_size=3, segment_max_bytes=300, max_segments=2)
+        for i in range(10):
+            store.append(make_record(i))
+        indexed = [entry["session_id"] for entry in reversed(store.list_sessions(limit=100))]
+        stats = store.get_stats()
+        print(f"索引中的会话: {indexed}，统计: {stats['total_sessions']} 条，内存 {stats['in_memory']} 条")
+        assert indexed and indexed[-1] == "s9"
+        assert stats["in_memory"] <= len(indexed), "内存中不应保留已删除分段的记录"
+        assert stats["total_sessions"] == len(indexed)
+
+        recent = [record["session_id"] for record in store.recent(5)]
+        print(f"recent(5): {recent}")
+        assert recent == indexed[-5:], "recent应按索引顺序返回且不重复"
+
+        for i in range(10):
+            session_id = f"s{i}"
+            found = store.get(session_id) is not None
+            assert found == (session_id in indexed), f"{session_id}: get与索引不一致"
+
+        # 重新加载后结果相同
+        reloaded = ThinkingHistoryStore(directory, memory_size=3, segment_max_bytes=300, max_segments=2)
+        assert [record["session_id"] for record in reloaded.recent(5)] == recent
+    print("测试通过")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if test_recent_after_prune() else 1)
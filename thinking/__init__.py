@@ -9,6 +9,7 @@ from .difficulty_judge import DifficultyJudge
 from .preference_filter import PreferenceFilter, UserPreference
 from .genetic_pruning import GeneticPruning
 from .thread_pools import ThreadPoolManager
+from .speculative import SpeculativeThinking
 
 __all__ = [
     'TreeThinkingEngine',
@@ -18,7 +19,8 @@ __all__ = [
     'PreferenceFilter',
     'UserPreference',
     'GeneticPruning',
-    'ThreadPoolManager'
+    'ThreadPoolManager',
+    'SpeculativeThinking'
 ]
 
 __version__ = "1.0.0" 
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""
+批量偏好打分
+- 所有候选结果放进一个结构化提示词，每条带基于内容哈希的稳定ID，模型返回JSON数组一次给出全部评分
+- JSON解析失败或缺少部分ID时，对缺失的结果以有限并发逐条打分
+- 评分按(内容哈希, 偏好)缓存，在多代遗传进化中保留下来的节点不会重复打分
+- 供PreferenceFilter（AI偏好评分）和QuickModelManager（结果打分）共用
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger("BatchScoring")
+
+
+def content_id(content: str) -> str:
+    """基于内容哈希的稳定ID"""
+    return "r" + hashlib.sha1((content or "").encode("utf-8")).hexdigest()[:8]
+
+
+def preference_key(preferences: Sequence[str]) -> str:
+    return hashlib.sha1("\n".join(preferences).encode("utf-8")).hexdigest()[:16]
+
+
+class ScoreCache:
+    """(内容哈希, 偏好) -> 评分 的LRU缓存"""
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, content: str, prefs_key: str) -> Optional[Dict]:
+        key = (content_id(content), prefs_key)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, content: str, prefs_key: str, entry: Dict):
+        with self._lock:
+            self._items[(content_id(content), prefs_key)] = entry
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"cached": len(self._items), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0}
+
+
+def build_batch_prompt(items: Sequence[Tuple[str, str]], preferences_text: str, score_range=(1, 5)) -> str:
+    """构造批量评分提示词，items为[(ID, 内容)]"""
+    low, high = score_range
+    candidates = "\n".join(f"[{item_id}]\n{content}\n" for item_id, content in items)
+    return f"""
+请根据用户偏好分别对以下每个候选结果进行评分（{low}-{high}分，{high}分最好）：
+
+用户偏好：
+{preferences_text}
+
+候选结果（每个以 [ID] 开头）：
+{candidates}
+只返回一个JSON数组，每个候选结果一项，ID必须与上面完全一致：
+[{{"id": "ID", "score": 分数, "reason": "简短理由"}}]
+"""
+
+
+def parse_batch_scores(response: str, ids: Sequence[str], score_range=(1, 5)) -> Dict[str, Dict]:
+    """解析JSON数组评分，返回{ID: {"score", "reason"}}（只包含有效的ID）"""
+    low, high = score_range
+    if not response:
+        return {}
+    match = re.search(r"```(?:json)?\s*(.*?)\s*```", response, re.DOTALL)
+    text = match.group(1) if match else response
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    wanted = set(ids)
+    scores = {}
+    for item in data if isinstance(data, list) else []:
+        if not isinstance(item, dict) or str(item.get("id", "")).strip("[] ") not in wanted:
+            continue
+        try:
+            score = float(item.get("score"))
+        except (TypeError, ValueError):
+            continue
+        scores[str(item["id"]).strip("[] ")] = {"score": max(low, min(high, score)),
+                                                 "reason": item.get("reason", "")}
+    return scores
+
+
+async def score_batch(contents: Sequence[str], preferences_text: str, cache: ScoreCache,
+                      call_batch: Callable[[str], Awaitable[str]],
+                      call_single: Callable[[str], Awaitable[Optional[float]]],
+                      concurrency: int = 3, score_range=(1, 5)) -> Tuple[List[Optional[Dict]], Dict]:
+    """
+    批量打分
+
+    Args:
+        contents: 候选结果内容
+        preferences_text: 偏好描述（同时作为缓存键的一部分）
+        call_batch: 发送批量提示词并返回模型回复
+        call_single: 对单条内容打分（批量解析失败时使用），失败返回None
+    Returns:
+        (与contents一一对应的评分{"score", "reason", "source"}，无法打分时为None; 本次统计)
+    """
+    prefs_key = preference_key([preferences_text])
+    results: List[Optional[Dict]] = [cache.get(c, prefs_key) for c in contents]
+    info = {"candidates": len(contents), "cached": sum(1 for r in results if r is not None),
+            "batch_requests": 0, "single_requests": 0}
+
+    # 相同内容只打一次分
+    pending: Dict[str, str] = {}
+    for content, result in zip(contents, results):
+        if result is None:
+            pending.setdefault(content_id(content), content)
+
+    if pending:
+        scored: Dict[str, Dict] = {}
+        if len(pending) > 1:
+            prompt = build_batch_prompt(list(pending.items()), preferences_text, score_range)
+            info["batch_requests"] += 1
+            try:
+                response = await call_batch(prompt)
+                scored = {k: {**v, "source": "batch"} for k, v in
+                          parse_batch_scores(response, list(pending), score_range).items()}
+            except Exception as e:
+                logger.warning(f"批量评分请求失败: {e}")
+            if len(scored) < len(pending):
+                logger.info(f"批量评分解析出 {len(scored)}/{len(pending)} 项，其余逐条评分")
+
+        missing = [item_id for item_id in pending if item_id not in scored]
+        if missing:
+            semaphore = asyncio.Semaphore(max(1, concurrency))
+
+            async def score_one(item_id: str):
+                async with semaphore:
+                    try:
+                        score = await call_single(pending[item_id])
+                    except Exception as e:
+                        logger.warning(f"单条评分失败: {e}")
+                        score = None
+                if score is not None:
+                    scored[item_id] = {"score": score, "reason": "", "source": "single"}
+
+            info["single_requests"] += len(missing)
+            await asyncio.gather(*(score_one(item_id) for item_id in missing))
+
+        for item_id, entry in scored.items():
+            cache.put(pending[item_id], prefs_key, entry)
+        results = [r if r is not None else scored.get(content_id(c)) for c, r in zip(contents, results)]
+    return results, info
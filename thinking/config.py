@@ -11,11 +11,53 @@ TREE_THINKING_CONFIG = {
     "thinking_timeout": 60,  # 秒
     "api_timeout": 30,       # 秒
     
+    # 推测式深度思考：难度判断达到阈值后立即与主回答并行思考
+    "speculative": True,
+    "deep_thinking_threshold": 4,         # 难度达到该值时启动深度思考
+    "speculative_sufficient_chars": 600,  # 主回答达到该长度视为足够详细，取消深度思考
+    "speculative_min_partial_routes": 2,  # 超时/取消时至少完成该数量的分支才输出部分结果
+
+    # 偏好打分：一次请求评完全部节点，解析失败时有限并发逐条评分
+    "scoring_fallback_concurrency": 3,
+    "score_cache_size": 1024,               # 按(内容哈希, 偏好)缓存的评分数
+
+    # 难度评估：结果缓存 + 本地分类器（置信度落在不确定区间时才调用LLM评估）
+    "difficulty_cache_size": 256,
+    "difficulty_cache_ttl": 3600,                    # 秒
+    "difficulty_uncertainty_band": (0.25, 0.75),     # 分类器概率落在该区间时调用LLM
+    "difficulty_audit_rate": 0.05,                   # 分类器有把握时仍抽样调用LLM，统计一致率
+    "difficulty_model_path": "logs/difficulty_model.json",
+    "difficulty_judgment_log": "logs/difficulty_judgments.jsonl",
+    "difficulty_retrain_every": 50,                  # 每新增N条LLM判断重新训练
+    "difficulty_min_samples": 30,
+    "difficulty_train_window": 1000,                 # 训练使用最近N条判断
+
+    # 路线执行：K条成功或到达截止时间即继续，取消其余路线
+    "route_quorum_ratio": 0.6,   # K = ceil(N * ratio)，设为1.0则等待全部路线
+    "route_min_quorum": 2,       # K的下限
+    "route_deadline": 25,        # 秒，到达后只要有成功路线即继续
+    "hedge_enabled": True,       # 超过近期p90耗时的路线发出对冲请求
+    "hedge_percentile": 0.9,
+    "hedge_min_samples": 5,      # 耗时样本不足时不对冲
+    "hedge_max_per_session": 2,  # 每次思考最多对冲的路线数
+
+    # 文本相似度（多样性适应度、重复思路惩罚）
+    "similarity_ngram": 2,                  # 中文按字、英文按词组合的n-gram长度
+    "similarity_num_perm": 64,              # MinHash签名长度
+    "similarity_cache_size": 1024,          # 按内容哈希缓存的签名数
+    "duplicate_similarity_threshold": 0.8,  # 超过该相似度视为重复思路
+    "duplicate_penalty": 0.5,               # 重复思路的偏好分扣减
+
+    # 思考历史：内存只保留最近N条，完整记录写入压缩分段文件
+    "history_dir": "logs/thinking_history",
+    "history_memory_size": 50,
+    "history_segment_max_mb": 4,
+    "history_max_segments": 50,             # 超过后删除最旧的分段
+    
     # 线程池配置
     "thinking_pool_size": 8,
     "api_pool_size": 4,
-    "max_concurrent_api": 3,
-    "min_api_interval": 0.5,
+    # API并发与限流由全局LLM调度器控制（config.api.scheduler_lane_limits / rpm_limit / tpm_limit）
     
     # 遗传算法配置
     "selection_rate": 0.6,
@@ -23,6 +65,13 @@ TREE_THINKING_CONFIG = {
     "crossover_rate": 0.8,
     "max_generations": 3,
     
+    # 进化预算：每次深度思考的遗传进化最多消耗的LLM调用、token与时间
+    "evolution_max_llm_calls": 6,
+    "evolution_max_tokens": 12000,       # 粗略估算（约2字符1个token）
+    "evolution_deadline": 20,            # 秒，同时不超过thinking_timeout的剩余时间
+    "evolution_patience": 1,             # 最优适应度连续N代提升不足即停止
+    "evolution_min_improvement": 0.01,
+    
     # 评分权重
     "scoring_weights": {
         "content_depth": 0.3,
@@ -4,9 +4,15 @@
 """
 
 import re
+import copy
 import logging
-from typing import Dict, List, Tuple
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 from .config import TREE_THINKING_CONFIG, COMPLEX_KEYWORDS, BRANCH_TYPES
+from .difficulty_model import DifficultyModel, load_judgments, append_judgment
 
 logger = logging.getLogger("DifficultyJudge")
 
@@ -27,18 +33,58 @@ class DifficultyJudge:
             "ai_assessment": 0.15     # AI深度评估
         }
         
+        # 评估结果缓存（归一化问题 -> (时间, 结果)）
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        
+        # 本地分类器：置信度落在不确定区间时才调用LLM评估
+        self.model_path = self.config.get("difficulty_model_path", "logs/difficulty_model.json")
+        self.judgment_log_path = self.config.get("difficulty_judgment_log", "logs/difficulty_judgments.jsonl")
+        self.model = DifficultyModel.load(self.model_path)
+        self._new_judgments = 0
+        self._training = False
+        self.stats = {
+            "assessments": 0, "cache_hits": 0, "llm_calls": 0, "local_decisions": 0,
+            "compared": 0, "agreed": 0, "audits": 0, "audit_agreed": 0, "trainings": 0
+        }
+        
         print("[TreeThinkingEngine] 🎯 问题难度判断器初始化完成")
     
     async def assess_difficulty(self, question: str) -> Dict:
-        """评估问题难度"""
+        """评估问题难度（相同问题命中缓存；本地分类器有把握时不调用LLM）"""
+        self.stats["assessments"] += 1
+        key = self._normalize_question(question)
+        cached = self._cache_get(key)
+        if cached is not None:
+            self.stats["cache_hits"] += 1
+            return cached
+        
         try:
             # 基础指标计算
             text_metrics = self._analyze_text_metrics(question)
             keyword_metrics = self._analyze_keywords(question)
             structure_metrics = self._analyze_structure(question)
+            features = {
+                "text": text_metrics,
+                "keywords": keyword_metrics,
+                "structure": structure_metrics,
+                "question_type": self._assess_question_type(question)
+            }
             
-            # AI深度评估（优先使用快速模型）
-            ai_metrics = await self._ai_deep_assessment(question)
+            # 本地分类器快速判断
+            probability = self.model.predict_proba(features) if self.api_client else None
+            low, high = self.config.get("difficulty_uncertainty_band", (0.25, 0.75))
+            confident = probability is not None and not (low <= probability <= high)
+            audit = confident and random.random() < self.config.get("difficulty_audit_rate", 0.05)
+            
+            if confident and not audit:
+                ai_metrics = self._local_assessment(probability)
+                self.stats["local_decisions"] += 1
+            else:
+                # AI深度评估（优先使用快速模型）
+                ai_metrics = await self._ai_deep_assessment(question)
+                if self.api_client:
+                    self.stats["llm_calls"] += 1
             
             # 综合评分
             final_score = self._calculate_final_score(
@@ -46,6 +92,15 @@ class DifficultyJudge:
             )
             
             difficulty = min(5, max(1, round(final_score)))
+            threshold = self.config.get("deep_thinking_threshold", 4)
+            if ai_metrics.get("source") == "local":
+                # 是否深度思考以分类器结论为准
+                if probability > high and difficulty < threshold:
+                    difficulty = threshold
+                elif probability < low and difficulty >= threshold:
+                    difficulty = threshold - 1
+            elif ai_metrics.get("source") == "llm":
+                self._record_judgment(question, features, ai_metrics, difficulty >= threshold, probability, audit)
             routes = self.config["difficulty_routes"][difficulty]
             
             # 生成推理说明
@@ -53,12 +108,13 @@ class DifficultyJudge:
                 difficulty, text_metrics, keyword_metrics, structure_metrics, ai_metrics
             )
             
-            logger.info(f"问题难度评估完成: 难度{difficulty}/5, {routes}条思考路线")
+            logger.info(f"问题难度评估完成: 难度{difficulty}/5, {routes}条思考路线（{ai_metrics.get('source', 'none')}）")
             
-            return {
+            result = {
                 "difficulty": difficulty,
                 "routes": routes,
                 "reasoning": reasoning,
+                "deep_probability": round(probability, 3) if probability is not None else None,
                 "metrics": {
                     "text": text_metrics,
                     "keywords": keyword_metrics,
@@ -66,6 +122,8 @@ class DifficultyJudge:
                     "ai_assessment": ai_metrics
                 }
             }
+            self._cache_put(key, result)
+            return copy.deepcopy(result)
             
         except Exception as e:
             logger.error(f"难度评估失败: {e}")
@@ -77,6 +135,103 @@ class DifficultyJudge:
                 "metrics": {}
             }
     
+    # ---------- 缓存 ----------
+    @staticmethod
+    def _normalize_question(question: str) -> str:
+        """归一化问题文本：小写、合并空白、去掉句末标点"""
+        text = re.sub(r"\s+", " ", (question or "").strip().lower())
+        return text.rstrip("。？！?!.～~ ")
+    
+    def _cache_get(self, key: str) -> Optional[Dict]:
+        ttl = self.config.get("difficulty_cache_ttl", 3600)
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return copy.deepcopy(entry[1])
+    
+    def _cache_put(self, key: str, result: Dict):
+        with self._cache_lock:
+            self._cache[key] = (time.time(), result)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.config.get("difficulty_cache_size", 256):
+                self._cache.popitem(last=False)
+    
+    # ---------- 本地分类器 ----------
+    @staticmethod
+    def _local_assessment(probability: float) -> Dict:
+        """由分类器概率换算AI评估分（1-5）"""
+        return {
+            "score": round(1 + 4 * probability, 2),
+            "reasoning": "",
+            "source": "local"
+        }
+    
+    def _record_judgment(self, question: str, features: Dict, ai_metrics: Dict, deep: bool,
+                         probability: Optional[float], audit: bool):
+        """记录LLM参与的判断，用于统计一致率和训练本地分类器"""
+        if ai_metrics.get("failed"):
+            return
+        if probability is not None:
+            agreed = (probability >= 0.5) == deep
+            self.stats["compared"] += 1
+            self.stats["agreed"] += int(agreed)
+            if audit:
+                self.stats["audits"] += 1
+                self.stats["audit_agreed"] += int(agreed)
+        try:
+            append_judgment(self.judgment_log_path, {
+                "question": question[:200],
+                "features": features,
+                "ai_score": ai_metrics.get("score"),
+                "label": int(deep),
+                "timestamp": time.time()
+            })
+        except Exception as e:
+            logger.debug(f"记录难度判断失败: {e}")
+            return
+        self._new_judgments += 1
+        if self._new_judgments >= self.config.get("difficulty_retrain_every", 50) and not self._training:
+            self._new_judgments = 0
+            self._training = True
+            threading.Thread(target=self._train_in_background, name="DifficultyModelTrain", daemon=True).start()
+    
+    def _train_in_background(self):
+        try:
+            self.train_model()
+        finally:
+            self._training = False
+    
+    def train_model(self) -> bool:
+        """用判断日志重新训练本地分类器并保存权重"""
+        samples = load_judgments(self.judgment_log_path, limit=self.config.get("difficulty_train_window", 1000))
+        if len(samples) < self.config.get("difficulty_min_samples", 30):
+            return False
+        model = DifficultyModel()
+        if not model.fit(samples):
+            logger.info("判断日志中只有一类样本，暂不训练难度分类器")
+            return False
+        model.save(self.model_path)
+        self.model = model
+        self.stats["trainings"] += 1
+        logger.info(f"难度分类器训练完成: {model.samples}条样本，训练集准确率 {model.accuracy:.1%}")
+        return True
+    
+    def get_stats(self) -> Dict:
+        """缓存命中、本地判断比例及与LLM判断的一致率"""
+        stats = dict(self.stats)
+        total = stats["assessments"]
+        stats["llm_avoided_rate"] = round((stats["cache_hits"] + stats["local_decisions"]) / total, 3) if total else 0.0
+        stats["agreement_rate"] = round(stats["agreed"] / stats["compared"], 3) if stats["compared"] else None
+        stats["audit_agreement_rate"] = round(stats["audit_agreed"] / stats["audits"], 3) if stats["audits"] else None
+        stats["cached"] = len(self._cache)
+        stats["model"] = {"ready": self.model.ready, "samples": self.model.samples, "accuracy": self.model.accuracy}
+        return stats
+    
     def _analyze_text_metrics(self, question: str) -> float:
         """分析文本长度复杂度"""
         length = len(question)
@@ -199,14 +354,15 @@ class DifficultyJudge:
                 
                 return {
                     "score": float(result.get("score", 3)),
-                    "reasoning": result.get("reasoning", "")
+                    "reasoning": result.get("reasoning", ""),
+                    "source": "llm"
                 }
             else:
-                return {"score": 3, "reasoning": "AI评估格式错误"}
+                return {"score": 3, "reasoning": "AI评估格式错误", "source": "llm", "failed": True}
                 
         except Exception as e:
             logger.warning(f"AI评估解析失败: {e}")
-            return {"score": 3, "reasoning": f"AI评估异常: {str(e)}"}
+            return {"score": 3, "reasoning": f"AI评估异常: {str(e)}", "source": "llm", "failed": True}
     
     def _calculate_final_score(self, question: str, text_metrics: float, keyword_metrics: float, 
                              structure_metrics: float, ai_metrics: Dict) -> float:
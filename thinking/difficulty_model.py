@@ -0,0 +1,133 @@
+"""
+本地难度分类器
+- 逻辑回归，输入为DifficultyJudge已有的文本长度/关键词/句式/问题类型指标，输出"需要深度思考"的概率
+- 训练数据来自调用LLM评估时记录的判断日志（JSONL），权重保存为JSON文件
+- 纯Python实现，特征只有几维，训练几百条样本耗时可忽略
+"""
+
+import json
+import logging
+import math
+import os
+import time
+from typing import Dict, List, Optional, Sequence
+
+logger = logging.getLogger("DifficultyModel")
+
+FEATURES = ["text", "keywords", "structure", "question_type"]
+
+
+def _sigmoid(z: float) -> float:
+    if z >= 0:
+        return 1.0 / (1.0 + math.exp(-z))
+    e = math.exp(z)
+    return e / (1.0 + e)
+
+
+class DifficultyModel:
+    """判断问题是否需要深度思考的逻辑回归模型"""
+
+    def __init__(self, weights: Optional[List[float]] = None, bias: float = 0.0, samples: int = 0):
+        self.weights = list(weights) if weights else None
+        self.bias = bias
+        self.samples = samples
+        self.accuracy: Optional[float] = None
+        self.trained_at: Optional[float] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.weights is not None
+
+    @staticmethod
+    def vectorize(features: Dict[str, float]) -> List[float]:
+        """各项指标为1-5分，缩放到0-1"""
+        return [float(features.get(name, 0.0)) / 5.0 for name in FEATURES]
+
+    def predict_proba(self, features: Dict[str, float]) -> Optional[float]:
+        if not self.ready:
+            return None
+        x = self.vectorize(features)
+        return _sigmoid(self.bias + sum(w * v for w, v in zip(self.weights, x)))
+
+    def fit(self, samples: Sequence[Dict], epochs: int = 500, lr: float = 0.5, l2: float = 0.01) -> bool:
+        """
+        批量梯度下降训练
+
+        Args:
+            samples: [{"features": {...}, "label": 0/1}]
+        Returns:
+            是否训练成功（两类样本都存在时才训练）
+        """
+        data = [(self.vectorize(s["features"]), int(s["label"])) for s in samples if "features" in s and "label" in s]
+        labels = {y for _, y in data}
+        if len(labels) < 2:
+            return False
+        n, dim = len(data), len(FEATURES)
+        weights, bias = [0.0] * dim, 0.0
+        for _ in range(epochs):
+            grad_w, grad_b = [0.0] * dim, 0.0
+            for x, y in data:
+                error = _sigmoid(bias + sum(w * v for w, v in zip(weights, x))) - y
+                for i in range(dim):
+                    grad_w[i] += error * x[i]
+                grad_b += error
+            weights = [w - lr * (g / n + l2 * w) for w, g in zip(weights, grad_w)]
+            bias -= lr * grad_b / n
+        self.weights, self.bias, self.samples = weights, bias, n
+        correct = sum(1 for x, y in data
+                      if (_sigmoid(bias + sum(w * v for w, v in zip(weights, x))) >= 0.5) == bool(y))
+        self.accuracy = correct / n
+        self.trained_at = time.time()
+        return True
+
+    # ---------- 持久化 ----------
+    def to_dict(self) -> Dict:
+        return {"features": FEATURES, "weights": self.weights, "bias": self.bias, "samples": self.samples,
+                "accuracy": self.accuracy, "trained_at": self.trained_at}
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "DifficultyModel":
+        """读取权重文件，不存在或格式不符时返回未训练的模型"""
+        if not os.path.exists(path):
+            return cls()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("features") != FEATURES or not data.get("weights"):
+                logger.warning(f"难度模型特征不匹配，忽略权重文件: {path}")
+                return cls()
+            model = cls(data["weights"], data.get("bias", 0.0), data.get("samples", 0))
+            model.accuracy = data.get("accuracy")
+            model.trained_at = data.get("trained_at")
+            return model
+        except Exception as e:
+            logger.warning(f"读取难度模型失败: {e}")
+            return cls()
+
+
+def load_judgments(path: str, limit: int = 5000) -> List[Dict]:
+    """读取判断日志（最近limit条）"""
+    if not os.path.exists(path):
+        return []
+    samples = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                samples.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return samples[-limit:]
+
+
+def append_judgment(path: str, record: Dict):
+    """追加一条判断日志"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -0,0 +1,139 @@
+"""
+遗传进化预算控制
+- 每次深度思考的进化过程有明确预算：LLM调用次数、token数（粗略估算）、截止时间
+- 最优适应度连续若干代提升不足时提前停止
+- 只依赖内容的适应度分量按内容哈希缓存，跨代保留下来的节点不重复计算
+- 进化历史只属于本次会话，不再累积在全局共享的GeneticPruning上
+"""
+
+import hashlib
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from .config import TREE_THINKING_CONFIG
+from .thinking_node import ThinkingGeneration
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数（与LLM调度器相同：约2字符1个token）"""
+    return len(text or "") // 2
+
+
+@dataclass
+class EvolutionBudget:
+    """单次进化的预算"""
+    max_llm_calls: int = 6
+    max_tokens: int = 12000
+    deadline: float = 20.0          # 秒
+    max_generations: int = 3
+    patience: int = 1               # 最优适应度连续N代提升不足即停止
+    min_improvement: float = 0.01
+
+    @classmethod
+    def from_config(cls, config: Optional[Dict] = None, deadline: Optional[float] = None) -> "EvolutionBudget":
+        """从配置创建预算，deadline可由调用方按剩余思考时间收紧"""
+        config = config or TREE_THINKING_CONFIG
+        budget = cls(
+            max_llm_calls=config.get("evolution_max_llm_calls", cls.max_llm_calls),
+            max_tokens=config.get("evolution_max_tokens", cls.max_tokens),
+            deadline=config.get("evolution_deadline", cls.deadline),
+            max_generations=config.get("max_generations", cls.max_generations),
+            patience=config.get("evolution_patience", cls.patience),
+            min_improvement=config.get("evolution_min_improvement", cls.min_improvement),
+        )
+        if deadline is not None:
+            budget.deadline = max(0.0, min(budget.deadline, deadline))
+        return budget
+
+
+class EvolutionController:
+    """单次进化的预算、早停与适应度缓存"""
+
+    def __init__(self, budget: EvolutionBudget):
+        self.budget = budget
+        self.start_time = time.monotonic()
+        self.llm_calls = 0
+        self.tokens = 0
+        self.generations: List[ThinkingGeneration] = []
+        self.stop_reason: Optional[str] = None
+        self._stale_generations = 0
+        self._fitness_cache: Dict[str, Dict[str, float]] = {}  # 内容哈希 -> 只依赖内容的适应度分量
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # ---------- 预算 ----------
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    def time_left(self) -> float:
+        return max(0.0, self.budget.deadline - self.elapsed)
+
+    def can_call(self, prompt: str, expected_output_tokens: int = 0) -> bool:
+        """发起一次LLM调用前检查预算，超出时记录停止原因"""
+        if self.llm_calls >= self.budget.max_llm_calls:
+            self.stop_reason = self.stop_reason or "llm_calls"
+            return False
+        if self.tokens + estimate_tokens(prompt) + expected_output_tokens > self.budget.max_tokens:
+            self.stop_reason = self.stop_reason or "tokens"
+            return False
+        if self.time_left() <= 0:
+            self.stop_reason = self.stop_reason or "deadline"
+            return False
+        return True
+
+    def record_call(self, prompt: str, response: str = ""):
+        self.llm_calls += 1
+        self.tokens += estimate_tokens(prompt) + estimate_tokens(response)
+
+    # ---------- 代际 ----------
+    def record_generation(self, generation: ThinkingGeneration):
+        """记录一代并更新停滞计数"""
+        if self.generations and generation.best_fitness - self.generations[-1].best_fitness < self.budget.min_improvement:
+            self._stale_generations += 1
+        else:
+            self._stale_generations = 0
+        self.generations.append(generation)
+
+    def should_continue(self, generation_id: int) -> bool:
+        """是否继续进化下一代"""
+        if self.stop_reason:
+            return False
+        if generation_id > self.budget.max_generations:
+            self.stop_reason = "max_generations"
+        elif len(self.generations) > 1 and self._stale_generations >= self.budget.patience:
+            self.stop_reason = "plateau"
+        elif self.time_left() <= 0:
+            self.stop_reason = "deadline"
+        elif self.llm_calls >= self.budget.max_llm_calls:
+            self.stop_reason = "llm_calls"
+        return self.stop_reason is None
+
+    # ---------- 适应度缓存 ----------
+    def cached_fitness(self, content: str) -> Optional[Dict[str, float]]:
+        entry = self._fitness_cache.get(hashlib.sha1((content or "").encode("utf-8")).hexdigest())
+        if entry is None:
+            self.cache_misses += 1
+        else:
+            self.cache_hits += 1
+        return entry
+
+    def store_fitness(self, content: str, components: Dict[str, float]):
+        self._fitness_cache[hashlib.sha1((content or "").encode("utf-8")).hexdigest()] = components
+
+    # ---------- 报告 ----------
+    def report(self) -> Dict:
+        """预算与实际消耗"""
+        return {
+            "budget": asdict(self.budget),
+            "spent": {
+                "llm_calls": self.llm_calls,
+                "tokens": self.tokens,
+                "elapsed": round(self.elapsed, 3),
+                "generations": max(0, len(self.generations) - 1),  # 不含初始代
+            },
+            "stop_reason": self.stop_reason or "completed",
+            "best_fitness": [round(gen.best_fitness, 3) for gen in self.generations],
+            "fitness_cache": {"hits": self.cache_hits, "misses": self.cache_misses},
+        }
@@ -3,26 +3,19 @@
 基于适应度选择最优思考方案并进行遗传进化
 """
 
+import asyncio
 import random
 import logging
 from typing import List, Dict, Tuple, Optional
 from .thinking_node import ThinkingNode, ThinkingBranch, ThinkingGeneration
 from .config import TREE_THINKING_CONFIG
-
-# numpy导入（可选，用于统计计算）
-try:
-    import numpy as np
-    HAS_NUMPY = True
-except ImportError:
-    HAS_NUMPY = False
-    # fallback实现
-    class np:
-        @staticmethod
-        def mean(data):
-            return sum(data) / len(data) if data else 0
+from .similarity import get_similarity_engine
+from .evolution_controller import EvolutionBudget, EvolutionController
 
 logger = logging.getLogger("GeneticPruning")
 
+CROSSOVER_OUTPUT_TOKENS = 300  # 融合子代（200-400字）的预估输出token数
+
 class GeneticPruning:
     """遗传算法剪枝器"""
     
@@ -35,42 +28,44 @@ class GeneticPruning:
         self.mutation_rate = self.config["mutation_rate"]
         self.crossover_rate = self.config["crossover_rate"]
         self.max_generations = self.config["max_generations"]
+        self.similarity = get_similarity_engine()
         
-        # 进化历史
+        # 进化历史（仅最近一次进化，预算与代际记录在每次进化的EvolutionController中）
         self.generations: List[ThinkingGeneration] = []
         self.current_generation = 0
+        self.last_evolution: Optional[EvolutionController] = None
         
         print("[TreeThinkingEngine] 🧬 遗传算法剪枝系统初始化完成")
     
-    async def evolve_thinking_tree(self, initial_nodes: List[ThinkingNode], 
-                                  target_count: int = 3) -> List[ThinkingNode]:
+    async def evolve_thinking_tree(self, initial_nodes: List[ThinkingNode], target_count: int = 3,
+                                   budget: Optional[EvolutionBudget] = None,
+                                   report: Optional[Dict] = None) -> List[ThinkingNode]:
         """
         对思考树进行遗传进化
         返回进化后的最优节点列表
+
+        Args:
+            budget: 本次进化的预算（LLM调用数、token数、截止时间），默认按配置创建
+            report: 传入字典时写入预算与实际消耗
         """
+        controller = EvolutionController(budget or EvolutionBudget.from_config(self.config))
+        self.last_evolution = controller
         try:
             if not initial_nodes:
                 return []
             
-            logger.info(f"开始遗传进化 - 初始节点: {len(initial_nodes)}, 目标数量: {target_count}")
+            logger.info(f"开始遗传进化 - 初始节点: {len(initial_nodes)}, 目标数量: {target_count}, "
+                        f"预算: {controller.budget}")
             
             # 计算初始适应度
-            await self._calculate_fitness(initial_nodes)
-            
-            # 创建初始代
-            initial_generation = ThinkingGeneration(generation_id=0)
-            initial_branch = ThinkingBranch()
-            
-            for node in initial_nodes:
-                initial_branch.add_node(node)
-            
-            initial_generation.add_branch(initial_branch)
-            self.generations.append(initial_generation)
+            self._calculate_fitness(initial_nodes, controller)
+            controller.record_generation(self._make_generation(0, initial_nodes))
             
             current_nodes = initial_nodes.copy()
             
-            # 进化循环
-            for generation_id in range(1, self.max_generations + 1):
+            # 进化循环：超出预算或最优适应度停滞时提前停止
+            generation_id = 1
+            while controller.should_continue(generation_id):
                 self.current_generation = generation_id
                 
                 logger.info(f"进化第 {generation_id} 代...")
@@ -79,30 +74,24 @@ class GeneticPruning:
                 selected_nodes = self._selection(current_nodes, target_count * 2)
                 
                 # 交叉
-                crossover_nodes = await self._crossover(selected_nodes)
+                crossover_nodes = await self._crossover(selected_nodes, controller)
                 
                 # 变异
                 mutated_nodes = await self._mutation(crossover_nodes)
                 
                 # 合并并重新评估
                 all_nodes = selected_nodes + crossover_nodes + mutated_nodes
-                await self._calculate_fitness(all_nodes)
+                self._calculate_fitness(all_nodes, controller)
                 
                 # 精英保留策略
                 current_nodes = self._elite_selection(all_nodes, target_count)
                 
                 # 记录当代
-                gen = ThinkingGeneration(generation_id=generation_id)
-                branch = ThinkingBranch()
-                for node in current_nodes:
-                    branch.add_node(node)
-                gen.add_branch(branch)
-                self.generations.append(gen)
-                
-                # 检查收敛条件
-                if self._check_convergence(generation_id):
-                    logger.info(f"在第 {generation_id} 代达到收敛")
-                    break
+                controller.record_generation(self._make_generation(generation_id, current_nodes))
+                generation_id += 1
+            
+            logger.info(f"进化停止（{controller.stop_reason}），共 {generation_id - 1} 代，"
+                        f"LLM调用 {controller.llm_calls} 次，约 {controller.tokens} tokens")
             
             # 返回最终结果
             final_nodes = self._elite_selection(current_nodes, target_count)
@@ -112,26 +101,49 @@ class GeneticPruning:
             
         except Exception as e:
             logger.error(f"遗传进化失败: {e}")
+            controller.stop_reason = "error"
             # 返回原始最优节点
             return self._elite_selection(initial_nodes, target_count)
+        
+        finally:
+            self.generations = controller.generations
+            if report is not None:
+                report.update(controller.report())
     
-    async def _calculate_fitness(self, nodes: List[ThinkingNode]):
-        """计算节点适应度"""
+    @staticmethod
+    def _make_generation(generation_id: int, nodes: List[ThinkingNode]) -> ThinkingGeneration:
+        generation = ThinkingGeneration(generation_id=generation_id)
+        branch = ThinkingBranch()
         for node in nodes:
+            branch.add_node(node)
+        generation.add_branch(branch)
+        return generation
+    
+    def _calculate_fitness(self, nodes: List[ThinkingNode], controller: Optional[EvolutionController] = None):
+        """计算节点适应度（只依赖内容的分量按内容哈希缓存）"""
+        # 整个种群的多样性一次性按相似度矩阵计算
+        diversities = self.similarity.diversity_scores([node.content for node in nodes])
+        for node, diversity_fitness in zip(nodes, diversities):
+            components = controller.cached_fitness(node.content) if controller else None
+            if components is None:
+                components = {
+                    "content": self._evaluate_content_quality(node.content),
+                    "innovation": self._evaluate_innovation(node.content),
+                }
+                if controller:
+                    controller.store_fitness(node.content, components)
+            
             # 多维度适应度计算
             fitness_score = 0.0
             
             # 内容质量 (40%)
-            content_fitness = self._evaluate_content_quality(node.content)
-            fitness_score += content_fitness * 0.4
+            fitness_score += components["content"] * 0.4
             
             # 多样性贡献 (30%)
-            diversity_fitness = self._evaluate_diversity(node, nodes)
             fitness_score += diversity_fitness * 0.3
             
             # 创新程度 (20%)
-            innovation_fitness = self._evaluate_innovation(node.content)
-            fitness_score += innovation_fitness * 0.2
+            fitness_score += components["innovation"] * 0.2
             
             # 偏好匹配 (10%)
             preference_fitness = node.score / 5.0 if node.score > 0 else 0.5
@@ -156,12 +168,8 @@ class GeneticPruning:
         else:
             quality_score += 0.1
         
-        # 信息密度
-        words = content.split()
-        unique_words = set(words)
-        if len(words) > 0:
-            density = len(unique_words) / len(words)
-            quality_score += density * 0.3
+        # 信息密度（中文按字、英文按词）
+        quality_score += self.similarity.token_density(content) * 0.3
         
         # 逻辑连贯性
         logical_connectors = ["因为", "所以", "然而", "但是", "因此", "由于"]
@@ -199,35 +207,6 @@ class GeneticPruning:
         
         return elite_nodes
     
-    def _evaluate_diversity(self, node: ThinkingNode, all_nodes: List[ThinkingNode]) -> float:
-        """评估节点多样性贡献"""
-        if len(all_nodes) <= 1:
-            return 1.0
-        
-        # 计算与其他节点的差异度
-        differences = []
-        node_words = set(node.content.lower().split())
-        
-        for other_node in all_nodes:
-            if other_node.id == node.id:
-                continue
-            
-            other_words = set(other_node.content.lower().split())
-            
-            # Jaccard距离
-            intersection = node_words & other_words
-            union = node_words | other_words
-            
-            if union:
-                jaccard_sim = len(intersection) / len(union)
-                jaccard_dist = 1 - jaccard_sim
-                differences.append(jaccard_dist)
-        
-        if differences:
-            return float(np.mean(differences))
-        else:
-            return 1.0
-    
     def _evaluate_innovation(self, content: str) -> float:
         """评估创新程度"""
         innovation_keywords = [
@@ -251,7 +230,8 @@ class GeneticPruning:
         
         return min(innovation_score, 1.0)
     
-    async def _crossover(self, nodes: List[ThinkingNode]) -> List[ThinkingNode]:
+    async def _crossover(self, nodes: List[ThinkingNode],
+                         controller: Optional[EvolutionController] = None) -> List[ThinkingNode]:
         """改进的交叉操作 - 基于兄弟样本的思路交叉"""
         if len(nodes) < 2:
             return []
@@ -269,13 +249,15 @@ class GeneticPruning:
                 parent1 = nodes[i]
                 parent2 = nodes[i + 1]
                 
-                children = await self._create_crossover_children_v2(parent1, parent2)
+                children = await self._create_crossover_children_v2(parent1, parent2, controller)
                 crossover_nodes.extend(children)
+                if controller and controller.stop_reason:
+                    break
         
         return crossover_nodes
     
-    async def _create_crossover_children_v2(self, parent1: ThinkingNode, 
-                                          parent2: ThinkingNode) -> List[ThinkingNode]:
+    async def _create_crossover_children_v2(self, parent1: ThinkingNode, parent2: ThinkingNode,
+                                          controller: Optional[EvolutionController] = None) -> List[ThinkingNode]:
         """基于思路融合的交叉子代生成"""
         try:
             # 为子代创建融合提示词
@@ -298,12 +280,18 @@ class GeneticPruning:
 请生成融合后的新思考内容：
 """
             
+            # 超出本次进化预算时不再发起调用
+            if controller and not controller.can_call(crossover_prompt, CROSSOVER_OUTPUT_TOKENS):
+                return []
+            
             # 使用中等偏高温度生成融合内容
             if self.api_client:
-                fusion_content = await self.api_client.get_response(
-                    crossover_prompt, 
-                    temperature=0.8
+                fusion_content = await asyncio.wait_for(
+                    self.api_client.get_response(crossover_prompt, temperature=0.8),
+                    timeout=controller.time_left() if controller else None
                 )
+                if controller:
+                    controller.record_call(crossover_prompt, fusion_content)
                 
                 # 创建融合子代
                 child = ThinkingNode(
@@ -340,6 +328,13 @@ class GeneticPruning:
             else:
                 return []
                 
+        except asyncio.TimeoutError:
+            logger.info("进化截止时间已到，放弃本次思路融合")
+            if controller:
+                controller.record_call(crossover_prompt)
+                controller.stop_reason = controller.stop_reason or "deadline"
+            return []
+        
         except Exception as e:
             logger.warning(f"思路融合交叉失败: {e}")
             return []
@@ -431,22 +426,6 @@ class GeneticPruning:
         #     logger.warning(f"内容变异生成失败: {e}")
         #     return node.content
     
-    def _check_convergence(self, generation_id: int) -> bool:
-        """检查收敛条件"""
-        if generation_id < 2:
-            return False
-        
-        # 获取最近两代的最佳适应度
-        if len(self.generations) >= 2:
-            current_best = self.generations[-1].best_fitness
-            previous_best = self.generations[-2].best_fitness
-            
-            # 如果改进幅度很小，认为收敛
-            if abs(current_best - previous_best) < 0.01:
-                return True
-        
-        return False
-    
     def get_evolution_summary(self) -> Dict:
         """获取进化过程摘要"""
         if not self.generations:
@@ -455,7 +434,8 @@ class GeneticPruning:
         summary = {
             "total_generations": len(self.generations),
             "current_generation": self.current_generation,
-            "evolution_history": []
+            "evolution_history": [],
+            "budget": self.last_evolution.report() if self.last_evolution else None
         }
         
         for gen in self.generations:
@@ -0,0 +1,276 @@
+"""
+思考历史存储
+- 内存中只保留最近N条完整记录（环形缓冲），长期运行不再无限增长
+- 完整记录追加写入压缩分段文件：每条记录是一个独立的gzip成员，按大小切分分段，超过分段数上限时删除最旧的分段
+- 索引文件（index.jsonl）每条记录一行：会话ID、问题哈希、时间戳、所在分段与偏移，以及用于统计的路线数/代数/耗时
+- 按会话获取记录时根据索引定位偏移，只解压这一条；统计信息增量维护，查询为O(1)
+"""
+
+import bisect
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from .config import TREE_THINKING_CONFIG
+
+logger = logging.getLogger("ThinkingHistory")
+
+INDEX_FILE = "index.jsonl"
+STAT_FIELDS = ("routes", "optimal_routes", "generations", "duration")  # 聚合统计的字段
+
+
+def question_hash(question: str) -> str:
+    """问题哈希（忽略首尾空白与大小写）"""
+    return hashlib.sha1((question or "").strip().lower().encode("utf-8")).hexdigest()[:16]
+
+
+class ThinkingHistoryStore:
+    """有界内存 + 压缩分段文件的思考历史存储"""
+
+    def __init__(self, directory: str = "logs/thinking_history", memory_size: int = 50,
+                 segment_max_bytes: int = 4 * 1024 * 1024, max_segments: int = 50):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_segments = max_segments
+        self._lock = threading.RLock()
+        self._recent: deque = deque(maxlen=max(1, memory_size))  # 最近的 (索引条目, 完整记录)
+        self._entries: List[Dict] = []                           # 索引条目（按时间顺序）
+        self._timestamps: List[float] = []
+        self._by_session: Dict[str, Dict] = {}
+        self._by_question: Dict[str, List[Dict]] = {}            # 问题哈希 -> 索引条目（按时间顺序）
+        self._totals = {"sessions": 0, **{name: 0.0 for name in STAT_FIELDS}}
+        self._segment = 0
+        self._disk_ok = True
+        try:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+        except Exception as e:
+            self._disk_ok = False
+            logger.error(f"思考历史目录不可用，仅保留内存记录: {e}")
+
+    # ---------- 写入 ----------
+    def append(self, record: Dict[str, Any]) -> Dict:
+        """追加一条完整记录，返回其索引条目"""
+        entry = {
+            "session_id": record.get("session_id"),
+            "question_hash": question_hash(record.get("question", "")),
+            "question": (record.get("question") or "")[:100],
+            "timestamp": record.get("timestamp", time.time()),
+            "routes": record.get("thinking_routes", 0),
+            "optimal_routes": record.get("optimal_routes", 0),
+            "generations": (record.get("evolution") or {}).get("spent", {}).get("generations", 0),
+            "duration": round(record.get("processing_time", 0.0), 3),
+        }
+        with self._lock:
+            self._recent.append((entry, record))
+            if self._disk_ok:
+                try:
+                    self._write(record, entry)
+                except Exception as e:
+                    logger.error(f"写入思考历史失败: {e}")
+            self._add_entry(entry)
+        return entry
+
+    def _write(self, record: Dict, entry: Dict):
+        data = gzip.compress(json.dumps(record, ensure_ascii=False, default=str).encode("utf-8"))
+        path = self._segment_path(self._segment)
+        if os.path.exists(path) and os.path.getsize(path) + len(data) > self.segment_max_bytes:
+            self._segment += 1
+            path = self._segment_path(self._segment)
+            self._prune_segments()
+        with open(path, "ab") as f:
+            entry["segment"] = self._segment
+            entry["offset"] = f.tell()
+            entry["length"] = len(data)
+            f.write(data)
+        with open(os.path.join(self.directory, INDEX_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def _add_entry(self, entry: Dict):
+        self._entries.append(entry)
+        self._timestamps.append(entry["timestamp"])
+        if entry.get("session_id"):
+            self._by_session[entry["session_id"]] = entry
+        self._by_question.setdefault(entry["question_hash"], []).append(entry)
+        self._totals["sessions"] += 1
+        for name in STAT_FIELDS:
+            self._totals[name] += entry.get(name) or 0
+
+    # ---------- 分段 ----------
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment_{segment:06d}.jsonl.gz")
+
+    def _prune_segments(self):
+        """超过分段数上限时删除最旧的分段，并从索引与统计中移除其记录"""
+        oldest = self._segment - self.max_segments + 1
+        if oldest <= 0 or not self._entries or self._entries[0].get("segment", oldest) >= oldest:
+            return
+        keep = 0
+        removed_ids = set()
+        while keep < len(self._entries) and self._entries[keep].get("segment", oldest) < oldest:
+            removed = self._entries[keep]
+            removed_ids.add(id(removed))
+            self._totals["sessions"] -= 1
+            for name in STAT_FIELDS:
+                self._totals[name] -= removed.get(name) or 0
+            if self._by_session.get(removed.get("session_id")) is removed:
+                del self._by_session[removed["session_id"]]
+            same_question = self._by_question.get(removed["question_hash"])
+            if same_question:
+                same_question.remove(removed)
+                if not same_question:
+                    del self._by_question[removed["question_hash"]]
+            keep += 1
+        for segment in {e.get("segment") for e in self._entries[:keep]}:
+            try:
+                os.remove(self._segment_path(segment))
+            except FileNotFoundError:
+                pass
+        del self._entries[:keep]
+        del self._timestamps[:keep]
+        # 内存中属于已删除分段的记录一并移除，保持与索引和统计一致
+        kept = [pair for pair in self._recent if id(pair[0]) not in removed_ids]
+        if len(kept) != len(self._recent):
+            self._recent.clear()
+            self._recent.extend(kept)
+        self._rewrite_index()
+
+    def _rewrite_index(self):
+        """写临时文件后原子替换"""
+        path = os.path.join(self.directory, INDEX_FILE)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in self._entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp, path)
+
+    def _load_index(self):
+        path = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._add_entry(entry)
+                self._segment = max(self._segment, entry.get("segment", 0))
+        logger.info(f"已加载思考历史索引: {len(self._entries)} 条")
+
+    # ---------- 查询 ----------
+    def list_sessions(self, limit: int = 10, offset: int = 0, session_id: Optional[str] = None,
+                      question: Optional[str] = None, since: Optional[float] = None,
+                      until: Optional[float] = None) -> List[Dict]:
+        """按时间倒序列出索引条目（不含完整内容），可按会话、问题、时间范围过滤"""
+        with self._lock:
+            if session_id is not None:
+                entry = self._by_session.get(session_id)
+                return [dict(entry)] if entry and offset == 0 and limit > 0 else []
+            if question is not None:
+                candidates = self._by_question.get(question_hash(question), [])
+            else:
+                start = bisect.bisect_left(self._timestamps, since) if since is not None else 0
+                end = bisect.bisect_right(self._timestamps, until) if until is not None else len(self._entries)
+                candidates = self._entries[start:end]
+            results = []
+            for entry in reversed(candidates):
+                if (since is not None and entry["timestamp"] < since) or \
+                        (until is not None and entry["timestamp"] > until):
+                    continue
+                if offset > 0:
+                    offset -= 1
+                    continue
+                if len(results) >= limit:
+                    break
+                results.append(dict(entry))
+            return results
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        """获取完整记录：先查内存，再按索引偏移从分段文件读取"""
+        with self._lock:
+            for _, record in reversed(self._recent):
+                if record.get("session_id") == session_id:
+                    return record
+            entry = self._by_session.get(session_id)
+        if entry is None or "segment" not in entry:
+            return None
+        try:
+            with open(self._segment_path(entry["segment"]), "rb") as f:
+                f.seek(entry["offset"])
+                return json.loads(gzip.decompress(f.read(entry["length"])).decode("utf-8"))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"读取思考历史失败 {session_id}: {e}")
+            return None
+
+    def recent(self, limit: int = 10) -> List[Dict]:
+        """最近的完整记录（按索引的时间顺序），优先取内存中的记录，其余从磁盘读取"""
+        if limit <= 0:
+            return []
+        with self._lock:
+            entries = self._entries[-limit:]
+            in_memory = {id(entry): record for entry, record in self._recent}
+        records = []
+        for entry in entries:
+            record = in_memory.get(id(entry))
+            if record is None and entry.get("session_id"):
+                record = self.get(entry["session_id"])
+            if record is not None:
+                records.append(record)
+        return records
+
+    def get_stats(self) -> Dict:
+        """聚合统计（增量维护，与历史总量无关）"""
+        with self._lock:
+            count = self._totals["sessions"]
+            stats = {"total_sessions": count, "in_memory": len(self._recent),
+                     "segments": self._segment - self._entries[0].get("segment", 0) + 1 if self._entries else 0,
+                     "persistent": self._disk_ok}
+            for name in STAT_FIELDS:
+                stats[f"avg_{name}"] = round(self._totals[name] / count, 3) if count else 0.0
+            return stats
+
+    def clear(self):
+        """清空内存与磁盘上的全部历史"""
+        with self._lock:
+            self._recent.clear()
+            if self._disk_ok:
+                for segment in {e.get("segment") for e in self._entries} | {self._segment}:
+                    try:
+                        os.remove(self._segment_path(segment))
+                    except (FileNotFoundError, TypeError):
+                        pass
+                try:
+                    os.remove(os.path.join(self.directory, INDEX_FILE))
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self._timestamps.clear()
+            self._by_session.clear()
+            self._by_question.clear()
+            self._totals = {"sessions": 0, **{name: 0.0 for name in STAT_FIELDS}}
+            self._segment = 0
+
+
+_STORE: Optional[ThinkingHistoryStore] = None
+
+
+def get_thinking_history_store() -> ThinkingHistoryStore:
+    """获取全局思考历史存储"""
+    global _STORE
+    if _STORE is None:
+        _STORE = ThinkingHistoryStore(
+            directory=TREE_THINKING_CONFIG.get("history_dir", "logs/thinking_history"),
+            memory_size=TREE_THINKING_CONFIG.get("history_memory_size", 50),
+            segment_max_bytes=int(TREE_THINKING_CONFIG.get("history_segment_max_mb", 4) * 1024 * 1024),
+            max_segments=TREE_THINKING_CONFIG.get("history_max_segments", 50),
+        )
+    return _STORE
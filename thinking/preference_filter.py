@@ -3,12 +3,14 @@
 根据用户偏好对思考方案进行评分筛选
 """
 
-import json
+import re
 import logging
 from typing import Dict, List, Optional
 from dataclasses import dataclass
 from .thinking_node import ThinkingNode
 from .config import TREE_THINKING_CONFIG
+from .similarity import get_similarity_engine
+from .batch_scoring import ScoreCache, score_batch
 
 logger = logging.getLogger("PreferenceFilter")
 
@@ -85,6 +87,7 @@ class PreferenceFilter:
         ]
         
         self.user_preferences = self.default_preferences.copy()
+        self.score_cache = ScoreCache(self.config.get("score_cache_size", 1024))
         print("[TreeThinkingEngine] ⭐ 偏好打分系统初始化完成")
     
     def update_preferences(self, new_preferences: List[UserPreference]):
@@ -121,6 +124,9 @@ class PreferenceFilter:
                             node_scores[node_id] * 0.7 + ai_score * 0.3
                         )
             
+            # 重复思路惩罚
+            self._apply_redundancy_penalty(nodes, node_scores)
+            
             logger.info(f"完成{len(nodes)}个节点的偏好打分")
             return node_scores
             
@@ -129,6 +135,22 @@ class PreferenceFilter:
             # 返回默认均等分数
             return {node.id: 3.0 for node in nodes}
     
+    def _apply_redundancy_penalty(self, nodes: List[ThinkingNode], node_scores: Dict[str, float]):
+        """与更高分节点高度相似的节点扣分（整组节点一次计算相似度矩阵）"""
+        threshold = self.config.get("duplicate_similarity_threshold", 0.8)
+        penalty = self.config.get("duplicate_penalty", 0.5)
+        if len(nodes) < 2 or penalty <= 0:
+            return
+        matrix = get_similarity_engine().similarity_matrix([node.content for node in nodes])
+        order = sorted(range(len(nodes)), key=lambda i: node_scores.get(nodes[i].id, 0), reverse=True)
+        kept = []
+        for i in order:
+            if any(matrix[i][j] > threshold for j in kept):
+                node_scores[nodes[i].id] = round(max(0.0, node_scores[nodes[i].id] - penalty), 2)
+                logger.debug(f"节点 {nodes[i].id} 与更高分节点思路重复，扣{penalty}分")
+            else:
+                kept.append(i)
+    
     def _calculate_base_score(self, node: ThinkingNode) -> float:
         """计算节点基础偏好分数"""
         total_score = 0.0
@@ -254,63 +276,41 @@ class PreferenceFilter:
         return min(practical_count / 3, 1.0) * 5
     
     async def _ai_batch_scoring(self, nodes: List[ThinkingNode]) -> Dict[str, float]:
-        """AI批量评分"""
+        """AI批量评分（一次请求评完全部节点，按内容和偏好缓存）"""
         if not self.api_client or not nodes:
             return {}
         
         try:
-            # 构建评分提示
-            nodes_text = ""
-            for i, node in enumerate(nodes, 1):
-                nodes_text += f"\n方案{i} (ID: {node.id}):\n{node.content}\n"
-            
             # 生成偏好描述
             preferences_text = ""
             for pref in self.user_preferences:
                 if pref.enabled:
                     preferences_text += f"- {pref.name}: {pref.description} (权重: {pref.weight})\n"
             
-            prompt = f"""
-请根据用户偏好对以下思考方案进行评分（1-5分）：
+            async def call_batch(prompt: str) -> str:
+                return await self.api_client.get_response(prompt, temperature=0.3)
+            
+            async def call_single(content: str) -> Optional[float]:
+                prompt = f"""
+请根据用户偏好对以下思考方案进行评分（1-5分，5分最好），只返回一个数字：
 
 用户偏好：
 {preferences_text}
-
 思考方案：
-{nodes_text}
-
-评分标准：
-- 5分：完全符合用户偏好，质量优秀
-- 4分：基本符合偏好，质量良好
-- 3分：部分符合偏好，质量一般
-- 2分：不太符合偏好，质量较差
-- 1分：不符合偏好，质量很差
-
-请返回JSON格式评分结果：
-{{
-    "scores": [
-        {{"node_id": "节点ID", "score": 分数, "reason": "评分理由"}},
-        ...
-    ]
-}}
+{content}
 """
+                response = await self.api_client.get_response(prompt, temperature=0.3)
+                numbers = re.findall(r"\d+(?:\.\d+)?", response or "")
+                return max(1.0, min(5.0, float(numbers[0]))) if numbers else None
             
-            response = await self.api_client.get_response(prompt, temperature=0.3)
-            
-            # 解析AI评分
-            scores = {}
-            if '{' in response and '}' in response:
-                json_start = response.find('{')
-                json_end = response.rfind('}') + 1
-                json_str = response[json_start:json_end]
-                result = json.loads(json_str)
-                
-                for score_data in result.get("scores", []):
-                    node_id = score_data.get("node_id")
-                    score = float(score_data.get("score", 3))
-                    scores[node_id] = score
+            results, info = await score_batch(
+                [node.content for node in nodes], preferences_text, self.score_cache,
+                call_batch, call_single, concurrency=self.config.get("scoring_fallback_concurrency", 3)
+            )
+            scores = {node.id: result["score"] for node, result in zip(nodes, results) if result is not None}
             
-            logger.info(f"AI批量评分完成: {len(scores)}个节点")
+            logger.info(f"AI批量评分完成: {len(scores)}个节点（缓存 {info['cached']}，"
+                        f"批量请求 {info['batch_requests']}，逐条请求 {info['single_requests']}）")
             return scores
             
         except Exception as e:
@@ -352,4 +352,5 @@ class PreferenceFilter:
                 "blacklist_count": len(pref.blacklist_keywords)
             })
         
+        summary["score_cache"] = self.score_cache.get_stats()
         return summary 
\ No newline at end of file
@@ -27,8 +27,14 @@ from config import (
     MODEL
 )
 
+from .batch_scoring import ScoreCache, score_batch
+
 logger = logging.getLogger("QuickModelManager")
 
+BATCH_SCORING_SYSTEM_PROMPT = """你是一个评分助手，按照用户给出的偏好对多个候选结果分别评分。
+只输出JSON数组，每个候选结果一项，ID与输入完全一致，不要输出其他内容。
+【重要】：只输出最终结果，不要包含思考过程或<think>标签。"""
+
 # 全局变量保护机制，避免重复初始化
 _QUICK_MODEL_MANAGER_GLOBAL_INITIALIZED = False
 
@@ -72,9 +78,15 @@ class QuickModelManager:
             "difficulty_judgments": 0,
             "scoring_operations": 0,
             "completeness_checks": 0,
-            "outputs_filtered": 0
+            "outputs_filtered": 0,
+            "batch_scoring_requests": 0,
+            "single_scoring_requests": 0,
+            "cached_scores": 0
         }
         
+        # 评分缓存：(内容哈希, 偏好) -> 评分
+        self.score_cache = ScoreCache(SCORING_SYSTEM_CONFIG.get("score_cache_size", 1024))
+        
         # 针对不同决策类型的专用系统提示词
         self.decision_system_prompts = {
             "binary": """你是一个二元判断助手，专门进行是/否的判断。
@@ -456,8 +468,11 @@ class QuickModelManager:
     async def _call_quick_model(self, prompt: str, system_prompt: str) -> Optional[str]:
         """调用快速模型"""
         try:
+            from apiserver.llm_scheduler import get_llm_scheduler, estimate_tokens
             response = await asyncio.wait_for(
-                self.quick_client.chat.completions.create(
+                get_llm_scheduler().run(
+                    self.quick_client.chat.completions.create,
+                    tokens=estimate_tokens(prompt + system_prompt, self.config["max_tokens"]),
                     model=self.config["model_name"],
                     messages=[
                         {"role": "system", "content": system_prompt},
@@ -487,8 +502,11 @@ class QuickModelManager:
     
     async def _call_fallback_model(self, prompt: str, system_prompt: str) -> str:
         """调用备用大模型"""
+        from apiserver.llm_scheduler import get_llm_scheduler, estimate_tokens
+        tokens = estimate_tokens(prompt + system_prompt, 1024)
         try:
-            response = await self.fallback_client.chat.completions.create(
+            response = await get_llm_scheduler().run(
+                self.fallback_client.chat.completions.create, tokens=tokens,
                 model=MODEL,
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -504,7 +522,8 @@ class QuickModelManager:
                 logger.debug(f"忽略连接关闭异常，重新创建客户端: {e}")
                 # 重新创建客户端并重试
                 self.fallback_client = AsyncOpenAI(api_key=API_KEY, base_url=BASE_URL.rstrip('/') + '/')
-                response = await self.fallback_client.chat.completions.create(
+                response = await get_llm_scheduler().run(
+                    self.fallback_client.chat.completions.create, tokens=tokens,
                     model=MODEL,
                     messages=[
                         {"role": "system", "content": system_prompt},
@@ -545,6 +564,10 @@ class QuickModelManager:
             "scoring_operations": self.stats["scoring_operations"],
             "completeness_checks": self.stats["completeness_checks"],
             "outputs_filtered": self.stats["outputs_filtered"],
+            "batch_scoring_requests": self.stats["batch_scoring_requests"],
+            "single_scoring_requests": self.stats["single_scoring_requests"],
+            "cached_scores": self.stats["cached_scores"],
+            "score_cache": self.score_cache.get_stats(),
             
             # 功能启用状态
             "features": {
@@ -674,46 +697,56 @@ class QuickModelManager:
         max_prefs = SCORING_SYSTEM_CONFIG.get("max_user_preferences", 3)
         user_preferences = user_preferences[:max_prefs]
         
-        scored_results = []
+        # 一次请求评完全部结果，解析失败时有限并发逐条评分
+        async def call_batch(prompt: str) -> str:
+            if self.enabled and self.quick_client:
+                response = await self._call_quick_model(prompt, BATCH_SCORING_SYSTEM_PROMPT)
+                if response:
+                    return self._filter_output(response)
+            return self._filter_output(await self._call_fallback_model(prompt, BATCH_SCORING_SYSTEM_PROMPT))
         
-        for i, result in enumerate(results):
-            try:
-                # 构建评分提示
-                prompt = f"""
+        async def call_single(content: str) -> Optional[float]:
+            prompt = f"""
 请对以下思考结果进行评分：
 
 思考结果：
-{result.get('content', '')}
+{content}
 
 用户偏好：
 {', '.join(user_preferences)}
 
 请根据用户偏好对这个结果的匹配度和质量进行1-5分评分。
 """
-                
-                # 调用评分
-                score_result = await self._get_score(prompt)
-                score = score_result.get("score", 3)
-                
-                # 检查相似性惩罚
-                similar_penalty = self._check_similarity_penalty(result, scored_results)
-                final_score = max(1, score - similar_penalty)
-                
-                scored_result = result.copy()
-                scored_result.update({
-                    "score": final_score,
-                    "original_score": score,
-                    "similarity_penalty": similar_penalty,
-                    "score_details": score_result
-                })
-                
-                scored_results.append(scored_result)
-                
-            except Exception as e:
-                logger.warning(f"评分失败，使用默认分数: {e}")
-                scored_result = result.copy()
-                scored_result["score"] = 3
-                scored_results.append(scored_result)
+            score_result = await self._get_score(prompt)
+            return None if "error" in score_result else score_result.get("score", 3)
+        
+        score_range = tuple(SCORING_SYSTEM_CONFIG.get("score_range", [1, 5]))
+        scores, info = await score_batch(
+            [result.get('content', '') for result in results],
+            "\n".join(f"- {pref}" for pref in user_preferences), self.score_cache,
+            call_batch, call_single,
+            concurrency=SCORING_SYSTEM_CONFIG.get("fallback_concurrency", 3), score_range=score_range
+        )
+        self.stats["batch_scoring_requests"] += info["batch_requests"]
+        self.stats["single_scoring_requests"] += info["single_requests"]
+        self.stats["cached_scores"] += info["cached"]
+        
+        scored_results = []
+        for result, score_entry in zip(results, scores):
+            score = int(round(score_entry["score"])) if score_entry else 3  # 无法评分时使用默认分数
+            
+            # 检查相似性惩罚
+            similar_penalty = self._check_similarity_penalty(result, scored_results)
+            final_score = max(1, score - similar_penalty)
+            
+            scored_result = result.copy()
+            scored_result.update({
+                "score": final_score,
+                "original_score": score,
+                "similarity_penalty": similar_penalty,
+                "score_details": score_entry or {"score": 3, "error": "评分失败"}
+            })
+            scored_results.append(scored_result)
         
         self.stats["scoring_operations"] += 1
         
@@ -874,21 +907,9 @@ class QuickModelManager:
         return 0
     
     def _calculate_similarity(self, text1: str, text2: str) -> float:
-        """简单的文本相似度计算"""
-        if not text1 or not text2:
-            return 0.0
-        
-        # 简单的词汇重叠相似度
-        words1 = set(text1.split())
-        words2 = set(text2.split())
-        
-        if not words1 or not words2:
-            return 0.0
-        
-        intersection = len(words1.intersection(words2))
-        union = len(words1.union(words2))
-        
-        return intersection / union if union > 0 else 0.0
+        """文本相似度（中文按字、英文按词的n-gram MinHash）"""
+        from .similarity import get_similarity_engine
+        return get_similarity_engine().similarity(text1, text2)
     
     def _filter_and_sort_results(self, scored_results: List[Dict]) -> List[Dict]:
         """过滤和排序结果"""
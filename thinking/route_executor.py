@@ -0,0 +1,191 @@
+"""
+思考路线执行器（法定数量提前结束 + 对冲请求）
+- N条路线并发生成，K条成功或到达截止时间即继续后续流程，取消仍未完成的路线
+- 某条路线运行时间超过近期路线耗时的p90时，可发出一条相同的对冲请求，先完成者胜出
+- 记录每条路线的耗时、是否对冲、是否被取消，便于根据真实数据调整N和K
+"""
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .config import TREE_THINKING_CONFIG
+
+logger = logging.getLogger("QuorumRouteExecutor")
+
+
+class QuorumRouteExecutor:
+    """按法定数量提前结束的路线执行器"""
+
+    def __init__(self, pool_manager, config: Optional[Dict] = None):
+        config = config or TREE_THINKING_CONFIG
+        self.pool_manager = pool_manager
+        self.quorum_ratio = config.get("route_quorum_ratio", 0.6)
+        self.min_quorum = config.get("route_min_quorum", 2)
+        self.deadline = config.get("route_deadline", 25)
+        self.hard_timeout = config.get("api_timeout", 30)
+        self.hedge_enabled = config.get("hedge_enabled", True)
+        self.hedge_percentile = config.get("hedge_percentile", 0.9)
+        self.hedge_min_samples = config.get("hedge_min_samples", 5)
+        self.hedge_max = config.get("hedge_max_per_session", 2)
+        self._latencies: deque = deque(maxlen=200)  # 近期成功路线的生成耗时（秒）
+        self.stats = {"sessions": 0, "routes": 0, "completed": 0, "failed": 0, "cancelled": 0,
+                      "hedged": 0, "hedge_wins": 0, "quorum_exits": 0, "deadline_exits": 0}
+
+    def quorum_for(self, total: int) -> int:
+        return min(total, max(self.min_quorum, math.ceil(total * self.quorum_ratio)))
+
+    def _hedge_threshold(self) -> Optional[float]:
+        if not self.hedge_enabled or len(self._latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile))]
+
+    async def run(self, routes: List[Tuple[Callable, tuple, Dict]],
+                  is_success: Callable[[Any], bool]) -> Tuple[List[Any], Dict]:
+        """
+        执行路线并按法定数量提前结束
+
+        Args:
+            routes: [(协程函数, 位置参数, 关键字参数)]，每项生成一条路线
+            is_success: 判断路线结果是否有效
+        Returns:
+            (按路线序号排列的有效结果, 执行报告)
+        """
+        total = len(routes)
+        quorum = self.quorum_for(total)
+        loop_start = time.monotonic()
+        branches = [{"index": i, "status": "pending", "started_at": None, "latency_ms": None,
+                     "hedged": False, "winner": None} for i in range(total)]
+        task_owner: Dict[asyncio.Task, Tuple[int, str]] = {}  # 任务 -> (路线序号, primary/hedge)
+        live: Dict[int, List[asyncio.Task]] = {i: [] for i in range(total)}
+        results: Dict[int, Any] = {}
+        hedges = 0
+
+        def launch(index: int, kind: str):
+            func, args, kwargs = routes[index]
+            if kind == "hedge":
+                kwargs = {**kwargs, "progress": None}  # 对冲结果胜出后再登记到进度中
+
+            async def timed():
+                # 在限流信号量内开始计时，不把排队时间算作路线耗时
+                started = time.monotonic()
+                branches[index].setdefault("attempt_started", {})[kind] = started
+                if branches[index]["started_at"] is None:
+                    branches[index]["started_at"] = started
+                return await func(*args, **kwargs)
+
+            task = asyncio.create_task(self.pool_manager.submit_api_task(timed))
+            task_owner[task] = (index, kind)
+            live[index].append(task)
+
+        for i in range(total):
+            launch(i, "primary")
+
+        exit_reason = "all_done"
+        try:
+            while any(live.values()):
+                now = time.monotonic()
+                elapsed = now - loop_start
+                succeeded = len(results)
+                if succeeded >= quorum and succeeded < total:
+                    exit_reason = "quorum"
+                    break
+                if elapsed >= self.deadline and succeeded > 0:
+                    exit_reason = "deadline"
+                    break
+                if elapsed >= self.deadline + self.hard_timeout:
+                    exit_reason = "timeout"
+                    break
+
+                # 对冲：所有路线都已开始（没有排队中的路线）且某条路线超过p90耗时
+                threshold = self._hedge_threshold()
+                if threshold is not None and hedges < self.hedge_max and \
+                        all(b["started_at"] is not None or b["status"] != "pending" for b in branches):
+                    for b in branches:
+                        if b["status"] == "pending" and not b["hedged"] and now - b["started_at"] > threshold:
+                            b["hedged"] = True
+                            hedges += 1
+                            launch(b["index"], "hedge")
+                            logger.info(f"路线 {b['index']} 超过p90耗时 {threshold:.1f}s，发出对冲请求")
+                            if hedges >= self.hedge_max:
+                                break
+
+                pending_tasks = [t for tasks in live.values() for t in tasks]
+                wait_for = self.deadline - elapsed if elapsed < self.deadline else self.deadline + self.hard_timeout - elapsed
+                if threshold is not None:
+                    wait_for = min(wait_for, 0.5)  # 定期检查是否需要对冲
+                done, _ = await asyncio.wait(pending_tasks, timeout=max(wait_for, 0.01),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    index, kind = task_owner.pop(task)
+                    live[index].remove(task)
+                    b = branches[index]
+                    if b["status"] != "pending":
+                        continue
+                    try:
+                        result = task.result()
+                    except (asyncio.CancelledError, Exception) as e:
+                        result = e
+                    if is_success(result):
+                        started = b.get("attempt_started", {}).get(kind, b["started_at"] or loop_start)
+                        latency = time.monotonic() - started
+                        self._latencies.append(latency)
+                        b.update(status="completed", latency_ms=round(latency * 1000, 1), winner=kind)
+                        results[index] = result
+                        # 同一路线的另一条请求不再需要
+                        for other in live[index]:
+                            other.cancel()
+                    elif not live[index]:
+                        b.update(status="failed",
+                                 latency_ms=round((time.monotonic() - (b["started_at"] or loop_start)) * 1000, 1))
+        finally:
+            # 取消仍未完成的路线
+            for index, tasks in live.items():
+                for task in tasks:
+                    task.cancel()
+                if branches[index]["status"] == "pending":
+                    started = branches[index]["started_at"]
+                    branches[index].update(
+                        status="cancelled",
+                        latency_ms=round((time.monotonic() - started) * 1000, 1) if started else None
+                    )
+
+        for b in branches:
+            b.pop("attempt_started", None)
+            b.pop("started_at", None)
+        counts = {status: sum(1 for b in branches if b["status"] == status)
+                  for status in ("completed", "failed", "cancelled")}
+        hedge_wins = sum(1 for b in branches if b["winner"] == "hedge")
+        self.stats["sessions"] += 1
+        self.stats["routes"] += total
+        for status, n in counts.items():
+            self.stats[status] += n
+        self.stats["hedged"] += hedges
+        self.stats["hedge_wins"] += hedge_wins
+        if exit_reason == "quorum":
+            self.stats["quorum_exits"] += 1
+        elif exit_reason in ("deadline", "timeout"):
+            self.stats["deadline_exits"] += 1
+
+        report = {
+            "routes": total,
+            "quorum": quorum,
+            "exit_reason": exit_reason,
+            "wall_ms": round((time.monotonic() - loop_start) * 1000, 1),
+            **counts,
+            "hedged": hedges,
+            "hedge_wins": hedge_wins,
+            "branches": branches,
+        }
+        logger.info(f"思考路线执行完成: {counts['completed']}/{total} 成功（法定数量 {quorum}），"
+                    f"取消 {counts['cancelled']}，对冲 {hedges}，结束原因 {exit_reason}，耗时 {report['wall_ms']:.0f}ms")
+        return [results[i] for i in sorted(results)], report
+
+    def get_stats(self) -> Dict:
+        threshold = self._hedge_threshold()
+        return {**self.stats, "latency_samples": len(self._latencies),
+                "hedge_threshold_s": round(threshold, 2) if threshold is not None else None}
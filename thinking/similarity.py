@@ -0,0 +1,263 @@
+"""
+文本相似度引擎
+- 中文按单字、英文/数字按单词切分，再组合为n-gram片段（中文文本没有空格，按str.split()切分基本只能得到整句）
+- 每段文本只计算一次MinHash签名，按内容缓存，遗传进化的各代之间复用
+- 种群较大时一次性用NumPy计算整个种群的两两相似度矩阵，替代逐对的Python集合运算（签名在首次需要时才计算）
+- 种群较小或未安装numpy时用n-gram集合上的精确Jaccard：只算上三角，并集大小由交集推出，两两结果按文本对缓存，跨代保留的节点不重复计算
+- 供GeneticPruning（多样性适应度）、PreferenceFilter（重复思路惩罚）、QuickModelManager（相似结果惩罚）共用
+
+运行 python -m thinking.similarity 可对比旧实现（按空格切分的Jaccard）的耗时
+"""
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+from .config import TREE_THINKING_CONFIG
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+logger = logging.getLogger("SimilarityEngine")
+
+_TOKEN_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]|[a-z0-9]+(?:'[a-z]+)?")  # 汉字逐字，字母数字按词
+_PRIME = 4294967291  # 小于2^32的最大素数，a*h+b不会溢出uint64
+_EXACT_MAX = 32  # 不超过该数量时精确Jaccard比计算MinHash签名更快
+
+
+def tokenize(text: str) -> List[str]:
+    """中文逐字、英文按词切分（忽略标点和空白）"""
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+class SimilarityEngine:
+    """基于n-gram与MinHash的文本相似度引擎"""
+
+    def __init__(self, ngram: int = 2, num_perm: int = 64, cache_size: int = 1024, seed: int = 42):
+        self.ngram = max(1, ngram)
+        self.num_perm = num_perm
+        self.cache_size = cache_size
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Dict]" = OrderedDict()  # 文本 -> {key, shingles, signature, tokens}
+        self._serial = 0
+        self._pairs: Dict[tuple, float] = {}  # 精确Jaccard：(序号, 序号) -> 相似度
+        self._stats = {"cache_hits": 0, "cache_misses": 0, "matrices": 0}
+        self._seed = seed
+        self._a = self._b = None  # MinHash哈希参数，首次计算签名时生成
+
+    # ---------- 签名 ----------
+    def _shingles(self, tokens: List[str]) -> set:
+        """n-gram片段，以词元元组的哈希值表示（整数集合的交集比字符串快，仅在进程内比较）"""
+        if len(tokens) < self.ngram:
+            return {hash(tuple(tokens))} if tokens else set()
+        return set(map(hash, zip(*(tokens[i:] for i in range(self.ngram)))))
+
+    def _signature(self, shingles: set):
+        if not HAS_NUMPY or not shingles:
+            return None
+        if self._a is None:
+            rng = np.random.RandomState(self._seed)
+            self._a = rng.randint(1, _PRIME, size=self.num_perm).astype(np.uint64)
+            self._b = rng.randint(0, _PRIME, size=self.num_perm).astype(np.uint64)
+        hashes = np.fromiter((h & 0xFFFFFFFF for h in shingles), dtype=np.uint64, count=len(shingles))
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def profile(self, text: str) -> Dict:
+        """文本的切分结果、n-gram集合和MinHash签名（按文本内容缓存，字符串哈希值由解释器缓存，无需另算摘要）"""
+        text = text or ""
+        with self._lock:
+            entry = self._cache.get(text)
+            if entry is not None:
+                self._cache.move_to_end(text)
+                self._stats["cache_hits"] += 1
+                return entry
+            self._stats["cache_misses"] += 1
+        tokens = tokenize(text)
+        shingles = self._shingles(tokens)
+        entry = {"tokens": tokens, "shingles": shingles}
+        with self._lock:
+            self._serial += 1
+            entry["key"] = self._serial  # 两两相似度缓存的键
+            self._cache[text] = entry
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return entry
+
+    # ---------- 相似度 ----------
+    def similarity(self, text1: str, text2: str) -> float:
+        """两段文本的相似度（0-1）"""
+        if not text1 or not text2:
+            return 0.0
+        return float(self.similarity_matrix([text1, text2])[0][1])
+
+    def similarity_matrix(self, texts: Sequence[str]):
+        """两两相似度矩阵（对角线为1）；有numpy时返回ndarray，否则返回嵌套列表"""
+        matrix = self._matrix(texts)
+        if HAS_NUMPY and isinstance(matrix, list):
+            return np.array(matrix).reshape(len(matrix), len(matrix))
+        return matrix
+
+    def _matrix(self, texts: Sequence[str]):
+        """种群较小或无numpy时返回精确Jaccard的嵌套列表，否则返回MinHash估计的ndarray"""
+        profiles = [self.profile(t) for t in texts]
+        n = len(profiles)
+        with self._lock:
+            self._stats["matrices"] += 1
+        if not HAS_NUMPY or n <= _EXACT_MAX:
+            return self._jaccard_matrix(profiles)
+        empty = np.array([not p["shingles"] for p in profiles])
+        for p in profiles:
+            if "signature" not in p:
+                p["signature"] = self._signature(p["shingles"])
+        signatures = np.stack([p["signature"] if p["signature"] is not None
+                               else np.full(self.num_perm, _PRIME, dtype=np.uint64) for p in profiles])
+        matrix = (signatures[:, None, :] == signatures[None, :, :]).mean(axis=2)
+        matrix[empty, :] = 0.0
+        matrix[:, empty] = 0.0
+        np.fill_diagonal(matrix, 1.0)
+        return matrix
+
+    def _jaccard_matrix(self, profiles: List[Dict]) -> List[List[float]]:
+        """精确Jaccard矩阵（嵌套列表）"""
+        n = len(profiles)
+        matrix = [[0.0] * n for _ in range(n)]
+        pairs = self._pairs
+        if len(pairs) > self.cache_size * 16:
+            pairs.clear()  # 简单的容量上限，整体清空比逐项LRU更省
+        for i in range(n):
+            row = matrix[i]
+            row[i] = 1.0
+            a = profiles[i]["shingles"]
+            if not a:
+                continue
+            key_a = profiles[i]["key"]
+            len_a = len(a)
+            for j in range(i + 1, n):
+                b = profiles[j]["shingles"]
+                if not b:
+                    continue
+                key_b = profiles[j]["key"]
+                pair = (key_a, key_b) if key_a < key_b else (key_b, key_a)
+                value = pairs.get(pair)
+                if value is None:
+                    common = len(a & b)
+                    value = pairs[pair] = common / (len_a + len(b) - common)
+                row[j] = matrix[j][i] = value
+        return matrix
+
+    def diversity_scores(self, texts: Sequence[str]) -> List[float]:
+        """每段文本与其余文本的平均距离（1 - 相似度），只有一段时为1"""
+        n = len(texts)
+        if n <= 1:
+            return [1.0] * n
+        matrix = self._matrix(texts)
+        if not isinstance(matrix, list):
+            return [float(x) for x in (1.0 - (matrix.sum(axis=1) - 1.0) / (n - 1))]
+        return [1.0 - (sum(row) - 1.0) / (n - 1) for row in matrix]
+
+    def token_density(self, text: str) -> float:
+        """信息密度：不重复词元占比"""
+        tokens = self.profile(text)["tokens"]
+        return len(set(tokens)) / len(tokens) if tokens else 0.0
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return {**self._stats, "cached": len(self._cache), "numpy": HAS_NUMPY,
+                    "ngram": self.ngram, "num_perm": self.num_perm}
+
+
+_ENGINE: Optional[SimilarityEngine] = None
+
+
+def get_similarity_engine() -> SimilarityEngine:
+    """获取全局相似度引擎"""
+    global _ENGINE
+    if _ENGINE is None:
+        _ENGINE = SimilarityEngine(
+            ngram=TREE_THINKING_CONFIG.get("similarity_ngram", 2),
+            num_perm=TREE_THINKING_CONFIG.get("similarity_num_perm", 64),
+            cache_size=TREE_THINKING_CONFIG.get("similarity_cache_size", 1024),
+        )
+    return _ENGINE
+
+
+# ---------- 微基准 ----------
+def _legacy_diversity(texts: Sequence[str]) -> List[float]:
+    """旧实现：按空格切分后逐对计算Jaccard距离"""
+    scores = []
+    for i, text in enumerate(texts):
+        words = set(text.lower().split())
+        distances = []
+        for j, other in enumerate(texts):
+            if i == j:
+                continue
+            other_words = set(other.lower().split())
+            union = words | other_words
+            if union:
+                distances.append(1 - len(words & other_words) / len(union))
+        scores.append(sum(distances) / len(distances) if distances else 1.0)
+    return scores
+
+
+def _synthetic_population(lang: str, size: int, seed: int = 7) -> List[str]:
+    """生成一组主题相近、部分为改写的文本"""
+    import random
+    rng = random.Random(seed)
+    if lang == "zh":
+        phrases = ["首先需要分析问题的根本原因", "因此我们应该从用户需求出发", "由于资源有限所以要排定优先级",
+                   "然而现有方案存在明显的性能瓶颈", "可以通过缓存和批处理降低延迟", "具体步骤包括评估测试和逐步上线",
+                   "从长期来看需要建立监控和反馈机制", "另辟蹊径的做法是重新设计数据结构", "综合考虑成本与收益后给出建议"]
+        joiner = "，"
+    else:
+        phrases = ["first we need to analyse the root cause", "therefore we should start from user needs",
+                   "resources are limited so priorities matter", "however the current design has a bottleneck",
+                   "caching and batching can reduce latency", "the steps are evaluation testing and rollout",
+                   "in the long run we need monitoring and feedback", "an alternative is to redesign the data model",
+                   "weighing cost and benefit we recommend a plan"]
+        joiner = ", "
+    base = [rng.sample(phrases, 5) for _ in range(max(1, size // 2))]
+    texts = []
+    for i in range(size):
+        parts = list(base[i % len(base)])
+        if i >= len(base):
+            rng.shuffle(parts)  # 与已有文本高度相似的改写
+        texts.append(joiner.join(parts) + ("。" if lang == "zh" else "."))
+    return texts
+
+
+def run_benchmark(population: int = 10, generations: int = 3, repeat: int = 20) -> Dict[str, Dict]:
+    """对比旧实现与新引擎：每代计算一次整个种群的多样性"""
+    import time
+    results = {}
+    for lang in ("zh", "en"):
+        texts = _synthetic_population(lang, population)
+        start = time.perf_counter()
+        for _ in range(repeat * generations):
+            legacy = _legacy_diversity(texts)
+        legacy_ms = (time.perf_counter() - start) * 1000 / repeat
+        start = time.perf_counter()
+        for _ in range(repeat):
+            engine = SimilarityEngine()  # 每次进化从空缓存开始，后续各代复用签名
+            for _ in range(generations):
+                current = engine.diversity_scores(texts)
+        engine_ms = (time.perf_counter() - start) * 1000 / repeat
+        results[lang] = {
+            "legacy_ms": round(legacy_ms, 3),
+            "engine_ms": round(engine_ms, 3),
+            # 多样性得分的离散程度：旧实现在中文上几乎全为1（无区分度）
+            "legacy_spread": round(max(legacy) - min(legacy), 3),
+            "engine_spread": round(max(current) - min(current), 3),
+        }
+    return results
+
+
+if __name__ == "__main__":
+    for size in (10, 40):
+        for lang, row in run_benchmark(population=size).items():
+            print(f"[{lang} x{size}] 旧实现 {row['legacy_ms']}ms/次进化 区分度 {row['legacy_spread']} | "
+                  f"新引擎 {row['engine_ms']}ms/次进化 区分度 {row['engine_spread']}")
@@ -0,0 +1,152 @@
+"""
+推测式深度思考
+难度判断达到阈值后立即启动深度思考，与主回答（工具调用循环）并行执行，而不是等主回答完成后再从头开始
+- 主回答已足够详细时可取消
+- 超时或取消时，已完成的思考分支可作为部分结果并入最终回答
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from .config import TREE_THINKING_CONFIG
+
+logger = logging.getLogger("SpeculativeThinking")
+
+_STATS = {"turns": 0, "triggered": 0, "cancelled": 0, "completed": 0, "partial": 0,
+          "overlap_seconds": 0.0, "deep_seconds": 0.0}
+
+
+class SpeculativeThinking:
+    """单轮对话的深度思考任务（判断 + 思考）"""
+
+    def __init__(self, engine, question: str, context: Optional[str] = None, speculative: Optional[bool] = None):
+        config = TREE_THINKING_CONFIG
+        self.engine = engine
+        self.question = question
+        self.context = context
+        self.speculative = config.get("speculative", True) if speculative is None else speculative
+        self.threshold = config.get("deep_thinking_threshold", 4)
+        self.sufficient_chars = config.get("speculative_sufficient_chars", 600)
+        self.min_partial_routes = config.get("speculative_min_partial_routes", 2)
+        self.assessment: Optional[Dict] = None
+        self.progress: Dict[str, Any] = {"stage": "judging", "routes": []}
+        self._judged = asyncio.Event()
+        self._judge_task: Optional[asyncio.Task] = None
+        self._deep_task: Optional[asyncio.Task] = None
+        self._deep_started_at: Optional[float] = None
+        self._main_done_at: Optional[float] = None
+        _STATS["turns"] += 1
+
+    @property
+    def triggered(self) -> bool:
+        return bool(self.assessment) and self.assessment.get("difficulty", 0) >= self.threshold
+
+    def start(self) -> "SpeculativeThinking":
+        self._judge_task = asyncio.create_task(self._judge())
+        return self
+
+    async def _judge(self):
+        try:
+            self.assessment = await self.engine.difficulty_judge.assess_difficulty(self.question)
+            logger.info(f"难度判断：{self.assessment.get('difficulty', 3)}/5，建议深度思考：{self.triggered}")
+        except Exception as e:
+            logger.debug(f"异步思考判断失败: {e}")
+            self.assessment = None
+        finally:
+            self._judged.set()
+        if self.triggered:
+            _STATS["triggered"] += 1
+            if self.speculative:
+                # 主回答仍在生成，立即开始深度思考
+                self._start_deep()
+            else:
+                self.progress["stage"] = "waiting"
+        else:
+            self.progress["stage"] = "skipped"
+
+    def _start_deep(self):
+        if self._deep_task is None:
+            from apiserver.llm_scheduler import llm_context, LLMLane
+            self._deep_started_at = time.time()
+            with llm_context(LLMLane.THINKING):  # 思考任务中的LLM调用排在交互对话之后
+                self._deep_task = asyncio.create_task(self.engine.think_deeply(
+                    self.question, difficulty_assessment=self.assessment,
+                    context=self.context, progress=self.progress
+                ))
+
+    async def should_think_deeply(self, timeout: float = 3.0) -> bool:
+        """等待难度判断结果（最多timeout秒）"""
+        try:
+            await asyncio.wait_for(self._judged.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.cancel()
+            return False
+        return self.triggered
+
+    def main_answer_done(self, answer: str) -> bool:
+        """主回答完成时调用，返回是否继续深度思考（主回答已足够详细时取消）"""
+        self._main_done_at = time.time()
+        if self._deep_task is not None and self.sufficient_chars and len(answer or "") >= self.sufficient_chars:
+            logger.info(f"主回答已足够详细（{len(answer)}字），取消深度思考")
+            self.cancel()
+            return False
+        return True
+
+    async def result(self, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """等待深度思考结果；超时时取消并返回部分结果（已完成分支不足时返回None）"""
+        self._start_deep()
+        timeout = timeout or TREE_THINKING_CONFIG.get("thinking_timeout", 60)
+        try:
+            result = await asyncio.wait_for(asyncio.shield(self._deep_task), timeout=timeout)
+            _STATS["completed"] += 1
+            return result
+        except asyncio.TimeoutError:
+            logger.warning(f"深度思考超时（{timeout}秒），使用已完成的分支")
+            self.cancel()
+            return self.partial_result()
+        finally:
+            self._record_timing()
+
+    def partial_result(self) -> Optional[Dict[str, Any]]:
+        """已完成分支拼接成的部分结果"""
+        routes = self.progress.get("optimal_routes") or self.progress.get("routes") or []
+        if len(routes) < self.min_partial_routes:
+            return None
+        _STATS["partial"] += 1
+        ranked = sorted(routes, key=lambda r: (r.score, len(r.content)), reverse=True)[:3]
+        answer = "\n\n".join(f"【{r.branch_type}】{r.content}" for r in ranked)
+        return {
+            "answer": answer,
+            "thinking_process": {"mode": "partial", "stage": self.progress.get("stage"),
+                                 "routes_generated": len(routes), "routes_selected": len(ranked)},
+            "session_id": None,
+        }
+
+    def _record_timing(self):
+        if self._deep_started_at is None:
+            return
+        finished = time.time()
+        _STATS["deep_seconds"] += finished - self._deep_started_at
+        if self._main_done_at is not None and self._main_done_at > self._deep_started_at:
+            # 与主回答重叠的时间即相比顺序执行节省的时间
+            overlap = self._main_done_at - self._deep_started_at
+            _STATS["overlap_seconds"] += overlap
+            logger.info(f"深度思考与主回答并行 {overlap:.1f}秒，总耗时 {finished - self._deep_started_at:.1f}秒")
+
+    def cancel(self):
+        """取消判断和深度思考"""
+        for task in (self._judge_task, self._deep_task):
+            if task is not None and not task.done():
+                task.cancel()
+                if task is self._deep_task:
+                    _STATS["cancelled"] += 1
+
+
+def get_speculative_stats() -> Dict[str, Any]:
+    """推测式深度思考统计"""
+    stats = dict(_STATS)
+    stats["overlap_seconds"] = round(stats["overlap_seconds"], 2)
+    stats["deep_seconds"] = round(stats["deep_seconds"], 2)
+    return stats
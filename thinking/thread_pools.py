@@ -4,7 +4,6 @@
 """
 
 import asyncio
-import time
 import logging
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Any, Callable, List
@@ -30,11 +29,6 @@ class ThreadPoolManager:
             thread_name_prefix="api"
         )
         
-        # API限流控制
-        self.api_semaphore = asyncio.Semaphore(config["max_concurrent_api"])
-        self.last_api_call = 0
-        self.min_api_interval = config["min_api_interval"]
-        
         # 统计信息
         self.stats = {
             "thinking_tasks": 0,
@@ -67,39 +61,30 @@ class ThreadPoolManager:
             raise
     
     async def submit_api_task(self, func: Callable, *args, **kwargs) -> Any:
-        """提交API任务到API线程池，带限流控制"""
+        """提交API任务，由全局LLM调度器的思考通道控制并发和限流"""
+        from apiserver.llm_scheduler import get_llm_scheduler, llm_context, LLMLane
         self.stats["api_tasks"] += 1
         
-        async with self.api_semaphore:
-            try:
-                # 限流控制
-                await self._rate_limit()
-                
-                # 检查是否为异步函数
-                if asyncio.iscoroutinefunction(func):
-                    # 异步函数直接执行
-                    result = await func(*args, **kwargs)
-                else:
-                    # 同步函数使用线程池
-                    loop = asyncio.get_event_loop()
-                    result = await loop.run_in_executor(self.api_pool, func, *args, **kwargs)
-                
-                self.stats["api_completed"] += 1
-                return result
-                
-            except Exception as e:
-                self.stats["api_errors"] += 1
-                logger.error(f"API任务执行失败: {e}")
-                raise
-    
-    async def _rate_limit(self):
-        """API限流控制"""
-        now = time.time()
-        if now - self.last_api_call < self.min_api_interval:
-            wait_time = self.min_api_interval - (now - self.last_api_call)
-            await asyncio.sleep(wait_time)
-        
-        self.last_api_call = time.time()
+        # 任务内的LLM调用复用本配额，不重复排队
+        with llm_context(LLMLane.THINKING):
+            async with get_llm_scheduler().slot(LLMLane.THINKING):
+                try:
+                    # 检查是否为异步函数
+                    if asyncio.iscoroutinefunction(func):
+                        # 异步函数直接执行
+                        result = await func(*args, **kwargs)
+                    else:
+                        # 同步函数使用线程池
+                        loop = asyncio.get_event_loop()
+                        result = await loop.run_in_executor(self.api_pool, func, *args, **kwargs)
+                    
+                    self.stats["api_completed"] += 1
+                    return result
+                    
+                except Exception as e:
+                    self.stats["api_errors"] += 1
+                    logger.error(f"API任务执行失败: {e}")
+                    raise
     
     async def submit_batch_thinking_tasks(self, tasks: List[tuple]) -> List[Any]:
         """批量提交思考任务"""
@@ -174,15 +159,16 @@ class ThreadPoolManager:
                 "pending_tasks": self.api_pool._work_queue.qsize() if hasattr(self.api_pool, '_work_queue') else 0
             }
             
-            semaphore_status = {
-                "available": getattr(self.api_semaphore, '_value', 0),
-                "waiting": len(getattr(self.api_semaphore, '_waiters', [])) if hasattr(self.api_semaphore, '_waiters') and self.api_semaphore._waiters is not None else 0
-            }
+            try:
+                from apiserver.llm_scheduler import get_llm_scheduler
+                scheduler_status = get_llm_scheduler().get_stats()["lanes"]["thinking"]
+            except Exception as e:
+                scheduler_status = {"status": "error", "error": str(e)}
             
             return {
                 "thinking_pool": thinking_pool_status,
                 "api_pool": api_pool_status,
-                "api_semaphore": semaphore_status,
+                "llm_scheduler": scheduler_status,
                 "stats": self.stats.copy()
             }
         except Exception as e:
@@ -190,7 +176,7 @@ class ThreadPoolManager:
             return {
                 "thinking_pool": {"status": "error"},
                 "api_pool": {"status": "error"},
-                "api_semaphore": {"status": "error"},
+                "llm_scheduler": {"status": "error"},
                 "stats": self.stats.copy(),
                 "error": str(e)
             }
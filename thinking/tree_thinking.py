@@ -11,8 +11,12 @@ from .thinking_node import ThinkingNode, ThinkingBranch
 from .difficulty_judge import DifficultyJudge
 from .preference_filter import PreferenceFilter, UserPreference
 from .genetic_pruning import GeneticPruning
-from .thread_pools import ThreadPoolManager, TaskBatch
+from .evolution_controller import EvolutionBudget, EvolutionController
+from .history_store import get_thinking_history_store
+from .thread_pools import ThreadPoolManager
 from .config import TREE_THINKING_CONFIG
+from .speculative import get_speculative_stats
+from .route_executor import QuorumRouteExecutor
 
 logger = logging.getLogger("TreeThinkingEngine")
 
@@ -21,7 +25,8 @@ _global_subsystems = {
     "difficulty_judge": None,
     "preference_filter": None,
     "genetic_pruning": None,
-    "thread_pool": None
+    "thread_pool": None,
+    "route_executor": None
 }
 
 class TreeThinkingEngine:
@@ -41,6 +46,7 @@ class TreeThinkingEngine:
             _global_subsystems["preference_filter"] = PreferenceFilter(api_client)
             _global_subsystems["genetic_pruning"] = GeneticPruning(api_client)
             _global_subsystems["thread_pool"] = ThreadPoolManager()
+            _global_subsystems["route_executor"] = QuorumRouteExecutor(_global_subsystems["thread_pool"])
             print("[TreeThinkingEngine] 🌳 树状思考引擎子系统初始化完成")
             print("[TreeThinkingEngine] 🚀 树状思考引擎初始化完成")
         else:
@@ -52,15 +58,23 @@ class TreeThinkingEngine:
         self.preference_filter = _global_subsystems["preference_filter"]
         self.genetic_pruning = _global_subsystems["genetic_pruning"]
         self.thread_pool = _global_subsystems["thread_pool"]
+        self.route_executor = _global_subsystems["route_executor"]
         
         # 运行状态
         self.is_enabled = self.config["enabled"]
         self.current_session = None
-        self.thinking_history = []
+        self.history = get_thinking_history_store()  # 有界内存 + 压缩分段文件
     
-    async def think_deeply(self, question: str, user_preferences: Optional[List[UserPreference]] = None) -> Dict[str, Any]:
+    async def think_deeply(self, question: str, user_preferences: Optional[List[UserPreference]] = None,
+                           difficulty_assessment: Optional[Dict] = None, context: Optional[str] = None,
+                           progress: Optional[Dict] = None) -> Dict[str, Any]:
         """
         深度思考主入口
+        
+        Args:
+            difficulty_assessment: 已有的难度评估结果（推测式思考中已判断过时复用，不再重复评估）
+            context: 对话上下文，与主回答使用相同的上下文
+            progress: 进度记录，思考过程中写入当前阶段（stage）和已完成的思考路线（routes），被取消时调用方可取用部分结果
         """
         if not self.is_enabled:
             logger.info("树状思考系统未启用，使用基础回答")
@@ -68,14 +82,15 @@ class TreeThinkingEngine:
         
         try:
             start_time = time.time()
-            session_id = f"thinking_{int(start_time)}"
+            session_id = f"thinking_{int(start_time * 1000)}"
             self.current_session = session_id
             
             logger.info(f"开始深度思考会话: {session_id}")
             logger.info(f"问题: {question[:100]}...")
             
             # 1. 问题难度评估
-            difficulty_assessment = await self.difficulty_judge.assess_difficulty(question)
+            if difficulty_assessment is None:
+                difficulty_assessment = await self.difficulty_judge.assess_difficulty(question)
             logger.info(f"难度评估: {difficulty_assessment['reasoning']}")
             
             # 2. 更新用户偏好
@@ -83,29 +98,44 @@ class TreeThinkingEngine:
                 self.preference_filter.update_preferences(user_preferences)
             
             # 3. 生成多路思考
+            if progress is not None:
+                progress["stage"] = "routes"
+            route_report: Dict[str, Any] = {}
             thinking_routes = await self._generate_thinking_routes(
-                question, difficulty_assessment
+                question, difficulty_assessment, context=context, progress=progress, report=route_report
             )
             
             # 4. 偏好打分
+            if progress is not None:
+                progress["stage"] = "scoring"
             if thinking_routes:
                 route_scores = await self.preference_filter.score_thinking_nodes(thinking_routes)
                 logger.info(f"完成 {len(thinking_routes)} 条思考路线的偏好打分")
             else:
                 route_scores = {}
             
-            # 5. 遗传算法剪枝
+            # 5. 遗传算法剪枝（预算截止时间不超过本次思考的剩余时间）
+            evolution_budget = EvolutionBudget.from_config(
+                self.config, deadline=self.config["thinking_timeout"] - (time.time() - start_time)
+            )
+            evolution_report: Dict[str, Any] = {}
             if len(thinking_routes) > 3:
                 optimal_routes = await self.genetic_pruning.evolve_thinking_tree(
-                    thinking_routes, target_count=3
+                    thinking_routes, target_count=3, budget=evolution_budget, report=evolution_report
                 )
                 logger.info(f"遗传剪枝后保留 {len(optimal_routes)} 条最优路线")
             else:
                 optimal_routes = thinking_routes
+                skipped = EvolutionController(evolution_budget)
+                skipped.stop_reason = "skipped"
+                evolution_report = skipped.report()
             
             # 6. 综合最终答案
+            if progress is not None:
+                progress["stage"] = "synthesis"
+                progress["optimal_routes"] = optimal_routes
             final_answer = await self._synthesize_final_answer(
-                question, optimal_routes, difficulty_assessment
+                question, optimal_routes, difficulty_assessment, context=context
             )
             
             # 7. 记录思考过程
@@ -116,12 +146,24 @@ class TreeThinkingEngine:
                 "thinking_routes": len(thinking_routes),
                 "optimal_routes": len(optimal_routes),
                 "route_scores": route_scores,
+                "route_execution": route_report,
+                "evolution": evolution_report,
                 "final_answer": final_answer,
+                "thinking_details": [
+                    {
+                        "route_id": route.id,
+                        "branch_type": route.branch_type,
+                        "content": route.content,
+                        "score": route.score,
+                        "fitness": route.fitness
+                    }
+                    for route in optimal_routes
+                ],
                 "processing_time": time.time() - start_time,
                 "timestamp": time.time()
             }
             
-            self.thinking_history.append(thinking_session)
+            self.history.append(thinking_session)
             
             logger.info(f"深度思考完成，耗时 {thinking_session['processing_time']:.2f}秒")
             
@@ -132,20 +174,17 @@ class TreeThinkingEngine:
                     "routes_generated": len(thinking_routes),
                     "routes_selected": len(optimal_routes),
                     "processing_time": thinking_session['processing_time'],
-                    "thinking_details": [
-                        {
-                            "route_id": route.id,
-                            "branch_type": route.branch_type,
-                            "content": route.content,
-                            "score": route.score,
-                            "fitness": route.fitness
-                        }
-                        for route in optimal_routes
-                    ]
+                    "route_execution": route_report,
+                    "evolution": evolution_report,
+                    "thinking_details": thinking_session["thinking_details"]
                 },
                 "session_id": session_id
             }
             
+        except asyncio.CancelledError:
+            logger.info(f"深度思考会话已取消: {self.current_session}")
+            raise
+        
         except Exception as e:
             logger.error(f"深度思考过程出错: {e}")
             # 降级到基础回答
@@ -154,51 +193,43 @@ class TreeThinkingEngine:
         finally:
             self.current_session = None
     
-    async def _generate_thinking_routes(self, question: str, difficulty_assessment: Dict) -> List[ThinkingNode]:
-        """生成多路思考"""
+    async def _generate_thinking_routes(self, question: str, difficulty_assessment: Dict,
+                                        context: Optional[str] = None, progress: Optional[Dict] = None,
+                                        report: Optional[Dict] = None) -> List[ThinkingNode]:
+        """生成多路思考（K条成功或到达截止时间即返回，report中记录各路线耗时与取消情况）"""
         routes_count = difficulty_assessment["routes"]
         temperatures = self.difficulty_judge.get_temperature_distribution(routes_count)
         branch_types = self.difficulty_judge.get_branch_types(routes_count)
         
         logger.info(f"生成 {routes_count} 条思考路线，温度范围: {min(temperatures)}-{max(temperatures)}")
         
-        # 创建任务批次
-        task_batch = TaskBatch(self.thread_pool)
-        
         # 为每个思考路线创建任务
+        routes = []
         for i in range(routes_count):
             temperature = temperatures[i]
             branch_type = branch_types[i]
             
             # 根据分支类型调整提示词
-            thinking_prompt = self._create_thinking_prompt(question, branch_type, i+1, routes_count)
-            
-            # 添加API任务
-            task_batch.add_api_task(
+            thinking_prompt = self._create_thinking_prompt(question, branch_type, i+1, routes_count, context=context)
+            routes.append((
                 self._generate_single_route,
-                thinking_prompt, temperature, branch_type, i
-            )
+                (thinking_prompt, temperature, branch_type, i),
+                {"progress": progress}
+            ))
         
-        # 并行执行所有思考任务
+        # 并行执行，达到法定数量后取消其余路线
         try:
-            thinking_results, api_results = await task_batch.execute_all()
-            
-            # 合并所有结果
-            all_results = (thinking_results or []) + (api_results or [])
-            logger.info(f"原始结果数量: thinking={len(thinking_results or [])}, api={len(api_results or [])}, 总计={len(all_results)}")
-            
-            # 过滤有效结果
-            valid_routes = []
-            for i, result in enumerate(all_results):
-                logger.info(f"结果 {i}: 类型={type(result)}, 是否为ThinkingNode={isinstance(result, ThinkingNode)}")
-                if isinstance(result, ThinkingNode):
-                    logger.info(f"  内容长度: {len(result.content)}, 内容预览: {result.content[:50]}...")
-                    if result.content and result.content.strip():
-                        valid_routes.append(result)
-                    else:
-                        logger.warning(f"  思考节点内容为空")
-                else:
-                    logger.warning(f"  结果不是ThinkingNode类型: {result}")
+            valid_routes, execution = await self.route_executor.run(routes, self._is_valid_route)
+            for branch in execution["branches"]:
+                branch["branch_type"] = branch_types[branch["index"]]
+            if report is not None:
+                report.update(execution)
+            if progress is not None:
+                # 对冲请求胜出的路线未经_generate_single_route登记，这里补上
+                done_routes = progress.setdefault("routes", [])
+                for route in valid_routes:
+                    if route not in done_routes:
+                        done_routes.append(route)
             
             # 建立兄弟关系
             if valid_routes:
@@ -213,7 +244,14 @@ class TreeThinkingEngine:
             traceback.print_exc()
             return []
     
-    def _create_thinking_prompt(self, question: str, branch_type: str, route_num: int, total_routes: int) -> str:
+    @staticmethod
+    def _is_valid_route(result: Any) -> bool:
+        """路线结果是否有效（生成失败的占位节点不计入法定数量）"""
+        return (isinstance(result, ThinkingNode) and bool(result.content and result.content.strip())
+                and not result.metadata.get("failed"))
+    
+    def _create_thinking_prompt(self, question: str, branch_type: str, route_num: int, total_routes: int,
+                                context: Optional[str] = None) -> str:
         """创建思考提示词"""
         from .config import BRANCH_TYPES
         
@@ -231,11 +269,13 @@ class TreeThinkingEngine:
             except Exception as e:
                 logger.warning(f"获取相关记忆失败: {e}")
         
+        context_block = f"\n对话上下文：\n{context}\n" if context else ""
+        
         prompt = f"""
 作为{branch_description}思考者，请深入分析以下问题（第{route_num}/{total_routes}路思考）：
 
 问题：{question}
-
+{context_block}
 {memory_context}
 
 请从{branch_description}的角度进行深度思考，要求：
@@ -250,7 +290,7 @@ class TreeThinkingEngine:
         return prompt
     
     async def _generate_single_route(self, prompt: str, temperature: float, 
-                                   branch_type: str, route_index: int) -> ThinkingNode:
+                                   branch_type: str, route_index: int, progress: Optional[Dict] = None) -> ThinkingNode:
         """生成单条思考路线"""
         try:
             logger.info(f"开始生成思考路线 {route_index}, 温度: {temperature}, 类型: {branch_type}")
@@ -274,6 +314,8 @@ class TreeThinkingEngine:
             )
             
             node.update_content(content.strip())
+            if progress is not None and node.content:
+                progress.setdefault("routes", []).append(node)  # 已完成的分支，取消时可作为部分结果
             
             logger.info(f"路线 {route_index} 思考节点创建成功")
             return node
@@ -286,11 +328,12 @@ class TreeThinkingEngine:
             return ThinkingNode(
                 content=f"思考路线 {route_index} 生成失败: {str(e)}",
                 temperature=temperature,
-                branch_type=branch_type
+                branch_type=branch_type,
+                metadata={"route_index": route_index, "failed": True}
             )
     
     async def _synthesize_final_answer(self, question: str, optimal_routes: List[ThinkingNode], 
-                                     difficulty_assessment: Dict) -> str:
+                                     difficulty_assessment: Dict, context: Optional[str] = None) -> str:
         """综合最终答案"""
         if not optimal_routes:
             return "抱歉，无法生成有效的思考方案。"
@@ -301,11 +344,13 @@ class TreeThinkingEngine:
             for i, route in enumerate(optimal_routes, 1):
                 routes_summary += f"\n思考路线{i}（{route.branch_type}，评分:{route.score:.1f}）：\n{route.content}\n"
             
+            context_block = f"\n对话上下文：\n{context}\n" if context else ""
+            
             synthesis_prompt = f"""
 基于以下多路深度思考的结果，请综合生成一个完整、准确的最终答案：
 
 原问题：{question}
-
+{context_block}
 问题难度：{difficulty_assessment['difficulty']}/5
 {routes_summary}
 
@@ -366,8 +411,11 @@ class TreeThinkingEngine:
         return {
             "enabled": self.is_enabled,
             "current_session": self.current_session,
-            "total_sessions": len(self.thinking_history),
+            "total_sessions": self.history.get_stats()["total_sessions"],
             "thread_pool_status": self.thread_pool.get_pool_status(),
+            "speculative": get_speculative_stats(),
+            "difficulty_judge": self.difficulty_judge.get_stats(),
+            "route_execution": self.route_executor.get_stats(),
             "config": self.config,
             "components": {
                 "difficulty_judge": "已初始化",
@@ -378,24 +426,36 @@ class TreeThinkingEngine:
         }
     
     def get_thinking_history(self, limit: int = 10) -> List[Dict]:
-        """获取思考历史"""
-        return self.thinking_history[-limit:] if self.thinking_history else []
+        """获取最近的思考历史（完整记录）"""
+        return self.history.recent(limit)
+    
+    def query_thinking_history(self, limit: int = 10, offset: int = 0, session_id: Optional[str] = None,
+                               question: Optional[str] = None, since: Optional[float] = None,
+                               until: Optional[float] = None) -> List[Dict]:
+        """按会话、问题、时间范围查询思考历史摘要（完整记录用get_thinking_session获取）"""
+        return self.history.list_sessions(limit, offset, session_id=session_id, question=question,
+                                          since=since, until=until)
+    
+    def get_thinking_session(self, session_id: str) -> Optional[Dict]:
+        """获取某次思考的完整记录"""
+        return self.history.get(session_id)
+    
+    def get_thinking_stats(self) -> Dict[str, Any]:
+        """思考历史聚合统计（平均路线数、进化代数、耗时）"""
+        return self.history.get_stats()
     
     def clear_thinking_history(self):
-        """清空思考历史"""
-        self.thinking_history.clear()
+        """清空思考历史（包括磁盘上的记录）"""
+        self.history.clear()
         logger.info("思考历史已清空")
     
     def cleanup(self):
         """清理资源"""
         logger.info("正在清理树状思考引擎资源...")
         
-        # 清理线程池
+        # 清理线程池（思考历史已持久化，内存部分有界，无需清理）
         self.thread_pool.cleanup()
         
-        # 清理历史记录
-        self.thinking_history.clear()
-        
         logger.info("树状思考引擎资源清理完成")
     
     def __enter__(self):
@@ -183,16 +183,10 @@ class StreamingWorker(EnhancedWorker):
                         # 立即发送流式数据到前端显示
                         self.stream_chunk.emit(content_str)
                         
-                        # 异步发送文本到语音集成模块（不阻塞前端显示）
+                        # 发送文本到语音集成模块（仅做断句缓冲，TTS在后台线程生成；同步调用保证句子顺序）
                         if self.voice_integration:
                             try:
-                                # 使用线程池异步处理音频，不阻塞UI
-                                import threading
-                                threading.Thread(
-                                    target=self.voice_integration.receive_text_chunk,
-                                    args=(content_str,),
-                                    daemon=True
-                                ).start()
+                                self.voice_integration.receive_text_chunk(content_str)
                             except Exception as e:
                                 print(f"语音集成错误: {e}")
                         
@@ -204,14 +198,10 @@ class StreamingWorker(EnhancedWorker):
                     result_chunks.append(content_str)
                     self.stream_chunk.emit(content_str)
                     
-                    # 异步发送文本到语音集成模块
+                    # 发送文本到语音集成模块
                     if self.voice_integration:
                         try:
-                            threading.Thread(
-                                target=self.voice_integration.receive_text_chunk,
-                                args=(content_str,),
-                                daemon=True
-                            ).start()
+                            self.voice_integration.receive_text_chunk(content_str)
                         except Exception as e:
                             print(f"语音集成错误: {e}")
                     
@@ -241,17 +231,10 @@ class StreamingWorker(EnhancedWorker):
                 # 立即发送完成信号，不等待音频处理
                 self.stream_complete.emit()
                 
-                # 异步发送最终完整文本到语音集成模块（不阻塞前端）
+                # 通知语音集成模块流结束，播放缓冲区中剩余的不完整句子
                 if self.voice_integration:
                     try:
-                        final_text = ''.join(result_chunks)
-                        # 使用线程池异步处理，确保前端立即显示
-                        import threading
-                        threading.Thread(
-                            target=self.voice_integration.receive_final_text,
-                            args=(final_text,),
-                            daemon=True
-                        ).start()
+                        self.voice_integration.receive_final_text(''.join(result_chunks))
                     except Exception as e:
                         print(f"语音集成错误: {e}")
                 
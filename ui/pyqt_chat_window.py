@@ -1022,11 +1022,11 @@ class ChatWindow(QWidget):
         try:
             # 检查是否存在知识图谱文件
             graph_file = "logs/knowledge_graph/graph.html"
-            quintuples_file = "logs/knowledge_graph/quintuples.json"
+            from summer_memory.quintuple_store import get_quintuple_store
             
             # 如果HTML文件不存在，尝试生成
             if not os.path.exists(graph_file):
-                if os.path.exists(quintuples_file):
+                if get_quintuple_store().exists():
                     # 有五元组数据，生成HTML
                     s.add_user_message("系统", "🔄 正在生成心智云图...")
                     try:
@@ -47,9 +47,19 @@ class VoiceIntegration:
         # 音频播放队列和状态管理
         self.audio_queue = Queue()  # 使用标准Queue替代asyncio.Queue
         self.playing_lock = threading.Lock()
-        self.playing_texts = set()  # 防止重复播放
+        self.playing_texts = set()  # 防止重复播放（流式模式下只在当前这次回复内去重）
         self.audio_files_in_use = set()  # 正在使用的音频文件
         
+        # 流式文本断句缓冲（LLM增量逐块到达，按句送入TTS）
+        self._stream_lock = threading.Lock()
+        self._stream_buffer = ""
+        self._stream_active = False
+        
+        # 按句子顺序入队：TTS并发生成，但播放顺序与文本顺序一致
+        self._next_seq = 0
+        self._release_seq = 0
+        self._pending_audio = {}
+        
         # 播放状态控制
         self.is_playing = False
         self.current_playback = None
@@ -95,6 +105,18 @@ class VoiceIntegration:
         """接收最终完整文本 - 立即处理，不等待音频"""
         if not config.system.voice_enabled:
             return
+        
+        # 流式模式下前面的句子已播放，只需处理缓冲区剩余部分
+        with self._stream_lock:
+            streamed = self._stream_active
+            rest = self._stream_buffer
+            self._stream_buffer = ""
+            self._stream_active = False
+        if streamed:
+            if rest.strip():
+                self._process_audio_async(rest.strip())
+            self._reset_dedup()  # 本次回复结束，后续回复中的相同短句（如"好的。"）仍需播放
+            return
             
         if final_text and final_text.strip():
             logger.info(f"接收最终文本: {final_text[:100]}")
@@ -102,13 +124,39 @@ class VoiceIntegration:
             self._process_audio_async(final_text)
 
     def receive_text_chunk(self, text: str):
-        """接收文本片段 - 流式处理"""
+        """接收文本片段 - 流式处理，累积到完整句子后送入TTS"""
         if not config.system.voice_enabled:
             return
             
-        if text and text.strip():
-            # 流式文本直接处理，不累积
-            self._process_audio_async(text.strip())
+        if not text:
+            return
+        with self._stream_lock:
+            if not self._stream_active:
+                self._reset_dedup()  # 新的回复开始
+            self._stream_active = True
+            self._stream_buffer += text
+            sentences = self._take_sentences()
+        for sentence in sentences:
+            self._process_audio_async(sentence)
+
+    def _take_sentences(self) -> List[str]:
+        """从缓冲区切出完整句子，过短的句子与后文合并（调用方持有锁）"""
+        sentences = []
+        start = 0
+        pending = ""
+        for match in re.finditer(SENTENCE_END_PUNCTUATIONS + r"|\n", self._stream_buffer):
+            pending += self._stream_buffer[start:match.end()]
+            start = match.end()
+            if len(pending.strip()) >= self.min_sentence_length:
+                sentences.append(pending.strip())
+                pending = ""
+        self._stream_buffer = pending + self._stream_buffer[start:]
+        return sentences
+
+    def _reset_dedup(self):
+        """清空去重记录"""
+        with self.playing_lock:
+            self.playing_texts.clear()
 
     def _process_audio_async(self, text: str):
         """异步处理音频，不阻塞主流程"""
@@ -120,19 +168,32 @@ class VoiceIntegration:
                     logger.debug(f"跳过重复播放: {text[:30]}...")
                     return
                 self.playing_texts.add(text_hash)
+                seq = self._next_seq
+                self._next_seq += 1
             
             # 在后台线程中处理音频，不阻塞主流程
             threading.Thread(
                 target=self._generate_and_play_audio,
-                args=(text,),
+                args=(text, seq),
                 daemon=True
             ).start()
             
         except Exception as e:
             logger.error(f"创建音频处理任务失败: {e}")
 
-    def _generate_and_play_audio(self, text: str):
+    def _release_in_order(self, seq: int, audio_file_path: Optional[str]):
+        """按句子顺序把生成好的音频放入播放队列"""
+        with self.playing_lock:
+            self._pending_audio[seq] = audio_file_path
+            while self._release_seq in self._pending_audio:
+                path = self._pending_audio.pop(self._release_seq)
+                self._release_seq += 1
+                if path:
+                    self.audio_queue.put(path)
+
+    def _generate_and_play_audio(self, text: str, seq: Optional[int] = None):
         """在后台线程中生成并播放音频"""
+        audio_file_path = None
         try:
             # 文本预处理
             if not getattr(config.tts, 'remove_filter', False):
@@ -142,14 +203,19 @@ class VoiceIntegration:
             # 生成音频文件
             audio_file_path = self._generate_audio_file_sync(text)
             if audio_file_path:
-                # 加入播放队列
-                self.audio_queue.put(audio_file_path)
-                logger.info(f"音频文件已加入播放队列: {text[:50]}... -> {audio_file_path}")
+                logger.info(f"音频文件已生成: {text[:50]}... -> {audio_file_path}")
             else:
                 logger.warning(f"音频文件生成失败: {text[:50]}...")
                 
         except Exception as e:
             logger.error(f"音频处理异常: {e}")
+        finally:
+            # 加入播放队列（按序号排队，失败的句子直接跳过）
+            if seq is None:
+                if audio_file_path:
+                    self.audio_queue.put(audio_file_path)
+            else:
+                self._release_in_order(seq, audio_file_path)
 
     def _generate_audio_file_sync(self, text: str) -> Optional[str]:
         """同步生成音频文件"""